@@ -0,0 +1,117 @@
+# Copyright 2015-2018 Chicharreros (https://launchpad.net/~chicharreros)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# For further info, check  http://launchpad.net/magicicada-server
+
+"""Benchmark broadcasting the notifications to all the user's connections.
+
+Compare copying and serializing the message for each connection (as it was
+done before) with serializing it once and sending it with each connection
+id, in notifications per second per CPU core (the CPU time of this
+process, which runs in a single thread).
+"""
+
+import argparse
+import os
+import struct
+
+import _pythonpath  # NOQA
+
+# fix environment before further imports
+os.environ["DJANGO_SETTINGS_MODULE"] = "magicicada.settings"
+
+import django  # NOQA
+django.setup()
+
+from magicicadaprotocol import protocol_pb2, request  # NOQA
+
+from magicicada.server.content import User  # NOQA
+from magicicada.server.server import StorageServer  # NOQA
+
+
+class Transport(object):
+    """Join what is written, as the transport does before sending it."""
+
+    def write(self, data):
+        b''.join([data])
+
+    def writeSequence(self, data):
+        b''.join(data)
+
+
+class Manager(object):
+    """What the User needs of the content manager."""
+
+    rpc_dal = None
+
+
+def copy_per_connection(user, message):
+    """Send the message to each connection, as it was done before."""
+    for protocol in user.protocols:
+        new_message = protocol_pb2.Message()
+        new_message.CopyFrom(message)
+        new_message.id = protocol.get_new_request_id()
+        m = new_message.SerializeToString()
+        protocol.write(struct.pack(request.SIZE_FMT, len(m)))
+        protocol.write(m)
+
+
+def cpu_time():
+    """Return the user and system CPU time of this process."""
+    times = os.times()
+    return times[0] + times[1]
+
+
+def measure(broadcast, user, message, total):
+    """Return the notifications per CPU second sending total of them."""
+    start = cpu_time()
+    for _ in xrange(total):
+        broadcast(user, message)
+    return total / (cpu_time() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument(
+        '--connections', type=int, default=8,
+        help='The connections of the user.')
+    parser.add_argument(
+        '--notifications', type=int, default=100000,
+        help='How many notifications to send with each method.')
+    args = parser.parse_args()
+
+    user = User(Manager(), 1, None, 'user', 'User')
+    for _ in range(args.connections):
+        protocol = StorageServer()
+        protocol.transport = Transport()
+        user.register_protocol(protocol)
+
+    message = protocol_pb2.Message()
+    message.type = protocol_pb2.Message.VOLUME_NEW_GENERATION
+    message.volume_new_generation.volume = str(os.urandom(16).encode('hex'))
+    message.volume_new_generation.generation = 123456
+
+    results = [
+        ('copy per connection', measure(
+            copy_per_connection, user, message, args.notifications)),
+        ('serialized once', measure(
+            User.broadcast, user, message, args.notifications)),
+    ]
+    for name, speed in results:
+        print "%-20s %10.1f notifications/s per core" % (name, speed)
+
+
+if __name__ == '__main__':
+    main()
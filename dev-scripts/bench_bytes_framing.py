@@ -0,0 +1,127 @@
+# Copyright 2015-2018 Chicharreros (https://launchpad.net/~chicharreros)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# For further info, check  http://launchpad.net/magicicada-server
+
+"""Benchmark the framing of the downloaded content in BYTES messages.
+
+Compare building and sending a message per payload (as it was done before)
+with the BytesMessageProducer, in bytes per second per CPU core (the CPU
+time of this process, which runs in a single thread).
+"""
+
+import argparse
+import os
+import struct
+
+import _pythonpath  # NOQA
+
+# fix environment before further imports
+os.environ["DJANGO_SETTINGS_MODULE"] = "magicicada.settings"
+
+import django  # NOQA
+django.setup()
+
+from magicicadaprotocol import protocol_pb2, request  # NOQA
+
+from magicicada import settings  # NOQA
+from magicicada.server.server import BytesMessageProducer  # NOQA
+
+
+class Protocol(object):
+    """Join what is written, as the transport does before sending it."""
+
+    def write(self, data):
+        b''.join([data])
+
+    def writeSequence(self, data):
+        b''.join(data)
+
+
+class Request(object):
+    """What BytesMessageProducer needs of a request."""
+
+    id = 1234
+    cancelled = False
+    transferred = 0
+    last_good_state_ts = None
+    protocol = Protocol()
+
+
+class NoProducer(object):
+    """Nothing to start."""
+
+    def startProducing(self, consumer):
+        pass
+
+
+def message_per_payload(req, content, payload_size):
+    """Send the content a message at a time, as it was done before."""
+    p = 0
+    part = content[p:p + payload_size]
+    while part:
+        response = protocol_pb2.Message()
+        response.type = protocol_pb2.Message.BYTES
+        response.bytes.bytes = part
+        req.transferred += len(part)
+        response.id = req.id
+        m = response.SerializeToString()
+        req.protocol.write(struct.pack(request.SIZE_FMT, len(m)))
+        req.protocol.write(m)
+        p += payload_size
+        part = content[p:p + payload_size]
+
+
+def cpu_time():
+    """Return the user and system CPU time of this process."""
+    times = os.times()
+    return times[0] + times[1]
+
+
+def measure(write, content, total):
+    """Return the bytes per CPU second writing the content until total."""
+    written = 0
+    start = cpu_time()
+    while written < total:
+        write(content)
+        written += len(content)
+    return written / (cpu_time() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument(
+        '--megabytes', type=int, default=1024,
+        help='How much content to send with each method.')
+    parser.add_argument(
+        '--chunk', type=int, default=settings.STORAGE_READ_CHUNK_SIZE,
+        help='The bytes given to the producer at a time.')
+    args = parser.parse_args()
+
+    content = os.urandom(args.chunk)
+    total = args.megabytes * 2 ** 20
+    producer = BytesMessageProducer(NoProducer(), Request())
+    results = [
+        ('message per payload', measure(
+            lambda data: message_per_payload(
+                Request(), data, producer.payload_size), content, total)),
+        ('BytesMessageProducer', measure(producer.write, content, total)),
+    ]
+    for name, speed in results:
+        print "%-22s %8.1f MB/s per core" % (name, speed / 2 ** 20)
+
+
+if __name__ == '__main__':
+    main()
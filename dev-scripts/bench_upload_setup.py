@@ -0,0 +1,122 @@
+# Copyright 2015-2018 Chicharreros (https://launchpad.net/~chicharreros)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# For further info, check  http://launchpad.net/magicicada-server
+
+"""Benchmark the setup of the uploads, before sending the bytes.
+
+Compare the DAL calls done to set up a PUT_CONTENT before (to look for a
+reusable blob, get the node, and get or make the upload job) with the
+single prepare_upload call, in milliseconds per upload set up, through the
+DAL threads as the server does. It needs the development database.
+"""
+
+import argparse
+import os
+import time
+import uuid
+
+import _pythonpath  # NOQA
+
+# fix environment before further imports
+os.environ["DJANGO_SETTINGS_MODULE"] = "magicicada.settings"
+
+import django  # NOQA
+django.setup()
+
+from twisted.internet import defer, task  # NOQA
+
+from magicicada.filesync import services  # NOQA
+from magicicada.rpcdb.inthread import ThreadedNonRPC  # NOQA
+
+
+@defer.inlineCallbacks
+def separate_calls(dal, user_id, node_id, hash_value, uploadjob_id):
+    """Set up the upload with a call for each step, as it was done before."""
+    r = yield dal.call('get_reusable_content', user_id=user_id,
+                       hash_value=hash_value, magic_hash=None)
+    if r['storage_key'] is not None:
+        return
+    yield dal.call('get_node', user_id=user_id, volume_id=None,
+                   node_id=node_id)
+    if uploadjob_id is None:
+        yield dal.call('make_uploadjob', user_id=user_id, volume_id=None,
+                       node_id=node_id, previous_hash=None,
+                       hash_value=hash_value, crc32=1, inflated_size=10,
+                       multipart_key=uuid.uuid4())
+    else:
+        yield dal.call('get_uploadjob', user_id=user_id, volume_id=None,
+                       node_id=node_id, uploadjob_id=uploadjob_id,
+                       hash_value=hash_value, crc32=1)
+        yield dal.call('touch_uploadjob', user_id=user_id, volume_id=None,
+                       uploadjob_id=uploadjob_id)
+
+
+def single_call(dal, user_id, node_id, hash_value, uploadjob_id):
+    """Set up the upload with prepare_upload."""
+    return dal.call('prepare_upload', user_id=user_id, volume_id=None,
+                    node_id=node_id, previous_hash=None,
+                    hash_value=hash_value, crc32=1, inflated_size=10,
+                    uploadjob_id=uploadjob_id, multipart_key=uuid.uuid4())
+
+
+@defer.inlineCallbacks
+def measure(setup, dal, user_id, node_id, hash_value, uploadjob_id, total):
+    """Return the average and median milliseconds of total setups."""
+    times = []
+    for _ in xrange(total):
+        start = time.time()
+        yield setup(dal, user_id, node_id, hash_value, uploadjob_id)
+        times.append((time.time() - start) * 1000)
+    times.sort()
+    defer.returnValue((sum(times) / total, times[total // 2]))
+
+
+@defer.inlineCallbacks
+def run(reactor, args):
+    user = services.make_storage_user(
+        'bench-%s' % (uuid.uuid4(),), 2 ** 40)
+    node = user.root.make_file(u'bench.txt')
+    hash_value = 'sha1:' + os.urandom(20).encode('hex')
+    resumed = user.root.make_file(u'resumed.txt')
+    uploadjob = resumed.make_uploadjob(
+        None, hash_value, 1, 10, multipart_key=uuid.uuid4())
+
+    dal = ThreadedNonRPC()
+    cases = [
+        ('new job', node.id, None),
+        ('resumed job', resumed.id, uploadjob.id),
+    ]
+    for case, node_id, uploadjob_id in cases:
+        for name, setup in [('separate calls', separate_calls),
+                            ('prepare_upload', single_call)]:
+            average, median = yield measure(
+                setup, dal, user.id, node_id, hash_value, uploadjob_id,
+                args.uploads)
+            print "%-12s %-15s %8.2f ms average %8.2f ms median" % (
+                case, name, average, median)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument(
+        '--uploads', type=int, default=1000,
+        help='How many uploads to set up with each method.')
+    args = parser.parse_args()
+    task.react(run, [args])
+
+
+if __name__ == '__main__':
+    main()
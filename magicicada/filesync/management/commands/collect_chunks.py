@@ -0,0 +1,50 @@
+# Copyright 2015-2018 Chicharreros (https://launchpad.net/~chicharreros)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# For further info, check  http://launchpad.net/magicicada-server
+
+"""Remove the stored chunks no node uses anymore."""
+
+from __future__ import unicode_literals
+
+import logging
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from magicicada.server.diskstorage import DiskStorage
+
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+
+    help = ("Walk the storage volumes removing the chunks not listed in "
+            "any manifest of the nodes stored in chunks, and report the "
+            "deduplication ratio.")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--grace-period', type=int, default=86400,
+            help='Keep the chunks touched in these seconds, as they may '
+                 'be of nodes being stored.')
+
+    def handle(self, *args, **options):
+        storage = DiskStorage(
+            settings.STORAGE_VOLUMES or settings.STORAGE_BASEDIR)
+        freed = storage.collect_chunks(
+            logger, grace_period=options['grace_period'])
+        self.stdout.write('Collected unused chunks, bytes freed: %d' % freed)
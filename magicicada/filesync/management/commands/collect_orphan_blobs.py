@@ -0,0 +1,66 @@
+# Copyright 2015-2018 Chicharreros (https://launchpad.net/~chicharreros)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# For further info, check  http://launchpad.net/magicicada-server
+
+"""Remove from disk the content of the blobs no node uses anymore."""
+
+from __future__ import unicode_literals
+
+import logging
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from magicicada.filesync import services
+from magicicada.server.diskstorage import DiskStorage
+
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+
+    help = ("Find in batches the blobs that are not used by any node, mark "
+            "them as dead and remove their stored content.")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size', type=int, default=500,
+            help='How many blobs to process in each batch.')
+        parser.add_argument(
+            '--grace-period', type=float, default=86400,
+            help='Only collect blobs created more than these seconds ago.')
+        parser.add_argument(
+            '--max-bytes-per-second', type=int, default=0,
+            help='If given, remove at most these bytes per second.')
+        parser.add_argument(
+            '--interval', type=float, default=0,
+            help='If given, keep running a full pass every these seconds.')
+
+    def handle(self, *args, **options):
+        storage = DiskStorage(
+            settings.STORAGE_VOLUMES or settings.STORAGE_BASEDIR)
+        while True:
+            reclaimed = services.collect_orphan_blobs(
+                logger, storage, options['grace_period'],
+                batch_size=options['batch_size'],
+                max_bytes_per_second=options['max_bytes_per_second'])
+            self.stdout.write(
+                'Collected orphan blobs, bytes reclaimed: %d' % reclaimed)
+            if not options['interval']:
+                break
+            time.sleep(options['interval'])
@@ -0,0 +1,56 @@
+# Copyright 2015-2018 Chicharreros (https://launchpad.net/~chicharreros)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# For further info, check  http://launchpad.net/magicicada-server
+
+"""Move the content of the small blobs from the disk to the database."""
+
+from __future__ import unicode_literals
+
+import logging
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from magicicada.filesync import services
+from magicicada.server.diskstorage import DiskStorage
+
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+
+    help = ("Find in batches the blobs stored in disk that are small enough "
+            "to be stored in the database, and move them there.")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size', type=int, default=500,
+            help='How many blobs to process in each batch.')
+        parser.add_argument(
+            '--max-size', type=int, default=settings.STORAGE_INLINE_MAX_SIZE,
+            help='Only move the blobs with content up to these bytes.')
+        parser.add_argument(
+            '--sleep', type=float, default=0,
+            help='Seconds to sleep between batches.')
+
+    def handle(self, *args, **options):
+        storage = DiskStorage(
+            settings.STORAGE_VOLUMES or settings.STORAGE_BASEDIR)
+        inlined = services.inline_small_blobs(
+            logger, storage, max_size=options['max_size'],
+            batch_size=options['batch_size'], sleep=options['sleep'])
+        self.stdout.write('Inlined small blobs: %d' % inlined)
@@ -0,0 +1,48 @@
+# Copyright 2015-2018 Chicharreros (https://launchpad.net/~chicharreros)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# For further info, check  http://launchpad.net/magicicada-server
+
+"""Move the stored nodes to their place after adding a storage volume."""
+
+from __future__ import unicode_literals
+
+import logging
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from magicicada.server.diskstorage import DiskStorage
+
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+
+    help = ("Walk the storage volumes moving each node to the volume where "
+            "it would be stored now, if it comes before the one it's in.")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--max-bytes-per-second', type=int, default=0,
+            help='If given, move at most these bytes per second.')
+
+    def handle(self, *args, **options):
+        storage = DiskStorage(
+            settings.STORAGE_VOLUMES or settings.STORAGE_BASEDIR)
+        moved = storage.rebalance(
+            logger, max_bytes_per_second=options['max_bytes_per_second'])
+        self.stdout.write('Rebalanced storage, bytes moved: %d' % moved)
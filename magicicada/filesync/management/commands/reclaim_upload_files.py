@@ -0,0 +1,81 @@
+# Copyright 2015-2018 Chicharreros (https://launchpad.net/~chicharreros)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# For further info, check  http://launchpad.net/magicicada-server
+
+"""Remove from disk the unfinished files of the abandoned uploads."""
+
+from __future__ import unicode_literals
+
+import functools
+import logging
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from magicicada.filesync import services
+from magicicada.filesync.management import cursor
+from magicicada.server.diskstorage import DiskStorage
+
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+
+    help = ("Walk the disk storage removing the unfinished files of the "
+            "uploads that are gone or too old.")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size', type=int, default=500,
+            help='How many files to check against the uploads at once.')
+        parser.add_argument(
+            '--grace-period', type=float, default=3600,
+            help='Only remove files not written in these seconds.')
+        parser.add_argument(
+            '--max-age', type=float, default=7 * 86400,
+            help='Remove files not written in these seconds even if their '
+                 'upload is still there.')
+        parser.add_argument(
+            '--max-files-per-second', type=int, default=0,
+            help='If given, check at most these files per second.')
+        parser.add_argument(
+            '--cursor-file',
+            help='If given, continue the walk from the cursor saved here.')
+        parser.add_argument(
+            '--interval', type=float, default=0,
+            help='If given, keep running a full pass every these seconds.')
+
+    def handle(self, *args, **options):
+        storage = DiskStorage(
+            settings.STORAGE_VOLUMES or settings.STORAGE_BASEDIR)
+        cursor_file = options['cursor_file']
+        save_cursor = None
+        if cursor_file is not None:
+            save_cursor = functools.partial(cursor.save, cursor_file)
+
+        while True:
+            reclaimed = services.reclaim_upload_files(
+                logger, storage, options['grace_period'],
+                options['max_age'], after=cursor.load(cursor_file),
+                save_cursor=save_cursor, batch_size=options['batch_size'],
+                max_files_per_second=options['max_files_per_second'])
+            self.stdout.write(
+                'Reclaimed upload files, bytes reclaimed: %d' % reclaimed)
+            if not options['interval']:
+                break
+            time.sleep(options['interval'])
@@ -0,0 +1,57 @@
+# Copyright 2015-2018 Chicharreros (https://launchpad.net/~chicharreros)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# For further info, check  http://launchpad.net/magicicada-server
+
+"""Reconcile the users' used bytes counter against their live files."""
+
+from __future__ import unicode_literals
+
+import logging
+import time
+
+from django.core.management.base import BaseCommand
+
+from magicicada.filesync import services
+
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+
+    help = ("Recalculate the used bytes of all the users in batches, "
+            "fixing and reporting any drift.")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size', type=int, default=500,
+            help='How many users to process in each batch.')
+        parser.add_argument(
+            '--sleep', type=float, default=0,
+            help='Seconds to sleep between batches.')
+        parser.add_argument(
+            '--interval', type=float, default=0,
+            help='If given, keep running a full pass every these seconds.')
+
+    def handle(self, *args, **options):
+        while True:
+            drift = services.reconcile_used_bytes(
+                logger, sleep=options['sleep'],
+                batch_size=options['batch_size'])
+            self.stdout.write('Reconciled used bytes, drift: %d' % drift)
+            if not options['interval']:
+                break
+            time.sleep(options['interval'])
@@ -0,0 +1,78 @@
+# Copyright 2015-2018 Chicharreros (https://launchpad.net/~chicharreros)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# For further info, check  http://launchpad.net/magicicada-server
+
+"""Check the stored content of the blobs, recording the damaged ones."""
+
+from __future__ import unicode_literals
+
+import functools
+import logging
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from magicicada.filesync import services
+from magicicada.filesync.management import cursor
+from magicicada.server.diskstorage import DiskStorage
+from magicicada.server.upload import verify_content
+
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+
+    help = ("Read the stored content of the blobs checking their hash, "
+            "crc32 and sizes, recording the ones missing or corrupt.")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size', type=int, default=500,
+            help='How many blobs to get from the database at once.')
+        parser.add_argument(
+            '--max-bytes-per-second', type=int, default=0,
+            help='If given, read at most these bytes per second.')
+        parser.add_argument(
+            '--workers', type=int, default=1,
+            help='How many blobs to read at the same time.')
+        parser.add_argument(
+            '--cursor-file',
+            help='If given, continue the walk from the cursor saved here.')
+        parser.add_argument(
+            '--interval', type=float, default=0,
+            help='If given, keep running a full pass every these seconds.')
+
+    def handle(self, *args, **options):
+        storage = DiskStorage(
+            settings.STORAGE_VOLUMES or settings.STORAGE_BASEDIR)
+        cursor_file = options['cursor_file']
+        save_cursor = None
+        if cursor_file is not None:
+            save_cursor = functools.partial(cursor.save, cursor_file)
+
+        while True:
+            damaged = services.scrub_blobs(
+                logger, storage, verify_content,
+                after=cursor.load(cursor_file),
+                save_cursor=save_cursor, batch_size=options['batch_size'],
+                max_bytes_per_second=options['max_bytes_per_second'],
+                workers=options['workers'])
+            self.stdout.write('Scrubbed blobs, damaged found: %d' % damaged)
+            if not options['interval']:
+                break
+            time.sleep(options['interval'])
@@ -0,0 +1,38 @@
+# Copyright 2015-2018 Chicharreros (https://launchpad.net/~chicharreros)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# For further info, check  http://launchpad.net/magicicada-server
+
+"""The cursor files of the commands that walk the storage in passes."""
+
+from __future__ import unicode_literals
+
+import os
+
+
+def load(path):
+    """Return where the previous walk stopped, if any."""
+    if path is None or not os.path.exists(path):
+        return None
+    with open(path) as fh:
+        return fh.read().strip() or None
+
+
+def save(path, position):
+    """Save the last position walked, atomically."""
+    temppath = path + '.new'
+    with open(temppath, 'w') as fh:
+        fh.write(position or '')
+    os.rename(temppath, path)
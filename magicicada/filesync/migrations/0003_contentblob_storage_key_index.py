@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9 on 2026-10-16 12:00
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('filesync', '0002_custom-sql'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='contentblob',
+            name='storage_key',
+            field=models.UUIDField(db_index=True, null=True),
+        ),
+    ]
@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9 on 2026-10-16 12:00
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('filesync', '0003_contentblob_storage_key_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DamagedBlob',
+            fields=[
+                ('content_blob', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, serialize=False, to='filesync.ContentBlob')),
+                ('storage_key', models.UUIDField()),
+                ('problem', models.CharField(choices=[('Missing', 'Missing'), ('Corrupt', 'Corrupt')], max_length=128)),
+                ('detail', models.TextField(default='')),
+                ('when_detected', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+        ),
+    ]
@@ -113,11 +113,11 @@ class StorageUser(AbstractUser):
     @property
     def free_bytes(self):
         """Return the free bytes."""
-        return max(0, self.max_storage_bytes - self.used_bytes)
+        return max(0, self.max_storage_bytes - self.used_storage_bytes)
 
     @property
     def used_bytes(self):
-        """Return the used bytes."""
+        """Return the used bytes, calculated from the live files."""
         return StorageObject.objects.calculate_size_by_owner(self)
 
     def get_storage_stats(self):
@@ -199,15 +199,15 @@ class ContentBlob(models.Model):
     # The size of the raw file content represented by this record, in bytes.
     size = models.BigIntegerField(default=0)
 
-    # The content key which references the deflated file contents,
-    # or NULL if it has been garbage collected.
-    storage_key = models.UUIDField(null=True)
+    # The content key which references the deflated file contents (which
+    # are gone if the blob is dead, as it was garbage collected).
+    storage_key = models.UUIDField(null=True, db_index=True)
 
     # The deflated size of the file content as stored or NULL if inapplicable.
     deflated_size = models.BigIntegerField(null=True)
 
     # The file content as a raw byte string, or else NULL.
-    # Used for symlinks and potentially sufficiently small files.
+    # Used for the small files (deflated, instead of storing it in disk).
     content = models.BinaryField(null=True)
 
     # Whether this content entry is live, or else a candidate for
@@ -219,7 +219,31 @@ class ContentBlob(models.Model):
     magic_hash = models.BinaryField(null=True)
 
     # timestamp at which the blob was first created
-    when_created = models.DateTimeField(default=now)
+    when_created = models.DateTimeField(default=now, db_index=True)
+
+
+class DamagedBlob(models.Model):
+    """A blob whose stored content was found missing or corrupt."""
+
+    PROBLEM_MISSING = 'Missing'
+    PROBLEM_CORRUPT = 'Corrupt'
+    PROBLEM_CHOICES = (
+        (PROBLEM_MISSING, PROBLEM_MISSING),
+        (PROBLEM_CORRUPT, PROBLEM_CORRUPT),
+    )
+
+    # The blob with the damaged content.
+    content_blob = models.OneToOneField(ContentBlob, primary_key=True)
+
+    # The content key of the blob when it was checked.
+    storage_key = models.UUIDField()
+
+    # What is wrong with the content, and the details of it.
+    problem = models.CharField(max_length=128, choices=PROBLEM_CHOICES)
+    detail = models.TextField(default='')
+
+    # When the problem was (last) detected.
+    when_detected = models.DateTimeField(default=now)
 
 
 class BaseStorageObject(models.Model):
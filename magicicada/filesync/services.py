@@ -25,13 +25,18 @@ security is imposed based on the user's access to the storage objects.
 
 from __future__ import unicode_literals
 
+import calendar
+import collections
+import datetime
 import mimetypes
 import os
 import posixpath as pypath
+import threading
 import time
 import uuid
 
 from functools import wraps
+from multiprocessing.pool import ThreadPool
 from weakref import WeakValueDictionary
 
 from django.conf import settings
@@ -53,6 +58,7 @@ from magicicada.filesync.models import (
     STATUS_LIVE,
     STATUS_DEAD,
     ContentBlob,
+    DamagedBlob,
     Download,
     MoveFromShare,
     Share,
@@ -125,13 +131,14 @@ class DAOStorageUser(DAOBase):
         self.root_volume_id = self.root_volume.id
         self._volumes = WeakValueDictionary()
         self.max_storage_bytes = user.max_storage_bytes
-        self.used_storage_bytes = user.used_bytes
+        self.used_storage_bytes = user.used_storage_bytes
         self._user = user
 
     @property
     def free_bytes(self):
         """Return the free bytes."""
-        self._load()
+        stats = self._gateway.get_storage_stats()
+        self.max_storage_bytes, self.used_storage_bytes = stats
         return max(0, self.max_storage_bytes - self.used_storage_bytes)
 
     def _load(self):
@@ -695,13 +702,13 @@ class FileNode(StorageNode):
     @fsync_commit
     def make_content(self, original_hash, hash_hint, crc32_hint,
                      inflated_size_hint, deflated_size_hint, storage_key,
-                     magic_hash=None):
+                     magic_hash=None, inline_content=None):
         """Make content or reuse it for this file."""
         self._load()
         ob = self._gateway.make_content(self.id, original_hash, hash_hint,
                                         crc32_hint, inflated_size_hint,
                                         deflated_size_hint, storage_key,
-                                        magic_hash)
+                                        magic_hash, inline_content)
         self._copy(ob)
         return self
 
@@ -724,9 +731,27 @@ class FileNodeContent(object):
         else:
             self.deflated_size = contentblob.deflated_size or 0
             self.storage_key = contentblob.storage_key
+        # the (deflated) content, if stored in the blob
+        if contentblob.content is None or contentblob.size == 0:
+            self.inline_content = None
+        else:
+            self.inline_content = bytes(contentblob.content)
         self.when_created = contentblob.when_created
 
 
+class DeltaNode(collections.namedtuple('DeltaNode', [
+        'id', 'parent_id', 'path', 'name', 'is_file', 'is_live',
+        'generation', 'is_public', 'content_hash', 'crc32', 'size',
+        'last_modified'])):
+    """What is sent to the clients about a node in a delta or rescan.
+
+    Built straight from the database rows, without models nor DAOs, as
+    there may be many of them.
+    """
+
+    __slots__ = ()
+
+
 class DAOUploadJob(VolumeObjectBase):
     """DAO for an Upload Job"""
 
@@ -1015,6 +1040,19 @@ class VolumeProxy(object):
                                                              limit))
         return (volume.generation, self.user.free_bytes, delta_nodes)
 
+    @fsync_readonly
+    def get_delta_nodes(self, generation, limit=None):
+        """Get this volumes generational delta, as DeltaNodes.
+
+        The return value is a tuple of (generation, free_bytes, [nodes])
+        """
+        volume = self.gateway.get_user_volume()
+        if volume.generation <= generation:
+            return (volume.generation, self.user.free_bytes, [])
+        delta_nodes = self.gateway.get_generation_delta_nodes(generation,
+                                                              limit)
+        return (volume.generation, self.user.free_bytes, delta_nodes)
+
     @fsync_readonly
     def get_from_scratch(self, start_from_path=None, limit=None,
                          max_generation=None):
@@ -1028,6 +1066,19 @@ class VolumeProxy(object):
                                            max_generation=max_generation)
         return (volume.generation, self.user.free_bytes, nodes)
 
+    @fsync_readonly
+    def get_from_scratch_nodes(self, start_from_path=None, limit=None,
+                               max_generation=None):
+        """Get all of this volumes live nodes, as DeltaNodes.
+
+        The return value is a tuple of (generation, free_bytes, [nodes])
+        """
+        volume = self.gateway.get_user_volume()
+        nodes = self.gateway.get_all_delta_nodes(
+            start_from_path=start_from_path, limit=limit,
+            max_generation=max_generation)
+        return (volume.generation, self.user.free_bytes, nodes)
+
     @retryable_transaction()
     @fsync_commit
     def undelete_all(self, prefix, limit=100):
@@ -1394,6 +1445,136 @@ class SystemGateway(GatewayBase):
         jobs = UploadJob.objects.filter(when_last_active__lte=last_active)
         return [DAOUploadJob(job) for job in jobs[:limit]]
 
+    def get_inlinable_blobs(self, max_size, after_key=None, limit=500):
+        """Get the live blobs stored in disk with content up to max_size.
+
+        Return (hash, storage_key) pairs ordered by storage key, starting
+        after the given one.
+        """
+        blobs = ContentBlob.objects.filter(
+            status=STATUS_LIVE, storage_key__isnull=False,
+            deflated_size__gt=0, deflated_size__lte=max_size)
+        if after_key is not None:
+            blobs = blobs.filter(storage_key__gt=after_key)
+        blobs = blobs.order_by('storage_key').values_list(
+            'hash', 'storage_key')
+        return [(bytes(h), key) for h, key in blobs[:limit]]
+
+    def inline_blob(self, hash_value, storage_key, inline_content):
+        """Store the content in the blob instead of in disk.
+
+        Return if it was done, as the blob may have changed meanwhile.
+        """
+        blob = get_object_or_none(
+            ContentBlob.objects.select_for_update(), hash=hash_value)
+        if (blob is None or blob.status != STATUS_LIVE or
+                str(blob.storage_key) != str(storage_key) or
+                blob.deflated_size != len(inline_content)):
+            return False
+        blob.content = inline_content
+        blob.storage_key = None
+        blob.save(update_fields=['content', 'storage_key'])
+        return True
+
+    def get_uploading_keys(self, storage_keys):
+        """Return which of the storage keys are of uploads in progress."""
+        jobs = UploadJob.objects.filter(multipart_key__in=storage_keys)
+        return set(
+            str(key) for key in jobs.values_list('multipart_key', flat=True))
+
+    def get_orphan_blobs(self, created_before, after_key=None, limit=500):
+        """Get the live blobs created before a date that no node uses.
+
+        Return (hash, storage_key) pairs ordered by storage key, starting
+        after the given one.
+        """
+        blobs = ContentBlob.objects.filter(
+            status=STATUS_LIVE, storage_key__isnull=False,
+            when_created__lt=created_before, storageobject=None)
+        if after_key is not None:
+            blobs = blobs.filter(storage_key__gt=after_key)
+        blobs = blobs.order_by('storage_key').values_list(
+            'hash', 'storage_key')
+        return [(bytes(h), key) for h, key in blobs[:limit]]
+
+    def kill_orphan_blob(self, hash_value):
+        """Mark the blob as dead if still no node uses it.
+
+        Return if it was killed, so its file can be removed.
+        """
+        blob = get_object_or_none(
+            ContentBlob.objects.select_for_update(), hash=hash_value)
+        if blob is None or blob.status != STATUS_LIVE:
+            return False
+        if StorageObject.objects.filter(content_blob=blob).exists():
+            return False
+        blob.status = STATUS_DEAD
+        blob.save(update_fields=['status'])
+        return True
+
+    def get_blob_hashes(self, after_hash=None, created_after=None,
+                        limit=10000):
+        """Get the hashes of all the blobs, in order, after the given one.
+
+        If `created_after` is given, only of the blobs created after it.
+        """
+        blobs = ContentBlob.objects.all()
+        if after_hash is not None:
+            blobs = blobs.filter(hash__gt=after_hash)
+        if created_after is not None:
+            blobs = blobs.filter(when_created__gt=created_after)
+        hashes = blobs.order_by('hash').values_list('hash', flat=True)
+        return [bytes(h) for h in hashes[:limit]]
+
+    def count_blobs(self):
+        """Count all the blobs."""
+        return ContentBlob.objects.count()
+
+    def get_blobs_to_scrub(self, after_key=None, limit=500):
+        """Get the live blobs stored in disk, to check their content.
+
+        Return (hash, storage_key, crc32, size, deflated_size) tuples
+        ordered by storage key, starting after the given one.
+        """
+        blobs = ContentBlob.objects.filter(
+            status=STATUS_LIVE, storage_key__isnull=False)
+        if after_key is not None:
+            blobs = blobs.filter(storage_key__gt=after_key)
+        blobs = blobs.order_by('storage_key').values_list(
+            'hash', 'storage_key', 'crc32', 'size', 'deflated_size')
+        return [(bytes(h), key, crc, size, deflated_size)
+                for h, key, crc, size, deflated_size in blobs[:limit]]
+
+    def record_scrubbed_blobs(self, damaged, verified):
+        """Record the result of checking the content of some blobs.
+
+        The `damaged` ones are (hash, storage_key, problem, detail) tuples,
+        recorded unless the blob changed meanwhile; the previous records of
+        the `verified` hashes are removed, as their content is fine now.
+        """
+        if verified:
+            DamagedBlob.objects.filter(
+                content_blob__in=list(verified)).delete()
+        for hash_value, storage_key, problem, detail in damaged:
+            blob = get_object_or_none(ContentBlob, hash=hash_value)
+            if blob is None or str(blob.storage_key) != str(storage_key):
+                continue
+            DamagedBlob.objects.update_or_create(
+                content_blob=blob, defaults=dict(
+                    storage_key=storage_key, problem=problem, detail=detail,
+                    when_detected=now()))
+
+    def get_damaged_blobs(self, limit=100):
+        """Get the blobs with damaged content, the last detected first.
+
+        Return (hash, storage_key, problem, detail, when_detected) tuples.
+        """
+        damaged = DamagedBlob.objects.order_by('-when_detected').values_list(
+            'content_blob', 'storage_key', 'problem', 'detail',
+            'when_detected')
+        return [(bytes(h), key, problem, detail, when)
+                for h, key, problem, detail, when in damaged[:limit]]
+
 
 class StorageUserGateway(GatewayBase):
     """Access point for accessing storage users and shares.
@@ -1421,6 +1602,12 @@ class StorageUserGateway(GatewayBase):
         user_dao._gateway = StorageUserGateway(user_dao, self.session_id)
         return user_dao
 
+    @timing_metric
+    def get_storage_stats(self):
+        """Return the user's (max_storage_bytes, used_storage_bytes)."""
+        return StorageUser.objects.values_list(
+            'max_storage_bytes', 'used_storage_bytes').get(id=self.user.id)
+
     @timing_metric
     def recalculate_quota(self):
         """Recalculate a user's quota."""
@@ -1857,8 +2044,8 @@ class StorageUserGateway(GatewayBase):
         except ContentBlob.DoesNotExist:
             contentblob = None
 
-        # if content is not there, is not reusable
-        if not contentblob:
+        # if content is not there (or was garbage collected), is not reusable
+        if not contentblob or contentblob.status == STATUS_DEAD:
             return False, None
 
         # if we have content have the same magic hash is reusable!
@@ -1918,6 +2105,12 @@ class ReadOnlyVolumeGateway(GatewayBase):
     their objects, even if it's on a UDF
     """
 
+    # what's read of the nodes to build the DeltaNodes
+    DELTA_FIELDS = (
+        'id', 'parent', 'path', 'name', 'kind', 'status', 'generation',
+        'public_uuid', 'content_blob__hash', 'content_blob__crc32',
+        'content_blob__size', 'when_last_modified')
+
     def __init__(self, user, udf=None, share=None, session_id=None,
                  notifier=None):
         super(ReadOnlyVolumeGateway, self).__init__(session_id=session_id,
@@ -2151,9 +2344,30 @@ class ReadOnlyVolumeGateway(GatewayBase):
             nodes = nodes.filter(mimetype__in=mimetypes)
         return self._node_finder(nodes, with_content)
 
-    @timing_metric
-    def get_generation_delta(self, generation, limit=None):
-        """Get nodes since a generation."""
+    def _get_delta_node(self, row):
+        """Get a DeltaNode from a row of the DELTA_FIELDS."""
+        (id, parent_id, path, name, kind, status, generation, public_uuid,
+         content_hash, crc32, size, when_last_modified) = row
+        # as StorageNode.factory, for shares the root appears as a root,
+        # and the paths start at the root
+        if self.share:
+            if id == self.root_id:
+                parent_id = None
+                path = '/'
+                name = ''
+            else:
+                path = path[len(self.root_path_mask):] or '/'
+        is_file = kind == StorageObject.FILE
+        return DeltaNode(
+            id=id, parent_id=parent_id, path=path, name=name,
+            is_file=is_file, is_live=status == STATUS_LIVE,
+            generation=generation or 0, is_public=public_uuid is not None,
+            content_hash=bytes(content_hash) if content_hash else None,
+            crc32=crc32 or 0, size=size or 0,
+            last_modified=calendar.timegm(when_last_modified.timetuple()))
+
+    def _get_generation_delta(self, generation):
+        """Get the query of the nodes since a generation."""
         if self.share:
             root = self._get_root_node()
             # if this is a share, get the delta from ShareVolumeDelta
@@ -2179,10 +2393,16 @@ class ReadOnlyVolumeGateway(GatewayBase):
             nodes = StorageObject.objects.filter(parent__isnull=False)
             nodes = self._is_on_volume(nodes)
 
-        nodes = nodes.select_related('content_blob').filter(
+        return nodes.filter(
             # Must have the same owner id
             volume__id=self.volume_id, volume__owner__id=self.owner.id,
             generation__gt=generation).order_by('generation')
+
+    @timing_metric
+    def get_generation_delta(self, generation, limit=None):
+        """Get nodes since a generation."""
+        nodes = self._get_generation_delta(generation)
+        nodes = nodes.select_related('content_blob')
         for node in nodes[:limit]:
             content = node.content_blob
             if content:
@@ -2191,6 +2411,13 @@ class ReadOnlyVolumeGateway(GatewayBase):
                 self, node, content=content,
                 owner=self.owner, permissions=self._get_node_perms(node))
 
+    @timing_metric
+    def get_generation_delta_nodes(self, generation, limit=None):
+        """Get nodes since a generation, as DeltaNodes."""
+        rows = self._get_generation_delta(generation).values_list(
+            *self.DELTA_FIELDS)
+        return [self._get_delta_node(row) for row in rows[:limit]]
+
     @timing_metric
     def get_node(self, id, verify_hash=None, with_content=False):
         """Get one of the user's nodes."""
@@ -2234,10 +2461,9 @@ class ReadOnlyVolumeGateway(GatewayBase):
             raise errors.DoesNotExist(self.node_dne_error)
         return node
 
-    @timing_metric
-    def get_all_nodes(self, mimetypes=None, kind=None, with_content=False,
-                      start_from_path=None, limit=None, max_generation=None):
-        """Get all nodes from this volume."""
+    def _get_all_nodes(self, mimetypes=None, kind=None, with_content=False,
+                       start_from_path=None, max_generation=None):
+        """Get the query of all nodes from this volume, by path."""
         nodes = self._get_kind(StorageObject.objects.all(), kind)
         if mimetypes:
             nodes = nodes.filter(mimetype__in=mimetypes)
@@ -2265,12 +2491,31 @@ class ReadOnlyVolumeGateway(GatewayBase):
                 path=start_from_path[0], name__gt=start_from_path[1])
             nodes = nodes.filter(
                 same_path | models.Q(path__gt=start_from_path[0]))
-        results = self._node_finder(nodes, with_content).order_by(
+        return self._node_finder(nodes, with_content).order_by(
             'path', 'name')
+
+    @timing_metric
+    def get_all_nodes(self, mimetypes=None, kind=None, with_content=False,
+                      start_from_path=None, limit=None, max_generation=None):
+        """Get all nodes from this volume."""
+        results = self._get_all_nodes(
+            mimetypes=mimetypes, kind=kind, with_content=with_content,
+            start_from_path=start_from_path, max_generation=max_generation)
         if limit:
             results = results[:limit]
         return list(self._get_storage_node(n) for n in results)
 
+    @timing_metric
+    def get_all_delta_nodes(self, start_from_path=None, limit=None,
+                            max_generation=None):
+        """Get all nodes from this volume, as DeltaNodes."""
+        rows = self._get_all_nodes(
+            start_from_path=start_from_path,
+            max_generation=max_generation).values_list(*self.DELTA_FIELDS)
+        if limit:
+            rows = rows[:limit]
+        return [self._get_delta_node(row) for row in rows]
+
     @timing_metric
     def get_deleted_files(self, start=0, limit=100):
         """Get Dead files on this volume.
@@ -2404,14 +2649,29 @@ class ReadWriteVolumeGateway(ReadOnlyVolumeGateway):
                                       node.volume.generation)
 
     def _make_content(self, hash, crc32, size, deflated_size,
-                      storage_key, magic_hash):
+                      storage_key, magic_hash, inline_content=None):
         """Make a content blob."""
         content = ContentBlob.objects.create(
             hash=hash, magic_hash=magic_hash, crc32=crc32, size=size,
             deflated_size=deflated_size, status=STATUS_LIVE,
-            storage_key=storage_key)
+            storage_key=storage_key, content=inline_content)
         return content
 
+    def _revive_content(self, content, deflated_size, storage_key,
+                        magic_hash, inline_content=None):
+        """Use again a garbage collected blob, with its new stored content."""
+        if inline_content is None and (
+                storage_key is None or
+                str(storage_key) == str(content.storage_key)):
+            # the only content we know of was removed
+            raise errors.ContentMissing("The content was removed.")
+        content.storage_key = storage_key
+        content.content = inline_content
+        content.deflated_size = deflated_size
+        content.magic_hash = magic_hash
+        content.status = STATUS_LIVE
+        content.save()
+
     def _get_directory_node(self, id, for_write=True):
         """Get a directory node so it can be modified."""
         if self.read_only and for_write:
@@ -2764,10 +3024,15 @@ class ReadWriteVolumeGateway(ReadOnlyVolumeGateway):
         elif previous_hash and fnode.content_hash != previous_hash:
             raise errors.HashMismatch("File hash has changed.")
 
-        content = get_object_or_none(ContentBlob, hash=hash)
+        # locked, to not race with the blobs garbage collection
+        content = get_object_or_none(
+            ContentBlob.objects.select_for_update(), hash=hash)
         if content is None:
             content = self._make_content(hash, crc32, size, deflated_size,
                                          storage_key, magic_hash)
+        elif content.status == STATUS_DEAD:
+            self._revive_content(content, deflated_size, storage_key,
+                                 magic_hash)
         else:
             if content.magic_hash is None:
                 # update magic hash now that we have it!
@@ -2788,10 +3053,12 @@ class ReadWriteVolumeGateway(ReadOnlyVolumeGateway):
     @timing_metric
     def make_content(self, file_id, original_hash, hash_hint, crc32_hint,
                      inflated_size_hint, deflated_size_hint,
-                     storage_key, magic_hash=None):
+                     storage_key, magic_hash=None, inline_content=None):
         """Make content (if necessary) and update the magic hash (if have it).
 
-        If there is no storage_key, we must have an existing content.
+        If there is no storage_key nor inline content (the content itself, if
+        small enough to be stored in the blob), we must have an existing
+        content.
         """
         fnode = self._get_node_simple(file_id)
         if fnode is None:
@@ -2799,14 +3066,20 @@ class ReadWriteVolumeGateway(ReadOnlyVolumeGateway):
         if fnode.content_hash != original_hash:
             raise errors.HashMismatch("The file's hash has changed.")
         self._check_can_write_node(fnode)
-        content = get_object_or_none(ContentBlob, hash=hash_hint)
+        # locked, to not race with the blobs garbage collection
+        content = get_object_or_none(
+            ContentBlob.objects.select_for_update(), hash=hash_hint)
         if content is None:
-            if storage_key is None:
+            if storage_key is None and inline_content is None:
                 # we must have content since we have no storage_key
                 raise errors.ContentMissing("The content does not exist.")
             content = self._make_content(
                 hash_hint, crc32_hint, inflated_size_hint,
-                deflated_size_hint, storage_key, magic_hash)
+                deflated_size_hint, storage_key, magic_hash, inline_content)
+        elif content.status == STATUS_DEAD:
+            self._revive_content(
+                content, deflated_size_hint, storage_key, magic_hash,
+                inline_content)
         else:
             if content.magic_hash is None:
                 # update magic hash now that we have it!
@@ -2930,6 +3203,294 @@ def fix_all_udfs_with_generation_out_of_sync(logger, sleep=0, batch_size=500):
         time.sleep(sleep)
 
 
+def reconcile_used_bytes(logger, sleep=0, batch_size=500):
+    """Recalculate the used bytes of all the users, in batches.
+
+    The used_storage_bytes column is the authoritative counter in the hot
+    path; this fixes any drift against the real size of the live files, and
+    reports it. Return the total (absolute) drift found.
+    """
+    reporter = metrics.get_meter('quota_reconciler')
+    start = time.time()
+    total_done = total_drift = 0
+    last_id = 0
+    while True:
+        user_ids = list(StorageUser.objects.filter(
+            id__gt=last_id).order_by('id').values_list(
+            'id', flat=True)[:batch_size])
+        if not user_ids:
+            break
+        last_id = user_ids[-1]
+
+        batch_drift = 0
+        for user_id in user_ids:
+            with fsync_commit():
+                user = StorageUser.objects.select_for_update().get(id=user_id)
+                previous = user.used_storage_bytes
+                drift = user.recalculate_used_bytes() - previous
+            if drift:
+                logger.info("Fixed used bytes for user %s from %s to %s",
+                            user_id, previous, previous + drift)
+                reporter.meter('users_fixed')
+                batch_drift += abs(drift)
+
+        total_done += len(user_ids)
+        total_drift += batch_drift
+        reporter.gauge('drift', batch_drift)
+        logger.info("Reconciled used bytes for %d users (drift: %d bytes) "
+                    "in %d seconds", total_done, total_drift,
+                    time.time() - start)
+        time.sleep(sleep)
+
+    reporter.gauge('total_drift', total_drift)
+    return total_drift
+
+
+def collect_orphan_blobs(logger, storage, grace_period, batch_size=500,
+                         max_bytes_per_second=0):
+    """Remove the files of the blobs that no node uses anymore.
+
+    Only blobs created more than `grace_period` seconds ago are considered,
+    to not race with the uploads still referencing them. The blobs are
+    marked as dead and then their file removed from `storage`, at most at
+    `max_bytes_per_second` (if given). Return the bytes reclaimed.
+    """
+    reporter = metrics.get_meter('blob_gc')
+    start = time.time()
+    created_before = now() - datetime.timedelta(seconds=grace_period)
+    total_blobs = total_bytes = 0
+    last_key = None
+    while True:
+        blobs = get_orphan_blobs(created_before, last_key, batch_size)
+        if not blobs:
+            break
+        last_key = blobs[-1][1]
+
+        for hash_value, storage_key in blobs:
+            if not kill_orphan_blob(hash_value):
+                continue
+            total_blobs += 1
+            total_bytes += storage.delete(str(storage_key))
+
+            # keep the removal under the I/O budget
+            if max_bytes_per_second:
+                ahead = (total_bytes / float(max_bytes_per_second) -
+                         (time.time() - start))
+                if ahead > 0:
+                    time.sleep(ahead)
+
+        reporter.gauge('blobs_collected', total_blobs)
+        logger.info("Collected %d orphan blobs (%d bytes) in %d seconds",
+                    total_blobs, total_bytes, time.time() - start)
+
+    reporter.gauge('bytes_reclaimed', total_bytes)
+    return total_bytes
+
+
+def reclaim_upload_files(logger, storage, grace_period, max_age, after=None,
+                         save_cursor=None, batch_size=500,
+                         max_files_per_second=0):
+    """Remove the unfinished files of the uploads that will not continue.
+
+    The files not written in `grace_period` seconds are removed if their
+    upload job is gone (or never existed, as in the small uploads), and
+    also the ones not written in `max_age` seconds anyway. The tree of
+    `storage` is walked from after the `after` leaf, giving each completed
+    leaf to `save_cursor` (if given) so the walk can be continued later,
+    and None when finished. At most `max_files_per_second` files are
+    checked (if given). Return the bytes reclaimed.
+    """
+    reporter = metrics.get_meter('upload_janitor')
+    start = time.time()
+    totals = dict(scanned=0, removed=0, reclaimed=0)
+
+    def remove(batch):
+        """Remove the files in the batch that are not of a live upload."""
+        keys = []
+        for node_id, _ in batch:
+            try:
+                keys.append(str(uuid.UUID(node_id)))
+            except ValueError:
+                pass
+        uploading = get_uploading_keys(keys) if keys else set()
+        removed = reclaimed = 0
+        for node_id, age in batch:
+            if node_id not in uploading or age >= max_age:
+                removed += 1
+                reclaimed += storage.delete(node_id, temp=True)
+        if removed:
+            totals['removed'] += removed
+            totals['reclaimed'] += reclaimed
+            logger.info("Removed %d unfinished upload files (%d bytes) in "
+                        "%d seconds", totals['removed'], totals['reclaimed'],
+                        time.time() - start)
+        del batch[:]
+
+    batch = []
+    current = None
+    for leaf, node_id, stat in storage.iter_temp_files(after):
+        if leaf != current:
+            # all the files of the previous leaf were handled
+            remove(batch)
+            if current is not None and save_cursor is not None:
+                save_cursor(current)
+            current = leaf
+
+        totals['scanned'] += 1
+        age = time.time() - stat.st_mtime
+        if age >= grace_period:
+            batch.append((node_id, age))
+            if len(batch) >= batch_size:
+                remove(batch)
+
+        # keep the walk under the I/O budget
+        if max_files_per_second:
+            ahead = (totals['scanned'] / float(max_files_per_second) -
+                     (time.time() - start))
+            if ahead > 0:
+                time.sleep(ahead)
+
+    remove(batch)
+    if save_cursor is not None:
+        save_cursor(None)
+
+    reporter.gauge('files_scanned', totals['scanned'])
+    reporter.gauge('files_removed', totals['removed'])
+    reporter.gauge('bytes_reclaimed', totals['reclaimed'])
+    return totals['reclaimed']
+
+
+def inline_small_blobs(logger, storage, max_size=None, batch_size=500,
+                       sleep=0):
+    """Move the content of the small blobs from disk to the database.
+
+    The blobs with content up to `max_size` (STORAGE_INLINE_MAX_SIZE by
+    default) get it stored in them, then it's removed from `storage`.
+    Return the number of blobs inlined.
+    """
+    reporter = metrics.get_meter('blob_inliner')
+    if max_size is None:
+        max_size = settings.STORAGE_INLINE_MAX_SIZE
+    start = time.time()
+    total_blobs = total_bytes = 0
+    last_key = None
+    while True:
+        blobs = get_inlinable_blobs(max_size, last_key, batch_size)
+        if not blobs:
+            break
+        last_key = blobs[-1][1]
+
+        for hash_value, storage_key in blobs:
+            data = storage.read(str(storage_key))
+            if data is None:
+                logger.warning("Content missing for blob %s", storage_key)
+                continue
+            if not inline_blob(hash_value, storage_key, data):
+                continue
+            storage.delete(str(storage_key))
+            total_blobs += 1
+            total_bytes += len(data)
+
+        reporter.gauge('blobs_inlined', total_blobs)
+        logger.info("Inlined %d blobs (%d bytes) in %d seconds",
+                    total_blobs, total_bytes, time.time() - start)
+        time.sleep(sleep)
+
+    reporter.gauge('bytes_inlined', total_bytes)
+    return total_blobs
+
+
+def scrub_blobs(logger, storage, verify, after=None, save_cursor=None,
+                batch_size=500, max_bytes_per_second=0, workers=1):
+    """Check the content of the blobs stored in disk, recording the damaged.
+
+    The live blobs are walked by storage key from after the `after` one,
+    giving the last key of each checked batch to `save_cursor` (if given)
+    so the walk can be continued later, and None when finished. Their
+    content is read from `storage` (at most `max_bytes_per_second` in
+    total, if given) by `workers` threads, so the volumes are read in
+    parallel, and checked against the blob with `verify` (which takes the
+    content chunks, hash, crc32, size and deflated size, and returns what
+    doesn't match, None if everything does); see get_damaged_blobs for the
+    ones missing or corrupt. Return how many were found damaged.
+    """
+    reporter = metrics.get_meter('blob_scrubber')
+    start = time.time()
+    totals = dict(blobs=0, bytes=0, damaged=0)
+    lock = threading.Lock()
+
+    def read(fh, size):
+        """Yield the content in chunks, keeping the reads under budget."""
+        with fh:
+            while size > 0:
+                data = fh.read(min(size, settings.STORAGE_READ_CHUNK_SIZE))
+                if not data:
+                    break
+                size -= len(data)
+                with lock:
+                    totals['bytes'] += len(data)
+                    read_bytes = totals['bytes']
+                if max_bytes_per_second:
+                    ahead = (read_bytes / float(max_bytes_per_second) -
+                             (time.time() - start))
+                    if ahead > 0:
+                        time.sleep(ahead)
+                yield data
+
+    def check(blob):
+        """Return the problem and its detail, None if the content is fine."""
+        hash_value, storage_key, crc32, size, deflated_size = blob
+        try:
+            opened = storage.open_content(str(storage_key))
+            if opened is None:
+                return DamagedBlob.PROBLEM_MISSING, 'Not in the storage'
+            detail = verify(
+                read(*opened), hash_value, crc32, size, deflated_size)
+        except EnvironmentError as err:
+            detail = "Can not read the content: %s" % (err,)
+        if detail is not None:
+            return DamagedBlob.PROBLEM_CORRUPT, detail
+
+    pool = ThreadPool(workers)
+    try:
+        while True:
+            blobs = get_blobs_to_scrub(after, batch_size)
+            if not blobs:
+                break
+            after = blobs[-1][1]
+
+            damaged = []
+            verified = []
+            for blob, result in zip(blobs, pool.map(check, blobs)):
+                hash_value, storage_key = blob[:2]
+                if result is None:
+                    verified.append(hash_value)
+                    continue
+                problem, detail = result
+                logger.warning("Content of blob %s is %s: %s", storage_key,
+                               problem.lower(), detail)
+                damaged.append((hash_value, storage_key, problem, detail))
+            record_scrubbed_blobs(damaged, verified)
+            if save_cursor is not None:
+                save_cursor(str(after))
+
+            totals['blobs'] += len(blobs)
+            totals['damaged'] += len(damaged)
+            reporter.gauge('blobs_scrubbed', totals['blobs'])
+            logger.info("Scrubbed %d blobs (%d bytes), %d damaged, in %d "
+                        "seconds", totals['blobs'], totals['bytes'],
+                        totals['damaged'], time.time() - start)
+    finally:
+        pool.close()
+        pool.join()
+
+    if save_cursor is not None:
+        save_cursor(None)
+    reporter.gauge('bytes_scrubbed', totals['bytes'])
+    reporter.gauge('blobs_damaged', totals['damaged'])
+    return totals['damaged']
+
+
 # original services.py starts here
 
 
@@ -2943,6 +3504,17 @@ def make_storage_user(
     return gw.create_or_update_user(username, max_storage_bytes, **kwargs)
 
 
+def _get_storage_user(user_id=None, username=None, session_id=None,
+                      active_only=True, readonly=False):
+    """Get a storage user, in the current transaction."""
+    gw = SystemGateway()
+    user = gw.get_user(user_id=user_id, username=username,
+                       session_id=session_id, ignore_lock=readonly)
+    if active_only and (user is None or not user.is_active):
+        raise errors.DoesNotExist("User does not exist.")
+    return user
+
+
 @fsync_readonly
 def get_storage_user(user_id=None, username=None, session_id=None,
                      active_only=True, readonly=False):
@@ -2951,12 +3523,55 @@ def get_storage_user(user_id=None, username=None, session_id=None,
     readonly kwarg is just to not raise LockedUserError in case the user is
     locked.
     """
-    gw = SystemGateway()
-    user = gw.get_user(user_id=user_id, username=username,
-                       session_id=session_id, ignore_lock=readonly)
-    if active_only and (user is None or not user.is_active):
-        raise errors.DoesNotExist("User does not exist.")
-    return user
+    return _get_storage_user(user_id=user_id, username=username,
+                             session_id=session_id, active_only=active_only,
+                             readonly=readonly)
+
+
+@retryable_transaction()
+@fsync_commit
+def prepare_upload(user_id, volume_id, node_id, previous_hash, hash_value,
+                   crc32, inflated_size, magic_hash=None,
+                   check_reusable=True, uploadjob_id=None,
+                   multipart_key=None):
+    """Get what's needed to upload content to a file, in one transaction.
+
+    If check_reusable, look for a blob with the content that can be reused;
+    if there's none, get the upload job uploadjob_id (if still there) and
+    touch it, or else make a new one with multipart_key (if given), which
+    checks the quota.
+
+    Return a tuple of (blob_exists, storage_key, node, uploadjob); the node
+    with its content, and the upload job None if there's none.
+    """
+    user = _get_storage_user(user_id)
+    gateway = user.volume(volume_id).gateway
+    blob_exists, storage_key = False, None
+    if check_reusable:
+        blob_exists, storage_key = user._gateway.is_reusable_content(
+            hash_value, magic_hash)
+
+    node = gateway.get_node(node_id, with_content=True)
+    if node.kind != StorageObject.FILE:
+        raise errors.NoPermission("Can only put content on files.")
+
+    uploadjob = None
+    if storage_key is None:
+        if uploadjob_id is not None:
+            try:
+                uploadjob = gateway.get_user_multipart_uploadjob(
+                    node_id, uploadjob_id, hash_hint=hash_value,
+                    crc32_hint=crc32)
+            except errors.DoesNotExist:
+                pass
+            else:
+                uploadjob = gateway.set_uploadjob_when_last_active(
+                    uploadjob.id, now())
+        if uploadjob is None and multipart_key is not None:
+            uploadjob = gateway.make_uploadjob(
+                node_id, previous_hash, hash_value, crc32, inflated_size,
+                multipart_key=multipart_key)
+    return blob_exists, storage_key, node, uploadjob
 
 
 @fsync_readonly
@@ -3024,3 +3639,98 @@ def cleanup_uploadjobs(uploadjob_ids):
     """
     gw = SystemGateway()
     return gw.cleanup_uploadjobs(uploadjob_ids)
+
+
+@fsync_readonly
+def get_inlinable_blobs(max_size, after_key=None, limit=500):
+    """Return the blobs stored in disk with content up to a size.
+
+    @param max_size: the maximum deflated size of the content.
+    @param after_key: only return blobs with a bigger storage key.
+    @param limit: the limit on the number of results
+    """
+    gw = SystemGateway()
+    return gw.get_inlinable_blobs(max_size, after_key, limit)
+
+
+@fsync_commit
+def inline_blob(hash_value, storage_key, inline_content):
+    """Store the content in the blob; return if it was done."""
+    gw = SystemGateway()
+    return gw.inline_blob(hash_value, storage_key, inline_content)
+
+
+@fsync_readonly
+def get_uploading_keys(storage_keys):
+    """Return which of the storage keys are of uploads in progress.
+
+    @param storage_keys: the multipart keys to check.
+    """
+    gw = SystemGateway()
+    return gw.get_uploading_keys(storage_keys)
+
+
+@fsync_readonly
+def get_orphan_blobs(created_before, after_key=None, limit=500):
+    """Return the blobs created before a date that are not used anymore.
+
+    @param created_before: datetime, a filter of the when_created field.
+    @param after_key: only return blobs with a bigger storage key.
+    @param limit: the limit on the number of results
+    """
+    gw = SystemGateway()
+    return gw.get_orphan_blobs(created_before, after_key, limit)
+
+
+@fsync_commit
+def kill_orphan_blob(hash_value):
+    """Mark a blob as dead if it's not used; return if it was killed."""
+    gw = SystemGateway()
+    return gw.kill_orphan_blob(hash_value)
+
+
+@fsync_readonly
+def get_blob_hashes(after_hash=None, created_after=None, limit=10000):
+    """Return the hashes of the blobs, in order.
+
+    @param after_hash: only return the hashes bigger than this one.
+    @param created_after: only of the blobs created after this datetime.
+    @param limit: the limit on the number of results
+    """
+    gw = SystemGateway()
+    return gw.get_blob_hashes(after_hash, created_after, limit)
+
+
+@fsync_readonly
+def count_blobs():
+    """Return how many blobs there are."""
+    gw = SystemGateway()
+    return gw.count_blobs()
+
+
+@fsync_readonly
+def get_blobs_to_scrub(after_key=None, limit=500):
+    """Return the blobs stored in disk, to check their content.
+
+    @param after_key: only return blobs with a bigger storage key.
+    @param limit: the limit on the number of results
+    """
+    gw = SystemGateway()
+    return gw.get_blobs_to_scrub(after_key, limit)
+
+
+@fsync_commit
+def record_scrubbed_blobs(damaged, verified):
+    """Record the blobs found damaged, and forget the verified ones."""
+    gw = SystemGateway()
+    return gw.record_scrubbed_blobs(damaged, verified)
+
+
+@fsync_readonly
+def get_damaged_blobs(limit=100):
+    """Return the blobs with damaged content, the last detected first.
+
+    @param limit: the limit on the number of results
+    """
+    gw = SystemGateway()
+    return gw.get_damaged_blobs(limit)
@@ -1391,6 +1391,33 @@ class GenerationsDAOTestCase(StorageDALTestCase):
         files_with_root = [root] + files[-5:]
         self.assertEqual(delta, files_with_root)
 
+    def test_get_delta_nodes(self):
+        """Test get_delta_nodes, as get_delta but with DeltaNodes."""
+        user = self.create_user(max_storage_bytes=1000)
+        files = self.create_files(user.root)
+        generation, free_bytes, delta = user.volume().get_delta(1, limit=5)
+        result = user.volume().get_delta_nodes(1, limit=5)
+        self.assertEqual(result[:2], (generation, free_bytes))
+        self.assertEqual([n.id for n in result[2]], [n.id for n in delta])
+        self.assertEqual([n.id for n in delta], [f.id for f in files[:5]])
+        # nothing new
+        result = user.volume().get_delta_nodes(generation)
+        self.assertEqual(result, (generation, free_bytes, []))
+
+    def test_get_from_scratch_nodes(self):
+        """Test get_from_scratch_nodes, as get_from_scratch but DeltaNodes."""
+        user = self.create_user(max_storage_bytes=1000)
+        self.create_files(user.root)
+        generation, free_bytes, nodes = user.volume().get_from_scratch(
+            limit=5)
+        result = user.volume().get_from_scratch_nodes(limit=5)
+        self.assertEqual(result[:2], (generation, free_bytes))
+        self.assertEqual([n.id for n in result[2]], [n.id for n in nodes])
+        last = result[2][-1]
+        result = user.volume().get_from_scratch_nodes(
+            start_from_path=(last.path, last.name))
+        self.assertEqual(len(result[2]), 6)
+
     def test_SharedDirectory_get_generation(self):
         """Test for SharedDirectory.get_generation method."""
         user = self.create_user()
@@ -20,6 +20,7 @@
 
 from __future__ import unicode_literals
 
+import calendar
 import logging
 import posixpath
 import os
@@ -59,6 +60,7 @@ from magicicada.filesync.services import (
     DAODownload,
     DAOStorageUser,
     DAOUserVolume,
+    DeltaNode,
     DirectoryNode,
     FileNode,
     GatewayBase,
@@ -3125,6 +3127,54 @@ class CommonReadWriteVolumeGatewayApiTest(BaseTestCase):
         self.assertTrue(dir3 in delta)
         self.assertTrue(file3 in delta)
 
+    def get_delta_node(self, node):
+        """Build the DeltaNode expected for a StorageNode."""
+        is_file = node.kind == StorageObject.FILE
+        content = node.content if is_file else None
+        return DeltaNode(
+            id=node.id, parent_id=node.parent_id, path=node.path,
+            name=node.name, is_file=is_file,
+            is_live=node.status == STATUS_LIVE, generation=node.generation,
+            is_public=node.is_public, content_hash=node.content_hash,
+            crc32=content.crc32 if content else 0,
+            size=content.size if content else 0,
+            last_modified=calendar.timegm(
+                node.when_last_modified.timetuple()))
+
+    def test_get_generation_delta_nodes(self):
+        """The DeltaNodes are the ones of the generation delta."""
+        root_id = self.root.id
+        last_gen = self.vgw._get_user_volume().generation
+        dir1 = self.vgw.make_subdirectory(root_id, 'dir1')
+        self.vgw.make_file_with_content(
+            dir1.id, 'file1.txt', self.factory.get_fake_hash(), 123, 10, 5,
+            uuid.uuid4())
+        file2 = self.vgw.make_file(dir1.id, 'file2.mp3')
+        self.vgw.delete_node(file2.id)
+        expected = [self.get_delta_node(n)
+                    for n in self.vgw.get_generation_delta(last_gen)]
+        self.assertEqual(len(expected), 3)
+        self.assertEqual(
+            self.vgw.get_generation_delta_nodes(last_gen), expected)
+        self.assertEqual(
+            self.vgw.get_generation_delta_nodes(last_gen, 2), expected[:2])
+
+    def test_get_all_delta_nodes(self):
+        """The DeltaNodes are the ones of all the nodes."""
+        root_id = self.root.id
+        dir1 = self.vgw.make_subdirectory(root_id, 'dir1')
+        self.vgw.make_file_with_content(
+            dir1.id, 'file1.txt', self.factory.get_fake_hash(), 123, 10, 5,
+            uuid.uuid4())
+        self.vgw.make_file(root_id, 'file2.mp3')
+        expected = [self.get_delta_node(n) for n in self.vgw.get_all_nodes()]
+        self.assertEqual(self.vgw.get_all_delta_nodes(), expected)
+        nodes = self.vgw.get_all_delta_nodes(limit=2)
+        self.assertEqual(nodes, expected[:2])
+        nodes = self.vgw.get_all_delta_nodes(
+            start_from_path=(nodes[-1].path, nodes[-1].name))
+        self.assertEqual(nodes, expected[2:])
+
     def test_get_directories_with_mimetypes(self):
         """Test get_directories_with_mimetype."""
         root_id = self.root.id
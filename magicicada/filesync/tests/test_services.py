@@ -20,20 +20,44 @@
 
 from __future__ import unicode_literals
 
+import datetime
+import io
+import logging
+import time
 import uuid
+import zlib
+
+from magicicadaprotocol.content_hash import content_hash_factory, crc32
 
 from django.utils.timezone import now
 
 from magicicada.filesync import errors
-from magicicada.filesync.models import StorageUser
+from magicicada.filesync.models import (
+    STATUS_DEAD,
+    STATUS_LIVE,
+    ContentBlob,
+    DamagedBlob,
+    StorageObject,
+    StorageUser,
+)
 from magicicada.filesync.services import (
     DAOStorageUser,
+    collect_orphan_blobs,
+    count_blobs,
     get_abandoned_uploadjobs,
+    get_blob_hashes,
+    get_damaged_blobs,
     get_node,
     get_public_file,
     get_public_directory,
     get_storage_user,
+    inline_small_blobs,
+    kill_orphan_blob,
     make_storage_user,
+    prepare_upload,
+    reclaim_upload_files,
+    reconcile_used_bytes,
+    scrub_blobs,
 )
 from magicicada.testing.testcase import BaseTestCase
 
@@ -91,6 +115,293 @@ class DataServicesTestCase(BaseTestCase):
         jobs = get_abandoned_uploadjobs(now(), 100)
         self.assertTrue(isinstance(jobs, list))
 
+    def test_prepare_upload(self):
+        """Test the prepare_upload function."""
+        user = make_storage_user("User 1", MAX_STORAGE_BYTES)
+        node = user.volume().root.make_file("test file")
+        blob_exists, storage_key, file_node, uploadjob = prepare_upload(
+            user.id, None, node.id, None, self.factory.get_fake_hash(), 1, 10)
+        self.assertFalse(blob_exists)
+        self.assertIsNone(storage_key)
+        self.assertEqual(file_node.id, node.id)
+        self.assertIsNone(uploadjob)
+
+    def test_prepare_upload_multipart(self):
+        """Test the prepare_upload function with an upload job."""
+        user = make_storage_user("User 1", MAX_STORAGE_BYTES)
+        node = user.volume().root.make_file("test file")
+        hash_value = self.factory.get_fake_hash()
+        multipart_key = uuid.uuid4()
+        uploadjob = prepare_upload(
+            user.id, None, node.id, None, hash_value, 1, 10,
+            multipart_key=multipart_key)[3]
+        self.assertEqual(uploadjob.multipart_key, multipart_key)
+        # and it's resumed
+        resumed = prepare_upload(
+            user.id, None, node.id, None, hash_value, 1, 10,
+            uploadjob_id=uploadjob.id, multipart_key=uuid.uuid4())[3]
+        self.assertEqual(resumed.id, uploadjob.id)
+
+    def test_prepare_upload_not_a_file(self):
+        """Test the prepare_upload function on a directory."""
+        user = make_storage_user("User 1", MAX_STORAGE_BYTES)
+        node = user.volume().root.make_subdirectory("dir")
+        self.assertRaises(
+            errors.NoPermission, prepare_upload, user.id, None, node.id,
+            None, self.factory.get_fake_hash(), 1, 10)
+
+    def test_get_storage_user_uses_used_bytes_counter(self):
+        """The DAO quota comes from the counter, files are not summed."""
+        user = make_storage_user("Cool UserName", MAX_STORAGE_BYTES)
+        StorageUser.objects.filter(id=user.id).update(used_storage_bytes=30)
+
+        def fail(*args):
+            raise AssertionError("calculate_size_by_owner was called")
+        self.patch(StorageObject.objects, 'calculate_size_by_owner', fail)
+
+        user = get_storage_user(user.id)
+        self.assertEqual(user.used_storage_bytes, 30)
+        self.assertEqual(user.free_bytes, MAX_STORAGE_BYTES - 30)
+
+    def test_reconcile_used_bytes(self):
+        """Test the reconcile_used_bytes function."""
+        user1 = make_storage_user("User 1", MAX_STORAGE_BYTES)
+        user2 = make_storage_user("User 2", MAX_STORAGE_BYTES)
+        for user in (user1, user2):
+            user.volume().root.make_file_with_content(
+                "file.txt", self.factory.get_fake_hash(), 123, 10, 1,
+                uuid.uuid4())
+        StorageUser.objects.filter(id=user1.id).update(used_storage_bytes=3)
+
+        drift = reconcile_used_bytes(logging.getLogger(), batch_size=1)
+
+        self.assertEqual(drift, 7)
+        for user in (user1, user2):
+            self.assertEqual(
+                StorageUser.objects.get(id=user.id).used_storage_bytes, 10)
+
+    def make_blob(self, user, name="file.txt", age=3600):
+        """Make a file with content, with its blob created 'age' ago."""
+        hash_value = self.factory.get_fake_hash(name)
+        storage_key = uuid.uuid4()
+        node = user.volume().root.make_file_with_content(
+            name, hash_value, 123, 10, 1, storage_key)
+        ContentBlob.objects.filter(hash=hash_value).update(
+            when_created=now() - datetime.timedelta(seconds=age))
+        return node, hash_value, storage_key
+
+    def test_collect_orphan_blobs(self):
+        """Test the collect_orphan_blobs function."""
+        user = make_storage_user("User 1", MAX_STORAGE_BYTES)
+        orphan, orphan_hash, orphan_key = self.make_blob(user, "orphan")
+        _, used_hash, _ = self.make_blob(user, "used")
+        recent, recent_hash, _ = self.make_blob(user, "recent", age=0)
+        StorageObject.objects.filter(id__in=[orphan.id, recent.id]).delete()
+
+        deleted = []
+
+        class FakeStorage(object):
+            def delete(self, node_id):
+                deleted.append(node_id)
+                return 10
+
+        reclaimed = collect_orphan_blobs(
+            logging.getLogger(), FakeStorage(), grace_period=60, batch_size=1)
+
+        self.assertEqual(reclaimed, 10)
+        self.assertEqual(deleted, [str(orphan_key)])
+        statuses = dict(ContentBlob.objects.values_list('hash', 'status'))
+        self.assertEqual(statuses[orphan_hash], STATUS_DEAD)
+        self.assertEqual(statuses[used_hash], STATUS_LIVE)
+        self.assertEqual(statuses[recent_hash], STATUS_LIVE)
+
+    def test_kill_orphan_blob_used_again(self):
+        """A blob is not killed if it's used when about to kill it."""
+        user = make_storage_user("User 1", MAX_STORAGE_BYTES)
+        _, hash_value, _ = self.make_blob(user)
+        self.assertFalse(kill_orphan_blob(hash_value))
+        self.assertEqual(
+            ContentBlob.objects.get(hash=hash_value).status, STATUS_LIVE)
+
+    def test_collected_blob_is_not_reused(self):
+        """A collected blob is used again only with new stored content."""
+        user = make_storage_user("User 1", MAX_STORAGE_BYTES)
+        node, hash_value, storage_key = self.make_blob(user)
+        StorageObject.objects.filter(id=node.id).delete()
+        self.assertTrue(kill_orphan_blob(hash_value))
+        root = user.volume().root
+
+        self.assertRaises(
+            errors.ContentMissing, root.make_file_with_content,
+            "again", hash_value, 123, 10, 1, storage_key)
+
+        new_key = uuid.uuid4()
+        root.make_file_with_content("again", hash_value, 123, 10, 1, new_key)
+        blob = ContentBlob.objects.get(hash=hash_value)
+        self.assertEqual(blob.status, STATUS_LIVE)
+        self.assertEqual(blob.storage_key, new_key)
+
+    def test_make_content_inline(self):
+        """Test the content can be stored in the blob."""
+        user = make_storage_user("User 1", MAX_STORAGE_BYTES)
+        node = user.volume().root.make_file("file.txt")
+        hash_value = self.factory.get_fake_hash()
+        node.make_content(node.content_hash, hash_value, 123, 10, 5, None,
+                          inline_content=b'12345')
+
+        content = node.get_content()
+        self.assertEqual(content.inline_content, b'12345')
+        self.assertIdentical(content.storage_key, None)
+        self.assertEqual(node.content_hash, hash_value)
+
+    def test_inline_small_blobs(self):
+        """Test the inline_small_blobs function."""
+        user = make_storage_user("User 1", MAX_STORAGE_BYTES)
+        _, small_hash, small_key = self.make_blob(user, "small")
+        _, missing_hash, missing_key = self.make_blob(user, "missing")
+        _, changed_hash, changed_key = self.make_blob(user, "changed")
+        _, big_hash, _ = self.make_blob(user, "big")
+        ContentBlob.objects.filter(hash=big_hash).update(deflated_size=11)
+
+        deleted = []
+
+        class FakeStorage(object):
+            def read(self, node_id):
+                return {str(small_key): b'x', str(changed_key): b'xx'}.get(
+                    node_id)
+
+            def delete(self, node_id):
+                deleted.append(node_id)
+                return 1
+
+        inlined = inline_small_blobs(
+            logging.getLogger(), FakeStorage(), max_size=10, batch_size=1)
+
+        self.assertEqual(inlined, 1)
+        self.assertEqual(deleted, [str(small_key)])
+        blob = ContentBlob.objects.get(hash=small_hash)
+        self.assertEqual(bytes(blob.content), b'x')
+        self.assertIdentical(blob.storage_key, None)
+        for hash_value in (missing_hash, changed_hash, big_hash):
+            blob = ContentBlob.objects.get(hash=hash_value)
+            self.assertIdentical(blob.content, None)
+            self.assertIsNot(blob.storage_key, None)
+
+    def test_reclaim_upload_files(self):
+        """Test the reclaim_upload_files function."""
+        user = make_storage_user("User 1", MAX_STORAGE_BYTES)
+        node = user.volume().root.make_file("file.txt")
+        uploading_key = str(uuid.uuid4())
+        node.make_uploadjob(node.content_hash, self.factory.get_fake_hash(),
+                            123, 100, multipart_key=uuid.UUID(uploading_key))
+        gone_key = str(uuid.uuid4())
+        recent_key = str(uuid.uuid4())
+        old_key = str(uuid.uuid4())
+
+        class FakeStat(object):
+            def __init__(self, age):
+                self.st_mtime = time.time() - age
+
+        deleted = []
+        walked = []
+
+        class FakeStorage(object):
+            def iter_temp_files(self, after=None):
+                walked.append(after)
+                yield "aaa", uploading_key, FakeStat(7200)
+                yield "aaa", gone_key, FakeStat(7200)
+                yield "bbb", recent_key, FakeStat(10)
+                yield "ccc", old_key, FakeStat(10 ** 6)
+                yield "ccc", "not-an-upload", FakeStat(7200)
+
+            def delete(self, node_id, temp=False):
+                assert temp
+                deleted.append(node_id)
+                return 10
+
+        cursors = []
+        reclaimed = reclaim_upload_files(
+            logging.getLogger(), FakeStorage(), grace_period=3600,
+            max_age=86400, after="000", save_cursor=cursors.append,
+            batch_size=1)
+
+        self.assertEqual(reclaimed, 30)
+        self.assertEqual(walked, ["000"])
+        self.assertEqual(deleted, [gone_key, old_key, "not-an-upload"])
+        self.assertEqual(cursors, ["aaa", "bbb", None])
+
+    def test_get_blob_hashes(self):
+        """Test the get_blob_hashes function."""
+        user = make_storage_user("User 1", MAX_STORAGE_BYTES)
+        old_hash = self.make_blob(user, "old", age=3600)[1]
+        new_hash = self.make_blob(user, "new", age=0)[1]
+        hashes = sorted([old_hash, new_hash])
+
+        self.assertEqual(get_blob_hashes(), hashes)
+        self.assertEqual(get_blob_hashes(limit=1), hashes[:1])
+        self.assertEqual(get_blob_hashes(after_hash=hashes[0]), hashes[1:])
+        created_after = now() - datetime.timedelta(seconds=60)
+        self.assertEqual(
+            get_blob_hashes(created_after=created_after), [new_hash])
+
+    def test_count_blobs(self):
+        """Test the count_blobs function."""
+        user = make_storage_user("User 1", MAX_STORAGE_BYTES)
+        before = count_blobs()
+        self.make_blob(user, "one")
+        self.make_blob(user, "two")
+        self.assertEqual(count_blobs(), before + 2)
+
+    def test_scrub_blobs(self):
+        """Test the scrub_blobs function."""
+        stored = {}
+        for name in ("good", "corrupt", "missing", "fixed"):
+            data = name.encode('ascii') * 100
+            hasher = content_hash_factory()
+            hasher.update(data)
+            blob = ContentBlob.objects.create(
+                hash=hasher.content_hash(), storage_key=uuid.uuid4(),
+                crc32=crc32(data), size=len(data),
+                deflated_size=len(zlib.compress(data)))
+            stored[name] = (hasher.content_hash(), str(blob.storage_key),
+                            zlib.compress(data))
+        stored['corrupt'] = stored['corrupt'][:2] + (b'not deflated',)
+        DamagedBlob.objects.create(
+            content_blob_id=stored['fixed'][0], storage_key=stored['fixed'][1],
+            problem=DamagedBlob.PROBLEM_CORRUPT)
+
+        class FakeStorage(object):
+            def open_content(self, node_id):
+                for name, (_, storage_key, content) in stored.items():
+                    if node_id == storage_key and name != "missing":
+                        return io.BytesIO(content), len(content)
+
+        def verify(chunks, hash_value, crc32_value, size, deflated_size):
+            try:
+                data = zlib.decompress(b''.join(chunks))
+            except zlib.error as err:
+                return "Can not inflate the content: %s" % (err,)
+            if crc32(data) != crc32_value:
+                return "Crc32 does not match"
+
+        cursors = []
+        damaged = scrub_blobs(
+            logging.getLogger(), FakeStorage(), verify,
+            save_cursor=cursors.append, batch_size=1, workers=2)
+
+        self.assertEqual(damaged, 2)
+        self.assertEqual(
+            cursors, sorted(key for _, key, _ in stored.values()) + [None])
+        problems = dict(
+            (bytes(h), (str(key), problem))
+            for h, key, problem, _, _ in get_damaged_blobs())
+        self.assertEqual(problems, {
+            stored['corrupt'][0]: (
+                stored['corrupt'][1], DamagedBlob.PROBLEM_CORRUPT),
+            stored['missing'][0]: (
+                stored['missing'][1], DamagedBlob.PROBLEM_MISSING),
+        })
+
     def test_get_public_file(self):
         """Test the get_public_file function."""
         user = make_storage_user("Cool UserName", 10)
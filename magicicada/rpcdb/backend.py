@@ -310,12 +310,14 @@ class DAL(object):
             size = content.size
             deflated_size = content.deflated_size
             storage_key = content.storage_key
+            inline_content = content.inline_content
             has_content = True
         else:
             crc32 = None
             size = None
             deflated_size = None
             storage_key = None
+            inline_content = None
             has_content = False
 
         d = dict(id=node.id, name=node.name, generation=node.generation,
@@ -325,7 +327,7 @@ class DAL(object):
                  size=size, is_file=is_file, volume_id=node.vol_id,
                  parent_id=node.parent_id, content_hash=node.content_hash,
                  path=node.path, has_content=has_content,
-                 public_url=node.public_url)
+                 inline_content=inline_content, public_url=node.public_url)
         return d
 
     def get_delta(self, user_id, volume_id, from_generation, limit):
@@ -346,6 +348,23 @@ class DAL(object):
         nodes = [self._process_node(n) for n in nodes]
         return dict(vol_generation=vol_gen, free_bytes=free_bytes, nodes=nodes)
 
+    def get_delta_nodes(self, user_id, volume_id, from_generation, limit):
+        """Get a delta from a given generation, as DeltaNodes."""
+        user = self._get_user(user_id)
+        get_delta = user.volume(volume_id).get_delta_nodes
+        vol_gen, free_bytes, nodes = get_delta(from_generation, limit=limit)
+        return dict(vol_generation=vol_gen, free_bytes=free_bytes, nodes=nodes)
+
+    def get_from_scratch_nodes(self, user_id, volume_id, start_from_path=None,
+                               limit=None, max_generation=None):
+        """Get all nodes from scratch, as DeltaNodes."""
+        user = self._get_user(user_id)
+        get_from_scratch = user.volume(volume_id).get_from_scratch_nodes
+        vol_gen, free_bytes, nodes = get_from_scratch(
+            start_from_path=start_from_path, limit=limit,
+            max_generation=max_generation)
+        return dict(vol_generation=vol_gen, free_bytes=free_bytes, nodes=nodes)
+
     def get_user_data(self, user_id, session_id):
         """Get data from the user."""
         user = self._get_user(user_id, session_id)
@@ -354,13 +373,14 @@ class DAL(object):
 
     def make_content(self, user_id, volume_id, node_id, original_hash,
                      hash_hint, crc32_hint, inflated_size_hint,
-                     deflated_size_hint, storage_key, magic_hash, session_id):
+                     deflated_size_hint, storage_key, magic_hash, session_id,
+                     inline_content=None):
         """Get node and make content for it."""
         user = self._get_user(user_id, session_id)
         node = user.volume(volume_id).get_node(node_id)
         node.make_content(original_hash, hash_hint, crc32_hint,
                           inflated_size_hint, deflated_size_hint,
-                          storage_key, magic_hash)
+                          storage_key, magic_hash, inline_content)
         return dict(generation=node.generation)
 
     def _process_uploadjob(self, uj):
@@ -404,7 +424,7 @@ class DAL(object):
         user = self._get_user(user_id)
         uj = user.volume(volume_id).get_uploadjob(uploadjob_id)
         uj.add_part(chunk_size)
-        return {}
+        return dict(uploaded_bytes=uj.uploaded_bytes)
 
     def touch_uploadjob(self, user_id, volume_id, uploadjob_id):
         """Touch an upload job."""
@@ -418,3 +438,40 @@ class DAL(object):
         user = self._get_user(user_id)
         be, sk = user.is_reusable_content(hash_value, magic_hash)
         return dict(blob_exists=be, storage_key=sk)
+
+    def prepare_upload(self, user_id, volume_id, node_id, previous_hash,
+                       hash_value, crc32, inflated_size, magic_hash=None,
+                       check_reusable=True, uploadjob_id=None,
+                       multipart_key=None):
+        """Get what's needed to upload content to a node, at once.
+
+        Return what get_reusable_content returns, with the node and the
+        upload job (None if there's none).
+        """
+        be, sk, node, uj = services.prepare_upload(
+            user_id, volume_id, node_id, previous_hash, hash_value, crc32,
+            inflated_size, magic_hash=magic_hash,
+            check_reusable=check_reusable, uploadjob_id=uploadjob_id,
+            multipart_key=multipart_key)
+        if uj is not None:
+            uj = self._process_uploadjob(uj)
+        return dict(blob_exists=be, storage_key=sk,
+                    node=self._process_node(node), uploadjob=uj)
+
+    def get_blob_hashes(self, after_hash=None, created_after=None,
+                        limit=10000):
+        """Return the hashes of the blobs, in order."""
+        hashes = services.get_blob_hashes(after_hash, created_after, limit)
+        return dict(hashes=hashes)
+
+    def count_blobs(self):
+        """Return how many blobs there are."""
+        return dict(count=services.count_blobs())
+
+    def get_damaged_blobs(self, limit=100):
+        """Return the blobs found with damaged content."""
+        damaged = services.get_damaged_blobs(limit)
+        blobs = [dict(hash=hash_value, storage_key=storage_key,
+                      problem=problem, detail=detail, when_detected=when)
+                 for hash_value, storage_key, problem, detail, when in damaged]
+        return dict(damaged_blobs=blobs)
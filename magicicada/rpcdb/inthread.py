@@ -16,22 +16,156 @@
 #
 # For further info, check  http://launchpad.net/magicicada-server
 
-"""An (non) RPC layer."""
+"""An (non) RPC layer.
+
+The calls to the DAL run in their own pool of threads (not the reactor's
+one), up to DAL_USER_THREADS of them at the same time for each user so
+no user takes all of them. The calls waiting for a thread are run by
+priority (authentication first, the rescans last) and, in each priority,
+taking turns among the users; when too many are waiting the new ones are
+rejected, for the clients to try again later.
+"""
 
 from __future__ import unicode_literals
 
+import collections
+import functools
 import logging
 import os
 import time
 
-from twisted.internet import defer, threads
+from twisted.internet import defer, reactor, threads
+from twisted.python.threadpool import ThreadPool
 
+from magicicada import metrics, settings
 from magicicada.rpcdb import backend
 
 
 # log setup
 logger = logging.getLogger(__name__)
 
+# the priorities of the calls, the lower the sooner they are run
+HIGH, NORMAL, BULK = range(3)
+
+# the calls not of NORMAL priority
+PRIORITIES = {
+    'get_user_data': HIGH,
+    'get_userid_from_token': HIGH,
+    'count_blobs': BULK,
+    'get_blob_hashes': BULK,
+    'get_delta': BULK,
+    'get_delta_nodes': BULK,
+    'get_from_scratch': BULK,
+    'get_from_scratch_nodes': BULK,
+}
+
+
+class Overloaded(Exception):
+    """Too many calls are waiting for a thread."""
+
+
+class DALPool(object):
+    """Run the calls in up to `size` threads, fairly among the users.
+
+    Up to `user_size` calls of each user run at the same time (the ones
+    without user are not limited), and the calls not of HIGH priority are
+    rejected when `max_queued` are waiting.
+    """
+
+    def __init__(self, size=None, user_size=None, max_queued=None):
+        if size is None:
+            size = settings.DAL_THREADS
+        self.size = size
+        if user_size is None:
+            user_size = settings.DAL_USER_THREADS
+        self.user_size = user_size
+        if max_queued is None:
+            max_queued = settings.DAL_MAX_QUEUED
+        self.max_queued = max_queued
+        self.running = 0
+        self.queued = 0
+        self._user_running = collections.Counter()
+        # the calls waiting of each priority, by user, in their turn order
+        self._queues = [collections.OrderedDict() for _ in range(BULK + 1)]
+        self._threadpool = None
+        self._shutdown_trigger = None
+        self.metrics = metrics.get_meter('dal_pool')
+
+    @property
+    def threadpool(self):
+        """The pool where the calls run, started when needed."""
+        if self._threadpool is None:
+            pool = ThreadPool(minthreads=0, maxthreads=self.size, name='dal')
+            pool.start()
+            self._shutdown_trigger = reactor.addSystemEventTrigger(
+                'during', 'shutdown', self.stop)
+            self._threadpool = pool
+        return self._threadpool
+
+    def stop(self):
+        """Stop the threads, waiting for the calls running."""
+        if self._threadpool is not None:
+            reactor.removeSystemEventTrigger(self._shutdown_trigger)
+            pool, self._threadpool = self._threadpool, None
+            pool.stop()
+
+    def run(self, user_id, priority, func, **kwargs):
+        """Run func in a thread when there's one for the user's call.
+
+        Return a deferred with its result.
+        """
+        if self.queued >= self.max_queued and priority != HIGH:
+            self.metrics.increment('rejected')
+            return defer.fail(Overloaded(
+                "%d calls waiting for the DAL." % (self.queued,)))
+        d = defer.Deferred()
+        calls = self._queues[priority].setdefault(
+            user_id, collections.deque())
+        calls.append((d, time.time(), func, kwargs))
+        self.queued += 1
+        self._dispatch()
+        return d
+
+    def _next(self):
+        """Take the next call to run, if any."""
+        for queue in self._queues:
+            for user_id in queue:
+                if (user_id is None or
+                        self._user_running[user_id] < self.user_size):
+                    # to the end of the queue, its turn is over
+                    calls = queue.pop(user_id)
+                    call = calls.popleft()
+                    if calls:
+                        queue[user_id] = calls
+                    return (user_id,) + call
+
+    def _dispatch(self):
+        """Run the calls waiting while there are threads for them."""
+        while self.running < self.size:
+            call = self._next()
+            if call is None:
+                break
+            user_id, d, queued, func, kwargs = call
+            self.queued -= 1
+            self.running += 1
+            self._user_running[user_id] += 1
+            self.metrics.timing('wait', time.time() - queued)
+            running = threads.deferToThreadPool(
+                reactor, self.threadpool, func, **kwargs)
+            running.addBoth(self._done, user_id)
+            running.chainDeferred(d)
+        self.metrics.gauge('queued', self.queued)
+        self.metrics.gauge('running', self.running)
+
+    def _done(self, result, user_id):
+        """The call of the user ended, run the next one."""
+        self.running -= 1
+        self._user_running[user_id] -= 1
+        if not self._user_running[user_id]:
+            del self._user_running[user_id]
+        self._dispatch()
+        return result
+
 
 class ThreadedNonRPC(object):
     """A threaded way to call endpoints, not really an RPC."""
@@ -39,10 +173,14 @@ class ThreadedNonRPC(object):
     def __init__(self):
         super(ThreadedNonRPC, self).__init__()
         self.backend = backend.DAL()
-        if int(os.getenv('MAGICICADA_DEBUG', '0')):
-            self.defer = defer.maybeDeferred
-        else:
-            self.defer = threads.deferToThread
+        self.pool = None
+        if not int(os.getenv('MAGICICADA_DEBUG', '0')):
+            self.pool = DALPool()
+
+    def stop(self):
+        """Stop the threads of the calls."""
+        if self.pool is not None:
+            self.pool.stop()
 
     @defer.inlineCallbacks
     def call(self, funcname, **kwargs):
@@ -53,7 +191,12 @@ class ThreadedNonRPC(object):
         start_time = time.time()
         try:
             method = getattr(self.backend, funcname)
-            result = yield self.defer(method, **kwargs)
+            if self.pool is None:
+                result = yield defer.maybeDeferred(method, **kwargs)
+            else:
+                priority = PRIORITIES.get(funcname, NORMAL)
+                result = yield self.pool.run(
+                    user_id, priority, functools.partial(method, **kwargs))
         except Exception as exc:
             time_delta = time.time() - start_time
             logger.info(
@@ -288,6 +288,7 @@ class DALTestCase(BaseTestCase):
         expect(content1.crc32).result('crc321')
         expect(content1.deflated_size).result('deflated_size1')
         expect(content1.storage_key).result('storage_key1')
+        expect(content1.inline_content).result(None)
         expect(node1.content).result(content1)
         expect(node1.public_url).result('public url 1')
 
@@ -309,6 +310,7 @@ class DALTestCase(BaseTestCase):
         expect(content2.crc32).result('crc322')
         expect(content2.deflated_size).result('deflated_size2')
         expect(content2.storage_key).result('storage_key2')
+        expect(content2.inline_content).result(None)
         expect(node2.content).result(content2)
         expect(node2.public_url).result('public url 2')
 
@@ -817,6 +819,7 @@ class DALTestCase(BaseTestCase):
         expect(content.crc32).result('crc32')
         expect(content.deflated_size).result('deflated_size')
         expect(content.storage_key).result('storage_key')
+        expect(content.inline_content).result(None)
         expect(node.content).count(1).result(content)
         expect(node.public_url).result(None)
 
@@ -836,7 +839,7 @@ class DALTestCase(BaseTestCase):
                       generation='generation', content_hash='content_hash',
                       deflated_size='deflated_size', storage_key='storage_key',
                       volume_id='volume_id', path='path', has_content=True,
-                      public_url=None)
+                      inline_content=None, public_url=None)
         self.assertEqual(result, should)
 
     def test_get_node_no_content(self):
@@ -874,7 +877,8 @@ class DALTestCase(BaseTestCase):
                       last_modified='last_modified', crc32=None,
                       generation='generation', content_hash='content_hash',
                       deflated_size=None, storage_key=None, public_url=None,
-                      volume_id='volume_id', path="path", has_content=False)
+                      volume_id='volume_id', path="path", has_content=False,
+                      inline_content=None)
         self.assertEqual(result, should)
 
     def test_get_node_from_user(self):
@@ -915,7 +919,8 @@ class DALTestCase(BaseTestCase):
                       last_modified='last_modified', crc32=None,
                       generation='generation', content_hash='content_hash',
                       deflated_size=None, storage_key=None, public_url=None,
-                      volume_id='volume_id', path='path', has_content=False)
+                      volume_id='volume_id', path='path', has_content=False,
+                      inline_content=None)
         self.assertEqual(result, should)
 
     def test_get_delta_and_from_scratch(self):
@@ -940,6 +945,7 @@ class DALTestCase(BaseTestCase):
         expect(content1.crc32).count(2).result('crc321')
         expect(content1.deflated_size).count(2).result('deflated_size1')
         expect(content1.storage_key).count(2).result('storage_key1')
+        expect(content1.inline_content).count(2).result(None)
         expect(node1.content).count(2).result(content1)
         expect(node1.public_url).count(2).result('public url')
 
@@ -961,6 +967,7 @@ class DALTestCase(BaseTestCase):
         expect(content2.crc32).count(2).result('crc322')
         expect(content2.deflated_size).count(2).result('deflated_size2')
         expect(content2.storage_key).count(2).result('storage_key2')
+        expect(content2.inline_content).count(2).result(None)
         expect(node2.content).count(2).result(content2)
         expect(node2.public_url).count(2).result(None)
 
@@ -1017,6 +1024,35 @@ class DALTestCase(BaseTestCase):
         self.assertEqual(node2['last_modified'], 'last_modified2')
         self.assertEqual(node2['public_url'], None)
 
+    def test_get_delta_nodes_and_from_scratch_nodes(self):
+        """Get delta and from scratch, as DeltaNodes."""
+        mocker = Mocker()
+        nodes = ['node1', 'node2']
+
+        # user
+        user = mocker.mock()
+        self.backend._get_user = lambda *a: user
+        expect(user.volume('volume_id').get_delta_nodes(
+            'from_gen', limit='limit')
+        ).result(('vol_generation', 'free_bytes', nodes))
+        expect(user.volume('volume_id').get_from_scratch_nodes(
+            start_from_path='path', limit='limit',
+            max_generation='max_gen')
+        ).result(('vol_generation', 'free_bytes', nodes))
+
+        with mocker:
+            result1 = self.backend.get_delta_nodes(
+                user_id='user_id', volume_id='volume_id',
+                from_generation='from_gen', limit='limit')
+            result2 = self.backend.get_from_scratch_nodes(
+                user_id='user_id', volume_id='volume_id',
+                start_from_path='path', limit='limit',
+                max_generation='max_gen')
+        should = dict(vol_generation='vol_generation',
+                      free_bytes='free_bytes', nodes=nodes)
+        self.assertEqual(result1, should)
+        self.assertEqual(result2, should)
+
     def test_get_user(self):
         """Get accessable nodes and their hashes."""
         mocker = Mocker()
@@ -1082,7 +1118,7 @@ class DALTestCase(BaseTestCase):
         expect(node.generation).result('new_generation')
         expect(node.make_content('original_hash', 'hash_hint', 'crc32_hint',
                                  'inflated_size_hint', 'deflated_size_hint',
-                                 'storage_key', 'magic_hash'))
+                                 'storage_key', 'magic_hash', None))
 
         # user
         user = mocker.mock()
@@ -1191,6 +1227,7 @@ class DALTestCase(BaseTestCase):
         # upload job
         uj = mocker.mock()
         expect(uj.add_part('chunk_size'))
+        expect(uj.uploaded_bytes).result('uploaded_bytes')
 
         # user
         user = mocker.mock()
@@ -1203,7 +1240,7 @@ class DALTestCase(BaseTestCase):
                      chunk_size='chunk_size', volume_id='volume_id')
             result = self.backend.add_part_to_uploadjob(**d)
 
-        self.assertEqual(result, {})
+        self.assertEqual(result, dict(uploaded_bytes='uploaded_bytes'))
 
     def test_touch_uploadjob(self):
         """Delete an uploadjob."""
@@ -1245,3 +1282,73 @@ class DALTestCase(BaseTestCase):
 
         should = dict(blob_exists='blob_exists', storage_key='storage_key')
         self.assertEqual(result, should)
+
+    def test_prepare_upload(self):
+        """Prepare an upload, all at once."""
+        calls = []
+        self.patch(backend.services, 'prepare_upload', lambda *a, **k: (
+            calls.append((a, k)) or (False, None, 'node', 'uploadjob')))
+        self.patch(self.backend, '_process_node', lambda n: n + ' info')
+        self.patch(self.backend, '_process_uploadjob', lambda uj: uj + ' info')
+
+        result = self.backend.prepare_upload(
+            user_id='user_id', volume_id='volume_id', node_id='node_id',
+            previous_hash='previous_hash', hash_value='hash_value',
+            crc32='crc32', inflated_size='inflated_size',
+            magic_hash='magic_hash', check_reusable=False,
+            uploadjob_id='uploadjob_id', multipart_key='multipart_key')
+
+        should = dict(blob_exists=False, storage_key=None, node='node info',
+                      uploadjob='uploadjob info')
+        self.assertEqual(result, should)
+        args = ('user_id', 'volume_id', 'node_id', 'previous_hash',
+                'hash_value', 'crc32', 'inflated_size')
+        kwargs = dict(magic_hash='magic_hash', check_reusable=False,
+                      uploadjob_id='uploadjob_id',
+                      multipart_key='multipart_key')
+        self.assertEqual(calls, [(args, kwargs)])
+
+    def test_prepare_upload_no_uploadjob(self):
+        """Prepare an upload without a job."""
+        self.patch(backend.services, 'prepare_upload', lambda *a, **k: (
+            True, 'storage_key', 'node', None))
+        self.patch(self.backend, '_process_node', lambda n: n + ' info')
+
+        result = self.backend.prepare_upload(
+            user_id='user_id', volume_id='volume_id', node_id='node_id',
+            previous_hash=None, hash_value='hash_value', crc32='crc32',
+            inflated_size='inflated_size')
+
+        should = dict(blob_exists=True, storage_key='storage_key',
+                      node='node info', uploadjob=None)
+        self.assertEqual(result, should)
+
+    def test_get_damaged_blobs(self):
+        """Get the damaged blobs."""
+        self.patch(backend.services, 'get_damaged_blobs', lambda limit: [
+            ('hash', 'storage_key', 'Corrupt', 'detail', 'when')])
+
+        result = self.backend.get_damaged_blobs(limit=10)
+
+        should = dict(damaged_blobs=[dict(
+            hash='hash', storage_key='storage_key', problem='Corrupt',
+            detail='detail', when_detected='when')])
+        self.assertEqual(result, should)
+
+    def test_get_blob_hashes(self):
+        """Get the hashes of the blobs."""
+        calls = []
+        self.patch(backend.services, 'get_blob_hashes', lambda *args: (
+            calls.append(args) or ['hash1', 'hash2']))
+
+        result = self.backend.get_blob_hashes(
+            after_hash='hash0', created_after='when', limit=2)
+
+        self.assertEqual(result, dict(hashes=['hash1', 'hash2']))
+        self.assertEqual(calls, [('hash0', 'when', 2)])
+
+    def test_count_blobs(self):
+        """Count the blobs."""
+        self.patch(backend.services, 'count_blobs', lambda: 42)
+        result = self.backend.count_blobs()
+        self.assertEqual(result, dict(count=42))
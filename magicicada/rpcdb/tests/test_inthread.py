@@ -0,0 +1,218 @@
+# Copyright 2015-2018 Chicharreros (https://launchpad.net/~chicharreros)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# For further info, check  http://launchpad.net/magicicada-server
+
+"""Tests for the threads of the calls to the DAL."""
+
+import threading
+
+from twisted.internet import defer
+from twisted.trial.unittest import TestCase
+
+from magicicada.rpcdb import inthread
+from magicicada.rpcdb.inthread import (
+    BULK,
+    HIGH,
+    NORMAL,
+    DALPool,
+    Overloaded,
+    ThreadedNonRPC,
+)
+
+
+class DALPoolTestCase(TestCase):
+    """Test the DALPool, in real threads."""
+
+    def setUp(self):
+        super(DALPoolTestCase, self).setUp()
+        self.pool = DALPool(size=2, user_size=1, max_queued=10)
+        self.addCleanup(self.pool.stop)
+
+    @defer.inlineCallbacks
+    def test_run(self):
+        result = yield self.pool.run(
+            'user', NORMAL, lambda a: (a, threading.current_thread().name),
+            a=3)
+        self.assertEqual(result[0], 3)
+        self.assertNotEqual(result[1], threading.current_thread().name)
+        self.assertEqual(self.pool.running, 0)
+        self.assertEqual(dict(self.pool._user_running), {})
+
+    @defer.inlineCallbacks
+    def test_failure(self):
+        yield self.assertFailure(
+            self.pool.run('user', NORMAL, lambda: 1 / 0), ZeroDivisionError)
+        self.assertEqual(self.pool.running, 0)
+
+    def test_stop(self):
+        self.assertIsNotNone(self.pool.threadpool)
+        self.pool.stop()
+        self.assertIsNone(self.pool._threadpool)
+        # it's fine to stop it again
+        self.pool.stop()
+
+
+class DALPoolDispatchTestCase(TestCase):
+    """Test the order in which the DALPool runs the calls."""
+
+    def setUp(self):
+        super(DALPoolDispatchTestCase, self).setUp()
+        self.running = {}
+        self.started = []
+        self.patch(inthread.threads, 'deferToThreadPool', self.run_call)
+        self.pool = DALPool(size=1, user_size=1, max_queued=3)
+        self.addCleanup(self.pool.stop)
+
+    def run_call(self, reactor, threadpool, func, **kwargs):
+        """Start the call, ended with self.end."""
+        name = func()
+        self.started.append(name)
+        self.running[name] = d = defer.Deferred()
+        return d
+
+    def call(self, name, user_id='user', priority=NORMAL):
+        """Call for the user, named name."""
+        return self.pool.run(user_id, priority, lambda: name)
+
+    def end(self, name):
+        """End the call."""
+        self.running.pop(name).callback(name)
+
+    @defer.inlineCallbacks
+    def test_size(self):
+        self.pool.size = 2
+        d1 = self.call('a1', 'a')
+        d2 = self.call('b1', 'b')
+        self.call('c1', 'c')
+        self.assertEqual(self.started, ['a1', 'b1'])
+        self.assertEqual((self.pool.running, self.pool.queued), (2, 1))
+        self.end('a1')
+        self.assertEqual(self.started, ['a1', 'b1', 'c1'])
+        self.assertEqual((self.pool.running, self.pool.queued), (2, 0))
+        result = yield d1
+        self.assertEqual(result, 'a1')
+        self.end('b1')
+        result = yield d2
+        self.assertEqual(result, 'b1')
+
+    def test_user_size(self):
+        self.pool.size = 3
+        self.call('a1', 'a')
+        self.call('a2', 'a')
+        self.call('b1', 'b')
+        self.assertEqual(self.started, ['a1', 'b1'])
+        self.end('b1')
+        self.assertEqual(self.started, ['a1', 'b1'])
+        self.end('a1')
+        self.assertEqual(self.started, ['a1', 'b1', 'a2'])
+
+    def test_no_user_not_limited(self):
+        self.pool.size = 3
+        for i in range(3):
+            self.call('auth%d' % i, None)
+        self.assertEqual(self.started, ['auth0', 'auth1', 'auth2'])
+
+    def test_turns(self):
+        self.call('running', 'c')
+        self.call('a1', 'a')
+        self.call('a2', 'a')
+        self.call('b1', 'b')
+        for name in ('running', 'a1', 'b1'):
+            self.end(name)
+        self.assertEqual(self.started, ['running', 'a1', 'b1', 'a2'])
+
+    def test_priority(self):
+        self.call('running', 'c')
+        self.call('rescan', 'a', BULK)
+        self.call('move', 'b')
+        self.call('auth', None, HIGH)
+        for name in ('running', 'auth', 'move'):
+            self.end(name)
+        self.assertEqual(self.started,
+                         ['running', 'auth', 'move', 'rescan'])
+
+    @defer.inlineCallbacks
+    def test_overloaded(self):
+        self.call('running', 'c')
+        for i in range(3):
+            self.call('queued%d' % i, 'a')
+        yield self.assertFailure(self.call('rejected', 'b'), Overloaded)
+        yield self.assertFailure(
+            self.call('rejected', 'b', BULK), Overloaded)
+        self.call('auth', None, HIGH)
+        self.assertEqual(self.pool.queued, 4)
+        self.end('running')
+        self.assertEqual(self.started, ['running', 'auth'])
+
+
+class ThreadedNonRPCTestCase(TestCase):
+    """Test the ThreadedNonRPC."""
+
+    def setUp(self):
+        super(ThreadedNonRPCTestCase, self).setUp()
+        # the test runner may set the debug mode, with no threads
+        self.patch(inthread.os, 'environ', dict(MAGICICADA_DEBUG='0'))
+        self.rpc = ThreadedNonRPC()
+        self.addCleanup(self.rpc.stop)
+        self.calls = []
+        self.patch(self.rpc.pool, 'run', self.fake_run)
+
+    def fake_run(self, user_id, priority, func):
+        """Record the call."""
+        self.calls.append(
+            (user_id, priority, func.func.__name__, func.keywords))
+        return defer.succeed('result')
+
+    @defer.inlineCallbacks
+    def test_call(self):
+        result = yield self.rpc.call('list_volumes', user_id='user_id')
+        self.assertEqual(result, 'result')
+        self.assertEqual(self.calls, [
+            ('user_id', NORMAL, 'list_volumes', dict(user_id='user_id'))])
+
+    @defer.inlineCallbacks
+    def test_call_priority(self):
+        yield self.rpc.call('get_userid_from_token', auth_parameters={})
+        yield self.rpc.call('get_from_scratch_nodes', user_id='user_id')
+        yield self.rpc.call('get_delta_nodes', user_id='user_id')
+        yield self.rpc.call('count_blobs')
+        yield self.rpc.call('get_blob_hashes', after_hash=None)
+        self.assertEqual([c[:3] for c in self.calls], [
+            (None, HIGH, 'get_userid_from_token'),
+            ('user_id', BULK, 'get_from_scratch_nodes'),
+            ('user_id', BULK, 'get_delta_nodes'),
+            (None, BULK, 'count_blobs'),
+            (None, BULK, 'get_blob_hashes'),
+        ])
+
+    def test_delta_nodes_queued_as_bulk(self):
+        # no threads, so the calls wait in their queue
+        self.rpc.pool = DALPool(size=0, user_size=1, max_queued=10)
+        self.rpc.call('get_delta_nodes', user_id='user_id', volume_id=None,
+                      from_generation=0, limit=100)
+        self.rpc.call('list_volumes', user_id='other')
+        queues = self.rpc.pool._queues
+        self.assertEqual(list(queues[BULK]), ['user_id'])
+        self.assertEqual(list(queues[NORMAL]), ['other'])
+
+    @defer.inlineCallbacks
+    def test_call_debug(self):
+        self.patch(inthread.os, 'environ', dict(MAGICICADA_DEBUG='1'))
+        rpc = ThreadedNonRPC()
+        self.assertIsNone(rpc.pool)
+        self.patch(rpc.backend, 'list_volumes', lambda user_id: user_id)
+        result = yield rpc.call('list_volumes', user_id='user_id')
+        self.assertEqual(result, 'user_id')
@@ -0,0 +1,180 @@
+# Copyright 2015-2018 Chicharreros (https://launchpad.net/~chicharreros)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# For further info, check  http://launchpad.net/magicicada-server
+
+"""Shape the bandwidth of the uploads and downloads.
+
+The content uploaded and downloaded goes through token buckets, one for
+the connection, whose parent is one for the user, whose parent is one for
+the whole server (in each direction). When any of them lets less through
+than what went, the reading of the connection (for the uploads) or the
+producer of the download is paused until it's back in credit.
+
+The rates (in bytes per second, 0 for no limit) are taken from the
+BandwidthLimits every time, so they can be changed while running.
+"""
+
+import collections
+
+from twisted.internet import reactor
+
+from magicicada import metrics, settings
+
+GLOBAL = 'global'
+USER = 'user'
+CONNECTION = 'connection'
+LEVELS = (GLOBAL, USER, CONNECTION)
+UPLOAD = 'upload'
+DOWNLOAD = 'download'
+DIRECTIONS = (UPLOAD, DOWNLOAD)
+
+
+class BandwidthLimits(object):
+    """The rates of the buckets, by level and direction.
+
+    A bucket takes up to `burst_time` seconds of its rate at once.
+    """
+
+    def __init__(self, burst_time=None, clock=reactor):
+        if burst_time is None:
+            burst_time = settings.BANDWIDTH_BURST_TIME
+        self.burst_time = burst_time
+        self.clock = clock
+        self.rates = {}
+        for level in LEVELS:
+            for direction in DIRECTIONS:
+                name = 'BANDWIDTH_%s_%s' % (level.upper(), direction.upper())
+                self.rates[level, direction] = getattr(settings, name)
+        self.throttles = collections.Counter()
+        self.buckets = dict((direction, TokenBucket(self, GLOBAL, direction))
+                            for direction in DIRECTIONS)
+        self.metrics = metrics.get_meter('bandwidth')
+
+    def limited(self, direction):
+        """Return if any level limits the direction."""
+        return any(self.rates[level, direction] for level in LEVELS)
+
+    def set_rate(self, level, direction, rate):
+        """Change the rate of the buckets of the level and direction."""
+        if (level, direction) not in self.rates:
+            raise ValueError("No such bucket: %s %s" % (level, direction))
+        if rate < 0:
+            raise ValueError("The rate can't be negative.")
+        self.rates[level, direction] = rate
+
+    def throttled(self, level, direction):
+        """A bucket of the level and direction is over its rate."""
+        self.throttles[level, direction] += 1
+        self.metrics.increment('throttled.%s.%s' % (level, direction))
+
+
+class TokenBucket(object):
+    """Let through the rate of its level and direction, and its parent's."""
+
+    def __init__(self, limits, level, direction, parent=None):
+        self.limits = limits
+        self.level = level
+        self.direction = direction
+        self.parent = parent
+        # full at first
+        self.tokens = None
+        self.updated = limits.clock.seconds()
+
+    def consume(self, size):
+        """Take the size that went through.
+
+        Return the seconds until this bucket and its parents are in credit
+        again (0 if they are).
+        """
+        now = self.limits.clock.seconds()
+        delay = 0
+        rate = self.limits.rates[self.level, self.direction]
+        if rate:
+            burst = rate * self.limits.burst_time
+            if self.tokens is None:
+                tokens = burst
+            else:
+                tokens = min(burst, self.tokens + (now - self.updated) * rate)
+            self.tokens = tokens - size
+            if self.tokens < 0:
+                delay = -self.tokens / float(rate)
+                self.limits.throttled(self.level, self.direction)
+        else:
+            self.tokens = None
+        self.updated = now
+        if self.parent is not None:
+            delay = max(delay, self.parent.consume(size))
+        return delay
+
+
+class Throttle(object):
+    """Pause something while the bucket is not in credit.
+
+    Each pause is followed by a resume, after the delay (unless stopped).
+    """
+
+    def __init__(self, bucket, pause, resume):
+        self.bucket = bucket
+        self.pause = pause
+        self.resume = resume
+        self._call = None
+
+    @property
+    def throttled(self):
+        """If it's paused by the throttle."""
+        return self._call is not None
+
+    def consume(self, size):
+        """Take the size that went through, pausing if needed."""
+        delay = self.bucket.consume(size)
+        if delay > 0 and self._call is None:
+            self.pause()
+            self._call = self.bucket.limits.clock.callLater(
+                delay, self._resume)
+
+    def _resume(self):
+        """The bucket is in credit again."""
+        self._call = None
+        self.resume()
+
+    def stop(self):
+        """Don't resume."""
+        if self._call is not None:
+            self._call.cancel()
+            self._call = None
+
+
+class PausableReading(object):
+    """Pause the reading of the connection while anyone wants it paused.
+
+    Each pauseProducing must be followed by a resumeProducing.
+    """
+
+    def __init__(self, protocol):
+        self.protocol = protocol
+        self.pauses = 0
+
+    def pauseProducing(self):
+        """Stop reading, if not paused."""
+        self.pauses += 1
+        if self.pauses == 1:
+            self.protocol.transport.pauseProducing()
+
+    def resumeProducing(self):
+        """Read again, if nobody else wants it paused."""
+        self.pauses -= 1
+        if not self.pauses:
+            self.protocol.transport.resumeProducing()
@@ -0,0 +1,205 @@
+# Copyright 2015-2018 Chicharreros (https://launchpad.net/~chicharreros)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# For further info, check  http://launchpad.net/magicicada-server
+
+"""Tell which content is surely new, without asking the database.
+
+Every upload starts looking for a blob with the content's hash to reuse
+it, but most of the uploaded content is new. The BlobFilter keeps a Bloom
+filter of the hashes of all the blobs, so when the hash is not there the
+database is not asked at all.
+
+The filter is rebuilt from time to time (as the blobs are never removed
+from it otherwise), and updated in between with the blobs created since
+the last time and the content committed by this server. A blob created
+by other server is unknown until the next update, and its content would
+be uploaded again instead of reused (as it happened before when racing
+with that upload).
+"""
+
+from __future__ import division
+
+import datetime
+import hashlib
+import logging
+import math
+import struct
+import time
+
+from django.utils.timezone import now
+from twisted.internet import defer
+
+from magicicada import metrics, settings
+
+logger = logging.getLogger(__name__)
+
+
+class BloomFilter(object):
+    """A set of strings that may answer it has one it doesn't.
+
+    It's sized for `capacity` strings with that `error_rate` of false
+    positives; it never has false negatives.
+    """
+
+    def __init__(self, capacity, error_rate):
+        self.capacity = capacity
+        self.size = max(8, int(math.ceil(
+            -capacity * math.log(error_rate) / math.log(2) ** 2)))
+        self.hashes = max(1, int(round(self.size / capacity * math.log(2))))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, value):
+        """Yield the positions of the bits of the value."""
+        h1, h2 = struct.unpack(b'<QQ', hashlib.md5(value).digest())
+        for i in xrange(self.hashes):
+            yield (h1 + i * h2) % self.size
+
+    def add(self, value):
+        """Add the value."""
+        for position in self._positions(value):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, value):
+        for position in self._positions(value):
+            if not self.bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+
+class BlobFilter(object):
+    """The filter of the hashes of the existing blobs.
+
+    Until it's first built (see refresh) every hash may exist. It's built
+    for twice the blobs there are (at least `min_capacity`), and built
+    again before its time if it gets more than that.
+    """
+
+    batch_size = 10000
+    min_capacity = 1000000
+    # the blobs created this before the last update are got again, in
+    # case they were committed later (or the clocks differ)
+    update_overlap = datetime.timedelta(seconds=60)
+
+    def __init__(self, content, error_rate=None, rebuild_interval=None):
+        self.content = content
+        if error_rate is None:
+            error_rate = settings.BLOB_FILTER_ERROR_RATE
+        self.error_rate = error_rate
+        if rebuild_interval is None:
+            rebuild_interval = settings.BLOB_FILTER_REBUILD_INTERVAL
+        self.rebuild_interval = rebuild_interval
+        self._filter = None
+        self._pending = None
+        self.last_rebuild = None
+        self.last_update = None
+        self.avoided = self.false_positives = 0
+        self.metrics = metrics.get_meter('blob_filter')
+
+    def might_exist(self, hash_value):
+        """Tell if there may be a blob with the hash (if not, surely not)."""
+        if self._filter is None or hash_value in self._filter:
+            return True
+        self.avoided += 1
+        self.metrics.increment('db_calls_avoided')
+        self._report()
+        return False
+
+    def checked(self, hash_value, exists):
+        """Record if the blob with the hash was found in the database."""
+        if self._filter is not None and not exists:
+            self.false_positives += 1
+            self.metrics.increment('false_positive')
+            self._report()
+
+    def _report(self):
+        """Report the part of the missing blobs that were asked anyway."""
+        self.metrics.gauge('false_positive_rate', self.false_positives / (
+            self.false_positives + self.avoided))
+
+    def add(self, hash_value):
+        """Add the hash of a blob just created (or revived)."""
+        if self._filter is not None:
+            self._filter.add(hash_value)
+        if self._pending is not None:
+            self._pending.append(hash_value)
+
+    @defer.inlineCallbacks
+    def refresh(self):
+        """Rebuild the filter if it's time, else update it.
+
+        The errors are logged, to try again the next time.
+        """
+        rebuild = (self._filter is None or
+                   time.time() - self.last_rebuild >= self.rebuild_interval or
+                   self._filter.count > self._filter.capacity)
+        try:
+            if rebuild:
+                yield self._rebuild()
+            else:
+                yield self._update()
+        except Exception:
+            logger.exception("Error refreshing the blob filter:")
+
+    @defer.inlineCallbacks
+    def _add_hashes(self, bloom, created_after=None):
+        """Add to the filter the hashes of the blobs; return how many."""
+        total = 0
+        after_hash = None
+        while True:
+            r = yield self.content.rpc_dal.call(
+                'get_blob_hashes', after_hash=after_hash,
+                created_after=created_after, limit=self.batch_size)
+            hashes = r['hashes']
+            for hash_value in hashes:
+                bloom.add(hash_value)
+            total += len(hashes)
+            if len(hashes) < self.batch_size:
+                break
+            after_hash = hashes[-1]
+        defer.returnValue(total)
+
+    @defer.inlineCallbacks
+    def _rebuild(self):
+        """Build a new filter with all the blobs."""
+        start = time.time()
+        started = now()
+        # what is added meanwhile may be missed by the queries
+        self._pending = []
+        try:
+            r = yield self.content.rpc_dal.call('count_blobs')
+            capacity = max(self.min_capacity, r['count'] * 2)
+            bloom = BloomFilter(capacity, self.error_rate)
+            total = yield self._add_hashes(bloom)
+            for hash_value in self._pending:
+                bloom.add(hash_value)
+        finally:
+            self._pending = None
+        self._filter = bloom
+        self.last_rebuild = start
+        self.last_update = started
+        self.metrics.gauge('blobs', total)
+        logger.info("Built the blob filter with %d blobs in %.1f seconds",
+                    total, time.time() - start)
+
+    @defer.inlineCallbacks
+    def _update(self):
+        """Add the blobs created since the last update."""
+        started = now()
+        yield self._add_hashes(
+            self._filter, self.last_update - self.update_overlap)
+        self.last_update = started
@@ -0,0 +1,170 @@
+# Copyright 2015-2018 Chicharreros (https://launchpad.net/~chicharreros)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# For further info, check  http://launchpad.net/magicicada-server
+
+"""Store the big nodes split in chunks shared by all of them.
+
+Many big files are stored again with just some changes, usually appended
+(as mailboxes or logs), so their content is split in chunks at points
+defined by the content itself: a change only affects the chunks around
+it, as the next cut points are found in the same places. The chunks are
+stored as nodes named by their sha1, so each one is stored once no
+matter how many nodes have it, and the node is a manifest listing its
+chunks (their sha1 and size) in order.
+
+The content stored is deflated, so it's almost random bytes: the cut
+points are the places where an anchor of two bytes appears, with chunks
+between a minimum and a maximum size. That is found by the fast search of
+the bytes, instead of a rolling hash computed in Python for each byte.
+
+The chunks no manifest lists anymore are removed later, walking all of
+them, see DiskStorage.collect_chunks.
+"""
+
+import binascii
+import re
+import struct
+
+# the suffix of the manifests, in the place of the nodes stored in chunks
+CHUNKS_SUFFIX = '.chunks'
+
+# a manifest entry: the sha1 of the chunk, and its size
+ENTRY = struct.Struct(b'>20sI')
+
+# the chunks are cut after these bytes (found every 64KiB in random data)
+ANCHOR = b'\x5c\xa1'
+
+CHUNK_NAME_RE = re.compile(r'^[0-9a-f]{40}$')
+
+
+def get_chunk_name(digest):
+    """Return the name of the node where the chunk is stored."""
+    return binascii.hexlify(digest)
+
+
+def is_chunk_name(name):
+    """Tell if the node is a chunk."""
+    return CHUNK_NAME_RE.match(name) is not None
+
+
+def split_chunks(fh, min_size, max_size, read_size=1048576):
+    """Yield the chunks of the file's content.
+
+    Each one ends after the first anchor found from `min_size` bytes, or
+    is `max_size` bytes if there is none before; the last one may be
+    smaller.
+    """
+    data = b''
+    searched = 0
+    eof = False
+    while True:
+        start = max(min_size - len(ANCHOR), searched)
+        position = data.find(ANCHOR, start, max_size)
+        if position != -1:
+            cut = position + len(ANCHOR)
+        elif len(data) >= max_size:
+            cut = max_size
+        elif eof:
+            if data:
+                yield data
+            return
+        else:
+            # look for the anchor in more data, from where it was left
+            searched = max(0, len(data) - len(ANCHOR) + 1)
+            read = fh.read(read_size)
+            eof = not read
+            data += read
+            continue
+        yield data[:cut]
+        data = data[cut:]
+        searched = 0
+
+
+def pack_manifest(entries):
+    """Return the manifest of the (digest, size) entries."""
+    return b''.join(ENTRY.pack(digest, size) for digest, size in entries)
+
+
+def read_manifest(path):
+    """Return the (digest, size) entries of the manifest."""
+    with open(path, 'rb') as fh:
+        data = fh.read()
+    return [ENTRY.unpack_from(data, offset)
+            for offset in xrange(0, len(data), ENTRY.size)]
+
+
+class ChunkedFile(object):
+    """A read-only file with the content of the chunks of a manifest.
+
+    The chunks are opened as they are read, finding their path with
+    `locate`; only seeking before reading is supported.
+    """
+
+    def __init__(self, entries, locate):
+        self.entries = entries
+        self.size = sum(size for _, size in entries)
+        self._locate = locate
+        self._index = 0
+        self._skip = 0
+        self._fh = None
+        self.closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _close_chunk(self):
+        """Close the chunk being read, if any."""
+        if self._fh is not None:
+            self._fh.close()
+            self._fh = None
+
+    def seek(self, offset):
+        """Continue reading from the offset."""
+        self._close_chunk()
+        self._index = 0
+        while (self._index < len(self.entries) and
+               offset >= self.entries[self._index][1]):
+            offset -= self.entries[self._index][1]
+            self._index += 1
+        self._skip = offset
+
+    def read(self, size=-1):
+        """Read up to size bytes (all of them if negative)."""
+        parts = []
+        while size and self._index < len(self.entries):
+            if self._fh is None:
+                digest, _ = self.entries[self._index]
+                self._fh = open(self._locate(get_chunk_name(digest)), 'rb')
+                if self._skip:
+                    self._fh.seek(self._skip)
+                    self._skip = 0
+            data = self._fh.read(size)
+            if not data:
+                self._close_chunk()
+                self._index += 1
+                continue
+            parts.append(data)
+            if size > 0:
+                size -= len(data)
+        return b''.join(parts)
+
+    def close(self):
+        """Close the file."""
+        self._close_chunk()
+        self.closed = True
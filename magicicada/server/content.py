@@ -22,6 +22,8 @@ This layer is the main interface to the RPC DAL.
 """
 
 import calendar
+import collections
+import itertools
 import logging
 import posixpath as pypath
 import uuid
@@ -32,12 +34,16 @@ import twisted.internet.error
 import twisted.web.error
 
 from magicicadaprotocol import protocol_pb2
-from twisted.internet import defer
+from twisted.internet import defer, reactor
+from twisted.python.threadpool import ThreadPool
 
 from magicicada import settings
 from magicicada.filesync import errors as dataerrors
 from magicicada.filesync.models import Share
-from magicicada.server import errors, upload
+from magicicada.server import bandwidth, errors, upload
+from magicicada.server.blobfilter import BlobFilter
+from magicicada.server.generationlog import GenerationLogs
+from magicicada.server.manifests import VolumeManifests
 
 ZERO_LENGTH_CONTENT_KEY = ""
 logger = logging.getLogger(__name__)
@@ -98,8 +104,11 @@ class Node(object):
         self.public_url = node['public_url']
         last_modif = node['last_modified']
 
+        # the content of small files is stored with the node, not in disk
+        self.inline_content = node['inline_content']
+
         # special cases for no content
-        if node['storage_key'] is None:
+        if node['storage_key'] is None and self.inline_content is None:
             self.has_content = False
             self.storage_key = ZERO_LENGTH_CONTENT_KEY
         else:
@@ -112,20 +121,27 @@ class Node(object):
     def get_content(self, start=None, previous_hash=None, user=None):
         """Get the content for this node.
 
-        @param start: the start offset
+        @param start: the offset from where to start sending the (deflated)
+            content, to resume previous downloads.
         @param previous_hash: not used for FileNode.
         @param user: the user doing the request, useful for logging.
         """
         if not self.is_file:
             raise TypeError("Content can be retrieved only on Files.")
         storage_key = self.storage_key
+        offset = start or 0
+        if offset > self.deflated_size:
+            raise errors.ProtocolError(
+                "Offset %d is past the end of the content (%d)." % (
+                    offset, self.deflated_size))
+        if self.inline_content is not None:
+            return FalseProducer(self.inline_content[offset:])
         if storage_key == ZERO_LENGTH_CONTENT_KEY:
             # we send the compressed empty string
-            return FalseProducer(zlib.compress(""))
+            return FalseProducer(zlib.compress("")[offset:])
 
-        # TODO: we should get bytes from a 'start' point, there are not
-        # test cases for this, did this work at all or client always sent 0?
-        producer = self.manager.factory.diskstorage.get(str(storage_key))
+        producer = self.manager.factory.diskstorage.get(
+            str(storage_key), offset)
         producer.deferred.addErrback(self._handle_errors, user)
         return producer
 
@@ -148,6 +164,95 @@ class Node(object):
         raise errors.NotAvailable(failure.getErrorMessage())
 
 
+class NodeStream(object):
+    """The nodes of a delta or rescan, fetched in pages while being sent.
+
+    Up to `max_pages` are fetched ahead of what's taken, so the database is
+    queried while the previous nodes are sent, without holding all of them
+    in memory (nor going on for a client that doesn't take them).
+
+    `fetch` is called with the last node fetched (None at first) and how
+    many to get, and returns a deferred with a tuple of (nodes, generation,
+    free_bytes); the generation and free bytes kept are the first ones.
+    """
+
+    def __init__(self, fetch, page_size, limit=None, max_pages=None):
+        self.fetch = fetch
+        self.page_size = page_size
+        self.limit = limit
+        if max_pages is None:
+            max_pages = settings.DELTA_PAGES_AHEAD
+        self.max_pages = max_pages
+        self.generation = None
+        self.free_bytes = None
+        self.count = 0
+        self.last = None
+        self.failure = None
+        self.finished = False
+        self.stopped = False
+        # called once when a page arrives or the stream finishes
+        self.waiter = None
+        self._pages = collections.deque()
+        self._fetching = False
+
+    def start(self):
+        """Start fetching the nodes."""
+        self._fill()
+
+    def _fill(self):
+        """Fetch the next page, if there's room for it."""
+        if (self._fetching or self.finished or self.stopped or
+                len(self._pages) >= self.max_pages):
+            return
+        limit = self.page_size
+        if self.limit is not None:
+            limit = min(limit, self.limit - self.count)
+        self._fetching = True
+        d = self.fetch(self.last, limit)
+        d.addCallback(self._fetched, limit)
+        d.addErrback(self._failed)
+
+    def _fetched(self, result, limit):
+        """Keep the page, and go for the next one."""
+        self._fetching = False
+        nodes, generation, free_bytes = result
+        if self.generation is None:
+            self.generation = generation
+            self.free_bytes = free_bytes
+        if nodes and not self.stopped:
+            self._pages.append(nodes)
+            self.count += len(nodes)
+            self.last = nodes[-1]
+        if len(nodes) < limit or self.count == self.limit:
+            self.finished = True
+        self._wake()
+        self._fill()
+
+    def _failed(self, failure):
+        """Finish with the failure."""
+        self._fetching = False
+        self.failure = failure
+        self.finished = True
+        self._wake()
+
+    def _wake(self):
+        """Call the waiter, if any."""
+        waiter, self.waiter = self.waiter, None
+        if waiter is not None:
+            waiter()
+
+    def get(self):
+        """Return the next page of nodes, None if there's none yet."""
+        page = self._pages.popleft() if self._pages else None
+        self._fill()
+        return page
+
+    def stop(self):
+        """Stop fetching the nodes."""
+        self.stopped = True
+        self._pages.clear()
+
+
 class DBUploadJob(object):
     """A proxy for Upload model objects."""
 
@@ -187,22 +292,44 @@ class DBUploadJob(object):
         d.addCallback(lambda r: cls(**r))
         return d
 
-    def add_part(self, chunk_size):
-        """Add a part to an upload job."""
+    def add_part(self, chunk_size, checkpoint=None):
+        """Add a part to an upload job.
+
+        The parts are accumulated and saved together; when that happens the
+        hashing state returned by 'checkpoint' (if given) is kept, to resume
+        the upload from there.
+        """
         self.unsaved_count += chunk_size
         if self.unsaved_count >= settings.STORAGE_CHUNK_SIZE:
-            self.unsaved_count -= settings.STORAGE_CHUNK_SIZE
+            chunk_size, self.unsaved_count = self.unsaved_count, 0
             kwargs = dict(user_id=self.user.id, volume_id=self.volume_id,
                           uploadjob_id=self.uploadjob_id,
                           chunk_size=chunk_size)
             d = self.user.rpc_dal.call('add_part_to_uploadjob', **kwargs)
+            if checkpoint is not None:
+                # the state may be ready later, don't wait for it
+                state = defer.maybeDeferred(checkpoint)
+                d.addCallback(self._save_checkpoint, state)
         else:
             d = defer.succeed(True)
         return d
 
+    def _save_checkpoint(self, result, state_deferred):
+        """Keep the hashing state if it matches what was saved."""
+        def save(state):
+            if (state is not None and
+                    state.deflated_size == result['uploaded_bytes']):
+                self.user.manager.upload_checkpoints.save(
+                    self.uploadjob_id, state)
+
+        # a failure getting the state is handled by who verifies the data
+        state_deferred.addCallbacks(save, lambda _: None)
+        return result
+
     @defer.inlineCallbacks
     def delete(self):
         """Delete an upload job."""
+        self.user.manager.upload_checkpoints.discard(self.uploadjob_id)
         try:
             yield self.user.rpc_dal.call('delete_uploadjob',
                                          user_id=self.user.id,
@@ -228,7 +355,7 @@ class BogusUploadJob(object):
         self.uploaded_bytes = 0  # always start from 0 (non resumable)
         self._bogus_deferred = defer.succeed(True)
 
-    def add_part(self, _):
+    def add_part(self, _, checkpoint=None):
         """Bogus add part."""
         return self._bogus_deferred
 
@@ -265,6 +392,8 @@ class BaseUploadJob(object):
         self._initial_data = True
         self.storage_key = None
         self.canceling = False
+        # the client transport, paused while the data can't be verified
+        self.transport = None
 
         self.original_file_hash = node_hash
         self.hash_hint = hash_hint
@@ -289,13 +418,16 @@ class BaseUploadJob(object):
         """The offset of this upload."""
         raise NotImplementedError("subclass responsability.")
 
+    def _get_checkpoint(self, offset):
+        """Return the hashing state to resume from the offset, if any."""
+
     def connect(self):
         """Setup the producer and consumer."""
         if self.blob_exists:
             # we have a storage object like this already (not magic upload
             # because other user); wrap the producer to only hash and
             # discard the bytes
-            self.producer = upload.ProxyHashingProducer(self.producer, True)
+            self.producer = self._make_producer(self.producer, True)
             self.consumer = upload.NullConsumer()
             self.consumer.registerProducer(self.producer)
             self.deferred.callback(None)
@@ -305,16 +437,31 @@ class BaseUploadJob(object):
 
     def _start_receiving(self):
         """Prepare the upload job to start receiving streaming bytes."""
-        self.storage_key = self.uploadjob.multipart_key
         offset = self.uploadjob.uploaded_bytes
-
-        self.consumer = self.user.manager.factory.diskstorage.put(
-            str(self.storage_key), offset)
-
-        streaming = offset == 0  # hash on the fly if receive from start
-        self.producer = upload.ProxyHashingProducer(self.consumer, streaming)
+        inline_max_size = settings.STORAGE_INLINE_MAX_SIZE
+        if offset == 0 and 0 < self.deflated_size_hint <= inline_max_size:
+            # small enough to be stored in the database, not in disk
+            self.consumer = upload.InlineConsumer(self.deflated_size_hint)
+        else:
+            self.storage_key = self.uploadjob.multipart_key
+            self.consumer = self.user.manager.factory.diskstorage.put(
+                str(self.storage_key), offset, self.deflated_size_hint)
+
+        # hash on the fly if receiving from the start or from where the
+        # hashing was checkpointed, else re-read the rest at the end
+        state = self._get_checkpoint(offset)
+        checkpointed = 0 if state is None else state.deflated_size
+        streaming = offset == checkpointed
+        self.producer = self._make_producer(self.consumer, streaming, state)
         self.consumer.registerProducer(self.producer, True)  # push producer
 
+    def _make_producer(self, consumer, streaming, state=None):
+        """Build the producer that verifies the received data."""
+        return upload.ProxyHashingProducer(
+            consumer, streaming, state,
+            threadpool=self.user.manager.hashing_threadpool,
+            transport=self.transport)
+
     @defer.inlineCallbacks
     def add_data(self, data):
         """Add data to this upload.
@@ -336,7 +483,8 @@ class BaseUploadJob(object):
         except Exception as err:
             self.deferred.errback(err)
         else:
-            yield self.uploadjob.add_part(len(data))
+            yield self.uploadjob.add_part(
+                len(data), self.producer.checkpoint)
 
     def _stop_producer_and_factory(self):
         """Cancel this upload job.
@@ -416,7 +564,7 @@ class BaseUploadJob(object):
     def _commit(self):
         """Make this upload the current content for the node."""
         self.producer.stopProducing()
-        self.consumer.commit()
+        yield self.consumer.commit()
         yield self.producer.flush_decompressor()
 
         # size matches hint
@@ -440,17 +588,22 @@ class BaseUploadJob(object):
         if self.producer.crc32 != self.crc32_hint:
             raise errors.UploadCorrupt(self._crc32_hint_mismatch)
 
+        inline_content = None
         storage_key = self.storage_key
-        if storage_key is None:
-            storage_key = self.file_node.storage_key
-        if storage_key is None and self.inflated_size == 0:
-            storage_key = ZERO_LENGTH_CONTENT_KEY
+        if isinstance(self.consumer, upload.InlineConsumer):
+            inline_content = self.consumer.data
+        else:
+            if storage_key is None:
+                storage_key = self.file_node.storage_key
+            if storage_key is None and self.inflated_size == 0:
+                storage_key = ZERO_LENGTH_CONTENT_KEY
 
-        new_gen = yield self._commit_content(storage_key, magic_hash_value)
+        new_gen = yield self._commit_content(
+            storage_key, magic_hash_value, inline_content)
         defer.returnValue(new_gen)
 
     @defer.inlineCallbacks
-    def _commit_content(self, storage_key, magic_hash):
+    def _commit_content(self, storage_key, magic_hash, inline_content=None):
         """Commit the content in the DAL."""
         kwargs = dict(user_id=self.user.id, node_id=self.file_node.id,
                       volume_id=self.file_node.volume_id,
@@ -459,6 +612,7 @@ class BaseUploadJob(object):
                       inflated_size_hint=self.inflated_size_hint,
                       deflated_size_hint=self.deflated_size_hint,
                       storage_key=storage_key, magic_hash=magic_hash,
+                      inline_content=inline_content,
                       session_id=self.session_id)
         try:
             r = yield self.user.rpc_dal.call('make_content', **kwargs)
@@ -466,6 +620,7 @@ class BaseUploadJob(object):
             raise errors.TryAgain("Content missing on commit content.")
         except dataerrors.HashMismatch:
             raise errors.ConflictError("The File changed while uploading.")
+        self.user.manager.blob_filter.add(self.hash_hint)
         defer.returnValue(r['generation'])
 
 
@@ -490,6 +645,14 @@ class UploadJob(BaseUploadJob):
     def offset(self):
         return self.uploadjob.uploaded_bytes
 
+    def _get_checkpoint(self, offset):
+        """Return the hashing state to resume from the offset, if any."""
+        if offset:
+            state = self.user.manager.upload_checkpoints.get(
+                self.uploadjob.uploadjob_id)
+            if state is not None and state.deflated_size <= offset:
+                return state
+
 
 class MagicUploadJob(BaseUploadJob):
     """The magic upload job.
@@ -546,6 +709,17 @@ class User(object):
         self.visible_name = visible_name
         self.protocols = []
         self.rpc_dal = self.manager.rpc_dal
+        self._buckets = {}
+
+    def get_bucket(self, limits, direction):
+        """The bandwidth bucket of the user in the direction."""
+        bucket = self._buckets.get(direction)
+        if bucket is None:
+            bucket = bandwidth.TokenBucket(
+                limits, bandwidth.USER, direction,
+                parent=limits.buckets[direction])
+            self._buckets[direction] = bucket
+        return bucket
 
     def register_protocol(self, protocol):
         """Register protocol as a connection authenticated for this user.
@@ -562,15 +736,21 @@ class User(object):
         self.protocols.remove(protocol)
 
     def broadcast(self, message, filter=lambda _: True):
-        """Send message to all connections from this user."""
+        """Send message to all connections from this user.
+
+        The message is serialized once without its id, and each connection
+        puts its own before it, see StorageServer.send_broadcast.
+        """
+        body = None
         for protocol in self.protocols:
             if not filter(protocol):
                 continue
-            new_message = protocol_pb2.Message()
-            new_message.CopyFrom(message)
-            new_message.id = protocol.get_new_request_id()
-            protocol.sendMessage(new_message)
-            protocol.log.trace_message("NOTIFICATION:", new_message)
+            if body is None:
+                without_id = protocol_pb2.Message()
+                without_id.CopyFrom(message)
+                without_id.ClearField('id')
+                body = without_id.SerializePartialToString()
+            protocol.send_broadcast(message, body)
 
     @defer.inlineCallbacks
     def get_root(self):
@@ -812,108 +992,55 @@ class User(object):
         if previous_hash == "":
             previous_hash = None
 
-        # reuse the content if we can
-        r = yield self.rpc_dal.call('get_reusable_content', user_id=self.id,
-                                    hash_value=hash_value,
-                                    magic_hash=magic_hash)
-        blob_exists, storage_key = r['blob_exists'], r['storage_key']
-
-        if storage_key is not None:
-            upload_job = yield self._get_magic_upload_job(
-                vol_id, node_id, previous_hash, hash_value,
-                crc32, inflated_size, deflated_size,
-                storage_key, magic_hash, session_id,
-                blob_exists)
-            defer.returnValue(upload_job)
-
-        upload_job = yield self._get_upload_job(
-            vol_id, node_id, previous_hash, hash_value, crc32, inflated_size,
-            deflated_size, session_id, blob_exists, magic_hash, upload_id)
-        defer.returnValue(upload_job)
+        # reuse the content if we can (if there may be such blob)
+        blob_filter = self.manager.blob_filter
+        check_reusable = blob_filter.might_exist(hash_value)
 
-    @defer.inlineCallbacks
-    def _get_upload_job(self, vol_id, node_id, previous_hash, hash_value,
-                        crc32, inflated_size, deflated_size,
-                        session_id, blob_exists, magic_hash, upload_id):
-        """Create an upload reservation for a node.
-
-        @param vol_id: the volume id this node belongs to.
-        @param node_id: the node to upload to.
-        @param previous_hash: the current hash of the node.
-        @param hash_value: the hash of the new content.
-        @param crc32: the crc32 of the new content.
-        @param size: the uncompressed size of the new content.
-        @param deflated_size: the compressed size of the new content.
-        """
-        node = yield self.rpc_dal.call('get_node', user_id=self.id,
-                                       volume_id=vol_id, node_id=node_id)
-        if not node["is_file"]:
-            raise dataerrors.NoPermission("Can only put content on files.")
-        file_node = Node(self.manager, node)
-
-        upload = None
+        uploadjob_id = None
         if upload_id:
-            # check if there is already a job.
+            # resume the upload if there's already a job
             try:
-                uploadid = uuid.UUID(upload_id)
+                uploadjob_id = uuid.UUID(upload_id)
             except ValueError:
                 # invalid upload_id, just ignore it a create a new upload.
-                upload = None
-            else:
-                try:
-                    upload = yield DBUploadJob.get(self, vol_id, node_id,
-                                                   uploadid, hash_value, crc32)
-                except dataerrors.DoesNotExist:
-                    # there is no uploadjob with the specified id
-                    upload = None
-
-        if upload is None:
-            # no uploadjob found, create a new one: if the file is small just
-            # get a bo
-            if deflated_size <= settings.STORAGE_CHUNK_SIZE:
-                upload = BogusUploadJob()
-            else:
-                try:
-                    upload = yield DBUploadJob.make(self, vol_id, node_id,
-                                                    previous_hash, hash_value,
-                                                    crc32, inflated_size)
-                except dataerrors.HashMismatch:
-                    raise errors.ConflictError("Previous hash does not match.")
-        else:
-            # update the when_last_active value.
-            yield upload.touch()
-
-        uj = UploadJob(self, file_node, previous_hash, hash_value,
-                       crc32, inflated_size, deflated_size,
-                       session_id, blob_exists, magic_hash, upload)
+                pass
+        multipart_key = None
+        if deflated_size > settings.STORAGE_CHUNK_SIZE:
+            # if there's no job for a big file, a new one is created
+            multipart_key = uuid.uuid4()
 
-        defer.returnValue(uj)
+        # all in one call, see services.prepare_upload
+        try:
+            r = yield self.rpc_dal.call(
+                'prepare_upload', user_id=self.id, volume_id=vol_id,
+                node_id=node_id, previous_hash=previous_hash,
+                hash_value=hash_value, crc32=crc32,
+                inflated_size=inflated_size, magic_hash=magic_hash,
+                check_reusable=check_reusable, uploadjob_id=uploadjob_id,
+                multipart_key=multipart_key)
+        except dataerrors.HashMismatch:
+            raise errors.ConflictError("Previous hash does not match.")
+        blob_exists, storage_key = r['blob_exists'], r['storage_key']
+        if check_reusable:
+            blob_filter.checked(hash_value, blob_exists)
+        file_node = Node(self.manager, r['node'])
 
-    @defer.inlineCallbacks
-    def _get_magic_upload_job(self, vol_id, node_id, previous_hash, hash_value,
-                              crc32, inflated_size, deflated_size, storage_key,
-                              magic_hash, session_id, blob_exists):
-        """Create a magic upload reservation for a node.
+        if storage_key is not None:
+            upload_job = MagicUploadJob(
+                self, file_node, previous_hash, hash_value, crc32,
+                inflated_size, deflated_size, storage_key, magic_hash,
+                session_id, blob_exists)
+            defer.returnValue(upload_job)
 
-        @param vol_id: the volume id this node belongs to.
-        @param node_id: the node to upload to.
-        @param previous_hash: the current hash of the node.
-        @param hash_value: the hash of the new content.
-        @param crc32: the crc32 of the new content.
-        @param size: the uncompressed size of the new content.
-        @param deflated_size: the compressed size of the new content.
-        @param storage_key: the content's storage key
-        @param magic_hash: the magic_hash from client
-        """
-        node = yield self.rpc_dal.call('get_node', user_id=self.id,
-                                       volume_id=vol_id, node_id=node_id)
-        if not node["is_file"]:
-            raise dataerrors.NoPermission("Can only put content on files.")
-        file_node = Node(self.manager, node)
-        uj = MagicUploadJob(self, file_node, previous_hash, hash_value,
-                            crc32, inflated_size, deflated_size,
-                            storage_key, magic_hash, session_id, blob_exists)
-        defer.returnValue(uj)
+        if r['uploadjob'] is None:
+            # the file is small, don't keep a job in the database
+            upload = BogusUploadJob()
+        else:
+            upload = DBUploadJob(self, vol_id, node_id, **r['uploadjob'])
+        upload_job = UploadJob(
+            self, file_node, previous_hash, hash_value, crc32, inflated_size,
+            deflated_size, session_id, blob_exists, magic_hash, upload)
+        defer.returnValue(upload_job)
 
     @defer.inlineCallbacks
     def get_delta(self, volume_id, from_generation, limit=None):
@@ -935,6 +1062,69 @@ class User(object):
         nodes = [Node(self.manager, n) for n in r['nodes']]
         defer.returnValue((nodes, r['vol_generation'], r['free_bytes']))
 
+    def stream_delta(self, volume_id, from_generation, limit=None):
+        """Get a NodeStream of the delta from generation for volume_id."""
+        @defer.inlineCallbacks
+        def fetch(last, limit):
+            """Get the nodes after the last one."""
+            generation = from_generation if last is None else last.generation
+            logs = self.manager.generation_logs
+            if logs is None:
+                r = yield self.rpc_dal.call(
+                    'get_delta_nodes', user_id=self.id, volume_id=volume_id,
+                    limit=limit, from_generation=generation)
+            else:
+                r = yield logs.get_delta(self, volume_id, generation, limit)
+            defer.returnValue((r['nodes'], r['vol_generation'],
+                               r['free_bytes']))
+
+        stream = NodeStream(fetch, settings.DELTA_PAGE_SIZE, limit=limit)
+        stream.start()
+        return stream
+
+    def stream_from_scratch(self, volume_id):
+        """Get a NodeStream of the live nodes in volume_id."""
+        @defer.inlineCallbacks
+        def fetch(last, limit):
+            """Get the nodes after the last one."""
+            kwargs = {}
+            if last is not None:
+                # don't include what changed while fetching the nodes
+                kwargs = dict(start_from_path=(last.path, last.name),
+                              max_generation=stream.generation)
+            r = yield self.rpc_dal.call('get_from_scratch_nodes',
+                                        user_id=self.id, volume_id=volume_id,
+                                        limit=limit, **kwargs)
+            defer.returnValue((r['nodes'], r['vol_generation'],
+                               r['free_bytes']))
+
+        stream = NodeStream(fetch, settings.GET_FROM_SCRATCH_LIMIT)
+        stream.start()
+        return stream
+
+    @defer.inlineCallbacks
+    def get_rescan_stream(self, volume_id):
+        """Get a NodeStream of the live nodes in volume_id, for a rescan.
+
+        They come from the manifest of the volume if there's one (or it's
+        built), see server.manifests.
+        """
+        result = None
+        if self.manager.manifests is not None:
+            result = yield self.manager.manifests.get_nodes(self, volume_id)
+        if result is None:
+            defer.returnValue(self.stream_from_scratch(volume_id))
+        nodes, generation, free_bytes = result
+
+        def fetch(last, limit):
+            """Get the next nodes."""
+            return defer.succeed((list(itertools.islice(nodes, limit)),
+                                  generation, free_bytes))
+
+        stream = NodeStream(fetch, settings.GET_FROM_SCRATCH_LIMIT)
+        stream.start()
+        defer.returnValue(stream)
+
     @defer.inlineCallbacks
     def get_volume_id(self, node_id):
         """Get the (client) volume_id (UDF id or root) of this node_id.
@@ -954,6 +1144,28 @@ class ContentManager(object):
         """Create a ContentManager."""
         self.factory = factory
         self.users = weakref.WeakValueDictionary()
+        self.upload_checkpoints = upload.HashingCheckpoints()
+        self.blob_filter = BlobFilter(self)
+        self.generation_logs = None
+        if settings.GENERATION_LOG_VOLUMES:
+            self.generation_logs = GenerationLogs()
+        self.manifests = None
+        if settings.RESCAN_MANIFEST_MAX_SIZE:
+            self.manifests = VolumeManifests(settings.RESCAN_MANIFEST_DIR)
+        self._hashing_threadpool = None
+
+    @property
+    def hashing_threadpool(self):
+        """The pool where the uploads are inflated and hashed, if any."""
+        threads = settings.UPLOAD_HASHING_THREADS
+        if self._hashing_threadpool is None and threads:
+            pool = ThreadPool(minthreads=0,
+                              maxthreads=threads,
+                              name='upload-hashing')
+            pool.start()
+            reactor.addSystemEventTrigger('during', 'shutdown', pool.stop)
+            self._hashing_threadpool = pool
+        return self._hashing_threadpool
 
     @defer.inlineCallbacks
     def get_user_by_id(self, user_id, session_id=None, required=False):
@@ -0,0 +1,173 @@
+# Copyright 2015-2018 Chicharreros (https://launchpad.net/~chicharreros)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# For further info, check  http://launchpad.net/magicicada-server
+
+"""Keep in memory the content of the most downloaded nodes.
+
+The same content is usually downloaded many times (by all the devices of
+a user, or all the users of a share) and never changes for a node id, so
+the ContentCache keeps the most recently used ones up to a total size,
+and the MemoryProducer serves them without copying.
+
+To not fill it with what is downloaded only once, a node is only admitted
+when requested again while it's still in the history of the last
+requested ones.
+"""
+
+import collections
+
+from twisted.internet import defer, reactor
+
+from magicicada import metrics
+
+
+class ContentCache(object):
+    """A size-bounded LRU cache of content by node id.
+
+    Only the content up to `max_item_size` bytes is admitted, the second
+    time it's requested while it's among the last `history_size` ones.
+    """
+
+    history_size = 65536
+
+    def __init__(self, max_size, max_item_size, history_size=None):
+        self.max_size = max_size
+        self.max_item_size = max_item_size
+        if history_size is not None:
+            self.history_size = history_size
+        self.size = 0
+        self.hits = self.misses = self.evictions = 0
+        self._items = collections.OrderedDict()
+        self._history = collections.OrderedDict()
+        self.metrics = metrics.get_meter('content_cache')
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, node_id):
+        return node_id in self._items
+
+    def get(self, node_id):
+        """Return the content of the node, None if not here."""
+        data = self._items.pop(node_id, None)
+        if data is None:
+            self.misses += 1
+            self.metrics.increment('miss')
+            return None
+        self._items[node_id] = data
+        self.hits += 1
+        self.metrics.increment('hit')
+        return data
+
+    def should_admit(self, node_id, size):
+        """Tell if the content of the node should be added once read.
+
+        This records the request, to admit the node when requested again.
+        """
+        if size > self.max_item_size or size > self.max_size:
+            return False
+        seen = self._history.pop(node_id, False)
+        if not seen:
+            self._history[node_id] = True
+            while len(self._history) > self.history_size:
+                self._history.popitem(last=False)
+        return seen
+
+    def add(self, node_id, data):
+        """Keep the content, evicting the least recently used if needed."""
+        if node_id in self._items or len(data) > self.max_size:
+            return
+        while self._items and self.size + len(data) > self.max_size:
+            _, evicted = self._items.popitem(last=False)
+            self.size -= len(evicted)
+            self.evictions += 1
+            self.metrics.increment('eviction')
+        self._items[node_id] = data
+        self.size += len(data)
+        self.metrics.gauge('size', self.size)
+
+    def discard(self, node_id):
+        """Forget the content of the node, if here."""
+        data = self._items.pop(node_id, None)
+        if data is not None:
+            self.size -= len(data)
+            self.metrics.gauge('size', self.size)
+
+
+class MemoryProducer(object):
+    """A producer of content already in memory, from the given offset.
+
+    The content is delivered in chunks which are read-only views of it (no
+    copies), one per reactor iteration unless paused. It also exposes a
+    deferred, triggered at the very end.
+    """
+
+    chunk = 65536
+
+    def __init__(self, data, offset=0, chunk=None):
+        self.data = data
+        self.position = offset
+        if chunk is not None:
+            self.chunk = chunk
+        self.deferred = defer.Deferred()
+        self.consumer = None
+        self.paused = False
+        self.keep_going = True
+        self._call = None
+
+    def startProducing(self, consumer):
+        """Start delivering the content to the consumer."""
+        self.consumer = consumer
+        self._schedule()
+        done = defer.Deferred()
+        self.deferred.addCallback(
+            lambda result: done.callback(result) or result)
+        return done
+
+    def _schedule(self):
+        """Deliver the next chunk in the next reactor iteration."""
+        if self._call is None:
+            self._call = reactor.callLater(0, self._produce)
+
+    def _produce(self):
+        """Deliver a chunk, or finish."""
+        self._call = None
+        if self.paused:
+            return
+        if not self.keep_going or self.position >= len(self.data):
+            if not self.deferred.called:
+                self.deferred.callback(None)
+            return
+        chunk = buffer(self.data, self.position, self.chunk)
+        self.position += len(chunk)
+        self.consumer.write(chunk)
+        self._schedule()
+
+    def pauseProducing(self):
+        """Temporarily suspend delivering the content."""
+        self.paused = True
+
+    def resumeProducing(self):
+        """Undo the effects of a previous pausing."""
+        if self.paused:
+            self.paused = False
+            self._schedule()
+
+    def stopProducing(self):
+        """Stop delivering the content."""
+        self.keep_going = False
+        self.paused = False
+        self._schedule()
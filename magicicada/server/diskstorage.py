@@ -15,28 +15,180 @@
 #
 # For further info, check  http://launchpad.net/magicicada-server
 
+import binascii
+import collections
+import ctypes
+import ctypes.util
+import errno
+import functools
+import hashlib
+import itertools
+import logging
+import math
 import os
+import shutil
+import struct
+import time
+import uuid
+import weakref
 
-from twisted.internet import defer, reactor
+try:
+    from os import scandir
+except ImportError:
+    from scandir import scandir
+
+from twisted.internet import defer, reactor, threads
+from twisted.python.threadpool import ThreadPool
+
+from magicicada import metrics, settings
+from magicicada.server.blobfilter import BloomFilter
+from magicicada.server.chunkstorage import (
+    CHUNKS_SUFFIX,
+    ChunkedFile,
+    get_chunk_name,
+    is_chunk_name,
+    pack_manifest,
+    read_manifest,
+    split_chunks,
+)
+from magicicada.server.contentcache import ContentCache, MemoryProducer
+from magicicada.server.packstorage import PackStorage, PackWriterConsumer
+
+logger = logging.getLogger(__name__)
 
 # the levels of directories for the tree where will store all nodes
 DIRS_LEVELS = 3
 
+# the suffix of the files still being written, being moved between
+# volumes, and of the chunks being collected
+TEMP_SUFFIX = '.temp'
+MOVING_SUFFIX = '.moving'
+COLLECTING_SUFFIX = '.collecting'
+
+# the durability modes for committed files: just written, fsync'ed, or also
+# fsync'ing their directory after being renamed into place
+DURABILITY_NONE = 'none'
+DURABILITY_FSYNC = 'fsync'
+DURABILITY_FSYNC_DIR = 'fsync+dirfsync'
+DURABILITY_MODES = (DURABILITY_NONE, DURABILITY_FSYNC, DURABILITY_FSYNC_DIR)
+
+# not available in Python 2's os module, only used if present
+posix_fadvise = getattr(os, 'posix_fadvise', None)
+
+# fallocate's flag to not change the file size (as posix_fallocate does)
+FALLOC_FL_KEEP_SIZE = 1
+
+
+def _get_fallocate():
+    """Return libc's fallocate, if available."""
+    try:
+        fallocate = ctypes.CDLL(ctypes.util.find_library('c')).fallocate
+    except (OSError, AttributeError):
+        return None
+    fallocate.argtypes = [
+        ctypes.c_int, ctypes.c_int, ctypes.c_longlong, ctypes.c_longlong]
+    return fallocate
+
+
+_fallocate = _get_fallocate()
+
+
+def _scandir(path):
+    """Iterate the entries of a directory, none if it's not there."""
+    try:
+        return scandir(path)
+    except OSError as err:
+        if err.errno != errno.ENOENT:
+            raise
+        return iter(())
+
+
+def preallocate(fd, offset, length):
+    """Reserve disk space for the file, if possible, keeping its size.
+
+    This is just an optimization, so it's ignored if it fails.
+    """
+    if _fallocate is not None:
+        _fallocate(fd, FALLOC_FL_KEEP_SIZE, offset, length)
+
+
+def fsync_path(path):
+    """Flush the file or directory in the given path to disk."""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _after(deferred):
+    """Return a new deferred triggered (with None) after the given one."""
+    d = defer.Deferred()
+    deferred.addBoth(lambda result: d.callback(None) or result)
+    return d
+
 
 class FileReaderProducer(object):
-    """A producer starting from a filepath.
+    """A producer starting from a filepath (or an open file).
 
     It also exposes a deferred, triggered at the very end.
+
+    The content is produced from the given offset, to resume downloads, and
+    up to `size` bytes if given (else up to the end of the file). If `tee`
+    is set, it's also called with each chunk given to the consumer.
+
+    Instead of the file, a function opening it can be given: it's called
+    on the first read, and returns the file (already at where to start)
+    and how many bytes to produce from there.
+
+    If a threadpool is given the (blocking) reads are done there, keeping
+    up to `read_ahead` chunks buffered, and the reactor only delivers them
+    to the consumer; otherwise the file is read in the reactor thread.
     """
 
     chunk = 65536
 
-    def __init__(self, filepath):
+    def __init__(self, filepath, offset=0, threadpool=None, chunk=None,
+                 read_ahead=1, size=None):
         super(FileReaderProducer, self).__init__()
-        self._fh = open(filepath, 'rb')
+        self._opener = None
+        if isinstance(filepath, basestring):
+            self._fh = open(filepath, 'rb')
+        elif callable(filepath):
+            self._fh = None
+            self._opener = filepath
+        else:
+            self._fh = filepath
+        if offset:
+            self._fh.seek(offset)
+        self._remaining = size
+        if size is None and self._fh is not None:
+            size = os.fstat(self._fh.fileno()).st_size - offset
+        self.size = size
+        self.tee = None
         self.deferred = defer.Deferred()
         self.pausing_deferred = None
         self.keep_going = True
+        self.threadpool = threadpool
+        if chunk is not None:
+            self.chunk = chunk
+        self.read_ahead = read_ahead
+        self.metrics = metrics.get_meter('diskstorage')
+
+        # threaded reading state
+        self._flag = None
+        self._consumer = None
+        self._buffer = collections.deque()
+        self._reading = False
+        self._eof = False
+        self._resume_pending = False
+        self._read_time = 0
+        self._max_lag = 0
+
+        if (threadpool is not None and posix_fadvise is not None and
+                hasattr(self._fh, 'fileno')):
+            posix_fadvise(
+                self._fh.fileno(), offset, 0, os.POSIX_FADV_SEQUENTIAL)
 
     def startProducing(self, consumer):
         """Start a reactor-friendly loop to yield the file content."""
@@ -48,19 +200,27 @@ class FileReaderProducer(object):
 
         flag = defer.Deferred()
         flag.addBoth(done)
-        reactor.callLater(0, self._readloop, flag, consumer)
+        if self.threadpool is None:
+            self._read_time = 0
+            reactor.callLater(0, self._readloop, flag, consumer)
+        else:
+            self._flag = flag
+            self._consumer = consumer
+            reactor.callLater(0, self._schedule_read)
         return flag
 
     def _readloop(self, flag, consumer):
         """Read one chunk from the input file and to the consumer."""
+        tini = time.time()
         try:
-            data = self._fh.read(self.chunk)
+            data = self._read_chunk()
         except Exception as err:
             flag.errback(err)
             return
+        self._read_time += time.time() - tini
 
         if data and self.keep_going:
-            consumer.write(data)
+            self._write(consumer, data)
             if self.pausing_deferred is None:
                 reactor.callLater(0, self._readloop, flag, consumer)
             else:
@@ -68,10 +228,101 @@ class FileReaderProducer(object):
                     return reactor.callLater(0, self._readloop, flag, consumer)
                 self.pausing_deferred.addCallback(f)
         else:
-            self._fh.close()
+            self._close()
+            self.metrics.timing('sync.reactor_blocked', self._read_time)
             if not flag.called:
                 flag.callback(None)
 
+    def _schedule_read(self):
+        """Read a chunk in the threadpool if there is room to buffer it."""
+        if not self.keep_going:
+            self._finish()
+            return
+        if (self._reading or self._eof or
+                len(self._buffer) >= self.read_ahead):
+            return
+        self._reading = True
+        d = threads.deferToThreadPool(reactor, self.threadpool, self._read)
+        d.addCallbacks(self._got_chunk, self._read_failed)
+
+    def _read_chunk(self):
+        """Read the next chunk of the file, up to the size to produce."""
+        if self._fh is None:
+            self._fh, self._remaining = self._opener()
+        if self._remaining is None:
+            return self._fh.read(self.chunk)
+        if self._remaining <= 0:
+            return b''
+        data = self._fh.read(min(self.chunk, self._remaining))
+        self._remaining -= len(data)
+        return data
+
+    def _read(self):
+        """Read a chunk from the file; this is run in the threadpool."""
+        tini = time.time()
+        data = self._read_chunk()
+        tend = time.time()
+        return data, tend - tini, tend
+
+    def _got_chunk(self, result):
+        """A chunk was read, back in the reactor thread."""
+        data, read_time, read_end = result
+        self._reading = False
+        self._read_time += read_time
+        self._max_lag = max(self._max_lag, time.time() - read_end)
+        if data:
+            self._buffer.append(data)
+        else:
+            self._eof = True
+        self._deliver()
+        self._schedule_read()
+
+    def _read_failed(self, failure):
+        """Reading from the file in the threadpool failed."""
+        self._reading = False
+        self._close()
+        if not self._flag.called:
+            self._flag.errback(failure)
+
+    def _deliver(self):
+        """Write the buffered chunks to the consumer, unless paused."""
+        while (self._buffer and self.keep_going and
+               self.pausing_deferred is None):
+            self._write(self._consumer, self._buffer.popleft())
+
+        if not self.keep_going or (self._eof and not self._buffer):
+            self._finish()
+        elif self.pausing_deferred is not None and not self._resume_pending:
+            self._resume_pending = True
+            self.pausing_deferred.addCallback(self._resumed)
+
+    def _write(self, consumer, data):
+        """Give the chunk to the consumer (and the tee)."""
+        if self.tee is not None:
+            self.tee(data)
+        consumer.write(data)
+
+    def _resumed(self, _):
+        """Continue delivering and reading after being paused."""
+        self._resume_pending = False
+        self._deliver()
+        self._schedule_read()
+
+    def _finish(self):
+        """Close the file and trigger the end, if no read is in flight."""
+        if self._reading or self._flag.called:
+            return
+        self._close()
+        self.metrics.timing('threaded.read_time', self._read_time)
+        self.metrics.timing('threaded.reactor_lag', self._max_lag)
+        if not self._flag.called:
+            self._flag.callback(None)
+
+    def _close(self):
+        """Close the file, if it was opened."""
+        if self._fh is not None:
+            self._fh.close()
+
     def pauseProducing(self):
         """Temporarily suspend moving bytes."""
         if self.pausing_deferred is None:
@@ -88,69 +339,883 @@ class FileReaderProducer(object):
         """Stop writing bytes from the file to the consumer."""
         self.keep_going = False
         self.resumeProducing()
+        if self._flag is not None:
+            self._finish()
 
 
 class FileWriterConsumer(object):
-    """A file consumer (writes to disk) starting from a filepath."""
+    """A file consumer (writes to disk) starting from a filepath.
+
+    Without a threadpool every write goes to disk right away, in the reactor
+    thread. With it, writes are coalesced in blocks of `block_size` bytes
+    that are written in the threadpool, so an error writing is raised in a
+    later write or commit. While more than `max_pending` bytes wait to be
+    written the registered producer is paused.
+
+    The file is preallocated up to `size_hint` bytes when possible, and on
+    commit it's made as durable as `durability` indicates.
+    """
+
+    block_size = 1048576
+    max_pending = 8388608
 
-    def __init__(self, filepath, offset):
+    def __init__(self, filepath, offset, threadpool=None, size_hint=None,
+                 durability=DURABILITY_NONE, block_size=None, after=None,
+                 max_pending=None):
+        if durability not in DURABILITY_MODES:
+            raise ValueError("Invalid durability mode: %r" % (durability,))
         self.filepath = filepath
-        self.temppath = temppath = filepath + ".temp"
+        self.temppath = filepath + TEMP_SUFFIX
+        self.threadpool = threadpool
+        self.durability = durability
+        if block_size is not None:
+            self.block_size = block_size
+        if max_pending is not None:
+            self.max_pending = max_pending
+        self.producer = None
+        self.fh = None
+        self.closing = False
+        self.closed = defer.Deferred()
 
+        # write behind state
+        self._buffer = []
+        self._buffered = 0
+        self._failure = None
+        self.pending = 0
+        self.paused = False
+
+        if after is None:
+            self._ops = defer.succeed(None)
+            self._open(offset, size_hint)
+        else:
+            # other writer is still closing the file, open it after that
+            self._ops = after
+            self._run(self._open, offset, size_hint)
+
+    def _open(self, offset, size_hint):
+        """Open the temp file, checking it's ok to resume from the offset."""
         if offset:
-            filesize = os.stat(temppath).st_size
+            filesize = os.stat(self.temppath).st_size
             if filesize != offset:
                 m = "Trying to resume a file with size={} using offset={}"
                 raise ValueError(m.format(filesize, offset))
-            fh = open(temppath, 'ab')
+            fh = open(self.temppath, 'ab')
             fh.seek(offset)
         else:
-            fh = open(temppath, 'wb')
+            fh = open(self.temppath, 'wb')
+        if size_hint is not None and size_hint > offset:
+            preallocate(fh.fileno(), offset, size_hint - offset)
         self.fh = fh
 
+    def _run(self, func, *args):
+        """Run the function in the threadpool after the previous ones.
+
+        Nothing else is run after a failure, which is kept to be raised
+        later.
+        """
+        def run(_):
+            if self._failure is None:
+                return threads.deferToThreadPool(
+                    reactor, self.threadpool, func, *args)
+
+        def failed(failure):
+            if self._failure is None:
+                self._failure = failure
+
+        self._ops.addCallback(run)
+        self._ops.addErrback(failed)
+
+    def _check_failure(self):
+        """Raise the error of a previous operation, if any."""
+        if self._failure is not None:
+            self._failure.raiseException()
+
+    def _result(self):
+        """Return a deferred triggered when all the operations finished."""
+        d = defer.Deferred()
+
+        def done(_):
+            if self._failure is None:
+                d.callback(None)
+            else:
+                d.errback(self._failure)
+
+        self._ops.addCallback(done)
+        return d
+
+    def _write_block(self, data):
+        """Write a block of data; this is run in the threadpool."""
+        self.fh.write(data)
+        self.fh.flush()
+
+    def _flush_buffer(self):
+        """Send the buffered data to be written."""
+        if self._buffer:
+            data = ''.join(self._buffer)
+            self._buffer = []
+            self._buffered = 0
+            self.pending += len(data)
+            if self.pending >= self.max_pending:
+                self._pause()
+            self._run(self._write_block, data)
+
+            def written(_):
+                self.pending -= len(data)
+                if self.pending < self.max_pending // 2:
+                    self._resume()
+            self._ops.addCallback(written)
+
+    def _pause(self):
+        """Stop the producer until the writes catch up."""
+        if not self.paused and self.producer is not None:
+            self.paused = True
+            self.producer.pauseProducing()
+
+    def _resume(self):
+        """Let the producer go on, if paused."""
+        if self.paused:
+            self.paused = False
+            if self.producer is not None:
+                self.producer.resumeProducing()
+
+    def _close(self):
+        """Close the file, once."""
+        if self.closing:
+            return
+        self.closing = True
+        if self.threadpool is None:
+            self.fh.close()
+            self.closed.callback(None)
+        else:
+            self._flush_buffer()
+            self._run(lambda: self.fh.close())
+            self._result().addBoth(lambda _: self.closed.callback(None))
+
+    def _commit_file(self):
+        """Make the file durable and put it in place."""
+        if self.durability != DURABILITY_NONE:
+            fsync_path(self.temppath)
+        os.rename(self.temppath, self.filepath)
+        if self.durability == DURABILITY_FSYNC_DIR:
+            fsync_path(os.path.dirname(self.filepath))
+
     def registerProducer(self, producer, streaming):
         self.producer = producer
         assert streaming
 
     def unregisterProducer(self):
+        self._resume()
         self.producer = None
-        self.fh.close()
+        self._close()
 
     def write(self, data):
-        self.fh.write(data)
-        self.fh.flush()
+        if self.threadpool is None:
+            self.fh.write(data)
+            self.fh.flush()
+            return
+
+        self._check_failure()
+        self._buffer.append(data)
+        self._buffered += len(data)
+        if self._buffered >= self.block_size:
+            self._flush_buffer()
 
     def commit(self):
-        """Commit the file."""
-        self.fh.close()
-        os.rename(self.temppath, self.filepath)
+        """Commit the file.
+
+        Return a deferred triggered when the file is in its final place and
+        as durable as configured.
+        """
+        self._close()
+        if self.threadpool is None:
+            return defer.maybeDeferred(self._commit_file)
+        self._run(self._commit_file)
+        return self._result()
+
+    def open_committed(self):
+        """Return the committed file, open to read it, and its size."""
+        fh = open(self.filepath, 'rb')
+        return fh, os.fstat(fh.fileno()).st_size
+
+
+class ChunkingWriterConsumer(FileWriterConsumer):
+    """A file consumer that stores the file in chunks when committed.
+
+    The whole file is written as usual (so the upload can be resumed), and
+    then split in chunks shared with the other nodes, see chunkstorage.
+    """
+
+    def __init__(self, storage, node_id, *args, **kwargs):
+        self.storage = storage
+        self.node_id = node_id
+        super(ChunkingWriterConsumer, self).__init__(*args, **kwargs)
+
+    def _commit_file(self):
+        """Store the chunks and the manifest in place of the file."""
+        self.storage.store_chunks(self.node_id, self.temppath,
+                                  self.durability)
+
+    def open_committed(self):
+        """Return the content of the stored chunks, and its size."""
+        fh = self.storage._open_chunked(self.filepath + CHUNKS_SUFFIX)
+        return fh, fh.size
+
+
+class Volume(object):
+    """A directory where nodes are stored, usually a whole disk.
+
+    Volumes are identified by their path for placing the nodes, and their
+    free space is checked at most every `free_space_ttl` seconds.
+    """
+
+    free_space_ttl = 10
+
+    def __init__(self, basedir, weight=1):
+        self.basedir = basedir
+        self.weight = weight
+        self._hash_prefix = (basedir.encode('utf-8')
+                             if isinstance(basedir, unicode) else basedir)
+        self._free_bytes = None
+        self._free_checked = 0
+
+    def __repr__(self):
+        return "<Volume %r (weight %s)>" % (self.basedir, self.weight)
+
+    def score(self, node_id):
+        """The weighted rendezvous hashing score of the node here."""
+        digest = hashlib.md5(self._hash_prefix + b'\0' + node_id).digest()
+        # an uniform value in the open (0, 1) interval
+        value = (struct.unpack('>Q', digest[:8])[0] + 1) / float(2 ** 64 + 1)
+        return -self.weight / math.log(value)
+
+    def free_bytes(self):
+        """The space available in the volume (0 if not there)."""
+        now = time.time()
+        if (self._free_bytes is None or
+                now - self._free_checked > self.free_space_ttl):
+            try:
+                stat = os.statvfs(self.basedir)
+            except OSError:
+                self._free_bytes = 0
+            else:
+                self._free_bytes = stat.f_bavail * stat.f_frsize
+            self._free_checked = now
+        return self._free_bytes
+
+    def get_treepath(self, node_id):
+        """Build the tree path of the node in this volume."""
+        return os.path.join(self.basedir, os.path.join(*node_id[:DIRS_LEVELS]))
+
+    def get_path(self, node_id):
+        """Build the path of the node in this volume."""
+        return os.path.join(self.get_treepath(node_id), node_id)
 
 
 class DiskStorage(object):
     """Store nodes in disk.
 
     Read and write those nodes acting like Twisted producers/consumers.
+
+    The nodes can be spread in many volumes, giving (basedir, weight) pairs
+    instead of a single basedir: each node is placed in the volume with the
+    biggest weighted rendezvous hashing score that has at least
+    `min_free_bytes` free, so adding a volume only moves the nodes that go
+    to it. As a node may not be there (if that volume was full when it was
+    stored, or while rebalancing), it's looked for in all the volumes in
+    the same order.
+
+    The nodes up to `pack_max_size` bytes are appended to pack files (in
+    `packdir`, by default in the first volume) instead, see packstorage;
+    the ones already there are still found if packing is disabled later.
+
+    The content that is read many times is kept in memory, if a cache of
+    `cache_size` bytes is given, see contentcache.
+
+    The nodes from `dedup_min_size` bytes (if given) are split in chunks
+    stored once for all the nodes that have them, and the node is just
+    the list of its chunks, see chunkstorage.
     """
-    def __init__(self, basedir):
+    def __init__(self, basedir, min_free_bytes=None, pack_max_size=None,
+                 packdir=None, cache_size=None, dedup_min_size=None):
         super(DiskStorage, self).__init__()
-        self.basedir = basedir
+        if isinstance(basedir, basestring):
+            self.volumes = [Volume(basedir)]
+        else:
+            self.volumes = [Volume(path, weight) for path, weight in basedir]
+        if not self.volumes:
+            raise ValueError("At least one volume is needed.")
+        if min_free_bytes is None:
+            min_free_bytes = settings.STORAGE_MIN_FREE_BYTES
+        self.min_free_bytes = min_free_bytes
+        if pack_max_size is None:
+            pack_max_size = settings.STORAGE_PACK_MAX_SIZE
+        self.pack_max_size = pack_max_size
+        if packdir is None:
+            packdir = os.path.join(self.volumes[0].basedir, 'packs')
+        self.packdir = packdir
+        self._packs = None
+        self._packs_checked = False
+        if cache_size is None:
+            cache_size = settings.STORAGE_CACHE_SIZE
+        self.cache = None
+        if cache_size:
+            self.cache = ContentCache(
+                cache_size, settings.STORAGE_CACHE_MAX_ITEM_SIZE)
+        if dedup_min_size is None:
+            dedup_min_size = settings.STORAGE_DEDUP_MIN_SIZE
+        self.dedup_min_size = dedup_min_size
+        self._threadpool = None
+        self._writers = weakref.WeakValueDictionary()
+        self._created = set()
 
-    def _get_treepath(self, node_id):
-        """Build the tree path."""
+    @property
+    def threadpool(self):
+        """The pool where the blocking disk operations are done, if any."""
+        if self._threadpool is None and settings.STORAGE_IO_THREADS:
+            pool = ThreadPool(minthreads=0,
+                              maxthreads=settings.STORAGE_IO_THREADS,
+                              name='diskstorage')
+            pool.start()
+            reactor.addSystemEventTrigger('during', 'shutdown', pool.stop)
+            self._threadpool = pool
+        return self._threadpool
+
+    @property
+    def packs(self):
+        """The store of the small nodes, None if they are not packed."""
+        if not self._packs_checked:
+            self._packs_checked = True
+            if self.pack_max_size or os.path.isdir(self.packdir):
+                self._packs = PackStorage(
+                    self.packdir,
+                    fsync=settings.STORAGE_DURABILITY != DURABILITY_NONE)
+        return self._packs
+
+    def _check_node_id(self, node_id):
+        """Validate the node id, to be used as a path."""
         if os.path.sep in node_id or len(node_id) < DIRS_LEVELS:
             raise ValueError("Invalid node id.")
 
-        return os.path.join(self.basedir, os.path.join(*node_id[:DIRS_LEVELS]))
+    def _get_volumes(self, node_id):
+        """Return the volumes in the order the node is placed in them."""
+        self._check_node_id(node_id)
+        if len(self.volumes) == 1:
+            return self.volumes
+        return sorted(self.volumes, key=lambda volume: volume.score(node_id),
+                      reverse=True)
 
-    def get(self, node_id):
-        """Get a producer that will retrieve bytes from disk."""
-        fpath = os.path.join(self._get_treepath(node_id), node_id)
-        return FileReaderProducer(fpath)
+    def _get_target(self, node_id):
+        """Return the volume where a new node is stored."""
+        volumes = self._get_volumes(node_id)
+        for volume in volumes[:-1]:
+            if volume.free_bytes() >= self.min_free_bytes:
+                return volume
+        return volumes[-1]
 
-    def put(self, node_id, offset=0):
-        """Get a consumer that will store bytes in disk."""
-        path = self._get_treepath(node_id)
-        if not os.path.exists(path):
+    def _find(self, node_id, suffix=''):
+        """Return the path of the node in the volume it's stored in.
+
+        The node is looked for (with the suffix) if there are many volumes;
+        None if it's in none of them.
+        """
+        volumes = self._get_volumes(node_id)
+        if len(volumes) == 1:
+            return volumes[0].get_path(node_id)
+        for volume in volumes:
+            path = volume.get_path(node_id)
+            if os.path.exists(path + suffix):
+                return path
+
+    def _find_manifest(self, node_id):
+        """Return the path of the node's manifest, None if not chunked."""
+        for volume in self._get_volumes(node_id):
+            path = volume.get_path(node_id) + CHUNKS_SUFFIX
+            if os.path.exists(path):
+                return path
+
+    def _locate_chunk(self, name):
+        """Return the path of the chunk (where it'd be if it's not there)."""
+        path = self._find(name)
+        if path is None:
+            path = self._get_volumes(name)[0].get_path(name)
+        return path
+
+    def _open_chunked(self, path):
+        """Open the content of the chunks listed in the manifest."""
+        return ChunkedFile(read_manifest(path), self._locate_chunk)
+
+    def _makedirs(self, path):
+        """Create the directory if not done already."""
+        if path in self._created:
+            return
+        try:
             os.makedirs(path)
-        fpath = os.path.join(path, node_id)
-        return FileWriterConsumer(fpath, offset)
+        except OSError as err:
+            if err.errno != errno.EEXIST:
+                raise
+        self._created.add(path)
+
+    def precreate(self, alphabet='0123456789abcdef'):
+        """Create the tree of all the volumes for the (hex) node ids.
+
+        That way the tree is not checked in each store, only once for the
+        directories of the nodes out of the alphabet.
+        """
+        for volume in self.volumes:
+            for prefix in itertools.product(alphabet, repeat=DIRS_LEVELS):
+                self._makedirs(os.path.join(volume.basedir, *prefix))
+
+    def _get_treepath(self, node_id):
+        """Build the tree path where a new node is stored."""
+        return self._get_target(node_id).get_treepath(node_id)
+
+    def get(self, node_id, offset=0):
+        """Get a producer that will retrieve bytes from disk (or memory)."""
+        if self.cache is not None:
+            data = self.cache.get(node_id)
+            if data is not None:
+                return MemoryProducer(
+                    data, offset, chunk=settings.STORAGE_READ_CHUNK_SIZE)
+
+        # only the index already loaded is looked at here; the packed
+        # content is opened in the producer's first read (in the threadpool
+        # if any), looking for it again there if it was compacted meanwhile
+        location = None
+        if self.packs is not None:
+            location = self.packs.lookup(node_id, refresh=False)
+        manifest = None
+        if location is None:
+            manifest = self._find_manifest(node_id)
+        if location is not None:
+            producer = self._make_producer(
+                functools.partial(self._open_packed, node_id, offset),
+                size=max(0, location.size - offset))
+        elif manifest is not None:
+            fpath = self._open_chunked(manifest)
+            producer = self._make_producer(
+                fpath, offset, size=max(0, fpath.size - offset))
+        else:
+            fpath = self._find(node_id)
+            if fpath is None:
+                # not there, let the producer fail as usual
+                fpath = self._get_volumes(node_id)[0].get_path(node_id)
+            try:
+                producer = self._make_producer(fpath, offset)
+            except IOError as err:
+                # other process may have packed it since the index was
+                # loaded, which is looked for in the producer too
+                if (err.errno != errno.ENOENT or self.packs is None or
+                        self.packs.writable):
+                    raise
+                producer = self._make_producer(
+                    functools.partial(self._open_packed, node_id, offset))
+
+        if (self.cache is not None and not offset and
+                producer.size is not None and
+                self.cache.should_admit(node_id, producer.size)):
+            self._cache_when_read(node_id, producer)
+        return producer
+
+    def _make_producer(self, fpath, offset=0, size=None):
+        """Return a producer of the file, reading it as configured."""
+        return FileReaderProducer(
+            fpath, offset=offset, threadpool=self.threadpool,
+            chunk=settings.STORAGE_READ_CHUNK_SIZE,
+            read_ahead=settings.STORAGE_READ_AHEAD, size=size)
+
+    def _open_packed(self, node_id, offset):
+        """Open the packed content of the node from the offset; this blocks.
+
+        Return the file and the size to read from it.
+        """
+        opened = self.packs.open_content(node_id)
+        if opened is None:
+            raise IOError(errno.ENOENT, "Node not found", node_id)
+        fh, size = opened
+        fh.seek(offset, os.SEEK_CUR)
+        return fh, max(0, size - offset)
+
+    def _cache_when_read(self, node_id, producer):
+        """Add the content to the cache once all of it is produced."""
+        chunks = []
+        producer.tee = chunks.append
+
+        def cache(result):
+            data = b''.join(chunks)
+            if len(data) == producer.size:
+                self.cache.add(node_id, data)
+            return result
+
+        producer.deferred.addCallback(cache)
+
+    def put(self, node_id, offset=0, size_hint=None):
+        """Get a consumer that will store bytes in disk."""
+        if (not offset and size_hint and size_hint <= self.pack_max_size and
+                self.packs is not None and self.packs.acquire()):
+            self._check_node_id(node_id)
+            return PackWriterConsumer(
+                self.packs, node_id, self.threadpool, size_hint)
+
+        # when resuming, continue where the upload started
+        fpath = self._find(node_id, TEMP_SUFFIX) if offset else None
+        if fpath is None:
+            fpath = self._get_target(node_id).get_path(node_id)
+        self._makedirs(os.path.dirname(fpath))
+
+        # if resuming while the previous writer is still closing the file,
+        # the new one needs to wait for it
+        after = None
+        previous = self._writers.get(fpath)
+        if (previous is not None and previous.closing and
+                not previous.closed.called):
+            after = _after(previous.closed)
+
+        kwargs = dict(
+            threadpool=self.threadpool, size_hint=size_hint,
+            durability=settings.STORAGE_DURABILITY,
+            block_size=settings.STORAGE_WRITE_BLOCK_SIZE, after=after,
+            max_pending=settings.STORAGE_WRITE_MAX_PENDING)
+        if (self.dedup_min_size and size_hint and
+                size_hint >= self.dedup_min_size):
+            consumer = ChunkingWriterConsumer(
+                self, node_id, fpath, offset, **kwargs)
+        else:
+            consumer = FileWriterConsumer(fpath, offset, **kwargs)
+        self._writers[fpath] = consumer
+        return consumer
+
+    def _store_chunk(self, name, data, durability):
+        """Store the chunk, unless it's there; return if it was stored.
+
+        An existing chunk is touched, so it's not collected meanwhile.
+        """
+        path = self._find(name)
+        if path is not None:
+            try:
+                os.utime(path, None)
+            except OSError as err:
+                if err.errno != errno.ENOENT:
+                    raise
+            else:
+                return False
+
+        path = self._get_target(name).get_path(name)
+        self._makedirs(os.path.dirname(path))
+        # other upload may be storing the same chunk
+        temppath = '%s.%s%s' % (path, uuid.uuid4().hex, TEMP_SUFFIX)
+        with open(temppath, 'wb') as fh:
+            fh.write(data)
+            if durability != DURABILITY_NONE:
+                fh.flush()
+                os.fsync(fh.fileno())
+        os.rename(temppath, path)
+        if durability == DURABILITY_FSYNC_DIR:
+            fsync_path(os.path.dirname(path))
+        return True
+
+    def store_chunks(self, node_id, temppath, durability):
+        """Store the unfinished file of the node in chunks.
+
+        The chunks not already there are stored, then the manifest listing
+        them is put in place and the file removed. This blocks.
+        """
+        entries = []
+        stored = deduplicated = 0
+        with open(temppath, 'rb') as fh:
+            chunks = split_chunks(
+                fh, settings.STORAGE_DEDUP_CHUNK_MIN_SIZE,
+                settings.STORAGE_DEDUP_CHUNK_MAX_SIZE)
+            for data in chunks:
+                digest = hashlib.sha1(data).digest()
+                if self._store_chunk(get_chunk_name(digest), data,
+                                     durability):
+                    stored += len(data)
+                else:
+                    deduplicated += len(data)
+                entries.append((digest, len(data)))
+
+        path = temppath[:-len(TEMP_SUFFIX)] + CHUNKS_SUFFIX
+        with open(path + TEMP_SUFFIX, 'wb') as fh:
+            fh.write(pack_manifest(entries))
+            if durability != DURABILITY_NONE:
+                fh.flush()
+                os.fsync(fh.fileno())
+        os.rename(path + TEMP_SUFFIX, path)
+        os.remove(temppath)
+        if durability == DURABILITY_FSYNC_DIR:
+            fsync_path(os.path.dirname(path))
+
+        reporter = metrics.get_meter('storage_dedup')
+        reporter.increment('bytes_stored', stored)
+        reporter.increment('bytes_deduplicated', deduplicated)
+        logger.info("Stored node %s in %d chunks, %d of %d bytes were "
+                    "already there", node_id, len(entries), deduplicated,
+                    stored + deduplicated)
+
+    def open_content(self, node_id):
+        """Return a file at the stored node's content and its size.
+
+        None if the node is not there. This blocks, out of the reactor.
+        """
+        if self.packs is not None:
+            opened = self.packs.open_content(node_id)
+            if opened is not None:
+                return opened
+
+        manifest = self._find_manifest(node_id)
+        path = self._find(node_id)
+        try:
+            if manifest is not None:
+                fh = self._open_chunked(manifest)
+                return fh, fh.size
+            if path is None:
+                return None
+            fh = open(path, 'rb')
+        except IOError as err:
+            if err.errno != errno.ENOENT:
+                raise
+            return None
+        return fh, os.fstat(fh.fileno()).st_size
+
+    def read(self, node_id):
+        """Return all the content of a stored node (None if not there).
+
+        This blocks, only for small nodes out of the reactor.
+        """
+        opened = self.open_content(node_id)
+        if opened is None:
+            return None
+        fh, size = opened
+        with fh:
+            return fh.read(size)
+
+    def delete(self, node_id, temp=False):
+        """Remove a stored node; return the bytes freed (0 if not there).
+
+        If `temp`, remove the unfinished file of the node instead.
+        """
+        freed = 0
+        if not temp and self.cache is not None:
+            self.cache.discard(node_id)
+        if not temp and self.packs is not None:
+            freed += self.packs.delete(node_id)
+        suffixes = [TEMP_SUFFIX] if temp else ['', CHUNKS_SUFFIX]
+        for volume in self._get_volumes(node_id):
+            for suffix in suffixes:
+                path = volume.get_path(node_id) + suffix
+                try:
+                    size = os.stat(path).st_size
+                    os.remove(path)
+                except OSError as err:
+                    if err.errno != errno.ENOENT:
+                        raise
+                else:
+                    freed += size
+        return freed
+
+    def compact_packs(self, logger):
+        """Compact the pack segments with too much garbage, if the writer.
+
+        Return a deferred with the bytes freed, done in the threadpool.
+        """
+        if self.packs is None:
+            return defer.succeed(0)
+        if self.threadpool is None:
+            return defer.maybeDeferred(self.packs.compact, logger)
+        return threads.deferToThreadPool(
+            reactor, self.threadpool, self.packs.compact, logger)
+
+    def _iter_leaves(self, prefix, after):
+        """Yield the leaf directories under the prefix, in order.
+
+        Each leaf is named by the node id prefix of its files, and is in
+        any of the volumes; only the ones after the given leaf are yielded.
+        """
+        names = set()
+        for volume in self.volumes:
+            path = os.path.join(volume.basedir, *prefix)
+            names.update(entry.name for entry in _scandir(path)
+                         if len(entry.name) == 1 and entry.is_dir())
+        for name in sorted(names):
+            leaf = prefix + name
+            if after is not None and leaf < after[:len(leaf)]:
+                continue
+            if len(leaf) < DIRS_LEVELS:
+                for subleaf in self._iter_leaves(leaf, after):
+                    yield subleaf
+            elif after is None or leaf > after:
+                yield leaf
+
+    def _iter_files(self, volume, leaf, suffix):
+        """Yield (node_id, entry) of the files in the leaf with the suffix."""
+        for entry in _scandir(os.path.join(volume.basedir, *leaf)):
+            if suffix:
+                if entry.name.endswith(suffix):
+                    yield entry.name[:-len(suffix)], entry
+            elif '.' not in entry.name:
+                yield entry.name, entry
+
+    def iter_temp_files(self, after=None):
+        """Yield (leaf, node_id, stat) for the unfinished files.
+
+        The tree is walked in order streaming each directory, so giving
+        the last leaf completed as `after` continues the walk from there.
+        """
+        for leaf in self._iter_leaves('', after):
+            for volume in self.volumes:
+                for node_id, entry in self._iter_files(
+                        volume, leaf, TEMP_SUFFIX):
+                    try:
+                        stat = entry.stat()
+                    except OSError as err:
+                        # finished or removed meanwhile
+                        if err.errno != errno.ENOENT:
+                            raise
+                        continue
+                    yield leaf, node_id, stat
+
+    def _move(self, node_id, source, target):
+        """Move a node between volumes, return the bytes moved.
+
+        The node is copied and made durable in the target before removing
+        it from the source, so it can always be read from one of them.
+        """
+        path = target.get_path(node_id)
+        self._makedirs(os.path.dirname(path))
+        movingpath = path + MOVING_SUFFIX
+        with open(source.get_path(node_id), 'rb') as src:
+            with open(movingpath, 'wb') as dst:
+                shutil.copyfileobj(src, dst, settings.STORAGE_READ_CHUNK_SIZE)
+                size = dst.tell()
+                dst.flush()
+                os.fsync(dst.fileno())
+        os.rename(movingpath, path)
+        os.remove(source.get_path(node_id))
+        return size
+
+    def rebalance(self, logger, max_bytes_per_second=0):
+        """Move the finished nodes to a better placed volume, if any.
+
+        A node is moved only if the volume where it'd be stored now comes
+        before the one it's in, at most `max_bytes_per_second` (if given).
+        Return the bytes moved.
+        """
+        reporter = metrics.get_meter('storage_rebalance')
+        start = time.time()
+        total_files = total_bytes = 0
+        for leaf in self._iter_leaves('', None):
+            for volume in self.volumes:
+                for node_id, _ in self._iter_files(volume, leaf, ''):
+                    volumes = self._get_volumes(node_id)
+                    target = self._get_target(node_id)
+                    if volumes.index(target) >= volumes.index(volume):
+                        continue
+                    try:
+                        total_bytes += self._move(node_id, volume, target)
+                    except (IOError, OSError) as err:
+                        # removed meanwhile, or the target got full
+                        logger.warning("Could not move node %s from %r to "
+                                       "%r: %s", node_id, volume.basedir,
+                                       target.basedir, err)
+                        continue
+                    total_files += 1
+
+                    # keep the moves under the I/O budget
+                    if max_bytes_per_second:
+                        ahead = (total_bytes / float(max_bytes_per_second) -
+                                 (time.time() - start))
+                        if ahead > 0:
+                            time.sleep(ahead)
+
+            if total_files:
+                reporter.gauge('files_moved', total_files)
+
+        logger.info("Moved %d nodes (%d bytes) in %d seconds",
+                    total_files, total_bytes, time.time() - start)
+        reporter.gauge('bytes_moved', total_bytes)
+        return total_bytes
+
+    def _iter_manifests(self):
+        """Yield the (digest, size) entries of all the manifests."""
+        for leaf in self._iter_leaves('', None):
+            for volume in self.volumes:
+                for _, entry in self._iter_files(volume, leaf, CHUNKS_SUFFIX):
+                    try:
+                        entries = read_manifest(entry.path)
+                    except IOError as err:
+                        # removed meanwhile
+                        if err.errno != errno.ENOENT:
+                            raise
+                        continue
+                    for item in entries:
+                        yield item
+
+    def _remove_chunk(self, path, grace_period):
+        """Remove the unused chunk, unless it was touched; tell if removed.
+
+        The chunk is moved away first, so it's not found to be used from
+        then on, and checked again: if it was touched meanwhile (a new node
+        has it) it's put back.
+        """
+        collecting = path + COLLECTING_SUFFIX
+        os.rename(path, collecting)
+        if time.time() - os.stat(collecting).st_mtime > grace_period:
+            os.remove(collecting)
+            return True
+        os.rename(collecting, path)
+        return False
+
+    def collect_chunks(self, logger, grace_period):
+        """Remove the chunks not listed in any manifest.
+
+        The chunks listed are marked in a Bloom filter first (so a few
+        unused ones may be kept until the next time), and then the ones
+        not there and not touched in `grace_period` seconds (as they may
+        be being stored) are removed. The deduplication ratio (the bytes
+        of the chunked nodes over the bytes of their chunks) is reported.
+        Return the bytes freed.
+        """
+        reporter = metrics.get_meter('storage_dedup')
+        start = time.time()
+        used_count = logical_bytes = 0
+        for _, size in self._iter_manifests():
+            used_count += 1
+        used = BloomFilter(max(used_count, 1), 0.001)
+        for digest, size in self._iter_manifests():
+            used.add(digest)
+            logical_bytes += size
+
+        total_chunks = total_bytes = freed_chunks = freed_bytes = 0
+        for leaf in self._iter_leaves('', None):
+            for volume in self.volumes:
+                # the ones left while collecting them are checked again
+                for _, entry in self._iter_files(
+                        volume, leaf, COLLECTING_SUFFIX):
+                    os.rename(entry.path, entry.path[:-len(COLLECTING_SUFFIX)])
+                for name, entry in self._iter_files(volume, leaf, ''):
+                    if not is_chunk_name(name):
+                        continue
+                    try:
+                        stat = entry.stat()
+                        if (binascii.unhexlify(name) not in used and
+                                time.time() - stat.st_mtime > grace_period and
+                                self._remove_chunk(entry.path, grace_period)):
+                            freed_chunks += 1
+                            freed_bytes += stat.st_size
+                            continue
+                    except OSError as err:
+                        if err.errno != errno.ENOENT:
+                            raise
+                        continue
+                    total_chunks += 1
+                    total_bytes += stat.st_size
+
+        ratio = logical_bytes / float(total_bytes) if total_bytes else 1.0
+        logger.info("Removed %d unused chunks (%d bytes) in %d seconds; "
+                    "%d chunks (%d bytes) store %d bytes, dedup ratio %.2f",
+                    freed_chunks, freed_bytes, time.time() - start,
+                    total_chunks, total_bytes, logical_bytes, ratio)
+        reporter.gauge('bytes_freed', freed_bytes)
+        reporter.gauge('chunk_bytes', total_bytes)
+        reporter.gauge('ratio', ratio)
+        return freed_bytes
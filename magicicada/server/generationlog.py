@@ -0,0 +1,224 @@
+# Copyright 2015-2018 Chicharreros (https://launchpad.net/~chicharreros)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# For further info, check  http://launchpad.net/magicicada-server
+
+"""Answer the GET_DELTAs of the volumes from their recent changes.
+
+Most GET_DELTAs ask for a few generations back, by each client of the
+user connected, right after the VOLUME_NEW_GENERATION notification of a
+change. The GenerationLogs keep the last nodes changed in the volumes
+asked for (each one once, as it's now, by generation), and answer the
+deltas they cover from memory.
+
+The notifications of the changes of a user (sent once they are committed)
+leave the logs of the user stale, so the next GET_DELTA of each volume
+takes what changed since from the database, once for all the ones asking
+meanwhile.
+"""
+
+import collections
+import time
+
+from twisted.internet import defer
+
+from magicicada import metrics, settings
+
+
+class GenerationLog(object):
+    """The nodes changed in a volume since a generation.
+
+    The deltas from `start` on are complete up to `generation`.
+    """
+
+    def __init__(self, start):
+        self.start = start
+        self.generation = None
+        self.free_bytes = None
+        self.stale = False
+        self.updated = time.time()
+        # by id, in the order of their generation
+        self.nodes = collections.OrderedDict()
+
+    def add(self, nodes, generation, free_bytes, max_nodes):
+        """Add the nodes changed up to generation, keeping max_nodes."""
+        for node in nodes:
+            self.nodes.pop(node.id, None)
+            self.nodes[node.id] = node
+        while len(self.nodes) > max_nodes:
+            _, node = self.nodes.popitem(last=False)
+            self.start = max(self.start, node.generation)
+        self.generation = generation
+        self.free_bytes = free_bytes
+
+    def delta(self, from_generation, limit):
+        """Return the first limit nodes changed after from_generation."""
+        nodes = []
+        for node_id in reversed(self.nodes):
+            node = self.nodes[node_id]
+            if node.generation <= from_generation:
+                break
+            nodes.append(node)
+        nodes.reverse()
+        return nodes[:limit]
+
+
+class GenerationLogs(object):
+    """The GenerationLogs of up to `max_volumes`, the last ones used.
+
+    Each one keeps up to `max_nodes`, and it's refreshed after `max_age`
+    seconds even if no change was notified.
+    """
+
+    def __init__(self, max_volumes=None, max_nodes=None, max_age=None):
+        if max_volumes is None:
+            max_volumes = settings.GENERATION_LOG_VOLUMES
+        self.max_volumes = max_volumes
+        if max_nodes is None:
+            max_nodes = settings.GENERATION_LOG_MAX_NODES
+        self.max_nodes = max_nodes
+        if max_age is None:
+            max_age = settings.GENERATION_LOG_MAX_AGE
+        self.max_age = max_age
+        # the logs by (user id, volume id), the last used at the end
+        self._logs = collections.OrderedDict()
+        # the keys of the logs of each user
+        self._user_logs = collections.defaultdict(set)
+        # the deferreds waiting for the logs being refreshed
+        self._refreshing = {}
+        self.notifications = 0
+        self.nodes = 0
+        self.metrics = metrics.get_meter('generation_logs')
+
+    def notify(self, user_id):
+        """Something changed for the user, its logs are stale."""
+        self.notifications += 1
+        for key in self._user_logs.get(user_id, ()):
+            self._logs[key].stale = True
+
+    def get_delta(self, user, volume_id, from_generation, limit):
+        """Get the delta of the user's volume, as the DAL's get_delta_nodes.
+
+        Return a deferred with a dict of nodes, vol_generation and
+        free_bytes.
+        """
+        key = (user.id, volume_id)
+        log = self._logs.get(key)
+        if log is None or from_generation < log.start:
+            self.metrics.increment('miss')
+            return self._fetch(user, volume_id, from_generation, limit)
+
+        self._logs[key] = self._logs.pop(key)
+        if (key not in self._refreshing and not log.stale and
+                from_generation <= log.generation and
+                time.time() - log.updated < self.max_age):
+            self.metrics.increment('hit')
+            return defer.succeed(self._get_result(log, from_generation, limit))
+
+        def refreshed(log):
+            """Answer from the log, or the database if it's gone."""
+            if log is None:
+                return self._fetch(user, volume_id, from_generation, limit)
+            return self._get_result(log, from_generation, limit)
+
+        d = defer.Deferred()
+        if key in self._refreshing:
+            self._refreshing[key].append(d)
+        else:
+            self.metrics.increment('refresh')
+            self._refreshing[key] = [d]
+            self._refresh(user, volume_id, log).addBoth(
+                self._refreshed, key)
+        d.addCallback(refreshed)
+        return d
+
+    def _get_result(self, log, from_generation, limit):
+        """Return the delta from the log, as the DAL does."""
+        return dict(nodes=log.delta(from_generation, limit),
+                    vol_generation=log.generation, free_bytes=log.free_bytes)
+
+    def _call(self, user, volume_id, from_generation, limit):
+        """Get the delta from the database."""
+        return user.rpc_dal.call(
+            'get_delta_nodes', user_id=user.id, volume_id=volume_id,
+            from_generation=from_generation, limit=limit)
+
+    @defer.inlineCallbacks
+    def _fetch(self, user, volume_id, from_generation, limit):
+        """Get the delta from the database, keeping it if it's complete."""
+        notifications = self.notifications
+        updated = time.time()
+        r = yield self._call(user, volume_id, from_generation, limit)
+        nodes = r['nodes']
+        if len(nodes) <= self.max_nodes and (limit is None or
+                                             len(nodes) < limit):
+            log = GenerationLog(from_generation)
+            log.add(nodes, r['vol_generation'], r['free_bytes'],
+                    self.max_nodes)
+            log.stale = self.notifications != notifications
+            log.updated = updated
+            self._add((user.id, volume_id), log)
+        defer.returnValue(r)
+
+    @defer.inlineCallbacks
+    def _refresh(self, user, volume_id, log):
+        """Add what changed to the log, or drop it if it's too much."""
+        log.stale = False
+        log.updated = time.time()
+        try:
+            r = yield self._call(user, volume_id, log.generation,
+                                 self.max_nodes + 1)
+        except Exception:
+            log.stale = True
+            raise
+        key = (user.id, volume_id)
+        if self._logs.get(key) is not log:
+            # evicted or replaced meanwhile
+            defer.returnValue(None)
+        if len(r['nodes']) > self.max_nodes:
+            self._remove(key)
+            defer.returnValue(None)
+        self.nodes -= len(log.nodes)
+        log.add(r['nodes'], r['vol_generation'], r['free_bytes'],
+                self.max_nodes)
+        self.nodes += len(log.nodes)
+        self.metrics.gauge('nodes', self.nodes)
+        defer.returnValue(log)
+
+    def _refreshed(self, result, key):
+        """Give the log refreshed to all the waiting."""
+        for d in self._refreshing.pop(key):
+            d.callback(result)
+
+    def _add(self, key, log):
+        """Keep the log, removing the least used if needed."""
+        if key in self._logs:
+            self._remove(key)
+        self._logs[key] = log
+        self._user_logs[key[0]].add(key)
+        self.nodes += len(log.nodes)
+        while len(self._logs) > self.max_volumes:
+            self._remove(next(iter(self._logs)))
+        self.metrics.gauge('volumes', len(self._logs))
+        self.metrics.gauge('nodes', self.nodes)
+
+    def _remove(self, key):
+        """Forget the log."""
+        log = self._logs.pop(key)
+        self.nodes -= len(log.nodes)
+        user_logs = self._user_logs[key[0]]
+        user_logs.discard(key)
+        if not user_logs:
+            del self._user_logs[key[0]]
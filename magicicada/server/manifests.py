@@ -0,0 +1,344 @@
+# Copyright 2015-2018 Chicharreros (https://launchpad.net/~chicharreros)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# For further info, check  http://launchpad.net/magicicada-server
+
+"""Serve the rescans of the volumes without scanning them every time.
+
+A rescan sends all the live nodes of a volume, and when many clients of
+a big volume rescan (after a server restart, for example) the same full
+scan is done again and again. The VolumeManifests keep the live nodes of
+each volume rescanned, at a generation, in a compact file read through a
+memory map, and the rescans are served from it plus the generation delta
+from the database on top (the nodes changed since are skipped from the
+manifest, and the live ones sent after it).
+
+A manifest is built once for all the rescans of the volume meanwhile, and
+kept until it's too old, too many nodes changed since, or to make room
+for the newer ones. The manifests of the small volumes are not kept (it's
+cheaper to scan them again).
+"""
+
+import collections
+import errno
+import itertools
+import logging
+import mmap
+import os
+import struct
+import tempfile
+import time
+import uuid
+
+from twisted.internet import defer, threads
+
+from magicicada import metrics, settings
+from magicicada.filesync.services import DeltaNode
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'MCVM'
+# magic, generation, count
+HEADER = struct.Struct(b'>4sQI')
+# id, parent_id, flags, generation, last_modified, crc32, size, and the
+# lengths of the content hash, path and name (which follow, in utf8)
+RECORD = struct.Struct(b'>16s16sBQqqQBII')
+NO_PARENT = b'\x00' * 16
+IS_FILE = 1
+IS_PUBLIC = 2
+HAS_PARENT = 4
+
+
+def encode_node(node):
+    """Encode the (live) DeltaNode as a record of a manifest."""
+    flags = 0
+    if node.is_file:
+        flags |= IS_FILE
+    if node.is_public:
+        flags |= IS_PUBLIC
+    parent = NO_PARENT
+    if node.parent_id is not None:
+        flags |= HAS_PARENT
+        parent = node.parent_id.bytes
+    content_hash = node.content_hash or b''
+    path = node.path.encode('utf8')
+    name = node.name.encode('utf8')
+    return b''.join([
+        RECORD.pack(node.id.bytes, parent, flags, node.generation,
+                    node.last_modified, node.crc32, node.size,
+                    len(content_hash), len(path), len(name)),
+        content_hash, path, name])
+
+
+def decode_node(data, offset):
+    """Decode the record at the offset; return the DeltaNode and the end."""
+    (node_id, parent, flags, generation, last_modified, crc32, size,
+     hash_len, path_len, name_len) = RECORD.unpack_from(data, offset)
+    offset += RECORD.size
+    content_hash = data[offset:offset + hash_len] or None
+    offset += hash_len
+    path = data[offset:offset + path_len].decode('utf8')
+    offset += path_len
+    name = data[offset:offset + name_len].decode('utf8')
+    offset += name_len
+    node = DeltaNode(
+        id=uuid.UUID(bytes=node_id),
+        parent_id=uuid.UUID(bytes=parent) if flags & HAS_PARENT else None,
+        path=path, name=name, is_file=bool(flags & IS_FILE), is_live=True,
+        generation=generation, is_public=bool(flags & IS_PUBLIC),
+        content_hash=content_hash, crc32=crc32, size=size,
+        last_modified=last_modified)
+    return node, offset
+
+
+class Manifest(object):
+    """The live nodes of a volume at a generation, from a manifest file."""
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as fh:
+            self.data = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.generation, self.count = HEADER.unpack_from(self.data)
+        if magic != MAGIC:
+            raise ValueError("Not a manifest: %r" % (path,))
+        self.size = len(self.data)
+        self.created = time.time()
+
+    def __iter__(self):
+        offset = HEADER.size
+        for _ in xrange(self.count):
+            node, offset = decode_node(self.data, offset)
+            yield node
+
+
+class MemoryManifest(object):
+    """The live nodes of a (small) volume at a generation, not kept."""
+
+    path = None
+    size = 0
+
+    def __init__(self, generation, nodes):
+        self.generation = generation
+        self.nodes = nodes
+        self.count = len(nodes)
+        self.created = time.time()
+
+    def __iter__(self):
+        return iter(self.nodes)
+
+
+class ManifestWriter(object):
+    """Write a manifest file, seen at its path only when committed."""
+
+    def __init__(self, path):
+        self.path = path
+        basedir = os.path.dirname(path)
+        try:
+            os.makedirs(basedir)
+        except OSError as err:
+            if err.errno != errno.EEXIST:
+                raise
+        fd, self.temp_path = tempfile.mkstemp(dir=basedir, suffix='.tmp')
+        self.fh = os.fdopen(fd, 'wb')
+        self.fh.write(HEADER.pack(MAGIC, 0, 0))
+        self.count = 0
+
+    def write(self, nodes):
+        """Add the nodes."""
+        self.fh.write(b''.join(encode_node(node) for node in nodes))
+        self.count += len(nodes)
+
+    def commit(self, generation):
+        """Finish the file, and return its Manifest."""
+        self.fh.seek(0)
+        self.fh.write(HEADER.pack(MAGIC, generation, self.count))
+        self.fh.close()
+        os.rename(self.temp_path, self.path)
+        return Manifest(self.path)
+
+    def abort(self):
+        """Forget the file."""
+        self.fh.close()
+        os.remove(self.temp_path)
+
+
+class VolumeManifests(object):
+    """The manifests of the volumes rescanned, shared by all the rescans.
+
+    They are kept in `basedir` up to `max_age` seconds and `max_size` bytes
+    in total, for the volumes of `min_nodes` live nodes or more, while no
+    more than `max_delta` nodes changed since.
+    """
+
+    suffix = '.manifest'
+
+    def __init__(self, basedir, max_age=None, max_size=None, min_nodes=None,
+                 max_delta=None):
+        self.basedir = basedir
+        if max_age is None:
+            max_age = settings.RESCAN_MANIFEST_MAX_AGE
+        self.max_age = max_age
+        if max_size is None:
+            max_size = settings.RESCAN_MANIFEST_MAX_SIZE
+        self.max_size = max_size
+        if min_nodes is None:
+            min_nodes = settings.RESCAN_MANIFEST_MIN_NODES
+        self.min_nodes = min_nodes
+        if max_delta is None:
+            max_delta = settings.RESCAN_MANIFEST_MAX_DELTA
+        self.max_delta = max_delta
+        self.size = 0
+        # the manifests kept by (user id, volume id), oldest first
+        self._manifests = collections.OrderedDict()
+        # the deferreds waiting for the manifests being built
+        self._building = {}
+        self.metrics = metrics.get_meter('volume_manifests')
+
+    def clean(self):
+        """Remove the manifest files left, as when starting."""
+        try:
+            names = os.listdir(self.basedir)
+        except OSError as err:
+            if err.errno != errno.ENOENT:
+                raise
+            return
+        for name in names:
+            if name.endswith(self.suffix) or name.endswith('.tmp'):
+                os.remove(os.path.join(self.basedir, name))
+
+    @defer.inlineCallbacks
+    def get_nodes(self, user, volume_id):
+        """Get the live nodes of the user's volume from its manifest.
+
+        Return a tuple of (nodes, generation, free_bytes), the nodes in an
+        iterator; or None if too many nodes changed since it was built (so
+        it's built again the next time).
+        """
+        manifest = yield self._get(user, volume_id)
+        r = yield user.rpc_dal.call(
+            'get_delta_nodes', user_id=user.id, volume_id=volume_id,
+            from_generation=manifest.generation, limit=self.max_delta + 1)
+        delta = r['nodes']
+        if len(delta) > self.max_delta:
+            self.metrics.increment('outdated')
+            self.discard((user.id, volume_id), manifest)
+            defer.returnValue(None)
+        changed = set(node.id for node in delta)
+        nodes = itertools.chain(
+            (node for node in manifest if node.id not in changed),
+            (node for node in delta if node.is_live))
+        defer.returnValue((nodes, r['vol_generation'], r['free_bytes']))
+
+    def _get(self, user, volume_id):
+        """Get the manifest of the volume, building it if needed."""
+        key = (user.id, volume_id)
+        manifest = self._manifests.get(key)
+        if manifest is not None:
+            if time.time() - manifest.created < self.max_age:
+                self.metrics.increment('hit')
+                return defer.succeed(manifest)
+            self.discard(key, manifest)
+
+        d = defer.Deferred()
+        if key in self._building:
+            self._building[key].append(d)
+        else:
+            self.metrics.increment('miss')
+            self._building[key] = [d]
+            self._build(user, volume_id).addBoth(self._built, key)
+        return d
+
+    def _built(self, result, key):
+        """Keep the manifest built, and give it to all the waiting."""
+        if isinstance(result, Manifest):
+            self._add(key, result)
+        for d in self._building.pop(key):
+            d.callback(result)
+
+    @defer.inlineCallbacks
+    def _build(self, user, volume_id):
+        """Build the manifest of the volume.
+
+        The nodes are written while fetched once there are min_nodes.
+        """
+        start = time.time()
+        stream = user.stream_from_scratch(volume_id)
+        nodes = []
+        writer = None
+        try:
+            while True:
+                page = stream.get()
+                if page is None:
+                    if stream.finished:
+                        break
+                    d = defer.Deferred()
+                    stream.waiter = lambda: d.callback(None)
+                    yield d
+                    continue
+                if writer is not None:
+                    yield threads.deferToThread(writer.write, page)
+                    continue
+                nodes.extend(page)
+                if len(nodes) >= self.min_nodes:
+                    name = '%s-%s-%d%s' % (user.id, volume_id or 'root',
+                                           stream.generation, self.suffix)
+                    writer = yield threads.deferToThread(
+                        ManifestWriter, os.path.join(self.basedir, name))
+                    yield threads.deferToThread(writer.write, nodes)
+                    nodes = None
+            if stream.failure is not None:
+                stream.failure.raiseException()
+            if writer is None:
+                manifest = MemoryManifest(stream.generation, nodes)
+            else:
+                manifest = yield threads.deferToThread(
+                    writer.commit, stream.generation)
+        except Exception:
+            stream.stop()
+            if writer is not None:
+                writer.abort()
+            raise
+        if manifest.path is not None:
+            logger.info("Built the manifest of volume %s (user %s) with %d "
+                        "nodes in %.1f seconds", volume_id, user.id,
+                        manifest.count, time.time() - start)
+        defer.returnValue(manifest)
+
+    def _add(self, key, manifest):
+        """Keep the manifest, removing the old ones if needed."""
+        self._manifests[key] = manifest
+        self.size += manifest.size
+        now = time.time()
+        for old_key, old in self._manifests.items():
+            if (now - old.created < self.max_age and
+                    self.size <= self.max_size):
+                break
+            if old is not manifest:
+                self.discard(old_key, old)
+        self.metrics.gauge('size', self.size)
+
+    def discard(self, key, manifest):
+        """Remove the manifest, if it's still the one of the volume."""
+        if self._manifests.get(key) is not manifest:
+            return
+        del self._manifests[key]
+        self.size -= manifest.size
+        self.metrics.gauge('size', self.size)
+        # who's still reading it keeps the memory map
+        try:
+            os.remove(manifest.path)
+        except OSError as err:
+            if err.errno != errno.ENOENT:
+                raise
@@ -0,0 +1,708 @@
+# Copyright 2008-2015 Canonical
+# Copyright 2015-2018 Chicharreros (https://launchpad.net/~chicharreros)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# For further info, check  http://launchpad.net/magicicada-server
+
+"""Store the small nodes appended in big segment files.
+
+Having one file per node wastes a block and an inode for each of the many
+small ones, so those are appended one after the other (each with a header
+of its id's md5 and size) in segment files, and found through an index.
+
+While a segment is being appended to, its index is a journal of entries in
+the order they were written, also kept in memory. When the segment gets
+full it's sealed: its entries are written sorted in a run, a file that is
+memory-mapped to binary search in it. Runs are merged as they pile up so
+there are only a few of them, each at least twice as big as the next (and
+newer) one, and a node is looked for in them newest first.
+
+The removed nodes are recorded in the dead journal, and the space they
+waste is reclaimed compacting the segments: appending the live nodes of
+the ones with too much garbage to the current segment, and removing them.
+"""
+
+from __future__ import unicode_literals
+
+import collections
+import contextlib
+import errno
+import fcntl
+import hashlib
+import heapq
+import mmap
+import os
+import re
+import struct
+import threading
+
+from twisted.internet import defer, reactor, threads
+
+from magicicada import metrics, settings
+from magicicada.server import errors
+
+
+# an index (and dead journal) entry: the md5 of the node id, and the
+# segment, offset and size of its content
+ENTRY = struct.Struct(b'>16sIQI')
+
+# what precedes the content of each node in a segment: the md5 of its id
+# and its size
+HEADER = struct.Struct(b'>16sI')
+
+SEGMENT_RE = re.compile(r'^(\d{8})\.pack$')
+JOURNAL_RE = re.compile(r'^(\d{8})\.journal$')
+RUN_RE = re.compile(r'^run-(\d{8})\.idx$')
+DEAD_JOURNAL = 'dead.journal'
+DEAD_LOCK = 'dead.lock'
+WRITER_LOCK = 'writer.lock'
+
+Location = collections.namedtuple('Location', 'segment offset size')
+
+
+def get_digest(node_id):
+    """Return the digest that identifies the node in the index."""
+    return hashlib.md5(node_id).digest()
+
+
+def _fsync_dir(path):
+    """Flush the directory to disk."""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _remove(path):
+    """Remove the file, if there."""
+    try:
+        os.remove(path)
+    except OSError as err:
+        if err.errno != errno.ENOENT:
+            raise
+
+
+def _write_entries(path, entries, fsync):
+    """Write the entries to a new file in the path, atomically."""
+    temppath = path + '.temp'
+    with open(temppath, 'wb') as fh:
+        for entry in entries:
+            fh.write(ENTRY.pack(*entry))
+        fh.flush()
+        if fsync:
+            os.fsync(fh.fileno())
+    os.rename(temppath, path)
+    if fsync:
+        _fsync_dir(os.path.dirname(path))
+
+
+def _unpack_entries(data):
+    """Return the entries in the data, skipping an incomplete last one."""
+    count = len(data) // ENTRY.size
+    return [ENTRY.unpack_from(data, i * ENTRY.size) for i in xrange(count)]
+
+
+def _read_entries(path):
+    """Return the entries of a journal, skipping an incomplete last one."""
+    with open(path, 'rb') as fh:
+        return _unpack_entries(fh.read())
+
+
+class IndexRun(object):
+    """A file of index entries sorted by digest and segment, memory-mapped.
+
+    The same node may be in many segments (if it was moved compacting),
+    the newest one is in the biggest segment.
+    """
+
+    def __init__(self, path, seq):
+        self.path = path
+        self.seq = seq
+        size = os.path.getsize(path)
+        self.count = size // ENTRY.size
+        self._map = None
+        if self.count:
+            with open(path, 'rb') as fh:
+                self._map = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __repr__(self):
+        return '<IndexRun %s (%d entries)>' % (self.path, self.count)
+
+    def __iter__(self):
+        for i in xrange(self.count):
+            yield ENTRY.unpack_from(self._map, i * ENTRY.size)
+
+    def _digest_at(self, i):
+        """Return the digest of the i-th entry."""
+        pos = i * ENTRY.size
+        return self._map[pos:pos + 16]
+
+    def find(self, digest):
+        """Return the newest location of the digest, None if not here."""
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self._digest_at(middle) < digest:
+                low = middle + 1
+            else:
+                high = middle
+        found = None
+        while low < self.count and self._digest_at(low) == digest:
+            found = ENTRY.unpack_from(self._map, low * ENTRY.size)
+            low += 1
+        if found is not None:
+            return Location(*found[1:])
+
+    def close(self):
+        """Unmap the file."""
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+
+
+class PackStorage(object):
+    """Store small nodes appended in segments of `segment_size` bytes.
+
+    Only one process appends to the segments (and compacts them): the first
+    one that needs to, holding a lock while it runs. The others just load
+    the index to find the nodes, reading what was appended to the journal
+    since then when a node is not found (or loading it again if the writer
+    moved to other segment, or a segment they read was compacted
+    meanwhile), and record the nodes they remove in the dead journal
+    (which the writer loads again before compacting).
+
+    The appends are done by one thread at a time (they may block on disk,
+    so better out of the reactor) while the nodes are looked for from any
+    thread; both are serialized by different locks.
+
+    If `fsync`, every change is flushed to disk (the files, and their
+    directory when they are created) before returning.
+    """
+
+    def __init__(self, packdir, segment_size=None, fsync=False):
+        if segment_size is None:
+            segment_size = settings.STORAGE_PACK_SEGMENT_SIZE
+        self.packdir = packdir
+        self.segment_size = segment_size
+        self.fsync = fsync
+        try:
+            os.makedirs(self.packdir)
+        except OSError as err:
+            if err.errno != errno.EEXIST:
+                raise
+
+        # the index, serialized by _lock
+        self._lock = threading.Lock()
+        self._runs = []  # newest first
+        self._active_index = {}
+        self._dead = {}  # (digest, segment): location
+        self._garbage = collections.Counter()  # bytes per segment
+        self._segments = set()
+        # for the readers, the inode and bytes read of each journal
+        self._journals = {}
+
+        # the segment being appended to, serialized by _append_lock
+        self._append_lock = threading.Lock()
+        self._writer_fh = None
+        self._active = None
+        self._active_size = 0
+        self._active_fh = None
+        self._journal_fh = None
+
+        with self._append_lock:
+            self._load()
+
+    @property
+    def writable(self):
+        """If this is the process appending to the segments."""
+        return self._writer_fh is not None
+
+    def get_path(self, segment):
+        """Return the path of the segment."""
+        return os.path.join(self.packdir, '%08d.pack' % segment)
+
+    def _get_journal_path(self, segment):
+        """Return the path of the journal of the segment."""
+        return os.path.join(self.packdir, '%08d.journal' % segment)
+
+    def _get_run_path(self, seq):
+        """Return the path of the index run."""
+        return os.path.join(self.packdir, 'run-%08d.idx' % seq)
+
+    @contextlib.contextmanager
+    def _locked(self, name):
+        """Hold the lock of the given name between processes."""
+        with open(os.path.join(self.packdir, name), 'ab') as fh:
+            fcntl.flock(fh.fileno(), fcntl.LOCK_EX)
+            yield
+
+    def acquire(self):
+        """Become the writer of the segments, if possible; tell if it is."""
+        if self._writer_fh is not None:
+            return True
+        with self._append_lock:
+            if self._writer_fh is not None:
+                return True
+            fh = open(os.path.join(self.packdir, WRITER_LOCK), 'ab')
+            try:
+                fcntl.flock(fh.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError as err:
+                fh.close()
+                if err.errno not in (errno.EAGAIN, errno.EACCES):
+                    raise
+                return False
+            self._writer_fh = fh
+            self._reload()
+        return True
+
+    def _reload(self):
+        """Load the index again.
+
+        This must be called holding the append lock.
+        """
+        with self._lock:
+            runs, self._runs = self._runs, []
+            self._active_index = {}
+            self._segments = set()
+        for run in runs:
+            run.close()
+        for fh in (self._active_fh, self._journal_fh):
+            if fh is not None:
+                fh.close()
+        self._active = self._active_fh = self._journal_fh = None
+        self._journals = {}
+        self._load()
+
+    def _load(self):
+        """Load the index.
+
+        The writer also recovers from an interrupted seal or append, and
+        opens the segment to append to.
+        """
+        segments, journals, runs = set(), set(), []
+        for name in os.listdir(self.packdir):
+            match = SEGMENT_RE.match(name)
+            if match:
+                segments.add(int(match.group(1)))
+            match = JOURNAL_RE.match(name)
+            if match:
+                journals.add(int(match.group(1)))
+            match = RUN_RE.match(name)
+            if match:
+                seq = int(match.group(1))
+                runs.append(IndexRun(self._get_run_path(seq), seq))
+        runs.sort(key=lambda run: run.seq, reverse=True)
+        sealed = set(run.seq for run in runs)
+
+        # the segments with a journal were not sealed yet (unless their run
+        # was written); only the last one is kept open to append to it
+        unsealed = sorted(journals - sealed)
+        index = {}
+        journals_read = {}
+        for segment in unsealed:
+            path = self.get_path(segment)
+            size = os.path.getsize(path) if os.path.exists(path) else 0
+            journal_path = self._get_journal_path(segment)
+            try:
+                with open(journal_path, 'rb') as fh:
+                    inode = os.fstat(fh.fileno()).st_ino
+                    data = fh.read()
+            except IOError as err:
+                # the writer sealed it meanwhile, found in the next load
+                if err.errno != errno.ENOENT or self.writable:
+                    raise
+                continue
+            entries = _unpack_entries(data)
+            journals_read[segment] = (inode, len(entries) * ENTRY.size)
+            # an entry may point beyond the content that got to disk
+            entries = [entry for entry in entries
+                       if entry[2] + entry[3] <= size]
+            index.update(
+                (entry[0], Location(*entry[1:])) for entry in entries)
+            if self.writable:
+                self._active_index = index
+                index = {}
+                self._open_segment(segment, entries)
+                if segment != unsealed[-1]:
+                    self._seal()
+
+        with self._lock:
+            self._runs[:0] = runs
+            self._segments.update(segments | journals)
+            if not self.writable:
+                self._active_index = index
+                self._journals = journals_read
+        self._load_dead()
+
+        if self.writable:
+            for segment in journals & sealed:
+                _remove(self._get_journal_path(segment))
+            if self._active is None:
+                self._open_segment(max(segments | journals | sealed or
+                                       [-1]) + 1)
+
+    def _load_dead(self):
+        """Load the dead journal."""
+        dead = {}
+        garbage = collections.Counter()
+        with self._locked(DEAD_LOCK):
+            path = os.path.join(self.packdir, DEAD_JOURNAL)
+            entries = _read_entries(path) if os.path.exists(path) else []
+        for entry in entries:
+            location = Location(*entry[1:])
+            dead[entry[0], location.segment] = location
+            garbage[location.segment] += location.size
+        with self._lock:
+            self._dead = dead
+            self._garbage = garbage
+
+    def _open_segment(self, segment, entries=()):
+        """Start appending to the segment, rewriting its journal."""
+        self._active = segment
+        path = self._get_journal_path(segment)
+        _write_entries(path, entries, self.fsync)
+        self._journal_fh = open(path, 'ab')
+        self._active_fh = open(self.get_path(segment), 'ab')
+        self._active_size = os.fstat(self._active_fh.fileno()).st_size
+        if self.fsync:
+            _fsync_dir(self.packdir)
+        with self._lock:
+            self._segments.add(segment)
+
+    def _flush(self, fh):
+        """Flush the file, to disk if durable."""
+        fh.flush()
+        if self.fsync:
+            os.fsync(fh.fileno())
+
+    def _locate(self, digest):
+        """Return the newest location of the digest, dead or alive.
+
+        This must be called holding the index lock.
+        """
+        location = self._active_index.get(digest)
+        if location is None:
+            for run in self._runs:
+                location = run.find(digest)
+                if location is not None:
+                    break
+        return location
+
+    def _refresh(self):
+        """Index what the writer appended since the index was loaded.
+
+        The new entries of the journals are read, unless the writer sealed
+        a segment or started again: then all the index is loaded again.
+        This must be called holding the append lock, only by the readers.
+        """
+        newest = max(self._journals or self._segments or [-1])
+        if os.path.exists(self._get_journal_path(newest + 1)):
+            self._reload()
+            return
+        for segment, (inode, read) in sorted(self._journals.items()):
+            data = None
+            try:
+                with open(self._get_journal_path(segment), 'rb') as fh:
+                    if os.fstat(fh.fileno()).st_ino == inode:
+                        fh.seek(read)
+                        data = fh.read()
+            except IOError as err:
+                if err.errno != errno.ENOENT:
+                    raise
+            if data is None:
+                # sealed, or rewritten by a new writer
+                self._reload()
+                return
+            entries = _unpack_entries(data)
+            if not entries:
+                continue
+            self._journals[segment] = (inode, read + len(entries) * ENTRY.size)
+            with self._lock:
+                self._active_index.update(
+                    (entry[0], Location(*entry[1:])) for entry in entries)
+
+    def _lookup(self, digest):
+        """Return the location of the live content, None if not indexed."""
+        with self._lock:
+            location = self._locate(digest)
+            if (location is None or location.segment not in self._segments or
+                    (digest, location.segment) in self._dead):
+                return None
+            return location
+
+    def lookup(self, node_id, refresh=True):
+        """Return the location of the node's content, None if not here.
+
+        A reader not finding it looks for what the writer appended since,
+        if `refresh` (which blocks; else only the loaded index is used).
+        """
+        digest = get_digest(node_id)
+        location = self._lookup(digest)
+        if location is None and refresh and not self.writable:
+            with self._append_lock:
+                self._refresh()
+            location = self._lookup(digest)
+        return location
+
+    def open_content(self, node_id):
+        """Return a file at the node's content and its size, None if not here.
+
+        If its segment was compacted meanwhile, look for it again.
+        """
+        for attempt in range(2):
+            location = self.lookup(node_id)
+            if location is None:
+                return None
+            try:
+                fh = open(self.get_path(location.segment), 'rb')
+            except IOError as err:
+                if err.errno != errno.ENOENT or attempt:
+                    raise
+            else:
+                fh.seek(location.offset)
+                return fh, location.size
+            if not self.writable:
+                with self._append_lock:
+                    self._reload()
+
+    def read(self, node_id):
+        """Return the content of the node, None if not here."""
+        opened = self.open_content(node_id)
+        if opened is None:
+            return None
+        fh, size = opened
+        with fh:
+            return fh.read(size)
+
+    def append(self, node_id, data):
+        """Store the node's content, blocking; only for the writer."""
+        with self._append_lock:
+            if not self.writable:
+                raise RuntimeError("Not the writer of %s." % self.packdir)
+            self._append(get_digest(node_id), data)
+
+    def _append(self, digest, data):
+        """Append the content to the active segment, and index it."""
+        offset = self._active_size + HEADER.size
+        self._active_fh.write(HEADER.pack(digest, len(data)))
+        self._active_fh.write(data)
+        self._flush(self._active_fh)
+        location = Location(self._active, offset, len(data))
+        self._journal_fh.write(ENTRY.pack(digest, *location))
+        self._flush(self._journal_fh)
+        self._active_size = offset + len(data)
+        with self._lock:
+            self._active_index[digest] = location
+        if self._active_size >= self.segment_size:
+            self._seal()
+            self._open_segment(self._active + 1)
+
+    def _seal(self):
+        """Write the run of the active segment, and stop appending to it."""
+        segment = self._active
+        entries = sorted((digest,) + location for digest, location
+                         in self._active_index.iteritems())
+        path = self._get_run_path(segment)
+        _write_entries(path, entries, self.fsync)
+        run = IndexRun(path, segment)
+        with self._lock:
+            self._runs.insert(0, run)
+            self._active_index = {}
+        self._active_fh.close()
+        self._journal_fh.close()
+        _remove(self._get_journal_path(segment))
+
+        # merge the runs while the newest one is not small enough
+        while (len(self._runs) > 1 and
+               self._runs[0].count * 2 > self._runs[1].count):
+            self._merge_runs()
+
+    def _merge_runs(self):
+        """Merge the two newest runs into one, keeping the newest name.
+
+        The entries of removed segments are dropped.
+        """
+        newer, older = self._runs[:2]
+        entries = (entry for entry in heapq.merge(newer, older)
+                   if entry[1] in self._segments)
+        _write_entries(newer.path, entries, self.fsync)
+        run = IndexRun(newer.path, newer.seq)
+        with self._lock:
+            self._runs[:2] = [run]
+        newer.close()
+        older.close()
+        _remove(older.path)
+
+    def delete(self, node_id):
+        """Remove the stored node; return its size (0 if not there)."""
+        digest = get_digest(node_id)
+        location = self.lookup(node_id)
+        if location is None:
+            return 0
+        with self._locked(DEAD_LOCK):
+            path = os.path.join(self.packdir, DEAD_JOURNAL)
+            with open(path, 'ab') as fh:
+                fh.write(ENTRY.pack(digest, *location))
+                self._flush(fh)
+        with self._lock:
+            self._dead[digest, location.segment] = location
+            self._garbage[location.segment] += location.size
+        return location.size
+
+    def get_garbage_ratios(self):
+        """Return the part of garbage of each sealed segment."""
+        with self._lock:
+            segments = self._segments - set([self._active])
+            garbage = self._garbage.copy()
+        ratios = {}
+        for segment in segments:
+            size = os.path.getsize(self.get_path(segment))
+            ratios[segment] = garbage[segment] / float(size or 1)
+        return ratios
+
+    def compact(self, logger, garbage_ratio=None):
+        """Rewrite the segments with too much garbage; return bytes freed.
+
+        The live nodes of those segments are appended to the active one,
+        and then they are removed; if interrupted, the nodes are already
+        found in their new place so they are not moved again. Nothing is
+        done if other process is the writer.
+        """
+        if garbage_ratio is None:
+            garbage_ratio = settings.STORAGE_PACK_GARBAGE_RATIO
+        if not self.acquire():
+            return 0
+        # get the nodes other processes removed
+        self._load_dead()
+
+        meter = metrics.get_meter('pack_compactor')
+        ratios = self.get_garbage_ratios()
+        freed = 0
+        for segment in sorted(ratios):
+            if ratios[segment] < garbage_ratio:
+                continue
+            size = os.path.getsize(self.get_path(segment))
+            moved = self._compact_segment(segment)
+            freed += size - moved
+            meter.gauge('moved', moved)
+            meter.gauge('freed', size - moved)
+            logger.info("Compacted segment %d (%d%% garbage): %d bytes moved, "
+                        "%d freed", segment, ratios[segment] * 100, moved,
+                        size - moved)
+        return freed
+
+    def _compact_segment(self, segment):
+        """Move the live nodes out of the segment, and remove it."""
+        moved = 0
+        with open(self.get_path(segment), 'rb') as fh:
+            while True:
+                header = fh.read(HEADER.size)
+                if len(header) < HEADER.size:
+                    break
+                digest, size = HEADER.unpack(header)
+                location = Location(segment, fh.tell(), size)
+                with self._append_lock:
+                    if self._is_current(digest, location):
+                        data = fh.read(size)
+                        if len(data) < size:
+                            break
+                        self._append(digest, data)
+                        moved += size
+                fh.seek(location.offset + size)
+
+        with self._append_lock:
+            with self._lock:
+                self._segments.discard(segment)
+            _remove(self.get_path(segment))
+            # forget the removed nodes of the segment
+            with self._locked(DEAD_LOCK):
+                path = os.path.join(self.packdir, DEAD_JOURNAL)
+                entries = _read_entries(path) if os.path.exists(path) else []
+                _write_entries(
+                    path, [entry for entry in entries if entry[1] != segment],
+                    self.fsync)
+            with self._lock:
+                for key in [key for key in self._dead if key[1] == segment]:
+                    del self._dead[key]
+                self._garbage.pop(segment, None)
+        return moved
+
+    def _is_current(self, digest, location):
+        """Tell if the location is where the node is found now."""
+        with self._lock:
+            return (self._locate(digest) == location and
+                    (digest, location.segment) not in self._dead)
+
+    def close(self):
+        """Close all the files, stopping being the writer."""
+        with self._append_lock:
+            for fh in (self._active_fh, self._journal_fh, self._writer_fh):
+                if fh is not None:
+                    fh.close()
+            self._active_fh = self._journal_fh = self._writer_fh = None
+            with self._lock:
+                for run in self._runs:
+                    run.close()
+                self._runs = []
+
+
+class PackWriterConsumer(object):
+    """A consumer that keeps the content to append it to a pack on commit.
+
+    The append is done in the threadpool, if given. If a `size` is given
+    the content kept is bounded by it: once more than that is written the
+    content is dropped and the upload fails.
+    """
+
+    def __init__(self, packs, node_id, threadpool=None, size=None):
+        self.packs = packs
+        self.node_id = node_id
+        self.threadpool = threadpool
+        self.size = size
+        self.producer = None
+        self._received = 0
+        self._data = []
+
+    def registerProducer(self, producer, streaming):
+        self.producer = producer
+        assert streaming
+
+    def unregisterProducer(self):
+        self.producer = None
+
+    def write(self, data):
+        self._received += len(data)
+        if self.size is not None and self._received > self.size:
+            self._data = []
+            raise errors.UploadCorrupt(
+                "Received more than the %d bytes expected." % (self.size,))
+        self._data.append(data)
+
+    def commit(self):
+        """Append the content to the pack.
+
+        Return a deferred triggered when it's there, and as durable as the
+        pack is.
+        """
+        if self.size is not None and self._received > self.size:
+            return defer.fail(errors.UploadCorrupt(
+                "Received more than the %d bytes expected." % (self.size,)))
+        data = b''.join(self._data)
+        self._data = []
+        if self.threadpool is None:
+            return defer.maybeDeferred(self.packs.append, self.node_id, data)
+        return threads.deferToThreadPool(
+            reactor, self.threadpool, self.packs.append, self.node_id, data)
@@ -28,6 +28,7 @@ import inspect
 import logging
 import os
 import re
+import struct
 import sys
 import time
 import urllib
@@ -42,10 +43,10 @@ import twisted.web.error
 
 from magicicadaprotocol import protocol_pb2, request, sharersp
 from twisted.application.service import MultiService, Service
-from twisted.application.internet import TCPServer
+from twisted.application.internet import TCPServer, TimerService
 from twisted.internet.defer import maybeDeferred, inlineCallbacks
 from twisted.internet.protocol import Factory
-from twisted.internet import defer, reactor, error, task, stdio
+from twisted.internet import defer, reactor, error, stdio
 from twisted.python.failure import Failure
 from ubuntuone.supervisor import utils as supervisor_utils
 
@@ -54,7 +55,7 @@ from magicicada.filesync import errors as dataerror
 from magicicada.filesync.notifier import notifier
 from magicicada.monitoring.reactor import ReactorInspector
 from magicicada.rpcdb import inthread
-from magicicada.server import auth, content, errors, stats
+from magicicada.server import auth, bandwidth, content, errors, stats
 from magicicada.server.diskstorage import DiskStorage
 
 
@@ -274,6 +275,8 @@ class StorageServer(request.RequestHandler):
         self.shutting_down = False
         self.request_locked = False
         self.pending_requests = collections.deque()
+        self.running_readonly = set()
+        self._scheduled_times = {}
         self.ping_loop = LoopingPing(StorageServer.PING_INTERVAL,
                                      StorageServer.PING_TIMEOUT,
                                      settings.IDLE_TIMEOUT, self)
@@ -284,11 +287,37 @@ class StorageServer(request.RequestHandler):
         self.waiting_on_poison = []
         self.connection_time = None
         self._metadata_count = set()
+        # the reading is paused by the uploads (to not take more than what
+        # can be hashed, or the bandwidth limits)
+        self.reading = bandwidth.PausableReading(self)
+        self._buckets = {}
+        self._upload_throttle = None
 
     def set_user(self, user):
         """Set user and adjust values that depend on which user it is."""
         self.user = user
 
+    def get_bucket(self, direction):
+        """The bandwidth bucket of the connection in the direction."""
+        bucket = self._buckets.get(direction)
+        if bucket is None:
+            limits = self.factory.bandwidth
+            bucket = bandwidth.TokenBucket(
+                limits, bandwidth.CONNECTION, direction,
+                parent=self.user.get_bucket(limits, direction))
+            self._buckets[direction] = bucket
+        return bucket
+
+    def throttle_upload(self, size):
+        """Pause the reading while the uploads are over the limits."""
+        if self._upload_throttle is None:
+            if not self.factory.bandwidth.limited(bandwidth.UPLOAD):
+                return
+            self._upload_throttle = bandwidth.Throttle(
+                self.get_bucket(bandwidth.UPLOAD),
+                self.reading.pauseProducing, self.reading.resumeProducing)
+        self._upload_throttle.consume(size)
+
     def poison(self, tag):
         """Inject a failure in the server. Works with check_poison."""
         self.poisoned.append(tag)
@@ -327,35 +356,88 @@ class StorageServer(request.RequestHandler):
 
     def schedule_request(self, request, callback, head=False):
         """Schedule this request to run."""
+        entry = (request, callback)
         if head:
-            self.pending_requests.appendleft((request, callback))
+            self.pending_requests.appendleft(entry)
         else:
-            self.pending_requests.append((request, callback))
+            self.pending_requests.append(entry)
+        self._scheduled_times[id(entry)] = time.time()
         # we do care if it fails, means no one handled the failure before
         if not isinstance(request, Action):
             request.deferred.addErrback(self._log_error, request.__class__)
-        if not self.request_locked:
+        self._execute_pending()
+
+    def _can_execute(self, request):
+        """Tell if the request can run with the ones already running.
+
+        The read-only requests run together (up to a limit), and the others
+        alone; as the queue is run in order, no request passes another.
+        """
+        if self.request_locked:
+            return False
+        if getattr(request, 'readonly', False):
+            return (len(self.running_readonly) <
+                    settings.MAX_READONLY_REQUESTS)
+        return not self.running_readonly
+
+    def _execute_pending(self):
+        """Execute the next request, if it can run now."""
+        if (self.pending_requests and
+                self._can_execute(self.pending_requests[0][0])):
             self.execute_next_request()
 
     def release(self, request):
         """Request 'request' finished, others may start."""
-        if self.request_locked is not request:
+        if self.request_locked is request:
+            self.request_locked = False
+        elif request in self.running_readonly:
+            self.running_readonly.remove(request)
+        else:
             # a release from someone not holding the lock does nothing
             return
 
-        self.request_locked = False
         if self.pending_requests and not self.shutting_down:
-            self.execute_next_request()
+            self._execute_pending()
 
     def execute_next_request(self):
         """Read the queue and execute a request."""
-        request, callback = self.pending_requests.popleft()
+        entry = self.pending_requests.popleft()
+        request, callback = entry
+        scheduled = self._scheduled_times.pop(id(entry), None)
+        if scheduled is not None:
+            self.factory.metrics.timing(
+                'request_queue_wait', time.time() - scheduled)
+        readonly = getattr(request, 'readonly', False)
         try:
-            self.request_locked = request
+            if readonly:
+                self.running_readonly.add(request)
+            else:
+                self.request_locked = request
             callback()
         except Exception as e:
             self._log_error(e, request.__class__, exc_info=sys.exc_info())
             self.release(request)
+        else:
+            if readonly and not self.shutting_down:
+                # the next ones may run with this one
+                self._execute_pending()
+
+    def send_broadcast(self, message, body):
+        """Send the message serialized without its id as a new request.
+
+        The id is the first field of the message, so the body (serialized
+        once for all the connections it's sent to) goes after the new one.
+        """
+        request_id = self.get_new_request_id()
+        prefix = _ID_TAG + _varint(request_id)
+        self.writeSequence([
+            struct.pack(request.SIZE_FMT, len(prefix) + len(body)) + prefix,
+            body])
+        if logger.isEnabledFor(settings.TRACE):
+            traced = protocol_pb2.Message()
+            traced.CopyFrom(message)
+            traced.id = request_id
+            self.log.trace_message('NOTIFICATION:', traced)
 
     def connectionLost(self, reason=None):
         """Unregister this connection and potentially remove user binding."""
@@ -384,8 +466,11 @@ class StorageServer(request.RequestHandler):
         self.log.debug('Shutdown Request')
         self.shutting_down = True
         self.ping_loop.stop()
+        if self._upload_throttle is not None:
+            self._upload_throttle.stop()
         self.transport.loseConnection()
         self.pending_requests.clear()
+        self._scheduled_times.clear()
 
         # stop all the pending requests
         for req in self.requests.values():
@@ -611,6 +696,10 @@ class BaseRequestResponse(request.RequestResponse):
 
     __slots__ = ('use_protocol_weakref', '_protocol_ref')
 
+    # the read-only requests run at the same time as the other read-only
+    # ones of the connection, the rest one at a time
+    readonly = False
+
     def __init__(self, protocol, message):
         """Create the request response."""
         self.use_protocol_weakref = settings.PROTOCOL_WEAKREF
@@ -884,6 +973,7 @@ class SimpleRequestResponse(StorageServerRequestResponse):
     try_again_errors = [
         dataerror.RetryLimitReached,
         error.TCPTimedOutError,
+        inthread.Overloaded,
     ]
 
     auth_required_error = 'Authentication required and the user is None.'
@@ -984,6 +1074,8 @@ class ListShares(SimpleRequestResponse):
 
     __slots__ = ()
 
+    readonly = True
+
     @inlineCallbacks
     def _process(self):
         """List shares for the client."""
@@ -1209,6 +1301,8 @@ class ListVolumes(SimpleRequestResponse):
 
     __slots__ = ()
 
+    readonly = True
+
     @inlineCallbacks
     def _process(self):
         """List volumes for the client."""
@@ -1303,6 +1397,8 @@ class ListPublicFiles(SimpleRequestResponse):
 
     __slots__ = ()
 
+    readonly = True
+
     @inlineCallbacks
     def _process(self):
         """List public files for the client."""
@@ -1366,27 +1462,84 @@ class ChangePublicAccess(SimpleRequestResponse):
                 share_id, node_id, is_public, public_url))
 
 
+def _varint(value):
+    """Encode the value as a protocol buffers varint."""
+    result = []
+    while value > 0x7f:
+        result.append(chr(value & 0x7f | 0x80))
+        value >>= 7
+    result.append(chr(value))
+    return ''.join(result)
+
+
+def _field_prefix(descriptor, name, length):
+    """Encode the tag and length of a length-delimited field."""
+    number = descriptor.fields_by_name[name].number
+    return _varint(number << 3 | 2) + _varint(length)
+
+
+# the tag of the (varint) id of the messages, their first field
+_ID_TAG = _varint(
+    protocol_pb2.Message.DESCRIPTOR.fields_by_name['id'].number << 3)
+
+
 class BytesMessageProducer(object):
-    """Adapt a bytes producer to produce BYTES messages."""
+    """Adapt a bytes producer to produce BYTES messages.
+
+    The messages are not built one by one: as they only differ in their
+    payload, all that goes before it (the size of the message, and the
+    message with the request id and type, up to the payload field) is
+    encoded once per payload length, and the frames of all the content
+    written are sent together to the transport.
+
+    The bytes producer is paused by the transport, and while the download
+    is over the bandwidth limits (see server.bandwidth).
+    """
 
     payload_size = request.MAX_PAYLOAD_SIZE
 
     def __init__(self, bytes_producer, request):
         self.producer = bytes_producer
         self.request = request
+        self._headers = {}
+        # paused by the transport, or by the bandwidth limits
+        self.paused = False
+        self.throttle = None
         bytes_producer.startProducing(self)
 
+    def _get_header(self, length):
+        """Return what goes before a payload of the given length."""
+        header = self._headers.get(length)
+        if header is None:
+            message = protocol_pb2.Message()
+            message.id = self.request.id
+            message.type = protocol_pb2.Message.BYTES
+            inner = _field_prefix(
+                protocol_pb2.Bytes.DESCRIPTOR, 'bytes', length)
+            outer = _field_prefix(
+                protocol_pb2.Message.DESCRIPTOR, 'bytes', len(inner) + length)
+            # the fields are serialized in order, 'bytes' is the last one
+            header = message.SerializeToString() + outer + inner
+            header = struct.pack(
+                request.SIZE_FMT, len(header) + length) + header
+            self._headers[length] = header
+        return header
+
     def resumeProducing(self):
         """IPushProducer interface."""
         logger.trace(
             'BytesMessageProducer resumed, http producer: %s', self.producer)
-        if self.producer:
+        self.paused = False
+        throttled = self.throttle is not None and self.throttle.throttled
+        if self.producer and not throttled:
             self.producer.resumeProducing()
 
     def stopProducing(self):
         """IPushProducer interface."""
         logger.trace(
             'BytesMessageProducer stopped, http producer: %s', self.producer)
+        if self.throttle is not None:
+            self.throttle.stop()
         if self.producer:
             self.producer.stopProducing()
 
@@ -1394,26 +1547,145 @@ class BytesMessageProducer(object):
         """IPushProducer interface."""
         logger.trace(
             'BytesMessageProducer paused, http producer: %s', self.producer)
+        self.paused = True
         if self.producer:
             self.producer.pauseProducing()
 
+    def finished(self, result):
+        """All the content was produced, don't resume it."""
+        if self.throttle is not None:
+            self.throttle.stop()
+        return result
+
+    def _throttled(self):
+        """Pause while over the bandwidth limits."""
+        if self.producer and not self.paused:
+            self.producer.pauseProducing()
+
+    def _unthrottled(self):
+        """Resume once under the bandwidth limits, if not paused."""
+        if self.producer and not self.paused:
+            self.producer.resumeProducing()
+
     def write(self, content):
         """Part of IConsumer."""
-        p = 0
-        part = content[p:p + self.payload_size]
-        while part:
-            if self.request.cancelled:
-                # stop generating messages
-                return
-            response = protocol_pb2.Message()
-            response.type = protocol_pb2.Message.BYTES
-            response.bytes.bytes = part
-            self.request.transferred += len(part)
-            self.request.sendMessage(response)
-            p += self.payload_size
-            part = content[p:p + self.payload_size]
+        if self.request.cancelled:
+            # stop generating messages
+            return
+        frames = []
+        for start in xrange(0, len(content), self.payload_size):
+            # the whole content if it fits, without copying it
+            part = content[start:start + self.payload_size]
+            frames.append(self._get_header(len(part)))
+            frames.append(part)
+        self.request.transferred += len(content)
+        self.request.protocol.writeSequence(frames)
         self.request.last_good_state_ts = time.time()
 
+        if self.throttle is None:
+            protocol = self.request.protocol
+            if not protocol.factory.bandwidth.limited(bandwidth.DOWNLOAD):
+                return
+            self.throttle = bandwidth.Throttle(
+                protocol.get_bucket(bandwidth.DOWNLOAD),
+                self._throttled, self._unthrottled)
+        self.throttle.consume(len(content))
+
+
+class DeltaInfoProducer(object):
+    """Send the DELTA_INFO of the nodes, as the producer of the request.
+
+    The transport pauses it while its buffer is full (as the client is not
+    taking what's sent), so the messages are built only as they are sent.
+
+    The messages are serialized in batches, each one written at once in
+    a reactor iteration, starting with MAX_DELTA_INFO nodes and adapting
+    the size so each batch takes about `batch_time` seconds. After the
+    given nodes, the ones of the stream (a content.NodeStream) are sent
+    as they are fetched, if any. It also exposes a deferred, triggered
+    when all the nodes were sent (or it was stopped).
+    """
+
+    batch_time = 0.005
+    max_batch_size = 5000
+
+    def __init__(self, request, nodes, share_id, stream=None):
+        self.request = request
+        self.nodes = nodes
+        self.share_id = share_id
+        self.stream = stream
+        self.batch_size = settings.MAX_DELTA_INFO
+        self.position = 0
+        self.deferred = defer.Deferred()
+        self.paused = True
+        self._call = None
+
+    def _schedule(self):
+        """Send the next batch in the next reactor iteration."""
+        if self._call is None:
+            self._call = reactor.callLater(0, self._produce)
+
+    def _produce(self):
+        """Send a batch of messages, or finish."""
+        self._call = None
+        if self.paused or self.deferred.called:
+            return
+        if self.position >= len(self.nodes):
+            page = None
+            if self.stream is not None:
+                page = self.stream.get()
+            if page is not None:
+                self.nodes = page
+                self.position = 0
+            elif self.stream is None or self.stream.finished:
+                if self.stream is not None and self.stream.failure:
+                    self.deferred.errback(self.stream.failure)
+                else:
+                    self.deferred.callback(None)
+                return
+            else:
+                # wait for the next page
+                self.stream.waiter = self._schedule
+                return
+
+        start = time.time()
+        batch = self.nodes[self.position:self.position + self.batch_size]
+        self.position += len(batch)
+        frames = []
+        for node in batch:
+            message = self.request.build_delta_info(node, self.share_id)
+            message.id = self.request.id
+            self.request.log.trace_message('OUT: ', message)
+            data = message.SerializeToString()
+            frames.append(struct.pack(request.SIZE_FMT, len(data)))
+            frames.append(data)
+        self.request.protocol.write(b''.join(frames))
+
+        elapsed = time.time() - start
+        if elapsed > self.batch_time:
+            self.batch_size = max(1, self.batch_size // 2)
+        elif (elapsed < self.batch_time / 2 and
+              len(batch) == self.batch_size):
+            self.batch_size = min(self.batch_size * 2, self.max_batch_size)
+        self._schedule()
+
+    def pauseProducing(self):
+        """IPushProducer interface."""
+        self.paused = True
+
+    def resumeProducing(self):
+        """IPushProducer interface."""
+        if self.paused:
+            self.paused = False
+            self._schedule()
+
+    def stopProducing(self):
+        """IPushProducer interface."""
+        if self.stream is not None:
+            self.stream.stop()
+        if not self.deferred.called:
+            self.deferred.callback(None)
+
 
 def cancel_filter(function):
     """Raises RequestCancelledError if the request is cancelled.
@@ -1444,6 +1716,8 @@ class GetContentResponse(SimpleRequestResponse):
     __slots__ = ('cancel_message', 'message_producer',
                  'transferred', 'init_time')
 
+    readonly = True
+
     def __init__(self, protocol, message):
         super(GetContentResponse, self).__init__(protocol, message)
         self.cancel_message = None
@@ -1518,9 +1792,11 @@ class GetContentResponse(SimpleRequestResponse):
             self.sendMessage(r)
 
             # save data to be logged on operation end
-            self.operation_data = 'vol_id=%s node_id=%s hash=%s size=%s' % (
-                share_id, self.source_message.get_content.node,
-                node.content_hash, node.size)
+            self.operation_data = (
+                'vol_id=%s node_id=%s hash=%s size=%s offset=%s' % (
+                    share_id, self.source_message.get_content.node,
+                    node.content_hash, node.size,
+                    self.source_message.get_content.offset))
             return node
 
         if self.protocol.user is None:
@@ -1558,7 +1834,7 @@ class GetContentResponse(SimpleRequestResponse):
         # release this request early
         self.protocol.release(self)
 
-        return producer.deferred
+        return producer.deferred.addBoth(message_producer.finished)
 
     def _cancel(self):
         """Cancel the request.
@@ -1735,6 +2011,7 @@ class PutContentResponse(SimpleRequestResponse):
             # process BYTES, stay here in UPLOADING
             received_bytes = message.bytes.bytes
             self.transferred += len(received_bytes)
+            self.protocol.throttle_upload(len(received_bytes))
             self.upload_job.add_operation(
                 lambda _: self.upload_job.add_data(received_bytes),
                 self._generic_error)
@@ -1819,6 +2096,7 @@ class PutContentResponse(SimpleRequestResponse):
                            self.state)
             yield self.upload_job.cancel()
             return
+        self.upload_job.transport = self.protocol.reading
         yield self.upload_job.connect()
         # register the client transport as the producer
         self.protocol.release(self)
@@ -1885,6 +2163,8 @@ class GetDeltaResponse(SimpleRequestResponse):
 
     __slots__ = ()
 
+    readonly = True
+
     def _get_node_info(self):
         """Return node info from the message."""
         volume_id = self.source_message.get_delta.share
@@ -1897,23 +2177,27 @@ class GetDeltaResponse(SimpleRequestResponse):
         share_id = self.convert_share_id(msg.get_delta.share)
         from_generation = msg.get_delta.from_generation
         delta_max_size = settings.DELTA_MAX_SIZE
-        delta_info = yield self.protocol.user.get_delta(
+        stream = self.protocol.user.stream_delta(
             share_id, from_generation, limit=delta_max_size)
-        nodes, vol_generation, free_bytes = delta_info
-        yield self.send_delta_info(nodes, msg.get_delta.share)
-        self.length = len(nodes)
+        yield self.send_delta_stream(stream, msg.get_delta.share)
+        self.length = stream.count
+        if not stream.finished:
+            # stopped, the client is gone
+            return
+        vol_generation = stream.generation
+        free_bytes = stream.free_bytes
 
         # now send the DELTA_END
         response = protocol_pb2.Message()
         response.type = protocol_pb2.Message.DELTA_END
         full = True
-        if nodes:
-            full = vol_generation == nodes[-1].generation
+        if stream.last is not None:
+            full = vol_generation == stream.last.generation
         response.delta_end.full = full
         if full:
             response.delta_end.generation = vol_generation
         else:
-            response.delta_end.generation = nodes[-1].generation
+            response.delta_end.generation = stream.last.generation
         response.delta_end.free_bytes = free_bytes
         self.sendMessage(response)
 
@@ -1923,44 +2207,56 @@ class GetDeltaResponse(SimpleRequestResponse):
         self.operation_data = t
 
     def send_delta_info(self, nodes, share_id):
-        """Build and send the DELTA_INFO for each node."""
-        return task.cooperate(
-            self._send_delta_info(nodes, share_id)).whenDone()
-
-    def _send_delta_info(self, nodes, share_id):
-        """Build and send the DELTA_INFO for each node."""
-        count = 0
-        for node in nodes:
-            if count == settings.MAX_DELTA_INFO:
-                count = 0
-                yield
-            message = protocol_pb2.Message()
-            message.type = protocol_pb2.Message.DELTA_INFO
-            message.delta_info.type = protocol_pb2.DeltaInfo.FILE_INFO
-            delta_info = message.delta_info
-            delta_info.generation = node.generation
-            delta_info.is_live = node.is_live
-            if node.is_file:
-                delta_info.file_info.type = protocol_pb2.FileInfo.FILE
-            else:
-                delta_info.file_info.type = protocol_pb2.FileInfo.DIRECTORY
-            delta_info.file_info.name = node.name
-            delta_info.file_info.share = share_id
-            delta_info.file_info.node = str(node.id)
-            if node.parent_id is None:
-                delta_info.file_info.parent = ''
-            else:
-                delta_info.file_info.parent = str(node.parent_id)
-            delta_info.file_info.is_public = node.is_public
-            if node.content_hash is None:
-                delta_info.file_info.content_hash = ''
-            else:
-                delta_info.file_info.content_hash = str(node.content_hash)
-            delta_info.file_info.crc32 = node.crc32
-            delta_info.file_info.size = node.size
-            delta_info.file_info.last_modified = node.last_modified
-            self.sendMessage(message)
-            count += 1
+        """Send the DELTA_INFO for each node, as the client takes them.
+
+        Return a deferred triggered when all of them were sent.
+        """
+        return self._send_delta_info(
+            DeltaInfoProducer(self, nodes, share_id))
+
+    def send_delta_stream(self, stream, share_id):
+        """Send the DELTA_INFO for each node of the stream, as fetched.
+
+        Return a deferred triggered when all of them were sent.
+        """
+        return self._send_delta_info(
+            DeltaInfoProducer(self, [], share_id, stream=stream))
+
+    def _send_delta_info(self, producer):
+        """Send the DELTA_INFO messages from the producer."""
+        self.registerProducer(producer, streaming=True)
+        producer.deferred.addBoth(
+            lambda result: self.unregisterProducer() or result)
+        return producer.deferred
+
+    def build_delta_info(self, node, share_id):
+        """Build the DELTA_INFO message for the node."""
+        message = protocol_pb2.Message()
+        message.type = protocol_pb2.Message.DELTA_INFO
+        message.delta_info.type = protocol_pb2.DeltaInfo.FILE_INFO
+        delta_info = message.delta_info
+        delta_info.generation = node.generation
+        delta_info.is_live = node.is_live
+        if node.is_file:
+            delta_info.file_info.type = protocol_pb2.FileInfo.FILE
+        else:
+            delta_info.file_info.type = protocol_pb2.FileInfo.DIRECTORY
+        delta_info.file_info.name = node.name
+        delta_info.file_info.share = share_id
+        delta_info.file_info.node = str(node.id)
+        if node.parent_id is None:
+            delta_info.file_info.parent = ''
+        else:
+            delta_info.file_info.parent = str(node.parent_id)
+        delta_info.file_info.is_public = node.is_public
+        if node.content_hash is None:
+            delta_info.file_info.content_hash = ''
+        else:
+            delta_info.file_info.content_hash = str(node.content_hash)
+        delta_info.file_info.crc32 = node.crc32
+        delta_info.file_info.size = node.size
+        delta_info.file_info.last_modified = node.last_modified
+        return message
 
 
 class RescanFromScratchResponse(GetDeltaResponse):
@@ -1972,26 +2268,17 @@ class RescanFromScratchResponse(GetDeltaResponse):
     def _process(self):
         """Get all the live nodes and send DeltaInfos."""
         msg = self.source_message
-        limit = settings.GET_FROM_SCRATCH_LIMIT
         share_id = self.convert_share_id(msg.get_delta.share)
-        # get the first chunk
-        delta_info = yield self.protocol.user.get_from_scratch(
-            share_id, limit=limit)
-        # keep vol_generation and free_bytes for later
-        nodes, vol_generation, free_bytes = delta_info
-        self.length = len(nodes)
-        while nodes:
-            # while it keep returning nodes, send the current nodes
-            yield self.send_delta_info(nodes, msg.get_delta.share)
-            # and request more
-            last_path = (nodes[-1].path, nodes[-1].name)
-            delta_info = yield self.protocol.user.get_from_scratch(
-                share_id, start_from_path=last_path, limit=limit,
-                max_generation=vol_generation)
-            # but don't overwrite vol_generation or free_bytes in case
-            # something changes while fetching nodes
-            nodes, _, _ = delta_info
-            self.length += len(nodes)
+        # the nodes are fetched in chunks while sent, keeping the first
+        # vol_generation and free_bytes in case something changes meanwhile
+        stream = yield self.protocol.user.get_rescan_stream(share_id)
+        yield self.send_delta_stream(stream, msg.get_delta.share)
+        self.length = stream.count
+        if not stream.finished:
+            # stopped, the client is gone
+            return
+        vol_generation = stream.generation
+        free_bytes = stream.free_bytes
 
         # now send the DELTA_END
         response = protocol_pb2.Message()
@@ -2158,6 +2445,8 @@ class FreeSpaceResponse(SimpleRequestResponse):
 
     __slots__ = ()
 
+    readonly = True
+
     expected_foreign_errors = [dataerror.NoPermission]
 
     @inlineCallbacks
@@ -2184,6 +2473,8 @@ class AccountResponse(SimpleRequestResponse):
 
     __slots__ = ()
 
+    readonly = True
+
     @inlineCallbacks
     def _process(self):
         """Reports user account information."""
@@ -2330,7 +2621,8 @@ class StorageServerFactory(Factory):
         """Create a StorageServerFactory."""
         self.auth_provider = auth_provider_class(self)
         self.content = content_class(self)
-        self.diskstorage = DiskStorage(settings.STORAGE_BASEDIR)
+        self.diskstorage = DiskStorage(
+            settings.STORAGE_VOLUMES or settings.STORAGE_BASEDIR)
 
         self.metrics = metrics.get_meter('root')
         self.user_metrics = metrics.get_meter('user')
@@ -2338,6 +2630,7 @@ class StorageServerFactory(Factory):
 
         self.servername = servername
         self.reactor_inspector = reactor_inspector
+        self.bandwidth = bandwidth.BandwidthLimits()
 
         # note that this relies on the notifier calling the
         # callback from the reactor thread
@@ -2521,6 +2814,9 @@ class StorageServerFactory(Factory):
             """Return True if the client should receive the notification."""
             return protocol.session_id != udf_delete.source_session
 
+        if self.content.generation_logs is not None:
+            self.content.generation_logs.notify(udf_delete.owner_id)
+
         user = yield self.content.get_user_by_id(udf_delete.owner_id)
         if user:  # connected instances for this user?
             resp = protocol_pb2.Message()
@@ -2536,6 +2832,10 @@ class StorageServerFactory(Factory):
             """Return True if the client should receive the notification."""
             return protocol.session_id != notif.source_session
 
+        # the deltas kept of the user's volumes are outdated
+        if self.content.generation_logs is not None:
+            self.content.generation_logs.notify(notif.user_id)
+
         user = yield self.content.get_user_by_id(notif.user_id)
         if user:  # connected instances for this user?
             resp = protocol_pb2.Message()
@@ -2646,6 +2946,14 @@ class StorageServerService(OrderedMultiService):
         self.tcp_service.setName('TCP')
         self.tcp_service.setServiceParent(listeners)
 
+        # compact the packed nodes from time to time
+        if settings.STORAGE_PACK_COMPACT_INTERVAL:
+            compactor = TimerService(
+                settings.STORAGE_PACK_COMPACT_INTERVAL,
+                self.factory.diskstorage.compact_packs, logger)
+            compactor.setName('PackCompactor')
+            compactor.setServiceParent(self)
+
         # setup the status service
         self.status_service = stats.create_status_service(
             self, listeners, status_port)
@@ -2669,10 +2977,23 @@ class StorageServerService(OrderedMultiService):
     def startService(self):
         """Start listening on two ports."""
         logger.info('- - - - - SERVER STARTING')
+        if settings.STORAGE_PRECREATE_DIRS:
+            self.factory.diskstorage.precreate()
+        if self.factory.content.manifests is not None:
+            self.factory.content.manifests.clean()
         yield OrderedMultiService.startService(self)
         yield defer.maybeDeferred(self.start_rpc_dal)
         self.factory.content.rpc_dal = self.rpc_dal
         self.factory.rpc_dal = self.rpc_dal
+
+        # keep the filter of the existing blobs up to date, once the DAL is
+        # there (it's stopped with the other services)
+        if settings.BLOB_FILTER_REBUILD_INTERVAL:
+            refresher = TimerService(
+                settings.BLOB_FILTER_UPDATE_INTERVAL,
+                self.factory.content.blob_filter.refresh)
+            refresher.setName('BlobFilterRefresher')
+            refresher.setServiceParent(self)
         self.metrics.meter('server_start')
         self.metrics.increment('services_active')
 
@@ -2689,6 +3010,8 @@ class StorageServerService(OrderedMultiService):
         logger.info('- - - - - SERVER STOPPING')
         yield OrderedMultiService.stopService(self)
         yield self.factory.wait_for_shutdown()
+        if self.rpc_dal is not None:
+            self.rpc_dal.stop()
         self.metrics.meter('server_stop')
         self.metrics.decrement('services_active')
         self._reactor_inspector.stop()
@@ -29,6 +29,7 @@ from twisted.web import server, resource
 
 from magicicada import metrics
 from magicicada.monitoring import dump
+from magicicada.server import bandwidth
 
 logger = logging.getLogger(__name__)
 
@@ -153,6 +154,72 @@ class _Status(resource.Resource):
         defer.returnValue('Status OK\n')
 
 
+class _DamagedBlobs(_Status):
+    """The blobs found with damaged content, see scrub_blobs."""
+
+    limit = 100
+
+    def __init__(self, server):
+        """Create the Resource."""
+        _Status.__init__(self, server, None)
+
+    @defer.inlineCallbacks
+    def _check(self):
+        """List the last damaged blobs found."""
+        r = yield self.content.rpc_dal.call(
+            'get_damaged_blobs', limit=self.limit)
+        blobs = r['damaged_blobs']
+        lines = ['Damaged blobs: %d\n' % len(blobs)]
+        for blob in blobs:
+            lines.append('%(storage_key)s %(problem)s %(when_detected)s '
+                         '%(detail)s\n' % blob)
+        defer.returnValue(''.join(lines))
+
+
+class _Bandwidth(resource.Resource):
+    """The bandwidth limits, see server.bandwidth.
+
+    They are changed POSTing the new rates as <level>_<direction>=<rate>.
+    """
+
+    isLeaf = True
+
+    def __init__(self, server):
+        """Create the Resource."""
+        resource.Resource.__init__(self)
+        self.storage_server = server
+
+    @property
+    def limits(self):
+        """The limits of the server."""
+        return self.storage_server.factory.bandwidth
+
+    def render_GET(self, request):
+        """List the rates, and how many times they throttled."""
+        lines = []
+        for level in bandwidth.LEVELS:
+            for direction in bandwidth.DIRECTIONS:
+                key = (level, direction)
+                lines.append('%s_%s %d throttled %d\n' % (
+                    level, direction, self.limits.rates[key],
+                    self.limits.throttles[key]))
+        return ''.join(lines)
+
+    def render_POST(self, request):
+        """Change the rates."""
+        try:
+            for name, values in sorted(request.args.items()):
+                level, _, direction = name.partition('_')
+                rate = int(values[-1])
+                self.limits.set_rate(level, direction, rate)
+                logger.info("Bandwidth of %s %s set to %d bytes/s",
+                            level, direction, rate)
+        except ValueError as err:
+            request.setResponseCode(400)
+            return '%s\n' % (err,)
+        return self.render_GET(request)
+
+
 def create_status_service(storage, parent_service, port,
                           user_id=0, ssl_context_factory=None):
     """Create the status service."""
@@ -160,6 +227,8 @@ def create_status_service(storage, parent_service, port,
     root.putChild('status', _Status(storage, user_id))
     root.putChild('+meliae', MeliaeResource())
     root.putChild('+gc-stats', GCResource())
+    root.putChild('+damaged-blobs', _DamagedBlobs(storage))
+    root.putChild('+bandwidth', _Bandwidth(storage))
     site = server.Site(root)
     if ssl_context_factory is None:
         service = TCPServer(port, site)
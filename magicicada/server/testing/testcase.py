@@ -90,6 +90,13 @@ class BaseProtocolTestCase(TwistedTestCase):
         self.ssl_key = crypto.load_privatekey(crypto.FILETYPE_PEM, server_key)
 
         self._state = State()
+        # the storage tree is created when needed
+        self.patch(settings, 'STORAGE_PRECREATE_DIRS', False)
+        # store the content in its own files, unless testing the packs
+        self.patch(settings, 'STORAGE_PACK_MAX_SIZE', 0)
+        # look for every content in the database, as the tests make blobs
+        # directly there
+        self.patch(settings, 'BLOB_FILTER_REBUILD_INTERVAL', 0)
         self.service = StorageServerService(
             0, auth_provider_class=self.auth_provider_class, status_port=0,
             heartbeat_interval=self.heartbeat_interval)
@@ -365,6 +372,8 @@ class TestWithDatabase(BaseTestCase, BaseProtocolTestCase):
 
         # tune the config for this tests
         self.patch(settings, 'STORAGE_CHUNK_SIZE', 1024 * 64)
+        # store the content in disk, unless testing the inline one
+        self.patch(settings, 'STORAGE_INLINE_MAX_SIZE', 0)
 
     def save_req(self, req, name):
         """Save a request for later use."""
@@ -0,0 +1,172 @@
+# Copyright 2015-2018 Chicharreros (https://launchpad.net/~chicharreros)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# For further info, check  http://launchpad.net/magicicada-server
+
+"""Test the shaping of the bandwidth."""
+
+from twisted.internet import task
+from twisted.trial.unittest import TestCase as TwistedTestCase
+
+from magicicada import settings
+from magicicada.server.bandwidth import (
+    CONNECTION,
+    DOWNLOAD,
+    GLOBAL,
+    UPLOAD,
+    USER,
+    BandwidthLimits,
+    PausableReading,
+    Throttle,
+    TokenBucket,
+)
+
+
+class BandwidthLimitsTestCase(TwistedTestCase):
+    """Test the BandwidthLimits."""
+
+    def test_from_settings(self):
+        self.patch(settings, 'BANDWIDTH_USER_UPLOAD', 1000)
+        limits = BandwidthLimits()
+        self.assertEqual(limits.rates[USER, UPLOAD], 1000)
+        self.assertEqual(limits.rates[USER, DOWNLOAD], 0)
+        self.assertTrue(limits.limited(UPLOAD))
+        self.assertFalse(limits.limited(DOWNLOAD))
+
+    def test_set_rate(self):
+        limits = BandwidthLimits()
+        limits.set_rate(CONNECTION, DOWNLOAD, 10)
+        self.assertEqual(limits.rates[CONNECTION, DOWNLOAD], 10)
+        self.assertTrue(limits.limited(DOWNLOAD))
+
+    def test_set_rate_invalid(self):
+        limits = BandwidthLimits()
+        self.assertRaises(ValueError, limits.set_rate, 'other', UPLOAD, 1)
+        self.assertRaises(ValueError, limits.set_rate, USER, 'other', 1)
+        self.assertRaises(ValueError, limits.set_rate, USER, UPLOAD, -1)
+
+
+class TokenBucketTestCase(TwistedTestCase):
+    """Test the TokenBucket."""
+
+    def setUp(self):
+        super(TokenBucketTestCase, self).setUp()
+        self.clock = task.Clock()
+        self.limits = BandwidthLimits(burst_time=1, clock=self.clock)
+        self.bucket = TokenBucket(self.limits, USER, UPLOAD,
+                                  parent=self.limits.buckets[UPLOAD])
+
+    def test_no_limit(self):
+        self.assertEqual(self.bucket.consume(10 ** 9), 0)
+        self.assertEqual(self.limits.throttles, {})
+
+    def test_burst(self):
+        self.limits.set_rate(USER, UPLOAD, 100)
+        self.assertEqual(self.bucket.consume(60), 0)
+        self.assertEqual(self.bucket.consume(40), 0)
+        self.assertEqual(self.bucket.consume(50), 0.5)
+        self.assertEqual(self.limits.throttles, {(USER, UPLOAD): 1})
+
+    def test_refill(self):
+        self.limits.set_rate(USER, UPLOAD, 100)
+        self.bucket.consume(150)
+        self.clock.advance(0.5)
+        self.assertEqual(self.bucket.consume(0), 0)
+        self.clock.advance(10)
+        # up to the burst
+        self.assertEqual(self.bucket.consume(100), 0)
+        self.assertEqual(self.bucket.consume(100), 1)
+
+    def test_parent(self):
+        self.limits.set_rate(USER, UPLOAD, 100)
+        self.limits.set_rate(GLOBAL, UPLOAD, 50)
+        self.assertEqual(self.bucket.consume(100), 1)
+        self.assertEqual(self.limits.throttles, {(GLOBAL, UPLOAD): 1})
+
+    def test_rate_changed(self):
+        self.limits.set_rate(USER, UPLOAD, 100)
+        self.bucket.consume(200)
+        self.limits.set_rate(USER, UPLOAD, 0)
+        self.assertEqual(self.bucket.consume(200), 0)
+        # full again when limited again
+        self.limits.set_rate(USER, UPLOAD, 100)
+        self.assertEqual(self.bucket.consume(100), 0)
+
+
+class ThrottleTestCase(TwistedTestCase):
+    """Test the Throttle."""
+
+    def setUp(self):
+        super(ThrottleTestCase, self).setUp()
+        self.clock = task.Clock()
+        limits = BandwidthLimits(burst_time=1, clock=self.clock)
+        limits.set_rate(GLOBAL, DOWNLOAD, 100)
+        self.calls = []
+        self.throttle = Throttle(
+            limits.buckets[DOWNLOAD], lambda: self.calls.append('pause'),
+            lambda: self.calls.append('resume'))
+
+    def test_pause(self):
+        self.throttle.consume(100)
+        self.assertEqual(self.calls, [])
+        self.throttle.consume(100)
+        self.assertEqual(self.calls, ['pause'])
+        self.assertTrue(self.throttle.throttled)
+        # not paused again
+        self.throttle.consume(100)
+        self.clock.advance(1)
+        self.assertEqual(self.calls, ['pause', 'resume'])
+        self.assertFalse(self.throttle.throttled)
+
+    def test_stop(self):
+        self.throttle.consume(200)
+        self.throttle.stop()
+        self.clock.advance(10)
+        self.assertEqual(self.calls, ['pause'])
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+
+class FakeTransport(object):
+    """A transport that records the pauses."""
+
+    def __init__(self):
+        self.calls = []
+
+    def pauseProducing(self):
+        self.calls.append('pause')
+
+    def resumeProducing(self):
+        self.calls.append('resume')
+
+
+class FakeProtocol(object):
+    """A protocol with its transport."""
+
+    def __init__(self):
+        self.transport = FakeTransport()
+
+
+class PausableReadingTestCase(TwistedTestCase):
+    """Test the PausableReading."""
+
+    def test_paused_by_all(self):
+        protocol = FakeProtocol()
+        reading = PausableReading(protocol)
+        reading.pauseProducing()
+        reading.pauseProducing()
+        reading.resumeProducing()
+        self.assertEqual(protocol.transport.calls, ['pause'])
+        reading.resumeProducing()
+        self.assertEqual(protocol.transport.calls, ['pause', 'resume'])
@@ -24,6 +24,7 @@ import os
 import shutil
 import struct
 import sys
+import uuid
 
 from StringIO import StringIO
 
@@ -35,7 +36,7 @@ from twisted.internet.error import ConnectionDone
 from twisted.web import client, error
 from ubuntuone.supervisor import utils as supervisor_utils
 
-from magicicada.filesync.models import StorageUser
+from magicicada.filesync.models import ContentBlob, DamagedBlob, StorageUser
 from magicicada.server.server import logger
 from magicicada.server.testing.testcase import TestWithDatabase
 
@@ -411,6 +412,22 @@ class ServerStatusTest(TestWithDatabase):
         else:
             self.fail('An error is expected.')
 
+    @defer.inlineCallbacks
+    def test_damaged_blobs(self):
+        """The damaged blobs are listed."""
+        blob = ContentBlob.objects.create(
+            hash=self.factory.get_fake_hash(), storage_key=uuid.uuid4())
+        DamagedBlob.objects.create(
+            content_blob=blob, storage_key=blob.storage_key,
+            problem=DamagedBlob.PROBLEM_MISSING, detail='Not in the storage')
+        response = yield client.getPage(
+            "http://localhost:%s/+damaged-blobs" % self.service.status_port)
+        lines = response.splitlines()
+        self.assertEqual(lines[0], 'Damaged blobs: 1')
+        self.assertTrue(lines[1].startswith(
+            '%s Missing ' % (blob.storage_key,)))
+        self.assertTrue(lines[1].endswith(' Not in the storage'))
+
 
 class DumpTest(TestWithDatabase):
     """Test the different dump services."""
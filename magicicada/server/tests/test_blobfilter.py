@@ -0,0 +1,203 @@
+# Copyright 2015-2018 Chicharreros (https://launchpad.net/~chicharreros)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# For further info, check  http://launchpad.net/magicicada-server
+
+"""Test the blob filter."""
+
+import datetime
+import hashlib
+
+from twisted.internet import defer
+from twisted.trial.unittest import TestCase as TwistedTestCase
+
+from magicicada.server.blobfilter import BlobFilter, BloomFilter
+
+
+def get_hash(key):
+    """Return a content hash."""
+    return 'sha1:' + hashlib.sha1(key).hexdigest()
+
+
+class BloomFilterTestCase(TwistedTestCase):
+    """Test the BloomFilter."""
+
+    def test_sizing(self):
+        bloom = BloomFilter(1000, 0.01)
+        # ~9.6 bits and ~7 hashes per value for a 1% of false positives
+        self.assertEqual(bloom.size, 9586)
+        self.assertEqual(bloom.hashes, 7)
+        self.assertEqual(len(bloom.bits), 1199)
+
+    def test_no_false_negatives(self):
+        bloom = BloomFilter(1000, 0.01)
+        hashes = [get_hash(str(i)) for i in range(1000)]
+        for hash_value in hashes:
+            bloom.add(hash_value)
+        self.assertEqual(bloom.count, 1000)
+        for hash_value in hashes:
+            self.assertIn(hash_value, bloom)
+
+    def test_false_positives(self):
+        bloom = BloomFilter(1000, 0.01)
+        for i in range(1000):
+            bloom.add(get_hash(str(i)))
+        false_positives = sum(
+            get_hash('other %d' % i) in bloom for i in range(10000))
+        self.assertTrue(false_positives < 200, false_positives)
+
+
+class FakeDAL(object):
+    """A DAL with some blobs."""
+
+    def __init__(self):
+        self.blobs = {}
+        self.calls = []
+
+    def call(self, name, **kwargs):
+        if name == 'count_blobs':
+            return defer.succeed(dict(count=len(self.blobs)))
+        assert name == 'get_blob_hashes'
+        return self.get_blob_hashes(**kwargs)
+
+    def get_blob_hashes(self, after_hash, created_after, limit):
+        self.calls.append((after_hash, created_after))
+        hashes = sorted(
+            hash_value for hash_value, when in self.blobs.items()
+            if (after_hash is None or hash_value > after_hash) and
+            (created_after is None or when > created_after))
+        return defer.succeed(dict(hashes=hashes[:limit]))
+
+
+class FakeContent(object):
+    """A content manager with its DAL."""
+
+    def __init__(self):
+        self.rpc_dal = FakeDAL()
+
+
+class BlobFilterTestCase(TwistedTestCase):
+    """Test the BlobFilter."""
+
+    def setUp(self):
+        super(BlobFilterTestCase, self).setUp()
+        self.content = FakeContent()
+        self.blob_filter = BlobFilter(
+            self.content, error_rate=0.01, rebuild_interval=3600)
+        self.patch(self.blob_filter, 'min_capacity', 100)
+        self.patch(self.blob_filter, 'batch_size', 2)
+
+    def add_blob(self, key, age=0):
+        """Make a blob created some seconds ago."""
+        hash_value = get_hash(key)
+        self.content.rpc_dal.blobs[hash_value] = (
+            datetime.datetime.now() - datetime.timedelta(seconds=age))
+        return hash_value
+
+    def test_everything_may_exist_until_built(self):
+        self.assertTrue(self.blob_filter.might_exist(get_hash('foo')))
+        self.blob_filter.checked(get_hash('foo'), False)
+        self.assertEqual(self.blob_filter.false_positives, 0)
+
+    @defer.inlineCallbacks
+    def test_rebuild(self):
+        hashes = [self.add_blob(str(i)) for i in range(5)]
+        yield self.blob_filter.refresh()
+        for hash_value in hashes:
+            self.assertTrue(self.blob_filter.might_exist(hash_value))
+        self.assertFalse(self.blob_filter.might_exist(get_hash('new')))
+        self.assertEqual(self.blob_filter.avoided, 1)
+        # got in batches
+        self.assertEqual([after for after, _ in self.content.rpc_dal.calls],
+                         [None] + sorted(hashes)[1::2])
+
+    @defer.inlineCallbacks
+    def test_update(self):
+        self.patch(self.blob_filter, 'update_overlap',
+                   datetime.timedelta(seconds=0))
+        yield self.blob_filter.refresh()
+        built = self.blob_filter._filter
+        hash_value = self.add_blob('new', age=-1)
+        yield self.blob_filter.refresh()
+        self.assertIdentical(self.blob_filter._filter, built)
+        self.assertTrue(self.blob_filter.might_exist(hash_value))
+        self.assertIsNot(self.content.rpc_dal.calls[-1][1], None)
+
+    @defer.inlineCallbacks
+    def test_sized_for_the_blobs(self):
+        yield self.blob_filter.refresh()
+        self.assertEqual(self.blob_filter._filter.capacity, 100)
+        for i in range(80):
+            self.add_blob(str(i))
+        self.blob_filter.last_rebuild -= 3600
+        yield self.blob_filter.refresh()
+        self.assertEqual(self.blob_filter._filter.capacity, 160)
+
+    @defer.inlineCallbacks
+    def test_rebuilt_when_full(self):
+        yield self.blob_filter.refresh()
+        built = self.blob_filter._filter
+        for i in range(101):
+            self.blob_filter.add(self.add_blob(str(i)))
+        yield self.blob_filter.refresh()
+        self.assertIsNot(self.blob_filter._filter, built)
+        self.assertEqual(self.blob_filter._filter.capacity, 202)
+
+    @defer.inlineCallbacks
+    def test_rebuilt_when_old(self):
+        yield self.blob_filter.refresh()
+        built = self.blob_filter._filter
+        self.blob_filter.last_rebuild -= 3600
+        yield self.blob_filter.refresh()
+        self.assertIsNot(self.blob_filter._filter, built)
+        self.assertEqual(self.content.rpc_dal.calls[-1], (None, None))
+
+    @defer.inlineCallbacks
+    def test_added(self):
+        yield self.blob_filter.refresh()
+        self.blob_filter.add(get_hash('new'))
+        self.assertTrue(self.blob_filter.might_exist(get_hash('new')))
+
+    @defer.inlineCallbacks
+    def test_added_while_rebuilding(self):
+        self.add_blob('old')
+        rebuilt = defer.Deferred()
+        calls = self.content.rpc_dal.call
+        self.content.rpc_dal.call = lambda *a, **kw: rebuilt.addCallback(
+            lambda _: calls(*a, **kw))
+        d = self.blob_filter.refresh()
+        self.blob_filter.add(get_hash('new'))
+        rebuilt.callback(None)
+        yield d
+        self.assertTrue(self.blob_filter.might_exist(get_hash('old')))
+        self.assertTrue(self.blob_filter.might_exist(get_hash('new')))
+
+    @defer.inlineCallbacks
+    def test_false_positive_rate(self):
+        yield self.blob_filter.refresh()
+        self.blob_filter.might_exist(get_hash('new'))
+        self.blob_filter.checked(get_hash('other'), False)
+        self.blob_filter.checked(get_hash('existing'), True)
+        self.assertEqual(self.blob_filter.false_positives, 1)
+        self.assertEqual(self.blob_filter.avoided, 1)
+
+    @defer.inlineCallbacks
+    def test_refresh_error(self):
+        self.content.rpc_dal.call = lambda *a, **kw: defer.fail(
+            ValueError('crash'))
+        yield self.blob_filter.refresh()
+        self.assertIdentical(self.blob_filter._filter, None)
+        self.assertIdentical(self.blob_filter._pending, None)
+        self.flushLoggedErrors(ValueError)
@@ -0,0 +1,268 @@
+# Copyright 2015-2018 Chicharreros (https://launchpad.net/~chicharreros)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# For further info, check  http://launchpad.net/magicicada-server
+
+"""Test the storage of the nodes in chunks."""
+
+import logging
+import os
+import random
+import shutil
+import StringIO
+import time
+
+from twisted.internet import defer
+from twisted.trial.unittest import TestCase as TwistedTestCase
+
+from magicicada import settings
+from magicicada.server.chunkstorage import (
+    ANCHOR,
+    CHUNKS_SUFFIX,
+    ChunkedFile,
+    get_chunk_name,
+    is_chunk_name,
+    pack_manifest,
+    read_manifest,
+    split_chunks,
+)
+from magicicada.server.diskstorage import COLLECTING_SUFFIX, DiskStorage
+
+
+def make_data(size, seed=0):
+    """Return the same varied bytes for the seed, none of them an anchor."""
+    rnd = random.Random(seed)
+    values = [chr(i) for i in range(256) if chr(i) != ANCHOR[0]]
+    return ''.join(rnd.choice(values) for _ in xrange(size))
+
+
+class SplitChunksTestCase(TwistedTestCase):
+    """Test the splitting of the content in chunks."""
+
+    def split(self, data, min_size=10, max_size=100, read_size=7):
+        return list(split_chunks(
+            StringIO.StringIO(data), min_size, max_size, read_size))
+
+    def test_empty(self):
+        self.assertEqual(self.split(''), [])
+
+    def test_cut_after_the_anchor(self):
+        data = 'a' * 20 + ANCHOR + 'b' * 30 + ANCHOR + 'c' * 5
+        self.assertEqual(self.split(data), [
+            'a' * 20 + ANCHOR, 'b' * 30 + ANCHOR, 'c' * 5])
+
+    def test_min_size(self):
+        data = 'a' * 3 + ANCHOR + 'b' * 30 + ANCHOR + 'c' * 5
+        self.assertEqual(self.split(data), [
+            'a' * 3 + ANCHOR + 'b' * 30 + ANCHOR, 'c' * 5])
+
+    def test_max_size(self):
+        data = 'a' * 250
+        self.assertEqual(self.split(data), ['a' * 100, 'a' * 100, 'a' * 50])
+
+    def test_same_chunks_whatever_is_read(self):
+        data = os.urandom(5000).replace(ANCHOR, '') + ANCHOR + 'x' * 50
+        data = ANCHOR.join([data[:1234], data[1234:3000], data[3000:]])
+        chunks = self.split(data, 100, 2000, read_size=3)
+        self.assertEqual(''.join(chunks), data)
+        self.assertEqual(chunks, self.split(data, 100, 2000, 1 << 20))
+        self.assertTrue(all(100 <= len(c) <= 2000 for c in chunks[:-1]))
+
+    def test_changes_only_affect_their_chunks(self):
+        parts = [os.urandom(50).replace(ANCHOR, '') + ANCHOR
+                 for _ in range(10)]
+        original = self.split(''.join(parts))
+        parts[5] = 'changed' + parts[5]
+        changed = self.split(''.join(parts))
+        self.assertEqual(len(set(original) - set(changed)), 1)
+
+
+class ManifestTestCase(TwistedTestCase):
+    """Test the manifests and the files of their chunks."""
+
+    def setUp(self):
+        self.tmpdir = self.mktemp()
+        os.makedirs(self.tmpdir)
+        self.chunks = ['first', 'second chunk', 'third']
+        entries = []
+        for data in self.chunks:
+            name = get_chunk_name(os.urandom(20))
+            with open(os.path.join(self.tmpdir, name), 'wb') as fh:
+                fh.write(data)
+            entries.append((name.decode('hex'), len(data)))
+        self.entries = entries
+
+    def open(self):
+        return ChunkedFile(
+            self.entries, lambda name: os.path.join(self.tmpdir, name))
+
+    def test_manifest(self):
+        path = os.path.join(self.tmpdir, 'node' + CHUNKS_SUFFIX)
+        with open(path, 'wb') as fh:
+            fh.write(pack_manifest(self.entries))
+        self.assertEqual(read_manifest(path), self.entries)
+
+    def test_chunk_names(self):
+        self.assertTrue(is_chunk_name(get_chunk_name(os.urandom(20))))
+        self.assertFalse(is_chunk_name('5f8bc1e8-24d4-4e44-9e8f-15d8e1f5c7d5'))
+
+    def test_read(self):
+        with self.open() as fh:
+            self.assertEqual(fh.size, 22)
+            self.assertEqual(fh.read(), ''.join(self.chunks))
+            self.assertEqual(fh.read(), '')
+        self.assertTrue(fh.closed)
+
+    def test_read_across_chunks(self):
+        fh = self.open()
+        self.assertEqual(fh.read(3), 'fir')
+        self.assertEqual(fh.read(6), 'stseco')
+        self.assertEqual(fh.read(100), 'nd chunkthird')
+
+    def test_seek(self):
+        for offset in (0, 4, 5, 21, 22):
+            fh = self.open()
+            fh.read(2)
+            fh.seek(offset)
+            self.assertEqual(fh.read(), ''.join(self.chunks)[offset:])
+
+    def test_missing_chunk(self):
+        os.remove(os.path.join(
+            self.tmpdir, get_chunk_name(self.entries[1][0])))
+        fh = self.open()
+        self.assertEqual(fh.read(5), 'first')
+        self.assertRaises(IOError, fh.read, 5)
+
+
+class DiskStorageChunksTestCase(TwistedTestCase):
+    """Test the disk storage keeping the big nodes in chunks."""
+
+    @defer.inlineCallbacks
+    def setUp(self):
+        yield super(DiskStorageChunksTestCase, self).setUp()
+        self.tmpdir = os.getcwd() + "/tmp/chunkstorage_tests"
+        os.makedirs(self.tmpdir)
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.patch(settings, 'STORAGE_IO_THREADS', 0)
+        self.patch(settings, 'STORAGE_DEDUP_CHUNK_MIN_SIZE', 100)
+        self.patch(settings, 'STORAGE_DEDUP_CHUNK_MAX_SIZE', 1000)
+        self.storage = DiskStorage(
+            self.tmpdir, pack_max_size=0, cache_size=0, dedup_min_size=2000)
+
+    @defer.inlineCallbacks
+    def put(self, node_id, data, offset=0):
+        """Store the node."""
+        consumer = self.storage.put(node_id, offset, size_hint=len(data))
+        consumer.write(data[offset:])
+        yield consumer.commit()
+
+    @defer.inlineCallbacks
+    def get(self, node_id, offset=0):
+        """Return the content of the node."""
+        consumer = StringIO.StringIO()
+        yield self.storage.get(node_id, offset).startProducing(consumer)
+        defer.returnValue(consumer.getvalue())
+
+    def chunk_files(self):
+        """Return the names of the stored chunks."""
+        return set(name for _, _, names in os.walk(self.tmpdir)
+                   for name in names if is_chunk_name(name))
+
+    @defer.inlineCallbacks
+    def test_stored_in_chunks(self):
+        # cut after the anchor, then every max size
+        data = make_data(500) + ANCHOR + make_data(4498, seed=1)
+        yield self.put('node-id', data)
+        self.assertFalse(os.path.exists(self.storage._find('node-id')))
+        self.assertEqual(len(self.chunk_files()), 6)
+        content = yield self.get('node-id')
+        self.assertEqual(content, data)
+        content = yield self.get('node-id', 1234)
+        self.assertEqual(content, data[1234:])
+        self.assertEqual(self.storage.read('node-id'), data)
+
+    @defer.inlineCallbacks
+    def test_small_not_chunked(self):
+        yield self.put('node-id', 'x' * 1999)
+        self.assertTrue(os.path.exists(self.storage._find('node-id')))
+        self.assertEqual(self.chunk_files(), set())
+
+    @defer.inlineCallbacks
+    def test_resumed(self):
+        data = make_data(3000)
+        consumer = self.storage.put('node-id', size_hint=len(data))
+        consumer.write(data[:1000])
+        consumer.unregisterProducer()
+        yield consumer.closed
+        yield self.put('node-id', data, offset=1000)
+        content = yield self.get('node-id')
+        self.assertEqual(content, data)
+
+    @defer.inlineCallbacks
+    def test_shared_chunks(self):
+        data = make_data(5000)
+        yield self.put('node-1', data)
+        yield self.put('node-2', data + 'appended')
+        # only the last chunk is new
+        self.assertEqual(len(self.chunk_files()), 6)
+        content = yield self.get('node-2')
+        self.assertEqual(content, data + 'appended')
+
+    @defer.inlineCallbacks
+    def test_delete_and_collect(self):
+        data = make_data(5000)
+        yield self.put('node-1', data)
+        yield self.put('node-2', data + 'appended')
+        self.assertEqual(self.storage.delete('node-2'), 6 * 24)
+        self.assertFalse(self.storage.open_content('node-2'))
+
+        # recently touched chunks are kept
+        logger = logging.getLogger()
+        self.assertEqual(self.storage.collect_chunks(logger, 60), 0)
+        freed = self.storage.collect_chunks(logger, -1)
+        self.assertEqual(freed, len('appended'))
+        self.assertEqual(len(self.chunk_files()), 5)
+        content = yield self.get('node-1')
+        self.assertEqual(content, data)
+
+    @defer.inlineCallbacks
+    def test_collect_touched_meanwhile(self):
+        yield self.put('node-1', make_data(3000))
+        self.assertEqual(self.storage.delete('node-1'), 3 * 24)
+        old = time.time() - 3600
+        for name in self.chunk_files():
+            os.utime(self.storage._find(name), (old, old))
+
+        # a new node has the chunks after they were checked
+        original = self.storage._remove_chunk
+
+        def remove_chunk(path, grace_period):
+            os.utime(path, None)
+            return original(path, grace_period)
+        self.patch(self.storage, '_remove_chunk', remove_chunk)
+        freed = self.storage.collect_chunks(logging.getLogger(), 60)
+        self.assertEqual(freed, 0)
+        self.assertEqual(len(self.chunk_files()), 3)
+
+    @defer.inlineCallbacks
+    def test_collect_interrupted(self):
+        data = make_data(3000)
+        yield self.put('node-1', data)
+        for name in self.chunk_files():
+            path = self.storage._find(name)
+            os.rename(path, path + COLLECTING_SUFFIX)
+        self.storage.collect_chunks(logging.getLogger(), 60)
+        self.assertEqual(len(self.chunk_files()), 3)
+        self.assertEqual(self.storage.read('node-1'), data)
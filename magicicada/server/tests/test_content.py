@@ -18,6 +18,7 @@
 
 """Test content operations."""
 
+import datetime
 import logging
 import os
 import uuid
@@ -38,18 +39,24 @@ from magicicadaprotocol.content_hash import (
 )
 from mocker import Mocker, expect, ARGS, KWARGS, ANY
 from twisted.internet import defer, reactor, threads, task, address
+from twisted.python.failure import Failure
 from twisted.trial.unittest import TestCase
 from twisted.test.proto_helpers import StringTransport
 
 from magicicada import settings
 from magicicada.filesync import errors
 from magicicada.filesync.models import StorageObject, StorageUser
-from magicicada.server import server, diskstorage
+from magicicada.server import server, diskstorage, upload
+from magicicada.server.blobfilter import BlobFilter, BloomFilter
+from magicicada.server.manifests import VolumeManifests
 from magicicada.server.content import (
     BaseUploadJob,
     BogusUploadJob,
     DBUploadJob,
     ContentManager,
+    FalseProducer,
+    MagicUploadJob,
+    NodeStream,
     UploadJob,
     User,
     logger,
@@ -2255,6 +2262,33 @@ class UserTest(TestWithDatabase):
                                                  root_id, u"new_name")
         self.assertEqual(new_generation, generation + 1)
 
+    def test_broadcast(self):
+        """The message is serialized once for all the connections."""
+        sent = []
+
+        class FakeProtocol(object):
+            def __init__(self, name):
+                self.name = name
+
+            def send_broadcast(self, message, body):
+                sent.append((self.name, message, body))
+
+        for name in ('first', 'second', 'filtered'):
+            self.user.register_protocol(FakeProtocol(name))
+        message = protocol_pb2.Message()
+        message.id = 5
+        message.type = protocol_pb2.Message.VOLUME_NEW_GENERATION
+        message.volume_new_generation.generation = 1234
+        self.user.broadcast(message, filter=lambda p: p.name != 'filtered')
+
+        self.assertEqual([name for name, _, _ in sent], ['first', 'second'])
+        self.assertIs(sent[0][2], sent[1][2])
+        self.assertEqual(sent[0][1], message)
+        body = protocol_pb2.Message()
+        body.ParseFromString(b'\x08\x07' + sent[0][2])
+        message.id = 7
+        self.assertEqual(body, message)
+
     @defer.inlineCallbacks
     def test_get_upload_job(self):
         """Test for _get_upload_job."""
@@ -2269,6 +2303,30 @@ class UserTest(TestWithDatabase):
             True)
         self.assertIsInstance(upload_job, UploadJob)
 
+    @defer.inlineCallbacks
+    def test_get_upload_job_new_content_not_looked_for(self):
+        """The DB is not asked for content the blob filter doesn't have."""
+        root_id, _ = yield self.user.get_root()
+        volume_id = yield self.user.get_volume_id(root_id)
+        node_id, _, _ = yield self.user.make_file(volume_id, root_id,
+                                                  u"name", True)
+        blob_filter = self.service.factory.content.blob_filter
+        self.patch(blob_filter, '_filter', BloomFilter(10, 0.01))
+        called = []
+        real_call = self.user.rpc_dal.call
+        self.patch(self.user.rpc_dal, 'call', lambda name, **kw: (
+            called.append((name, kw)) or real_call(name, **kw)))
+
+        size = 1024
+        upload_job = yield self.user.get_upload_job(
+            None, node_id, NO_CONTENT_HASH, 'foo', 10, size / 2, size / 4,
+            True)
+        self.assertIsInstance(upload_job, UploadJob)
+        [(name, kwargs)] = called
+        self.assertEqual(name, 'prepare_upload')
+        self.assertFalse(kwargs['check_reusable'])
+        self.assertEqual(blob_filter.avoided, 1)
+
     @defer.inlineCallbacks
     def test_get_free_bytes_root(self):
         """Get the user free bytes, normal case."""
@@ -2547,6 +2605,18 @@ class TestUploadJob(TestWithDatabase):
         self.assertFailure(upload_job.deferred, server.errors.UploadCorrupt)
         yield upload_job.cancel()
 
+    @defer.inlineCallbacks
+    def test_add_data_past_inline_hint(self):
+        """An inline upload fails once it gets more than its size hint."""
+        size = self.half_size
+        self.patch(settings, 'STORAGE_INLINE_MAX_SIZE', size * 2)
+        deflated_data, hash_value, upload_job = yield self.make_upload(size)
+        yield upload_job.connect()
+        self.assertIsInstance(upload_job.consumer, upload.InlineConsumer)
+        yield upload_job.add_data(deflated_data + 'extra')
+        self.assertFailure(upload_job.deferred, server.errors.UploadCorrupt)
+        yield upload_job.cancel()
+
     @defer.inlineCallbacks
     def test_upload_id(self):
         """Test the upload_id generation."""
@@ -2735,6 +2805,62 @@ class TestNode(TestWithDatabase):
         self.assertEqual(len(consumer.buffer.getvalue()), len(deflated_data))
         self.assertEqual(consumer.buffer.getvalue(), deflated_data)
 
+    @defer.inlineCallbacks
+    def test_get_content_from_offset(self):
+        """Node.get_content starts from the given offset."""
+        node, deflated_data = yield self._upload_a_file(self.user, self.suser)
+        for offset in (1, len(deflated_data) // 2, len(deflated_data) - 1,
+                       len(deflated_data)):
+            producer = yield node.get_content(
+                start=offset, previous_hash=node.content_hash)
+            consumer = BufferedConsumer(producer)
+            producer.startProducing(consumer)
+            yield producer.deferred
+            self.assertEqual(
+                consumer.buffer.getvalue(), deflated_data[offset:])
+
+    @defer.inlineCallbacks
+    def test_get_content_past_the_end(self):
+        """Node.get_content refuses an offset past the end of the content."""
+        node, deflated_data = yield self._upload_a_file(self.user, self.suser)
+        ds = self.service.factory.diskstorage
+        self.patch(ds, 'get', lambda *a: self.fail("Read from disk!"))
+        for offset in (len(deflated_data) + 1, len(deflated_data) + 10):
+            self.assertRaises(
+                server.errors.ProtocolError, node.get_content,
+                start=offset, previous_hash=node.content_hash)
+
+    @defer.inlineCallbacks
+    def test_get_content_inline_past_the_end(self):
+        """An offset past the end of inline content is refused too."""
+        self.patch(settings, 'STORAGE_INLINE_MAX_SIZE', self.chunk_size)
+        node, deflated_data = yield self._upload_a_file(self.user, self.suser)
+        self.assertEqual(node.inline_content, deflated_data)
+        self.assertRaises(
+            server.errors.ProtocolError, node.get_content,
+            start=len(deflated_data) + 1, previous_hash=node.content_hash)
+
+    @defer.inlineCallbacks
+    def test_get_content_inline(self):
+        """Small content is stored in the database, and served from there."""
+        self.patch(settings, 'STORAGE_INLINE_MAX_SIZE', self.chunk_size)
+        ds = self.service.factory.diskstorage
+        self.patch(ds, 'put', lambda *a: self.fail("Stored in disk!"))
+        self.patch(ds, 'get', lambda *a: self.fail("Read from disk!"))
+        node, deflated_data = yield self._upload_a_file(self.user, self.suser)
+        self.assertEqual(node.inline_content, deflated_data)
+
+        for offset in (0, 1, len(deflated_data)):
+            producer = yield node.get_content(
+                start=offset, previous_hash=node.content_hash)
+            self.assertIsInstance(producer, FalseProducer)
+            consumer = BufferedConsumer(producer)
+            producer.startProducing(consumer)
+            producer.resumeProducing()
+            yield producer.deferred
+            self.assertEqual(
+                consumer.buffer.getvalue(), deflated_data[offset:])
+
     @defer.inlineCallbacks
     def _get_user_node(self):
         """Get a user and a node."""
@@ -2847,6 +2973,84 @@ class TestGenerations(TestWithDatabase):
         self.assertEqual(len(nodes) + 1, len(live_nodes))
         self.assertEqual(30, gen)
 
+    @defer.inlineCallbacks
+    def read_stream(self, stream):
+        """Return all the nodes of the stream."""
+        nodes = []
+        while True:
+            page = stream.get()
+            if page is not None:
+                nodes.extend(page)
+            elif stream.finished:
+                break
+            else:
+                d = defer.Deferred()
+                stream.waiter = lambda: d.callback(None)
+                yield d
+        defer.returnValue(nodes)
+
+    @defer.inlineCallbacks
+    def test_stream_delta(self):
+        """Test User.stream_delta."""
+        self.patch(settings, 'DELTA_PAGE_SIZE', 3)
+        root = self.suser.root
+        nodes = [root.make_file(u"name%s" % i) for i in range(10)]
+        stream = self.user.stream_delta(None, nodes[1].generation, limit=7)
+        delta = yield self.read_stream(stream)
+        self.assertEqual([n.id for n in delta], [n.id for n in nodes[2:9]])
+        self.assertEqual(stream.generation, nodes[-1].generation)
+        self.assertEqual(stream.free_bytes, self.suser.free_bytes)
+        self.assertEqual(stream.failure, None)
+
+    @defer.inlineCallbacks
+    def test_stream_from_scratch(self):
+        """Test User.stream_from_scratch."""
+        self.patch(settings, 'GET_FROM_SCRATCH_LIMIT', 3)
+        root = self.suser.root
+        nodes = [root.make_file(u"name%s" % i) for i in range(5)]
+        nodes += [root.make_subdirectory(u"dir%s" % i) for i in range(5)]
+        for f in [root.make_file(u"name%s" % i) for i in range(5, 10)]:
+            f.delete()
+        stream = self.user.stream_from_scratch(None)
+        live_nodes = yield self.read_stream(stream)
+        # nodes + root
+        self.assertEqual(len(nodes) + 1, len(live_nodes))
+        self.assertEqual(25, stream.generation)
+
+    @defer.inlineCallbacks
+    def test_get_rescan_stream(self):
+        """Test User.get_rescan_stream, from the manifest of the volume."""
+        self.patch(settings, 'GET_FROM_SCRATCH_LIMIT', 3)
+        tmpdir = self.mktemp()
+        self.patch(self.user.manager, 'manifests',
+                   VolumeManifests(tmpdir, min_nodes=5))
+        root = self.suser.root
+        files = [root.make_file(u"name%s" % i) for i in range(10)]
+        stream = yield self.user.get_rescan_stream(None)
+        live_nodes = yield self.read_stream(stream)
+        self.assertEqual(len(live_nodes), 11)
+        self.assertEqual(len(os.listdir(tmpdir)), 1)
+
+        # what changed since is taken from the database
+        files[0].delete()
+        new = root.make_file(u"new")
+        stream = yield self.user.get_rescan_stream(None)
+        live_nodes = yield self.read_stream(stream)
+        ids = set(n.id for n in live_nodes)
+        self.assertEqual(len(live_nodes), 11)
+        self.assertNotIn(files[0].id, ids)
+        self.assertIn(new.id, ids)
+        self.assertEqual(stream.generation, new.generation)
+
+    @defer.inlineCallbacks
+    def test_get_rescan_stream_no_manifests(self):
+        """Without manifests the rescan is taken from the database."""
+        self.patch(self.user.manager, 'manifests', None)
+        self.suser.root.make_file(u"name")
+        stream = yield self.user.get_rescan_stream(None)
+        live_nodes = yield self.read_stream(stream)
+        self.assertEqual(len(live_nodes), 2)
+
 
 class TestContentManagerTests(TestWithDatabase):
     """Test ContentManger class."""
@@ -2992,6 +3196,7 @@ class DBUploadJobTestCase(TestCase):
             self.to_return = to_return
             self.recorded = None
             self.id = 'fake_user_id'
+            self.upload_checkpoints = upload.HashingCheckpoints()
 
         def call(self, method, **attribs):
             """Record the call."""
@@ -2999,6 +3204,7 @@ class DBUploadJobTestCase(TestCase):
             return defer.succeed(self.to_return)
 
         rpc_dal = property(lambda self: self)
+        manager = property(lambda self: self)
 
     def setUp(self):
         """Set up."""
@@ -3083,6 +3289,64 @@ class DBUploadJobTestCase(TestCase):
                       chunk_size=chunk_size, volume_id='volume_id')
         self.assertEqual(attribs, should)
 
+    @defer.inlineCallbacks
+    def test_add_part_accumulates(self):
+        """Test add_part saves all the accumulated parts together."""
+        dbuj = yield self._make_uj()
+        chunk_size = int(settings.STORAGE_CHUNK_SIZE) // 2 + 1
+        yield dbuj.add_part(chunk_size)
+        self.assertEqual(self.user.recorded[0], 'make_uploadjob')
+        yield dbuj.add_part(chunk_size)
+
+        method, attribs = self.user.recorded
+        self.assertEqual(method, 'add_part_to_uploadjob')
+        self.assertEqual(attribs['chunk_size'], chunk_size * 2)
+        self.assertEqual(dbuj.unsaved_count, 0)
+
+    @defer.inlineCallbacks
+    def test_add_part_saves_checkpoint(self):
+        """Test add_part keeps the hashing state when saving the parts."""
+        dbuj = yield self._make_uj()
+        chunk_size = int(settings.STORAGE_CHUNK_SIZE)
+        state = upload.HashingState(None, None, None, 0, 0, chunk_size)
+        self.user.to_return = dict(uploaded_bytes=chunk_size)
+        yield dbuj.add_part(chunk_size, lambda: state)
+        self.assertIdentical(
+            self.user.upload_checkpoints.get('uploadjob_id'), state)
+
+    @defer.inlineCallbacks
+    def test_add_part_saves_later_checkpoint(self):
+        """Test add_part keeps the hashing state when it's ready."""
+        dbuj = yield self._make_uj()
+        chunk_size = int(settings.STORAGE_CHUNK_SIZE)
+        state = upload.HashingState(None, None, None, 0, 0, chunk_size)
+        self.user.to_return = dict(uploaded_bytes=chunk_size)
+        later = defer.Deferred()
+        yield dbuj.add_part(chunk_size, lambda: later)
+        self.assertEqual(len(self.user.upload_checkpoints), 0)
+        later.callback(state)
+        self.assertIdentical(
+            self.user.upload_checkpoints.get('uploadjob_id'), state)
+
+    @defer.inlineCallbacks
+    def test_add_part_checkpoint_not_matching(self):
+        """Test the hashing state is not kept if it's not what was saved."""
+        dbuj = yield self._make_uj()
+        chunk_size = int(settings.STORAGE_CHUNK_SIZE)
+        state = upload.HashingState(None, None, None, 0, 0, chunk_size)
+        self.user.to_return = dict(uploaded_bytes=chunk_size * 2)
+        yield dbuj.add_part(chunk_size, lambda: state)
+        self.assertIdentical(
+            self.user.upload_checkpoints.get('uploadjob_id'), None)
+
+    @defer.inlineCallbacks
+    def test_add_part_checkpoint_only_when_saving(self):
+        """Test the hashing state is only taken when saving the parts."""
+        dbuj = yield self._make_uj()
+        called = []
+        yield dbuj.add_part(10, lambda: called.append(True))
+        self.assertEqual(called, [])
+
     @defer.inlineCallbacks
     def test_delete(self):
         """Test delete method."""
@@ -3096,6 +3360,14 @@ class DBUploadJobTestCase(TestCase):
                       volume_id='volume_id')
         self.assertEqual(attribs, should)
 
+    @defer.inlineCallbacks
+    def test_delete_forgets_checkpoint(self):
+        """Test delete forgets the hashing state of the upload."""
+        dbuj = yield self._make_uj()
+        self.user.upload_checkpoints.save('uploadjob_id', 'state')
+        yield dbuj.delete()
+        self.assertEqual(len(self.user.upload_checkpoints), 0)
+
     @defer.inlineCallbacks
     def test_touch(self):
         """Test the touch method."""
@@ -3126,3 +3398,285 @@ class DBUploadJobTestCase(TestCase):
         # check methods
         yield uj.add_part(123)
         yield uj.delete()
+
+
+class NodeStreamTestCase(TestCase):
+    """Tests for the NodeStream."""
+
+    def setUp(self):
+        """Set up."""
+        self.nodes = range(10)
+        self.fetched = []
+        return super(NodeStreamTestCase, self).setUp()
+
+    def fetch(self, last, limit):
+        """Return the nodes after the last one."""
+        self.fetched.append((last, limit))
+        start = 0 if last is None else last + 1
+        return defer.succeed((self.nodes[start:start + limit], 12, 34))
+
+    def read(self, stream):
+        """Return all the pages available."""
+        pages = []
+        page = stream.get()
+        while page is not None:
+            pages.append(page)
+            page = stream.get()
+        return pages
+
+    def test_pages_ahead(self):
+        """Only up to max_pages are fetched ahead of what's taken."""
+        stream = NodeStream(self.fetch, 3, max_pages=2)
+        self.assertEqual(self.fetched, [])
+        stream.start()
+        self.assertEqual(self.fetched, [(None, 3), (2, 3)])
+        self.assertEqual(stream.get(), [0, 1, 2])
+        self.assertEqual(self.fetched, [(None, 3), (2, 3), (5, 3)])
+        self.assertFalse(stream.finished)
+
+    def test_finished_on_short_page(self):
+        """All the nodes are fetched, until a page is not full."""
+        stream = NodeStream(self.fetch, 3, max_pages=2)
+        stream.start()
+        self.assertEqual(self.read(stream), [[0, 1, 2], [3, 4, 5], [6, 7, 8],
+                                             [9]])
+        self.assertTrue(stream.finished)
+        self.assertEqual((stream.count, stream.last), (10, 9))
+        self.assertEqual((stream.generation, stream.free_bytes), (12, 34))
+
+    def test_finished_on_empty_page(self):
+        """The empty page is not kept."""
+        self.nodes = range(6)
+        stream = NodeStream(self.fetch, 3, max_pages=2)
+        stream.start()
+        self.assertEqual(self.read(stream), [[0, 1, 2], [3, 4, 5]])
+        self.assertTrue(stream.finished)
+        self.assertEqual(len(self.fetched), 3)
+
+    def test_limit(self):
+        """No more than the limit are fetched."""
+        stream = NodeStream(self.fetch, 3, limit=5, max_pages=2)
+        stream.start()
+        self.assertEqual(self.read(stream), [[0, 1, 2], [3, 4]])
+        self.assertTrue(stream.finished)
+        self.assertEqual(self.fetched, [(None, 3), (2, 2)])
+
+    def test_waiter(self):
+        """The waiter is called when a page arrives."""
+        d = defer.Deferred()
+        stream = NodeStream(lambda last, limit: d, 3)
+        stream.start()
+        called = []
+        stream.waiter = lambda: called.append(stream.get())
+        d.callback(([0, 1, 2], 12, 34))
+        self.assertEqual(called, [[0, 1, 2]])
+        self.assertEqual(stream.waiter, None)
+
+    def test_failure(self):
+        """A failure fetching finishes the stream, waking the waiter."""
+        failure = Failure(ValueError('crash'))
+        stream = NodeStream(lambda last, limit: defer.fail(failure), 3)
+        called = []
+        stream.waiter = lambda: called.append(True)
+        stream.start()
+        self.assertTrue(stream.finished)
+        self.assertIdentical(stream.failure, failure)
+        self.assertEqual(called, [True])
+
+    def test_stop(self):
+        """When stopped, nothing else is fetched nor kept."""
+        d = defer.Deferred()
+        stream = NodeStream(lambda last, limit: d, 3)
+        stream.start()
+        stream.stop()
+        d.callback(([0, 1, 2], 12, 34))
+        self.assertEqual(stream.get(), None)
+        self.assertEqual(stream.count, 0)
+
+
+class FakeStreamNode(object):
+    """A node as used by the NodeStreams of the User."""
+
+    def __init__(self, generation, path, name):
+        self.generation = generation
+        self.path = path
+        self.name = name
+
+
+class UserNodeStreamTestCase(TestCase):
+    """Tests for the NodeStreams of the User."""
+
+    class FakeManager(object):
+        """Fake object that simulates rpc_dal calls."""
+
+        generation_logs = None
+
+        def __init__(self):
+            self.recorded = []
+            self.results = []
+
+        def call(self, method, **attribs):
+            """Record the call."""
+            self.recorded.append((method, attribs))
+            nodes = self.results.pop(0)
+            return defer.succeed(
+                dict(nodes=nodes, vol_generation=12, free_bytes=34))
+
+        rpc_dal = property(lambda self: self)
+
+    def setUp(self):
+        """Set up."""
+        self.manager = self.FakeManager()
+        self.user = User(self.manager, 'user_id', 'root_id', 'username',
+                         'visible_name')
+        return super(UserNodeStreamTestCase, self).setUp()
+
+    def test_stream_delta(self):
+        """The delta continues from the last generation fetched."""
+        self.patch(settings, 'DELTA_PAGE_SIZE', 2)
+        self.patch(settings, 'DELTA_PAGES_AHEAD', 5)
+        self.manager.results = [[FakeStreamNode(3, '/', 'a'),
+                                 FakeStreamNode(5, '/', 'b')],
+                                [FakeStreamNode(6, '/', 'c')]]
+        stream = self.user.stream_delta('volume_id', 1, limit=10)
+        self.assertTrue(stream.finished)
+        self.assertEqual((stream.count, stream.generation), (3, 12))
+        should = [
+            ('get_delta_nodes', dict(user_id='user_id', volume_id='volume_id',
+                                     limit=2, from_generation=1)),
+            ('get_delta_nodes', dict(user_id='user_id', volume_id='volume_id',
+                                     limit=2, from_generation=5)),
+        ]
+        self.assertEqual(self.manager.recorded, should)
+
+    def test_stream_from_scratch(self):
+        """The rescan continues from the last path fetched."""
+        self.patch(settings, 'GET_FROM_SCRATCH_LIMIT', 2)
+        self.patch(settings, 'DELTA_PAGES_AHEAD', 5)
+        self.manager.results = [[FakeStreamNode(3, '/', ''),
+                                 FakeStreamNode(5, '/', 'b')],
+                                []]
+        stream = self.user.stream_from_scratch('volume_id')
+        self.assertTrue(stream.finished)
+        self.assertEqual(stream.count, 2)
+        should = [
+            ('get_from_scratch_nodes', dict(user_id='user_id',
+                                            volume_id='volume_id', limit=2)),
+            ('get_from_scratch_nodes', dict(user_id='user_id',
+                                            volume_id='volume_id', limit=2,
+                                            start_from_path=('/', 'b'),
+                                            max_generation=12)),
+        ]
+        self.assertEqual(self.manager.recorded, should)
+
+
+class UserUploadJobTestCase(TestCase):
+    """Tests for the upload jobs the User gets."""
+
+    class FakeManager(object):
+        """Fake object that simulates rpc_dal calls."""
+
+        def __init__(self):
+            self.recorded = []
+            self.blob_filter = BlobFilter(self)
+            self.blob_filter._filter = None
+            self.result = dict(
+                blob_exists=False, storage_key=None, uploadjob=None,
+                node=dict(
+                    id='node_id', volume_id=None, path='/', name='name',
+                    parent_id='root_id', is_file=True, content_hash=None,
+                    size=None, crc32=None, deflated_size=None, is_live=True,
+                    generation=3, is_public=False, public_url=None,
+                    last_modified=datetime.datetime(2018, 1, 1),
+                    inline_content=None, storage_key=None,
+                    has_content=False))
+
+        def call(self, method, **attribs):
+            """Record the call."""
+            self.recorded.append((method, attribs))
+            if isinstance(self.result, Exception):
+                return defer.fail(self.result)
+            return defer.succeed(self.result)
+
+        rpc_dal = property(lambda self: self)
+
+    def setUp(self):
+        """Set up."""
+        self.manager = self.FakeManager()
+        self.user = User(self.manager, 'user_id', 'root_id', 'username',
+                         'visible_name')
+        return super(UserUploadJobTestCase, self).setUp()
+
+    def get_upload_job(self, deflated_size=10, upload_id=None):
+        """Get the upload job of a file."""
+        return self.user.get_upload_job(
+            'vol_id', 'node_id', '', 'hash', 'crc32', 20, deflated_size,
+            session_id='session_id', magic_hash='magic_hash',
+            upload_id=upload_id)
+
+    @defer.inlineCallbacks
+    def test_one_call(self):
+        """Everything is done in one call."""
+        self.patch(uuid, 'uuid4', lambda: 'multipart_key')
+        upload_id = '12345678-1234-5678-1234-567812345678'
+        yield self.get_upload_job(
+            deflated_size=settings.STORAGE_CHUNK_SIZE + 1,
+            upload_id=upload_id)
+        should = dict(
+            user_id='user_id', volume_id='vol_id', node_id='node_id',
+            previous_hash=None, hash_value='hash', crc32='crc32',
+            inflated_size=20, magic_hash='magic_hash', check_reusable=True,
+            uploadjob_id=uuid.UUID(upload_id), multipart_key='multipart_key')
+        self.assertEqual(self.manager.recorded, [('prepare_upload', should)])
+
+    @defer.inlineCallbacks
+    def test_small(self):
+        """No job is kept in the database for a small file."""
+        upload_job = yield self.get_upload_job(upload_id='not an uuid')
+        self.assertIsInstance(upload_job, UploadJob)
+        self.assertIsInstance(upload_job.uploadjob, BogusUploadJob)
+        self.assertEqual(upload_job.file_node.id, 'node_id')
+        [(_, attribs)] = self.manager.recorded
+        self.assertIsNone(attribs['uploadjob_id'])
+        self.assertIsNone(attribs['multipart_key'])
+
+    @defer.inlineCallbacks
+    def test_big(self):
+        """The job of a big file is in the database."""
+        self.manager.result['uploadjob'] = dict(
+            uploadjob_id='uploadjob_id', uploaded_bytes=5,
+            multipart_key='multipart_key', chunk_count=1,
+            when_last_active='when_last_active')
+        upload_job = yield self.get_upload_job(
+            deflated_size=settings.STORAGE_CHUNK_SIZE + 1)
+        self.assertIsInstance(upload_job, UploadJob)
+        job = upload_job.uploadjob
+        self.assertIsInstance(job, DBUploadJob)
+        self.assertEqual(job.user, self.user)
+        self.assertEqual(job.volume_id, 'vol_id')
+        self.assertEqual(job.node_id, 'node_id')
+        self.assertEqual(job.uploadjob_id, 'uploadjob_id')
+        self.assertEqual(job.uploaded_bytes, 5)
+
+    @defer.inlineCallbacks
+    def test_reused(self):
+        """The content is reused if there's a blob for it."""
+        self.manager.result.update(blob_exists=True, storage_key='key')
+        upload_job = yield self.get_upload_job()
+        self.assertIsInstance(upload_job, MagicUploadJob)
+        self.assertEqual(upload_job.storage_key, 'key')
+
+    @defer.inlineCallbacks
+    def test_not_reused_if_filtered(self):
+        """The blob isn't looked for if the filter says it's not there."""
+        self.manager.blob_filter._filter = BloomFilter(10, 0.01)
+        yield self.get_upload_job()
+        [(_, attribs)] = self.manager.recorded
+        self.assertFalse(attribs['check_reusable'])
+
+    @defer.inlineCallbacks
+    def test_hash_mismatch(self):
+        """The node changed since the client knows of it."""
+        self.manager.result = errors.HashMismatch('changed')
+        yield self.assertFailure(self.get_upload_job(),
+                                 server.errors.ConflictError)
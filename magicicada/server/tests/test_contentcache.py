@@ -0,0 +1,224 @@
+# Copyright 2015-2018 Chicharreros (https://launchpad.net/~chicharreros)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# For further info, check  http://launchpad.net/magicicada-server
+
+"""Test the content cache."""
+
+import os
+import shutil
+import StringIO
+
+from twisted.internet import defer, reactor
+from twisted.trial.unittest import TestCase as TwistedTestCase
+
+from magicicada import settings
+from magicicada.server.contentcache import ContentCache, MemoryProducer
+from magicicada.server.diskstorage import DiskStorage
+
+
+class ContentCacheTestCase(TwistedTestCase):
+    """Test the ContentCache."""
+
+    def test_get_missing(self):
+        cache = ContentCache(100, 10)
+        self.assertEqual(cache.get('node'), None)
+        self.assertEqual((cache.hits, cache.misses), (0, 1))
+
+    def test_add_and_get(self):
+        cache = ContentCache(100, 10)
+        cache.add('node', 'content')
+        self.assertEqual(cache.get('node'), 'content')
+        self.assertEqual((cache.hits, cache.misses), (1, 0))
+        self.assertEqual(cache.size, len('content'))
+        self.assertIn('node', cache)
+
+    def test_evicts_least_recently_used(self):
+        cache = ContentCache(30, 10)
+        cache.add('node-1', 'a' * 10)
+        cache.add('node-2', 'b' * 10)
+        cache.add('node-3', 'c' * 10)
+        cache.get('node-1')
+        cache.add('node-4', 'd' * 10)
+        self.assertEqual(sorted(cache._items), ['node-1', 'node-3', 'node-4'])
+        self.assertEqual(cache.size, 30)
+        self.assertEqual(cache.evictions, 1)
+
+    def test_add_too_big(self):
+        cache = ContentCache(10, 10)
+        cache.add('node', 'a' * 11)
+        self.assertEqual(len(cache), 0)
+
+    def test_discard(self):
+        cache = ContentCache(100, 10)
+        cache.add('node', 'content')
+        cache.discard('node')
+        cache.discard('other')
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.size, 0)
+
+    def test_admitted_when_requested_again(self):
+        cache = ContentCache(100, 10)
+        self.assertFalse(cache.should_admit('node', 10))
+        self.assertTrue(cache.should_admit('node', 10))
+
+    def test_not_admitted_if_too_big(self):
+        cache = ContentCache(100, 10)
+        self.assertFalse(cache.should_admit('node', 11))
+        self.assertFalse(cache.should_admit('node', 11))
+
+    def test_not_admitted_if_forgotten(self):
+        cache = ContentCache(100, 10, history_size=2)
+        cache.should_admit('node-1', 5)
+        cache.should_admit('node-2', 5)
+        cache.should_admit('node-3', 5)
+        self.assertFalse(cache.should_admit('node-1', 5))
+        self.assertTrue(cache.should_admit('node-3', 5))
+
+
+class MemoryProducerTestCase(TwistedTestCase):
+    """Test the MemoryProducer."""
+
+    @defer.inlineCallbacks
+    def test_produce(self):
+        data = os.urandom(1000)
+        for offset in (0, 1, 333, 999, 1000):
+            producer = MemoryProducer(data, offset, chunk=64)
+            consumer = StringIO.StringIO()
+            yield producer.startProducing(consumer)
+            self.assertEqual(consumer.getvalue(), data[offset:])
+            self.assertTrue(producer.deferred.called)
+
+    @defer.inlineCallbacks
+    def test_chunks_are_not_copies(self):
+        data = 'x' * 100
+        written = []
+        producer = MemoryProducer(data, chunk=64)
+        consumer = StringIO.StringIO()
+        consumer.write = written.append
+        yield producer.startProducing(consumer)
+        self.assertEqual([type(chunk) for chunk in written], [buffer, buffer])
+        self.assertEqual(''.join(map(str, written)), data)
+
+    @defer.inlineCallbacks
+    def test_pause_and_resume(self):
+        data = os.urandom(1000)
+        producer = MemoryProducer(data, chunk=100)
+        written = []
+
+        class Consumer(object):
+            def write(self, chunk):
+                written.append(str(chunk))
+                producer.pauseProducing()
+                reactor.callLater(0.01, producer.resumeProducing)
+
+        yield producer.startProducing(Consumer())
+        self.assertEqual(len(written), 10)
+        self.assertEqual(''.join(written), data)
+
+    @defer.inlineCallbacks
+    def test_stop(self):
+        producer = MemoryProducer('x' * 1000, chunk=100)
+        consumer = StringIO.StringIO()
+        producer.startProducing(consumer)
+        producer.stopProducing()
+        yield producer.deferred
+        self.assertEqual(consumer.getvalue(), '')
+
+
+class DiskStorageCacheTestCase(TwistedTestCase):
+    """Test the disk storage caching the content."""
+
+    @defer.inlineCallbacks
+    def setUp(self):
+        yield super(DiskStorageCacheTestCase, self).setUp()
+        self.tmpdir = os.getcwd() + "/tmp/contentcache_tests"
+        os.makedirs(self.tmpdir)
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.patch(settings, 'STORAGE_IO_THREADS', 0)
+        self.patch(settings, 'STORAGE_CACHE_MAX_ITEM_SIZE', 100)
+        self.storage = DiskStorage(
+            self.tmpdir, pack_max_size=0, cache_size=1000)
+
+    @defer.inlineCallbacks
+    def put(self, node_id, data):
+        """Store the node."""
+        consumer = self.storage.put(node_id)
+        consumer.write(data)
+        yield consumer.commit()
+
+    @defer.inlineCallbacks
+    def get(self, node_id, offset=0):
+        """Return the content of the node, and its producer."""
+        consumer = StringIO.StringIO()
+        producer = self.storage.get(node_id, offset)
+        producer.startProducing(consumer)
+        yield producer.deferred
+        defer.returnValue((consumer.getvalue(), producer))
+
+    @defer.inlineCallbacks
+    def test_cached_when_read_again(self):
+        yield self.put('node-id', 'content')
+        content, _ = yield self.get('node-id')
+        self.assertEqual(content, 'content')
+        self.assertNotIn('node-id', self.storage.cache)
+        content, _ = yield self.get('node-id')
+        self.assertEqual(content, 'content')
+        self.assertIn('node-id', self.storage.cache)
+
+        # then it's served from memory
+        os.remove(self.storage._find('node-id'))
+        content, producer = yield self.get('node-id')
+        self.assertEqual(content, 'content')
+        self.assertIsInstance(producer, MemoryProducer)
+        content, _ = yield self.get('node-id', 3)
+        self.assertEqual(content, 'tent')
+        self.assertEqual(self.storage.cache.hits, 2)
+
+    @defer.inlineCallbacks
+    def test_not_cached_if_too_big(self):
+        yield self.put('node-id', 'x' * 101)
+        yield self.get('node-id')
+        yield self.get('node-id')
+        self.assertNotIn('node-id', self.storage.cache)
+
+    @defer.inlineCallbacks
+    def test_not_cached_when_resuming(self):
+        yield self.put('node-id', 'content')
+        yield self.get('node-id', 1)
+        yield self.get('node-id', 1)
+        self.assertNotIn('node-id', self.storage.cache)
+
+    @defer.inlineCallbacks
+    def test_not_cached_if_stopped(self):
+        yield self.put('node-id', 'content')
+        yield self.get('node-id')
+        producer = self.storage.get('node-id')
+        producer.startProducing(StringIO.StringIO())
+        producer.stopProducing()
+        yield producer.deferred
+        self.assertNotIn('node-id', self.storage.cache)
+
+    @defer.inlineCallbacks
+    def test_discarded_when_deleted(self):
+        yield self.put('node-id', 'content')
+        yield self.get('node-id')
+        yield self.get('node-id')
+        self.storage.delete('node-id')
+        self.assertNotIn('node-id', self.storage.cache)
+
+    def test_no_cache(self):
+        storage = DiskStorage(self.tmpdir, cache_size=0)
+        self.assertEqual(storage.cache, None)
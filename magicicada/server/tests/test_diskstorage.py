@@ -19,14 +19,62 @@
 
 """Test Disk Storage backend."""
 
+import logging
 import os
 import shutil
 import StringIO
+import threading
+import uuid
 
-from twisted.internet import defer
+from twisted.internet import defer, reactor
+from twisted.python.threadpool import ThreadPool
 from twisted.trial.unittest import TestCase as TwistedTestCase
 
-from magicicada.server.diskstorage import DiskStorage, DIRS_LEVELS
+from magicicada import settings
+from magicicada.server import diskstorage
+from magicicada.server.diskstorage import (
+    DiskStorage,
+    DIRS_LEVELS,
+    DURABILITY_FSYNC,
+    DURABILITY_FSYNC_DIR,
+    DURABILITY_NONE,
+    FileReaderProducer,
+    FileWriterConsumer,
+    Volume,
+)
+
+
+class PausingConsumer(object):
+    """A consumer that pauses the producer after every write."""
+
+    def __init__(self):
+        self.producer = None
+        self.written = []
+        self.paused = False
+
+    def write(self, data):
+        assert not self.paused, "Written while paused!"
+        self.written.append(data)
+        self.paused = True
+        self.producer.pauseProducing()
+        reactor.callLater(0, self.resume)
+
+    def resume(self):
+        self.paused = False
+        self.producer.resumeProducing()
+
+
+class FakeProducer(object):
+    """A producer that records if it's paused or resumed."""
+
+    def __init__(self):
+        self.calls = []
+
+    def pauseProducing(self):
+        self.calls.append('pause')
+
+    def resumeProducing(self):
+        self.calls.append('resume')
 
 
 class BaseTestCase(TwistedTestCase):
@@ -40,6 +88,10 @@ class BaseTestCase(TwistedTestCase):
         os.makedirs(self.tmpdir)
         self.addCleanup(shutil.rmtree, self.tmpdir)
 
+        # the basic functionality is tested doing the disk operations in
+        # the reactor thread, see below for the threaded ones
+        self.patch(settings, 'STORAGE_IO_THREADS', 0)
+
     def test_treepath_simple(self):
         t = DiskStorage("foo")._get_treepath("simple")
         self.assertEqual(t, "foo/s/i/m")
@@ -71,10 +123,60 @@ class BaseTestCase(TwistedTestCase):
         yield producer.startProducing(consumer)
         self.assertEqual(consumer.getvalue(), data)
 
+    @defer.inlineCallbacks
+    def test_get_node_from_offset(self):
+        # write a fake file
+        node_id = "dinw78cdync8"
+        path = DiskStorage(self.tmpdir)._get_treepath(node_id)
+        os.makedirs(path)
+        data = os.urandom(1000)
+        with open(os.path.join(path, node_id), 'wb') as fh:
+            fh.write(data)
+
+        # get it from different offsets, both reading it in threads or not
+        for threads in (0, 2):
+            self.patch(settings, 'STORAGE_IO_THREADS', threads)
+            ds = DiskStorage(self.tmpdir)
+            if ds.threadpool is not None:
+                self.addCleanup(ds.threadpool.stop)
+            for offset in (0, 1, 333, 999, 1000):
+                producer = ds.get(node_id, offset)
+                consumer = StringIO.StringIO()
+                yield producer.startProducing(consumer)
+                self.assertEqual(consumer.getvalue(), data[offset:])
+
+    @defer.inlineCallbacks
+    def test_producer_size(self):
+        filepath = os.path.join(self.tmpdir, "testfile")
+        data = os.urandom(1000)
+        with open(filepath, 'wb') as fh:
+            fh.write(data)
+
+        # only the given bytes are produced, both in threads or not
+        threadpool = ThreadPool(minthreads=0, maxthreads=1)
+        threadpool.start()
+        self.addCleanup(threadpool.stop)
+        for pool in (None, threadpool):
+            producer = FileReaderProducer(
+                filepath, offset=100, threadpool=pool, chunk=64, size=300)
+            consumer = StringIO.StringIO()
+            producer.startProducing(consumer)
+            yield producer.deferred
+            self.assertEqual(consumer.getvalue(), data[100:400])
+
     def test_get_node_missing(self):
-        ds = DiskStorage(self.tmpdir)
+        ds = DiskStorage(self.tmpdir, pack_max_size=0)
         self.assertRaises(IOError, ds.get, "not there")
 
+    @defer.inlineCallbacks
+    def test_get_node_missing_maybe_packed(self):
+        # other process may have packed it, so the producer fails instead
+        ds = DiskStorage(self.tmpdir)
+        self.addCleanup(ds.packs.close)
+        producer = ds.get("not there")
+        producer.startProducing(StringIO.StringIO())
+        yield self.assertFailure(producer.deferred, IOError)
+
     def test_put_node_ok(self):
         # write it
         node_id = "dinw78cdync8"
@@ -177,3 +279,600 @@ class BaseTestCase(TwistedTestCase):
             written = fh.read()
         self.assertEqual(written, data)
         self.assertFalse(os.path.exists(consumer.temppath))
+
+    @defer.inlineCallbacks
+    def test_delete_node(self):
+        node_id = "dinw78cdync8"
+        ds = DiskStorage(self.tmpdir)
+        consumer = ds.put(node_id)
+        consumer.write(b'test content')
+        yield consumer.commit()
+
+        freed = ds.delete(node_id)
+        self.assertEqual(freed, 12)
+        path = os.path.join(ds._get_treepath(node_id), node_id)
+        self.assertFalse(os.path.exists(path))
+
+    @defer.inlineCallbacks
+    def test_read_node(self):
+        node_id = "dinw78cdync8"
+        ds = DiskStorage(self.tmpdir)
+        consumer = ds.put(node_id)
+        consumer.write(b'test content')
+        yield consumer.commit()
+        self.assertEqual(ds.read(node_id), b'test content')
+
+    def test_read_node_missing(self):
+        ds = DiskStorage(self.tmpdir)
+        self.assertIdentical(ds.read("dinw78cdync8"), None)
+
+    @defer.inlineCallbacks
+    def test_open_content(self):
+        node_id = "dinw78cdync8"
+        ds = DiskStorage(self.tmpdir)
+        consumer = ds.put(node_id)
+        consumer.write(b'test content')
+        yield consumer.commit()
+        fh, size = ds.open_content(node_id)
+        with fh:
+            self.assertEqual(size, 12)
+            self.assertEqual(fh.read(), b'test content')
+
+    def test_open_content_missing(self):
+        ds = DiskStorage(self.tmpdir)
+        self.assertIdentical(ds.open_content("dinw78cdync8"), None)
+
+    def test_delete_node_missing(self):
+        ds = DiskStorage(self.tmpdir)
+        self.assertEqual(ds.delete("dinw78cdync8"), 0)
+
+    def test_delete_node_temp(self):
+        node_id = "dinw78cdync8"
+        ds = DiskStorage(self.tmpdir)
+        consumer = ds.put(node_id)
+        consumer.write(b'test content')
+        consumer.fh.flush()
+
+        freed = ds.delete(node_id, temp=True)
+        self.assertEqual(freed, 12)
+        self.assertFalse(os.path.exists(consumer.temppath))
+
+    def test_iter_temp_files(self):
+        ds = DiskStorage(self.tmpdir)
+        for node_id in ("bcd-2", "abc-1", "abd-1", "abc-2"):
+            consumer = ds.put(node_id)
+            consumer.write(b'test content')
+            consumer.fh.flush()
+        # finished files are not included
+        consumer = ds.put("abc-3")
+        consumer.write(b'test content')
+        consumer.commit()
+
+        found = sorted((leaf, node_id, stat.st_size)
+                       for leaf, node_id, stat in ds.iter_temp_files())
+        self.assertEqual(found, [
+            ("abc", "abc-1", 12), ("abc", "abc-2", 12),
+            ("abd", "abd-1", 12), ("bcd", "bcd-2", 12)])
+        # the leaves are walked in order
+        leaves = [leaf for leaf, _, _ in ds.iter_temp_files()]
+        self.assertEqual(leaves, sorted(leaves))
+
+    def test_iter_temp_files_after(self):
+        ds = DiskStorage(self.tmpdir)
+        for node_id in ("abc-1", "abd-1", "acb-1", "bcd-1"):
+            consumer = ds.put(node_id)
+            consumer.write(b'test content')
+            consumer.fh.flush()
+
+        found = [node_id for _, node_id, _ in ds.iter_temp_files("abc")]
+        self.assertEqual(found, ["abd-1", "acb-1", "bcd-1"])
+        found = [node_id for _, node_id, _ in ds.iter_temp_files("acb")]
+        self.assertEqual(found, ["bcd-1"])
+
+    def test_iter_temp_files_empty(self):
+        ds = DiskStorage(os.path.join(self.tmpdir, "missing"))
+        self.assertEqual(list(ds.iter_temp_files()), [])
+
+
+class ThreadedReaderTestCase(TwistedTestCase):
+    """Test the threaded reading of the FileReaderProducer."""
+
+    @defer.inlineCallbacks
+    def setUp(self):
+        yield super(ThreadedReaderTestCase, self).setUp()
+        self.tmpdir = os.getcwd() + "/tmp/diskstorage_tests"
+        os.makedirs(self.tmpdir)
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+
+        self.threadpool = ThreadPool(minthreads=0, maxthreads=2)
+        self.threadpool.start()
+        self.addCleanup(self.threadpool.stop)
+
+        self.data = os.urandom(1000)
+        self.filepath = os.path.join(self.tmpdir, "testfile")
+        with open(self.filepath, 'wb') as fh:
+            fh.write(self.data)
+
+    @defer.inlineCallbacks
+    def test_read_all(self):
+        producer = FileReaderProducer(
+            self.filepath, threadpool=self.threadpool, chunk=100,
+            read_ahead=3)
+        consumer = StringIO.StringIO()
+        yield producer.startProducing(consumer)
+        self.assertEqual(consumer.getvalue(), self.data)
+        self.assertTrue(producer._fh.closed)
+        self.assertTrue(producer.deferred.called)
+
+    @defer.inlineCallbacks
+    def test_read_empty_file(self):
+        with open(self.filepath, 'wb'):
+            pass
+        producer = FileReaderProducer(
+            self.filepath, threadpool=self.threadpool)
+        consumer = StringIO.StringIO()
+        yield producer.startProducing(consumer)
+        self.assertEqual(consumer.getvalue(), '')
+
+    @defer.inlineCallbacks
+    def test_honors_pausing(self):
+        producer = FileReaderProducer(
+            self.filepath, threadpool=self.threadpool, chunk=100,
+            read_ahead=2)
+        consumer = PausingConsumer()
+        consumer.producer = producer
+        yield producer.startProducing(consumer)
+        self.assertEqual(len(consumer.written), 10)
+        self.assertEqual(''.join(consumer.written), self.data)
+
+    @defer.inlineCallbacks
+    def test_read_ahead_is_bounded(self):
+        producer = FileReaderProducer(
+            self.filepath, threadpool=self.threadpool, chunk=100,
+            read_ahead=2)
+        producer.pauseProducing()
+        consumer = StringIO.StringIO()
+        d = producer.startProducing(consumer)
+
+        # let it read while paused, it will stop when the buffer is full
+        while len(producer._buffer) < 2 or producer._reading:
+            yield self.deferLater(0.01)
+        self.assertEqual(consumer.getvalue(), '')
+        self.assertEqual(len(producer._buffer), 2)
+
+        producer.resumeProducing()
+        yield d
+        self.assertEqual(consumer.getvalue(), self.data)
+
+    @defer.inlineCallbacks
+    def test_stop_producing(self):
+        producer = FileReaderProducer(
+            self.filepath, threadpool=self.threadpool, chunk=100)
+        consumer = PausingConsumer()
+        consumer.producer = producer
+        d = producer.startProducing(consumer)
+        producer.stopProducing()
+        yield d
+        self.assertTrue(len(consumer.written) < 10)
+        self.assertTrue(producer._fh.closed)
+
+    @defer.inlineCallbacks
+    def test_read_error(self):
+        producer = FileReaderProducer(
+            self.filepath, threadpool=self.threadpool)
+
+        def crash(*args):
+            raise ValueError("crash")
+        producer._fh = self.FakeFile(crash)
+        yield producer.startProducing(StringIO.StringIO())
+        yield self.assertFailure(producer.deferred, ValueError)
+
+    def deferLater(self, delay):
+        d = defer.Deferred()
+        reactor.callLater(delay, d.callback, None)
+        return d
+
+    class FakeFile(object):
+        """A file that calls a function when read."""
+
+        def __init__(self, read):
+            self.read = read
+            self.closed = False
+
+        def close(self):
+            self.closed = True
+
+    def test_diskstorage_uses_threadpool(self):
+        self.patch(settings, 'STORAGE_IO_THREADS', 2)
+        self.patch(settings, 'STORAGE_READ_CHUNK_SIZE', 123)
+        self.patch(settings, 'STORAGE_READ_AHEAD', 5)
+        node_id = "dinw78cdync8"
+        ds = DiskStorage(self.tmpdir)
+        path = ds._get_treepath(node_id)
+        os.makedirs(path)
+        open(os.path.join(path, node_id), 'wb').close()
+
+        producer = ds.get(node_id)
+        self.addCleanup(ds.threadpool.stop)
+        self.assertIdentical(producer.threadpool, ds.threadpool)
+        self.assertEqual(producer.chunk, 123)
+        self.assertEqual(producer.read_ahead, 5)
+        producer._fh.close()
+
+    def test_diskstorage_without_threads(self):
+        self.patch(settings, 'STORAGE_IO_THREADS', 0)
+        node_id = "dinw78cdync8"
+        ds = DiskStorage(self.tmpdir)
+        path = ds._get_treepath(node_id)
+        os.makedirs(path)
+        open(os.path.join(path, node_id), 'wb').close()
+
+        producer = ds.get(node_id)
+        self.assertIdentical(producer.threadpool, None)
+        producer._fh.close()
+
+
+class ThreadedWriterTestCase(TwistedTestCase):
+    """Test the threaded writing of the FileWriterConsumer."""
+
+    @defer.inlineCallbacks
+    def setUp(self):
+        yield super(ThreadedWriterTestCase, self).setUp()
+        self.tmpdir = os.getcwd() + "/tmp/diskstorage_tests"
+        os.makedirs(self.tmpdir)
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+
+        self.threadpool = ThreadPool(minthreads=0, maxthreads=2)
+        self.threadpool.start()
+        self.addCleanup(self.threadpool.stop)
+
+        self.filepath = os.path.join(self.tmpdir, "testfile")
+
+    def get_consumer(self, offset=0, **kwargs):
+        """Return a threaded consumer for the test file."""
+        return FileWriterConsumer(
+            self.filepath, offset, threadpool=self.threadpool, **kwargs)
+
+    def read(self, path):
+        """Return the content of the file in the given path."""
+        with open(path, 'rb') as fh:
+            return fh.read()
+
+    @defer.inlineCallbacks
+    def test_write_and_commit(self):
+        consumer = self.get_consumer(block_size=10)
+        data = os.urandom(1000)
+        for i in range(0, 1000, 7):
+            consumer.write(data[i:i + 7])
+        consumer.unregisterProducer()
+        yield consumer.commit()
+        self.assertEqual(self.read(self.filepath), data)
+        self.assertFalse(os.path.exists(consumer.temppath))
+
+    @defer.inlineCallbacks
+    def test_writes_are_coalesced(self):
+        consumer = self.get_consumer(block_size=100)
+        written = []
+        self.patch(consumer, '_write_block', written.append)
+        for _ in range(25):
+            consumer.write('x' * 10)
+        consumer.unregisterProducer()
+        yield consumer.closed
+        self.assertEqual([len(block) for block in written], [100, 100, 50])
+
+    @defer.inlineCallbacks
+    def test_commit_waits_the_writes(self):
+        consumer = self.get_consumer(block_size=10)
+        release = threading.Event()
+        original_write = consumer._write_block
+
+        def slow_write(data):
+            release.wait()
+            original_write(data)
+        self.patch(consumer, '_write_block', slow_write)
+
+        consumer.write('x' * 20)
+        d = consumer.commit()
+        self.assertFalse(d.called)
+        self.assertFalse(os.path.exists(self.filepath))
+        release.set()
+        yield d
+        self.assertEqual(self.read(self.filepath), 'x' * 20)
+
+    @defer.inlineCallbacks
+    def test_backpressure(self):
+        consumer = self.get_consumer(block_size=10, max_pending=30)
+        producer = FakeProducer()
+        consumer.registerProducer(producer, True)
+        release = threading.Event()
+        original_write = consumer._write_block
+
+        def slow_write(data):
+            release.wait()
+            original_write(data)
+        self.patch(consumer, '_write_block', slow_write)
+
+        consumer.write('x' * 20)
+        self.assertEqual(producer.calls, [])
+        consumer.write('x' * 10)
+        self.assertEqual(producer.calls, ['pause'])
+        release.set()
+        yield consumer._result()
+        self.assertEqual(producer.calls, ['pause', 'resume'])
+        self.assertEqual(consumer.pending, 0)
+        yield consumer.commit()
+
+    @defer.inlineCallbacks
+    def test_resume(self):
+        consumer = self.get_consumer()
+        consumer.write('foo')
+        consumer.unregisterProducer()
+        yield consumer.closed
+
+        consumer = self.get_consumer(3)
+        consumer.write('bar')
+        yield consumer.commit()
+        self.assertEqual(self.read(self.filepath), 'foobar')
+
+    @defer.inlineCallbacks
+    def test_resume_with_wrong_offset(self):
+        consumer = self.get_consumer()
+        consumer.write('foo')
+        consumer.unregisterProducer()
+        yield consumer.closed
+
+        consumer = self.get_consumer(5, after=defer.succeed(None))
+        yield self.assertFailure(consumer.commit(), ValueError)
+
+    @defer.inlineCallbacks
+    def test_write_error_is_raised_later(self):
+        consumer = self.get_consumer(block_size=1)
+
+        def crash(data):
+            raise IOError("disk full")
+        self.patch(consumer, '_write_block', crash)
+
+        consumer.write('foo')
+        consumer.unregisterProducer()
+        yield consumer.closed
+        self.assertRaises(IOError, consumer.write, 'bar')
+        yield self.assertFailure(consumer.commit(), IOError)
+        self.assertFalse(os.path.exists(self.filepath))
+
+    def test_preallocates_from_size_hint(self):
+        called = []
+        self.patch(diskstorage, 'preallocate',
+                   lambda *args: called.append(args[1:]))
+        consumer = FileWriterConsumer(self.filepath, 0, size_hint=1000)
+        consumer.commit()
+        self.assertEqual(called, [(0, 1000)])
+
+    def test_preallocates_keeping_the_size(self):
+        consumer = FileWriterConsumer(self.filepath, 0, size_hint=100000)
+        consumer.write('foo')
+        consumer.commit()
+        self.assertEqual(os.stat(self.filepath).st_size, 3)
+
+    def test_invalid_durability(self):
+        self.assertRaises(ValueError, FileWriterConsumer, self.filepath, 0,
+                          durability='always')
+
+    @defer.inlineCallbacks
+    def check_durability(self, durability, expected):
+        """Write a file with the given durability and check what's synced."""
+        synced = []
+        self.patch(diskstorage, 'fsync_path', synced.append)
+        consumer = self.get_consumer(durability=durability)
+        consumer.write('foo')
+        yield consumer.commit()
+        expected = [consumer.temppath if path == 'file' else self.tmpdir
+                    for path in expected]
+        self.assertEqual(synced, expected)
+
+    def test_durability_none(self):
+        return self.check_durability(DURABILITY_NONE, [])
+
+    def test_durability_fsync(self):
+        return self.check_durability(DURABILITY_FSYNC, ['file'])
+
+    def test_durability_fsync_dir(self):
+        return self.check_durability(DURABILITY_FSYNC_DIR, ['file', 'dir'])
+
+    @defer.inlineCallbacks
+    def test_diskstorage_uses_threadpool(self):
+        self.patch(settings, 'STORAGE_IO_THREADS', 2)
+        self.patch(settings, 'STORAGE_WRITE_BLOCK_SIZE', 123)
+        self.patch(settings, 'STORAGE_WRITE_MAX_PENDING', 456)
+        self.patch(settings, 'STORAGE_DURABILITY', DURABILITY_NONE)
+        ds = DiskStorage(self.tmpdir, pack_max_size=0)
+        consumer = ds.put("dinw78cdync8", size_hint=10)
+        self.addCleanup(ds.threadpool.stop)
+        self.assertIdentical(consumer.threadpool, ds.threadpool)
+        self.assertEqual(consumer.block_size, 123)
+        self.assertEqual(consumer.max_pending, 456)
+        self.assertEqual(consumer.durability, DURABILITY_NONE)
+        yield consumer.commit()
+
+    @defer.inlineCallbacks
+    def test_diskstorage_resume_waits_previous_writer(self):
+        self.patch(settings, 'STORAGE_IO_THREADS', 2)
+        node_id = "dinw78cdync8"
+        ds = DiskStorage(self.tmpdir)
+        self.addCleanup(lambda: ds.threadpool.stop())
+
+        consumer1 = ds.put(node_id)
+        consumer1.write('foo')
+        consumer1.unregisterProducer()
+
+        consumer2 = ds.put(node_id, 3)
+        consumer2.write('bar')
+        yield consumer2.commit()
+        with open(consumer2.filepath, 'rb') as fh:
+            self.assertEqual(fh.read(), 'foobar')
+
+
+class MultiVolumeTestCase(TwistedTestCase):
+    """Test the disk storage spreading the nodes in many volumes."""
+
+    @defer.inlineCallbacks
+    def setUp(self):
+        yield super(MultiVolumeTestCase, self).setUp()
+        self.tmpdir = os.getcwd() + "/tmp/diskstorage_tests"
+        os.makedirs(self.tmpdir)
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.patch(settings, 'STORAGE_IO_THREADS', 0)
+        self.node_ids = [str(uuid.uuid4()) for _ in range(300)]
+
+    def make_storage(self, *weights, **kwargs):
+        """Make a storage with volumes of those weights."""
+        volumes = [(os.path.join(self.tmpdir, "vol%d" % i), weight)
+                   for i, weight in enumerate(weights)]
+        kwargs.setdefault('min_free_bytes', 0)
+        return DiskStorage(volumes, **kwargs)
+
+    @defer.inlineCallbacks
+    def store(self, ds, node_id, data='test content'):
+        """Store a node."""
+        consumer = ds.put(node_id)
+        consumer.write(data)
+        yield consumer.commit()
+        defer.returnValue(consumer.filepath)
+
+    @defer.inlineCallbacks
+    def read(self, ds, node_id):
+        """Read a node."""
+        consumer = StringIO.StringIO()
+        yield ds.get(node_id).startProducing(consumer)
+        defer.returnValue(consumer.getvalue())
+
+    def placement(self, ds):
+        """Return the basedir where each node is stored."""
+        return dict((node_id, ds._get_target(node_id).basedir)
+                    for node_id in self.node_ids)
+
+    def test_no_volumes(self):
+        self.assertRaises(ValueError, DiskStorage, [])
+
+    def test_placement_is_stable(self):
+        placement = self.placement(self.make_storage(1, 1))
+        self.assertEqual(placement, self.placement(self.make_storage(1, 1)))
+
+    def test_placement_follows_the_weights(self):
+        ds = self.make_storage(1, 3)
+        placement = self.placement(ds).values()
+        in_heavier = placement.count(ds.volumes[1].basedir)
+        # 3/4 of the nodes, more or less
+        self.assertTrue(180 < in_heavier < 270, in_heavier)
+
+    def test_adding_a_volume_only_moves_to_it(self):
+        before = self.placement(self.make_storage(1, 1))
+        ds = self.make_storage(1, 1, 1)
+        after = self.placement(ds)
+        moved = [node_id for node_id in self.node_ids
+                 if before[node_id] != after[node_id]]
+        self.assertTrue(moved)
+        for node_id in moved:
+            self.assertEqual(after[node_id], ds.volumes[2].basedir)
+
+    def test_full_volume_is_skipped(self):
+        ds = self.make_storage(1, 1, min_free_bytes=100)
+        self.patch(ds.volumes[0], 'free_bytes', lambda: 99)
+        self.patch(ds.volumes[1], 'free_bytes', lambda: 100)
+        placement = self.placement(ds)
+        self.assertEqual(set(placement.values()), {ds.volumes[1].basedir})
+
+    def test_free_bytes_is_cached(self):
+        volume = Volume(self.tmpdir)
+        self.assertTrue(volume.free_bytes() > 0)
+        volume._free_bytes = 123
+        self.assertEqual(volume.free_bytes(), 123)
+        volume._free_checked -= Volume.free_space_ttl + 1
+        self.assertNotEqual(volume.free_bytes(), 123)
+
+    def test_free_bytes_missing_volume(self):
+        volume = Volume(os.path.join(self.tmpdir, "missing"))
+        self.assertEqual(volume.free_bytes(), 0)
+
+    @defer.inlineCallbacks
+    def test_get_falls_back_to_other_volumes(self):
+        ds = self.make_storage(1, 1)
+        node_id = self.node_ids[0]
+        # stored in the second choice, as if the first one was full
+        other = ds._get_volumes(node_id)[1]
+        self.patch(ds, '_get_target', lambda node_id: other)
+        path = yield self.store(ds, node_id)
+        self.assertTrue(path.startswith(other.basedir))
+
+        data = yield self.read(self.make_storage(1, 1), node_id)
+        self.assertEqual(data, 'test content')
+
+    @defer.inlineCallbacks
+    def test_put_resumes_in_the_same_volume(self):
+        ds = self.make_storage(1, 1)
+        node_id = self.node_ids[0]
+        other = ds._get_volumes(node_id)[1]
+        self.patch(ds, '_get_target', lambda node_id: other)
+        consumer = ds.put(node_id)
+        consumer.write('foo')
+        consumer.unregisterProducer()
+
+        ds = self.make_storage(1, 1)
+        consumer = ds.put(node_id, 3)
+        self.assertTrue(consumer.filepath.startswith(other.basedir))
+        consumer.write('bar')
+        yield consumer.commit()
+        data = yield self.read(ds, node_id)
+        self.assertEqual(data, 'foobar')
+
+    @defer.inlineCallbacks
+    def test_delete_from_all_volumes(self):
+        ds = self.make_storage(1, 1)
+        node_id = self.node_ids[0]
+        for volume in ds.volumes:
+            self.patch(ds, '_get_target', lambda node_id: volume)
+            yield self.store(ds, node_id)
+        self.assertEqual(ds.delete(node_id), 24)
+        for volume in ds.volumes:
+            self.assertFalse(os.path.exists(volume.get_path(node_id)))
+
+    def test_iter_temp_files_in_all_volumes(self):
+        ds = self.make_storage(1, 1)
+        for node_id, volume in zip(self.node_ids, ds.volumes):
+            self.patch(ds, '_get_target', lambda node_id: volume)
+            ds.put(node_id).write('foo')
+        found = sorted(node_id for _, node_id, _ in ds.iter_temp_files())
+        self.assertEqual(found, sorted(self.node_ids[:2]))
+
+    def test_precreate(self):
+        ds = self.make_storage(1, 1)
+        ds.precreate(alphabet='ab')
+        for volume in ds.volumes:
+            for node_id in ('aaa', 'abb', 'bab', 'bbb'):
+                self.assertTrue(os.path.isdir(volume.get_treepath(node_id)))
+        # not checked again
+        self.patch(os, 'makedirs', None)
+        ds.put('aaaa')
+
+    @defer.inlineCallbacks
+    def test_rebalance(self):
+        ds = self.make_storage(1, 1)
+        for node_id in self.node_ids[:50]:
+            yield self.store(ds, node_id, node_id)
+        # an unfinished file is not moved
+        ds.put(self.node_ids[50]).write('foo')
+
+        ds = self.make_storage(1, 1, 1)
+        moved = ds.rebalance(logging.getLogger())
+
+        new = ds.volumes[2]
+        in_new = [node_id for node_id in self.node_ids[:50]
+                  if os.path.exists(new.get_path(node_id))]
+        self.assertTrue(in_new)
+        self.assertEqual(moved, 36 * len(in_new))
+        for node_id in self.node_ids[:50]:
+            data = yield self.read(ds, node_id)
+            self.assertEqual(data, node_id)
+            self.assertEqual(ds._find(node_id),
+                             ds._get_target(node_id).get_path(node_id))
+        self.assertEqual(ds.rebalance(logging.getLogger()), 0)
+        self.assertEqual(len(list(ds.iter_temp_files())), 1)
@@ -0,0 +1,240 @@
+# Copyright 2015-2018 Chicharreros (https://launchpad.net/~chicharreros)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# For further info, check  http://launchpad.net/magicicada-server
+
+"""Test the logs of the generations of the volumes."""
+
+import collections
+
+from twisted.internet import defer
+from twisted.trial.unittest import TestCase as TwistedTestCase
+
+from magicicada.server.generationlog import GenerationLog, GenerationLogs
+
+
+FakeNode = collections.namedtuple('FakeNode', 'id generation')
+
+
+class GenerationLogTestCase(TwistedTestCase):
+    """Test the GenerationLog."""
+
+    def test_delta(self):
+        log = GenerationLog(3)
+        nodes = [FakeNode(i, i + 3) for i in range(1, 6)]
+        log.add(nodes, 10, 123, 10)
+        self.assertEqual(log.generation, 10)
+        self.assertEqual(log.free_bytes, 123)
+        self.assertEqual(log.delta(3, None), nodes)
+        self.assertEqual(log.delta(5, None), nodes[2:])
+        self.assertEqual(log.delta(5, 2), nodes[2:4])
+        self.assertEqual(log.delta(10, None), [])
+
+    def test_changed_again(self):
+        log = GenerationLog(0)
+        log.add([FakeNode('a', 1), FakeNode('b', 2)], 2, 123, 10)
+        log.add([FakeNode('a', 3)], 3, 12, 10)
+        self.assertEqual(log.delta(0, None),
+                         [FakeNode('b', 2), FakeNode('a', 3)])
+        self.assertEqual(log.delta(2, None), [FakeNode('a', 3)])
+        self.assertEqual(log.free_bytes, 12)
+
+    def test_max_nodes(self):
+        log = GenerationLog(0)
+        log.add([FakeNode(i, i) for i in range(1, 6)], 5, 123, 3)
+        self.assertEqual(log.start, 2)
+        self.assertEqual(log.delta(2, None),
+                         [FakeNode(i, i) for i in range(3, 6)])
+
+
+class FakeDAL(object):
+    """A DAL with the changes of the volumes."""
+
+    def __init__(self):
+        self.nodes = {}
+        self.generations = {}
+        self.calls = []
+        self.waiting = None
+
+    def call(self, name, user_id, volume_id, from_generation, limit):
+        assert name == 'get_delta_nodes'
+        self.calls.append((volume_id, from_generation, limit))
+        nodes = [node for node in self.nodes.get(volume_id, [])
+                 if node.generation > from_generation]
+        result = dict(nodes=nodes[:limit], free_bytes=123,
+                      vol_generation=self.generations.get(volume_id, 0))
+        if self.waiting is not None:
+            d = self.waiting = defer.Deferred()
+            return d.addCallback(lambda _: result)
+        return defer.succeed(result)
+
+    def change(self, volume_id, node_id):
+        """Change the node in the volume."""
+        generation = self.generations.get(volume_id, 0) + 1
+        self.generations[volume_id] = generation
+        nodes = [node for node in self.nodes.get(volume_id, [])
+                 if node.id != node_id]
+        self.nodes[volume_id] = nodes + [FakeNode(node_id, generation)]
+
+
+class FakeUser(object):
+    """A user with its DAL."""
+
+    def __init__(self, user_id=42):
+        self.id = user_id
+        self.rpc_dal = FakeDAL()
+
+
+class GenerationLogsTestCase(TwistedTestCase):
+    """Test the GenerationLogs."""
+
+    def setUp(self):
+        super(GenerationLogsTestCase, self).setUp()
+        self.logs = GenerationLogs(max_volumes=2, max_nodes=5, max_age=60)
+        self.user = FakeUser()
+        self.dal = self.user.rpc_dal
+        for i in range(10):
+            self.dal.change(None, i)
+
+    def get_delta(self, from_generation, limit=10, volume_id=None,
+                  user=None):
+        """Return the generations of the delta, and the volume's one."""
+        d = self.logs.get_delta(user or self.user, volume_id,
+                                from_generation, limit)
+        d.addCallback(lambda r: ([n.generation for n in r['nodes']],
+                                 r['vol_generation'], r['free_bytes']))
+        return d
+
+    @defer.inlineCallbacks
+    def test_hit(self):
+        delta = yield self.get_delta(7)
+        self.assertEqual(delta, ([8, 9, 10], 10, 123))
+        delta = yield self.get_delta(8)
+        self.assertEqual(delta, ([9, 10], 10, 123))
+        delta = yield self.get_delta(10)
+        self.assertEqual(delta, ([], 10, 123))
+        self.assertEqual(self.dal.calls, [(None, 7, 10)])
+        self.assertEqual(self.logs.nodes, 3)
+
+    @defer.inlineCallbacks
+    def test_not_covered(self):
+        yield self.get_delta(7)
+        delta = yield self.get_delta(6)
+        self.assertEqual(delta, ([7, 8, 9, 10], 10, 123))
+        self.assertEqual(self.dal.calls, [(None, 7, 10), (None, 6, 10)])
+        # the new one covers more
+        yield self.get_delta(6)
+        self.assertEqual(len(self.dal.calls), 2)
+
+    @defer.inlineCallbacks
+    def test_incomplete(self):
+        yield self.get_delta(7, limit=2)
+        yield self.get_delta(7, limit=2)
+        self.assertEqual(self.dal.calls, [(None, 7, 2), (None, 7, 2)])
+        # too many to keep
+        yield self.get_delta(0)
+        yield self.get_delta(0)
+        self.assertEqual(len(self.dal.calls), 4)
+
+    @defer.inlineCallbacks
+    def test_notified(self):
+        yield self.get_delta(7)
+        self.dal.change(None, 8)
+        self.dal.change(None, 'new')
+        self.logs.notify(42)
+        delta = yield self.get_delta(7)
+        self.assertEqual(delta, ([8, 10, 11, 12], 12, 123))
+        self.assertEqual(self.dal.calls, [(None, 7, 10), (None, 10, 6)])
+        delta = yield self.get_delta(11)
+        self.assertEqual(delta, ([12], 12, 123))
+        self.assertEqual(len(self.dal.calls), 2)
+
+    @defer.inlineCallbacks
+    def test_notified_other_user(self):
+        yield self.get_delta(7)
+        self.logs.notify(43)
+        yield self.get_delta(7)
+        self.assertEqual(len(self.dal.calls), 1)
+
+    @defer.inlineCallbacks
+    def test_notified_while_fetching(self):
+        self.dal.waiting = True
+        d = self.get_delta(7)
+        self.logs.notify(42)
+        self.dal.waiting.callback(None)
+        yield d
+        self.dal.waiting = None
+        yield self.get_delta(7)
+        self.assertEqual(self.dal.calls, [(None, 7, 10), (None, 10, 6)])
+
+    @defer.inlineCallbacks
+    def test_refresh_shared(self):
+        yield self.get_delta(7)
+        self.dal.change(None, 'new')
+        self.logs.notify(42)
+        self.dal.waiting = True
+        d1 = self.get_delta(7)
+        d2 = self.get_delta(9)
+        self.dal.waiting.callback(None)
+        results = yield defer.gatherResults([d1, d2])
+        self.assertEqual(results, [([8, 9, 10, 11], 11, 123),
+                                   ([10, 11], 11, 123)])
+        self.assertEqual(self.dal.calls, [(None, 7, 10), (None, 10, 6)])
+
+    @defer.inlineCallbacks
+    def test_refresh_too_many(self):
+        yield self.get_delta(7)
+        for i in range(6):
+            self.dal.change(None, 'new%d' % i)
+        self.logs.notify(42)
+        delta = yield self.get_delta(15)
+        self.assertEqual(delta, ([16], 16, 123))
+        self.assertEqual(self.dal.calls,
+                         [(None, 7, 10), (None, 10, 6), (None, 15, 10)])
+
+    @defer.inlineCallbacks
+    def test_refresh_failure(self):
+        yield self.get_delta(7)
+        self.logs.notify(42)
+        self.patch(self.dal, 'call', lambda *a, **k: defer.fail(ValueError()))
+        yield self.assertFailure(self.get_delta(7), ValueError)
+        self.assertTrue(self.logs._logs[(42, None)].stale)
+
+    @defer.inlineCallbacks
+    def test_max_age(self):
+        yield self.get_delta(7)
+        self.logs._logs[(42, None)].updated -= 60
+        yield self.get_delta(7)
+        self.assertEqual(self.dal.calls, [(None, 7, 10), (None, 10, 6)])
+
+    @defer.inlineCallbacks
+    def test_client_ahead(self):
+        yield self.get_delta(7)
+        self.dal.change(None, 'new')
+        delta = yield self.get_delta(11)
+        self.assertEqual(delta, ([], 11, 123))
+        self.assertEqual(self.dal.calls, [(None, 7, 10), (None, 10, 6)])
+
+    @defer.inlineCallbacks
+    def test_max_volumes(self):
+        yield self.get_delta(7)
+        yield self.get_delta(0, volume_id='udf')
+        yield self.get_delta(7)
+        other = FakeUser(43)
+        yield self.get_delta(0, user=other)
+        self.assertEqual(list(self.logs._logs), [(42, None), (43, None)])
+        self.assertEqual(dict(self.logs._user_logs),
+                         {42: {(42, None)}, 43: {(43, None)}})
+        self.assertEqual(self.logs.nodes, 3)
@@ -0,0 +1,291 @@
+# Copyright 2015-2018 Chicharreros (https://launchpad.net/~chicharreros)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# For further info, check  http://launchpad.net/magicicada-server
+
+"""Test the manifests of the volumes."""
+
+import os
+import uuid
+
+from twisted.internet import defer
+from twisted.trial.unittest import TestCase as TwistedTestCase
+
+from magicicada.filesync.services import DeltaNode
+from magicicada.server.content import NodeStream
+from magicicada.server.manifests import (
+    Manifest,
+    ManifestWriter,
+    MemoryManifest,
+    VolumeManifests,
+    decode_node,
+    encode_node,
+)
+
+
+def make_node(name, parent_id=None, is_file=True, generation=1, **kwargs):
+    """Return a live DeltaNode."""
+    values = dict(
+        id=uuid.uuid4(), parent_id=parent_id, path=u'/', name=name,
+        is_file=is_file, is_live=True, generation=generation,
+        is_public=False, content_hash=None, crc32=0, size=0,
+        last_modified=1500000000)
+    values.update(kwargs)
+    return DeltaNode(**values)
+
+
+class EncodingTestCase(TwistedTestCase):
+    """Test the records of the manifests."""
+
+    def test_round_trip(self):
+        root = make_node(u'', is_file=False)
+        nodes = [
+            root,
+            make_node(u'\xf1and\xfa.txt', parent_id=root.id, generation=7,
+                      is_public=True, content_hash=b'sha1:1234',
+                      crc32=-12, size=2 ** 40, path=u'/d\xedr'),
+        ]
+        data = b''.join(encode_node(node) for node in nodes)
+        decoded = []
+        offset = 0
+        while offset < len(data):
+            node, offset = decode_node(data, offset)
+            decoded.append(node)
+        self.assertEqual(decoded, nodes)
+
+
+class ManifestTestCase(TwistedTestCase):
+    """Test the Manifest and ManifestWriter."""
+
+    def setUp(self):
+        super(ManifestTestCase, self).setUp()
+        self.tmpdir = self.mktemp()
+
+    def test_commit(self):
+        nodes = [make_node(u'name%d' % i) for i in range(10)]
+        path = os.path.join(self.tmpdir, 'a.manifest')
+        writer = ManifestWriter(path)
+        writer.write(nodes[:3])
+        writer.write(nodes[3:])
+        self.assertFalse(os.path.exists(path))
+        manifest = writer.commit(42)
+        self.assertEqual(os.listdir(self.tmpdir), ['a.manifest'])
+        self.assertEqual(manifest.generation, 42)
+        self.assertEqual(manifest.count, 10)
+        self.assertEqual(manifest.size, os.path.getsize(path))
+        self.assertEqual(list(manifest), nodes)
+        # it can be read again
+        self.assertEqual(list(Manifest(path)), nodes)
+
+    def test_abort(self):
+        writer = ManifestWriter(os.path.join(self.tmpdir, 'a.manifest'))
+        writer.write([make_node(u'name')])
+        writer.abort()
+        self.assertEqual(os.listdir(self.tmpdir), [])
+
+    def test_not_a_manifest(self):
+        os.makedirs(self.tmpdir)
+        path = os.path.join(self.tmpdir, 'a.manifest')
+        with open(path, 'wb') as fh:
+            fh.write(b'x' * 100)
+        self.assertRaises(ValueError, Manifest, path)
+
+
+class FakeDAL(object):
+    """A DAL with the delta of a volume."""
+
+    def __init__(self, user):
+        self.user = user
+
+    def call(self, name, user_id, volume_id, from_generation, limit):
+        assert name == 'get_delta_nodes'
+        nodes = [n for n in self.user.delta if n.generation > from_generation]
+        return defer.succeed(dict(nodes=nodes[:limit],
+                                  vol_generation=self.user.generation,
+                                  free_bytes=123))
+
+
+class FakeUser(object):
+    """A user with the nodes of a volume."""
+
+    id = 42
+
+    def __init__(self, nodes, generation):
+        self.nodes = nodes
+        self.generation = generation
+        self.delta = []
+        self.rpc_dal = FakeDAL(self)
+        self.rescans = 0
+        self.failure = None
+
+    def stream_from_scratch(self, volume_id):
+        self.rescans += 1
+
+        def fetch(last, limit):
+            if self.failure is not None:
+                return defer.fail(self.failure)
+            start = 0 if last is None else self.nodes.index(last) + 1
+            return defer.succeed((self.nodes[start:start + limit],
+                                  self.generation, 123))
+
+        stream = NodeStream(fetch, 3)
+        stream.start()
+        return stream
+
+
+class VolumeManifestsTestCase(TwistedTestCase):
+    """Test the VolumeManifests."""
+
+    def setUp(self):
+        super(VolumeManifestsTestCase, self).setUp()
+        self.tmpdir = self.mktemp()
+        self.manifests = VolumeManifests(
+            self.tmpdir, max_age=60, max_size=2 ** 20, min_nodes=5,
+            max_delta=3)
+        self.nodes = [make_node(u'name%d' % i) for i in range(10)]
+        self.user = FakeUser(self.nodes, 10)
+
+    @defer.inlineCallbacks
+    def get_nodes(self, user=None, volume_id=None):
+        """Return the nodes and generation of the user's volume."""
+        nodes, generation, free_bytes = yield self.manifests.get_nodes(
+            user or self.user, volume_id)
+        self.assertEqual(free_bytes, 123)
+        defer.returnValue((list(nodes), generation))
+
+    @defer.inlineCallbacks
+    def test_build(self):
+        nodes, generation = yield self.get_nodes()
+        self.assertEqual(nodes, self.nodes)
+        self.assertEqual(generation, 10)
+        self.assertEqual(os.listdir(self.tmpdir), ['42-root-10.manifest'])
+        manifest = self.manifests._manifests[(42, None)]
+        self.assertEqual(self.manifests.size, manifest.size)
+
+    @defer.inlineCallbacks
+    def test_small_volume(self):
+        user = FakeUser(self.nodes[:4], 10)
+        nodes, generation = yield self.get_nodes(user)
+        self.assertEqual(nodes, self.nodes[:4])
+        self.assertFalse(os.path.exists(self.tmpdir))
+        self.assertEqual(self.manifests._manifests, {})
+        # it's not kept
+        yield self.get_nodes(user)
+        self.assertEqual(user.rescans, 2)
+
+    @defer.inlineCallbacks
+    def test_shared(self):
+        d1 = self.get_nodes()
+        d2 = self.get_nodes()
+        results = yield defer.gatherResults([d1, d2])
+        self.assertEqual(results, [(self.nodes, 10)] * 2)
+        yield self.get_nodes()
+        self.assertEqual(self.user.rescans, 1)
+        self.assertEqual(len(os.listdir(self.tmpdir)), 1)
+
+    @defer.inlineCallbacks
+    def test_by_volume(self):
+        yield self.get_nodes()
+        other = FakeUser(self.nodes[1:], 10)
+        other.id = 43
+        nodes, _ = yield self.get_nodes(other, 'vol')
+        self.assertEqual(nodes, self.nodes[1:])
+        self.assertEqual(sorted(os.listdir(self.tmpdir)),
+                         ['42-root-10.manifest', '43-vol-10.manifest'])
+
+    @defer.inlineCallbacks
+    def test_delta(self):
+        yield self.get_nodes()
+        changed = self.nodes[2]._replace(name=u'other', generation=11)
+        deleted = self.nodes[5]._replace(is_live=False, generation=12)
+        created = make_node(u'new', generation=13)
+        self.user.delta = [changed, deleted, created]
+        self.user.generation = 13
+        nodes, generation = yield self.get_nodes()
+        should = self.nodes[:2] + self.nodes[3:5] + self.nodes[6:]
+        self.assertEqual(nodes, should + [changed, created])
+        self.assertEqual(generation, 13)
+        self.assertEqual(self.user.rescans, 1)
+
+    @defer.inlineCallbacks
+    def test_outdated(self):
+        yield self.get_nodes()
+        self.user.delta = [make_node(u'new%d' % i, generation=11 + i)
+                           for i in range(4)]
+        result = yield self.manifests.get_nodes(self.user, None)
+        self.assertIsNone(result)
+        self.assertEqual(os.listdir(self.tmpdir), [])
+        self.assertEqual(self.manifests.size, 0)
+        # and it's built again
+        self.user.nodes = self.nodes + self.user.delta
+        self.user.generation = 14
+        nodes, _ = yield self.get_nodes()
+        self.assertEqual(nodes, self.user.nodes)
+        self.assertEqual(self.user.rescans, 2)
+
+    @defer.inlineCallbacks
+    def test_max_age(self):
+        yield self.get_nodes()
+        self.manifests._manifests[(42, None)].created -= 60
+        self.user.nodes = self.nodes[1:]
+        self.user.generation = 11
+        nodes, _ = yield self.get_nodes()
+        self.assertEqual(nodes, self.nodes[1:])
+        self.assertEqual(os.listdir(self.tmpdir), ['42-root-11.manifest'])
+        self.assertEqual(self.user.rescans, 2)
+
+    @defer.inlineCallbacks
+    def test_max_size(self):
+        yield self.get_nodes()
+        self.manifests.max_size = self.manifests.size + 1
+        other = FakeUser(self.nodes, 10)
+        other.id = 43
+        yield self.get_nodes(other)
+        self.assertEqual(os.listdir(self.tmpdir), ['43-root-10.manifest'])
+        self.assertEqual(list(self.manifests._manifests), [(43, None)])
+
+    @defer.inlineCallbacks
+    def test_failure(self):
+        self.user.failure = ValueError('broken')
+        d1 = self.manifests.get_nodes(self.user, None)
+        d2 = self.manifests.get_nodes(self.user, None)
+        yield self.assertFailure(d1, ValueError)
+        yield self.assertFailure(d2, ValueError)
+        self.assertEqual(self.manifests._manifests, {})
+        self.assertEqual(self.manifests._building, {})
+
+    @defer.inlineCallbacks
+    def test_failure_while_writing(self):
+        self.patch(ManifestWriter, 'write', lambda *a: 1 / 0)
+        yield self.assertFailure(
+            self.manifests.get_nodes(self.user, None), ZeroDivisionError)
+        self.assertEqual(os.listdir(self.tmpdir), [])
+        self.assertEqual(self.manifests._manifests, {})
+
+    @defer.inlineCallbacks
+    def test_clean(self):
+        yield self.get_nodes()
+        other = os.path.join(self.tmpdir, 'other')
+        open(other, 'w').close()
+        self.manifests.clean()
+        self.assertEqual(os.listdir(self.tmpdir), ['other'])
+
+    def test_clean_no_dir(self):
+        self.manifests.clean()
+
+    def test_memory_manifest(self):
+        manifest = MemoryManifest(3, self.nodes)
+        self.assertEqual(manifest.count, 10)
+        self.assertEqual(list(manifest), self.nodes)
@@ -91,6 +91,9 @@ class TestDelivery(TwistedTestCase):
     @inlineCallbacks
     def test_new_volume_generation_ok(self):
         """Test new volume generation delivery ok."""
+        generation_logs = self.mocker.mock()
+        expect(self.content.generation_logs).count(2).result(generation_logs)
+        generation_logs.notify('user_id')
         user = self.mocker.mock()
         expect(self.content.get_user_by_id('user_id')
                ).count(1).result(succeed(user))
@@ -104,6 +107,7 @@ class TestDelivery(TwistedTestCase):
     @inlineCallbacks
     def test_new_volume_generation_not_connected(self):
         """Test new volume generation delivery for a not connected user."""
+        expect(self.content.generation_logs).result(None)
         expect(self.content.get_user_by_id('user_id')
                ).count(1).result(succeed(None))
 
@@ -141,6 +145,7 @@ class TestDelivery(TwistedTestCase):
 
             deferred.callback(None)
 
+        expect(self.content.generation_logs).result(None)
         user = self.mocker.mock()
         expect(self.content.get_user_by_id('user_id')
                ).count(1).result(succeed(user))
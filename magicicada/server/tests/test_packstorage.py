@@ -0,0 +1,504 @@
+# Copyright 2015-2018 Chicharreros (https://launchpad.net/~chicharreros)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# For further info, check  http://launchpad.net/magicicada-server
+
+"""Test the pack storage of small nodes."""
+
+import hashlib
+import logging
+import logging.handlers
+import os
+import shutil
+import StringIO
+
+from twisted.internet import defer
+from twisted.trial.unittest import TestCase as TwistedTestCase
+
+from magicicada import settings
+from magicicada.server import errors
+from magicicada.server.diskstorage import DiskStorage
+from magicicada.server.packstorage import (
+    ENTRY,
+    HEADER,
+    PackStorage,
+    PackWriterConsumer,
+)
+
+
+class PackStorageTestCase(TwistedTestCase):
+    """Test the pack storage."""
+
+    @defer.inlineCallbacks
+    def setUp(self):
+        yield super(PackStorageTestCase, self).setUp()
+        self.tmpdir = os.getcwd() + "/tmp/packstorage_tests"
+        os.makedirs(self.tmpdir)
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.logger = logging.getLogger('test_packstorage')
+
+    def make_packs(self, segment_size=1000, acquire=True):
+        """Return a pack storage, the writer if `acquire`."""
+        packs = PackStorage(self.tmpdir, segment_size=segment_size)
+        self.addCleanup(packs.close)
+        if acquire:
+            self.assertTrue(packs.acquire())
+        return packs
+
+    def list_files(self, suffix):
+        """Return the files with the suffix in the pack dir."""
+        return sorted(name for name in os.listdir(self.tmpdir)
+                      if name.endswith(suffix))
+
+    def test_append_and_read(self):
+        packs = self.make_packs()
+        packs.append('node-1', 'content 1')
+        packs.append('node-2', 'content 2')
+        self.assertEqual(packs.read('node-1'), 'content 1')
+        self.assertEqual(packs.read('node-2'), 'content 2')
+        self.assertEqual(packs.read('node-3'), None)
+
+    def test_open_content(self):
+        packs = self.make_packs()
+        packs.append('node-1', 'content 1')
+        packs.append('node-2', 'content 2')
+        fh, size = packs.open_content('node-2')
+        with fh:
+            self.assertEqual(fh.read(size), 'content 2')
+        self.assertEqual(packs.open_content('node-3'), None)
+
+    def test_lookup(self):
+        packs = self.make_packs()
+        packs.append('node-1', 'content')
+        location = packs.lookup('node-1')
+        self.assertEqual(location.segment, 0)
+        self.assertEqual(location.offset, HEADER.size)
+        self.assertEqual(location.size, len('content'))
+        with open(packs.get_path(location.segment), 'rb') as fh:
+            header = HEADER.pack(hashlib.md5('node-1').digest(), 7)
+            self.assertEqual(fh.read(), header + 'content')
+
+    def test_append_not_writer(self):
+        packs = self.make_packs(acquire=False)
+        self.assertFalse(packs.writable)
+        self.assertRaises(RuntimeError, packs.append, 'node-1', 'content')
+
+    def test_only_one_writer(self):
+        packs = self.make_packs()
+        other = self.make_packs(acquire=False)
+        self.assertFalse(other.acquire())
+        packs.close()
+        self.assertTrue(other.acquire())
+
+    def test_seal(self):
+        packs = self.make_packs(segment_size=100)
+        packs.append('node-1', 'x' * 60)
+        self.assertEqual(self.list_files('.journal'), ['00000000.journal'])
+        packs.append('node-2', 'y' * 60)
+        self.assertEqual(self.list_files('.idx'), ['run-00000000.idx'])
+        self.assertEqual(self.list_files('.journal'), ['00000001.journal'])
+        self.assertEqual(packs.lookup('node-2').segment, 0)
+        packs.append('node-3', 'z' * 10)
+        self.assertEqual(packs.lookup('node-3').segment, 1)
+        self.assertEqual(packs.read('node-1'), 'x' * 60)
+        self.assertEqual(packs.read('node-2'), 'y' * 60)
+        self.assertEqual(packs.read('node-3'), 'z' * 10)
+
+    def test_runs_are_merged(self):
+        packs = self.make_packs(segment_size=10)
+        for i in range(50):
+            packs.append('node-%d' % i, 'content %d' % i)
+        # each run is at least twice as big as the next one
+        counts = [run.count for run in packs._runs]
+        self.assertEqual(sum(counts), 50)
+        for newer, older in zip(counts, counts[1:]):
+            self.assertTrue(newer * 2 <= older, counts)
+        self.assertEqual(len(self.list_files('.idx')), len(counts))
+        for i in range(50):
+            self.assertEqual(packs.read('node-%d' % i), 'content %d' % i)
+
+    def test_reload(self):
+        packs = self.make_packs(segment_size=100)
+        for i in range(20):
+            packs.append('node-%d' % i, 'content %d' % i)
+        packs.close()
+
+        for acquire in (False, True):
+            other = self.make_packs(segment_size=100, acquire=acquire)
+            for i in range(20):
+                self.assertEqual(other.read('node-%d' % i), 'content %d' % i)
+            other.close()
+
+    def test_recover_incomplete_append(self):
+        packs = self.make_packs()
+        packs.append('node-1', 'content 1')
+        packs.append('node-2', 'content 2')
+        packs.close()
+        # the content of the last one didn't get to disk
+        path = packs.get_path(0)
+        with open(path, 'r+b') as fh:
+            fh.truncate(os.path.getsize(path) - 1)
+
+        packs = self.make_packs()
+        self.assertEqual(packs.read('node-1'), 'content 1')
+        self.assertEqual(packs.read('node-2'), None)
+        packs.append('node-3', 'content 3')
+        self.assertEqual(packs.read('node-3'), 'content 3')
+        self.assertEqual(
+            os.path.getsize(packs._get_journal_path(0)), ENTRY.size * 2)
+
+    def test_recover_incomplete_journal_entry(self):
+        packs = self.make_packs()
+        packs.append('node-1', 'content 1')
+        packs.close()
+        with open(packs._get_journal_path(0), 'ab') as fh:
+            fh.write('garbage')
+
+        packs = self.make_packs()
+        packs.append('node-2', 'content 2')
+        packs.close()
+        packs = self.make_packs(acquire=False)
+        self.assertEqual(packs.read('node-1'), 'content 1')
+        self.assertEqual(packs.read('node-2'), 'content 2')
+
+    def test_recover_interrupted_seal(self):
+        packs = self.make_packs(segment_size=10)
+        packs.append('node-1', 'content 1')
+        packs.close()
+        # the journal was not removed after writing the run
+        with open(packs._get_journal_path(0), 'wb') as fh:
+            fh.write('')
+
+        packs = self.make_packs(segment_size=10)
+        self.assertEqual(self.list_files('.journal'), ['00000001.journal'])
+        self.assertEqual(packs.read('node-1'), 'content 1')
+
+    def test_delete(self):
+        packs = self.make_packs()
+        packs.append('node-1', 'content 1')
+        self.assertEqual(packs.delete('node-1'), len('content 1'))
+        self.assertEqual(packs.read('node-1'), None)
+        self.assertEqual(packs.delete('node-1'), 0)
+        packs.close()
+
+        packs = self.make_packs(acquire=False)
+        self.assertEqual(packs.read('node-1'), None)
+
+    def test_delete_by_other_process(self):
+        packs = self.make_packs(segment_size=10)
+        packs.append('node-1', 'content 1')
+        other = self.make_packs(segment_size=10, acquire=False)
+        self.assertEqual(other.delete('node-1'), len('content 1'))
+
+        # the writer knows it once it loads the dead journal to compact
+        self.assertEqual(packs.get_garbage_ratios(), {0: 0})
+        self.assertEqual(packs.compact(self.logger, garbage_ratio=0.3),
+                         HEADER.size + len('content 1'))
+        self.assertEqual(packs.read('node-1'), None)
+
+    def test_compact(self):
+        packs = self.make_packs(segment_size=100)
+        packs.append('node-1', 'a' * 40)
+        packs.append('node-2', 'b' * 40)
+        packs.append('node-3', 'c' * 40)
+        packs.delete('node-1')
+        size = os.path.getsize(packs.get_path(0))
+        self.assertEqual(packs.get_garbage_ratios(), {0: 40.0 / size})
+
+        handler = logging.handlers.MemoryHandler(100)
+        self.logger.addHandler(handler)
+        self.addCleanup(self.logger.removeHandler, handler)
+        self.patch(self.logger, 'level', logging.INFO)
+        freed = packs.compact(self.logger, garbage_ratio=0.3)
+
+        self.assertEqual(freed, size - 40)
+        self.assertFalse(os.path.exists(packs.get_path(0)))
+        self.assertEqual(packs.lookup('node-2').segment, 1)
+        self.assertEqual(packs.read('node-2'), 'b' * 40)
+        self.assertEqual(packs.read('node-3'), 'c' * 40)
+        self.assertEqual(packs.read('node-1'), None)
+        self.assertEqual(packs.get_garbage_ratios(), {1: 0})
+        self.assertIn("Compacted segment 0", handler.buffer[0].getMessage())
+        packs.close()
+
+        # the dead journal forgot the removed segment
+        packs = self.make_packs(segment_size=100)
+        self.assertEqual(packs._dead, {})
+        self.assertEqual(packs.read('node-2'), 'b' * 40)
+
+    def test_compact_below_ratio(self):
+        packs = self.make_packs(segment_size=100)
+        packs.append('node-1', 'a' * 40)
+        packs.append('node-2', 'b' * 80)
+        packs.delete('node-1')
+        self.assertEqual(packs.compact(self.logger, garbage_ratio=0.5), 0)
+        self.assertTrue(os.path.exists(packs.get_path(0)))
+        self.assertEqual(packs.read('node-2'), 'b' * 80)
+
+    def test_compact_not_writer(self):
+        packs = self.make_packs(segment_size=10)
+        packs.append('node-1', 'content 1')
+        packs.delete('node-1')
+        other = self.make_packs(acquire=False)
+        self.assertEqual(other.compact(self.logger, garbage_ratio=0), 0)
+        self.assertTrue(os.path.exists(packs.get_path(0)))
+
+    def test_compact_interrupted(self):
+        packs = self.make_packs(segment_size=100)
+        packs.append('node-1', 'a' * 40)
+        packs.append('node-2', 'b' * 80)
+        packs.delete('node-1')
+        # the live node was already moved, but the segment is still there
+        packs.append('node-2', 'b' * 80)
+        size = os.path.getsize(packs.get_path(0))
+        self.assertEqual(packs.compact(self.logger, garbage_ratio=0.2), size)
+        self.assertEqual(packs.lookup('node-2').segment, 1)
+        self.assertEqual(packs.read('node-2'), 'b' * 80)
+
+    def test_reader_reloads_compacted(self):
+        packs = self.make_packs(segment_size=100)
+        packs.append('node-1', 'a' * 40)
+        packs.append('node-2', 'b' * 80)
+        reader = self.make_packs(segment_size=100, acquire=False)
+        packs.delete('node-1')
+        packs.compact(self.logger, garbage_ratio=0.2)
+        self.assertEqual(reader.read('node-2'), 'b' * 80)
+        self.assertEqual(reader.lookup('node-2').segment, 1)
+
+    def test_reader_finds_appended_since(self):
+        packs = self.make_packs()
+        packs.append('node-1', 'content 1')
+        reader = self.make_packs(acquire=False)
+        packs.append('node-2', 'content 2')
+        self.assertEqual(reader.read('node-2'), 'content 2')
+        self.assertEqual(reader.read('node-3'), None)
+        self.assertEqual(reader.delete('node-2'), len('content 2'))
+
+    def test_reader_finds_appended_after_seal(self):
+        packs = self.make_packs(segment_size=100)
+        packs.append('node-1', 'a' * 40)
+        reader = self.make_packs(segment_size=100, acquire=False)
+        packs.append('node-2', 'b' * 80)
+        packs.append('node-3', 'c' * 10)
+        self.assertEqual(reader.read('node-2'), 'b' * 80)
+        self.assertEqual(reader.read('node-3'), 'c' * 10)
+        self.assertEqual(reader.lookup('node-3').segment, 1)
+
+    def test_reader_finds_appended_by_new_writer(self):
+        packs = self.make_packs()
+        packs.append('node-1', 'content 1')
+        reader = self.make_packs(acquire=False)
+        packs.close()
+        # the new writer rewrites the journal
+        packs = self.make_packs()
+        packs.append('node-2', 'content 2')
+        self.assertEqual(reader.read('node-2'), 'content 2')
+        self.assertEqual(reader.read('node-1'), 'content 1')
+
+    @defer.inlineCallbacks
+    def test_writer_consumer(self):
+        packs = self.make_packs()
+        consumer = PackWriterConsumer(packs, 'node-1')
+        consumer.registerProducer(None, True)
+        consumer.write('foo')
+        consumer.write('bar')
+        consumer.unregisterProducer()
+        self.assertEqual(packs.read('node-1'), None)
+        yield consumer.commit()
+        self.assertEqual(packs.read('node-1'), 'foobar')
+
+    @defer.inlineCallbacks
+    def test_writer_consumer_size_exceeded(self):
+        packs = self.make_packs()
+        consumer = PackWriterConsumer(packs, 'node-1', size=6)
+        consumer.registerProducer(None, True)
+        consumer.write('foo')
+        consumer.write('bar')
+        self.assertRaises(errors.UploadCorrupt, consumer.write, 'x')
+        self.assertEqual(consumer._data, [])
+        consumer.unregisterProducer()
+        yield self.assertFailure(consumer.commit(), errors.UploadCorrupt)
+        self.assertEqual(packs.read('node-1'), None)
+
+
+class DiskStoragePacksTestCase(TwistedTestCase):
+    """Test the disk storage packing the small nodes."""
+
+    @defer.inlineCallbacks
+    def setUp(self):
+        yield super(DiskStoragePacksTestCase, self).setUp()
+        self.tmpdir = os.getcwd() + "/tmp/packstorage_tests"
+        os.makedirs(self.tmpdir)
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.patch(settings, 'STORAGE_IO_THREADS', 0)
+        self.patch(settings, 'STORAGE_DURABILITY', 'none')
+
+    def make_storage(self, pack_max_size=10):
+        """Return a disk storage packing the nodes up to the size."""
+        storage = DiskStorage(self.tmpdir, pack_max_size=pack_max_size)
+        self.addCleanup(lambda: storage.packs and storage.packs.close())
+        return storage
+
+    @defer.inlineCallbacks
+    def put(self, storage, node_id, data):
+        """Store the node."""
+        consumer = storage.put(node_id, size_hint=len(data))
+        consumer.write(data)
+        yield consumer.commit()
+
+    @defer.inlineCallbacks
+    def get(self, storage, node_id, offset=0):
+        """Return the content of the node."""
+        consumer = StringIO.StringIO()
+        producer = storage.get(node_id, offset)
+        producer.startProducing(consumer)
+        yield producer.deferred
+        defer.returnValue(consumer.getvalue())
+
+    @defer.inlineCallbacks
+    def test_small_nodes_are_packed(self):
+        storage = self.make_storage()
+        yield self.put(storage, 'small-node', '12345')
+        yield self.put(storage, 'other-node', '67890')
+        self.assertFalse(os.path.exists(storage._find('small-node')))
+        self.assertEqual(storage.packs.lookup('small-node').size, 5)
+
+        content = yield self.get(storage, 'small-node')
+        self.assertEqual(content, '12345')
+        content = yield self.get(storage, 'small-node', 2)
+        self.assertEqual(content, '345')
+        self.assertEqual(storage.read('other-node'), '67890')
+
+    def test_packed_bounded_by_size_hint(self):
+        storage = self.make_storage()
+        consumer = storage.put('small-node', size_hint=5)
+        self.assertIsInstance(consumer, PackWriterConsumer)
+        self.assertRaises(errors.UploadCorrupt, consumer.write, '123456')
+
+    @defer.inlineCallbacks
+    def test_get_packed_past_the_end(self):
+        storage = self.make_storage()
+        yield self.put(storage, 'small-node', '12345')
+        yield self.put(storage, 'other-node', '67890')
+
+        # nothing after its own content is produced, in threads or not
+        for threads in (0, 2):
+            self.patch(settings, 'STORAGE_IO_THREADS', threads)
+            storage = self.make_storage()
+            if storage.threadpool is not None:
+                self.addCleanup(storage.threadpool.stop)
+            for offset in (5, 6, 15):
+                content = yield self.get(storage, 'small-node', offset)
+                self.assertEqual(content, '')
+
+    @defer.inlineCallbacks
+    def test_big_nodes_are_not_packed(self):
+        storage = self.make_storage()
+        yield self.put(storage, 'big-node', '1234567890a')
+        self.assertTrue(os.path.exists(storage._find('big-node')))
+        self.assertEqual(storage.packs.lookup('big-node'), None)
+        content = yield self.get(storage, 'big-node')
+        self.assertEqual(content, '1234567890a')
+
+    @defer.inlineCallbacks
+    def test_not_packed_if_other_writer(self):
+        other = PackStorage(os.path.join(self.tmpdir, 'packs'))
+        self.addCleanup(other.close)
+        self.assertTrue(other.acquire())
+        storage = self.make_storage()
+        yield self.put(storage, 'small-node', '12345')
+        self.assertTrue(os.path.exists(storage._find('small-node')))
+
+    @defer.inlineCallbacks
+    def test_packing_disabled(self):
+        storage = self.make_storage()
+        yield self.put(storage, 'small-node', '12345')
+        storage.packs.close()
+
+        storage = self.make_storage(pack_max_size=0)
+        yield self.put(storage, 'other-node', '67890')
+        self.assertTrue(os.path.exists(storage._find('other-node')))
+        # the ones already packed are still there
+        content = yield self.get(storage, 'small-node')
+        self.assertEqual(content, '12345')
+
+    @defer.inlineCallbacks
+    def test_get_packed_by_other_process(self):
+        writer = self.make_storage()
+        reader = self.make_storage()
+        self.assertFalse(reader.packs.writable)
+        yield self.put(writer, 'node-1', '12345')
+
+        # what was appended since is looked for in the producer, not before
+        refreshed = []
+        refresh = reader.packs._refresh
+        self.patch(reader.packs, '_refresh',
+                   lambda: refreshed.append(True) or refresh())
+        producer = reader.get('node-1', 1)
+        self.assertEqual(refreshed, [])
+        consumer = StringIO.StringIO()
+        producer.startProducing(consumer)
+        yield producer.deferred
+        self.assertEqual(consumer.getvalue(), '2345')
+        self.assertEqual(refreshed, [True])
+
+    @defer.inlineCallbacks
+    def test_get_compacted_by_other_process(self):
+        self.patch(settings, 'STORAGE_PACK_SEGMENT_SIZE', 50)
+        writer = self.make_storage()
+        yield self.put(writer, 'node-1', '12345')
+        yield self.put(writer, 'node-2', '67890')
+        storage = self.make_storage()
+        self.assertEqual(storage.packs.lookup('node-2').segment, 0)
+        writer.delete('node-1')
+        writer.packs.compact(logging.getLogger(), garbage_ratio=0.1)
+        self.assertFalse(os.path.exists(writer.packs.get_path(0)))
+        content = yield self.get(storage, 'node-2')
+        self.assertEqual(content, '67890')
+
+    def test_packing_disabled_no_packs(self):
+        storage = self.make_storage(pack_max_size=0)
+        self.assertEqual(storage.packs, None)
+        self.assertFalse(os.path.exists(storage.packdir))
+
+    @defer.inlineCallbacks
+    def test_delete(self):
+        storage = self.make_storage()
+        yield self.put(storage, 'small-node', '12345')
+        self.assertEqual(storage.delete('small-node'), 5)
+        self.assertEqual(storage.read('small-node'), None)
+
+    @defer.inlineCallbacks
+    def test_open_content(self):
+        storage = self.make_storage()
+        yield self.put(storage, 'small-node', '12345')
+        yield self.put(storage, 'big-node', '1234567890a')
+        for node_id, content in (('small-node', '12345'),
+                                 ('big-node', '1234567890a')):
+            fh, size = storage.open_content(node_id)
+            with fh:
+                self.assertEqual(fh.read(size), content)
+
+    @defer.inlineCallbacks
+    def test_compact_packs(self):
+        self.patch(settings, 'STORAGE_PACK_SEGMENT_SIZE', 30)
+        self.patch(settings, 'STORAGE_PACK_GARBAGE_RATIO', 0.1)
+        storage = self.make_storage()
+        yield self.put(storage, 'small-node', '12345')
+        yield self.put(storage, 'other-node', '67890')
+        storage.delete('small-node')
+        freed = yield storage.compact_packs(logging.getLogger('test'))
+        self.assertEqual(freed, HEADER.size * 2 + 5)
+        self.assertEqual(storage.read('other-node'), '67890')
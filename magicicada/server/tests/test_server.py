@@ -23,25 +23,27 @@
 import collections
 import logging
 import os
+import struct
 import types
 import time
 import uuid
 import weakref
 
-from django.utils.timezone import now
 from magicicadaprotocol import protocol_pb2, request
 from mocker import expect, Mocker, MockerTestCase, ARGS, KWARGS, ANY
 from twisted.python.failure import Failure
 from twisted.python import log
-from twisted.internet import defer, task, error as txerror
+from twisted.internet import defer, reactor, task, error as txerror
 from twisted.trial.unittest import TestCase as TwistedTestCase
 
 from magicicada import metrics, settings
 from magicicada.filesync import errors as dataerror
 from magicicada.filesync.models import Share
-from magicicada.server import errors
+from magicicada.rpcdb import inthread
+from magicicada.server import bandwidth, errors
+from magicicada.server.bandwidth import BandwidthLimits
+from magicicada.server.content import NodeStream, User
 from magicicada.server.server import (
-    PREFERRED_CAP,
     AccountResponse,
     Action,
     AuthenticateResponse,
@@ -51,6 +53,7 @@ from magicicada.server.server import (
     CreateUDF,
     DeleteShare,
     DeleteVolume,
+    DeltaInfoProducer,
     FreeSpaceResponse,
     GetContentResponse,
     GetDeltaResponse,
@@ -103,6 +106,32 @@ class FakeNode(object):
     public_url = 'public_url'
 
 
+def make_stream(pages, generation, free_bytes):
+    """Make a NodeStream of the pages, already fetched."""
+    pages = list(pages) + [[]]
+
+    def fetch(last, limit):
+        """Return the next page."""
+        return defer.succeed((pages.pop(0), generation, free_bytes))
+
+    stream = NodeStream(fetch, max(len(p) for p in pages), max_pages=100)
+    stream.start()
+    return stream
+
+
+class FakeStreamUser(object):
+    """A fake user, with the nodes of a delta or rescan."""
+
+    def __init__(self, stream):
+        self.stream = stream
+
+    def stream_delta(self, *args, **kwargs):
+        return self.stream
+
+    def get_rescan_stream(self, *args, **kwargs):
+        return defer.succeed(self.stream)
+
+
 class FakeUser(object):
     """A fake user."""
     id = 42
@@ -122,6 +151,14 @@ class FakeProducer(object):
     resumeProducing = stopProducing = pauseProducing = startProducing = dummy
 
 
+class FakeScheduledRequest(object):
+    """A request to schedule, read-only or not."""
+
+    def __init__(self, readonly):
+        self.readonly = readonly
+        self.deferred = defer.Deferred()
+
+
 class FakedStats(object):
     """A faked statsmeter"""
 
@@ -145,6 +182,7 @@ class FakedFactory(object):
         self.sli_metrics = metrics.get_meter('sli_metrics')
         self.servername = "fakeservername"
         self.trace_users = []
+        self.bandwidth = BandwidthLimits()
 
 
 class FakedPeer(object):
@@ -162,6 +200,7 @@ class FakedTransport(object):
         self.registerProducer = noop
         self.unregisterProducer = noop
         self.loseConnection = noop
+        self.writeSequence = noop
         self.getPeer = lambda *_: FakedPeer()
 
 
@@ -288,6 +327,66 @@ class StorageServerTestCase(BaseStorageServerTestCase):
         self.assertEqual(expected_deque, self.server.pending_requests)
         self.assertEqual(req2.id, self.server.pending_requests.popleft()[0].id)
 
+    def schedule(self, *readonly):
+        """Schedule requests, return them and the list of the started."""
+        started = []
+        requests = []
+        for is_readonly in readonly:
+            req = FakeScheduledRequest(is_readonly)
+            requests.append(req)
+            self.server.schedule_request(
+                req, lambda req=req: started.append(req))
+        return requests, started
+
+    def test_send_broadcast(self):
+        """The message is sent with a new id before its body."""
+        written = []
+        self.patch(self.server.transport, 'writeSequence', written.extend)
+        message = protocol_pb2.Message()
+        message.type = protocol_pb2.Message.VOLUME_NEW_GENERATION
+        message.volume_new_generation.volume = 'volume'
+        message.volume_new_generation.generation = 1234
+        body = message.SerializePartialToString()
+        self.server.request_counter = 301
+        self.server.send_broadcast(message, body)
+        self.assertIs(written[1], body)
+
+        data = ''.join(written)
+        size = struct.unpack(request.SIZE_FMT, data[:4])[0]
+        self.assertEqual(size, len(data) - 4)
+        sent = protocol_pb2.Message()
+        sent.ParseFromString(data[4:])
+        message.id = 301
+        self.assertEqual(sent, message)
+        self.assertEqual(self.server.request_counter, 303)
+
+    def test_readonly_requests_run_together(self):
+        """Read-only requests run at the same time, up to the limit."""
+        self.patch(settings, 'MAX_READONLY_REQUESTS', 2)
+        requests, started = self.schedule(True, True, True)
+        self.assertEqual(started, requests[:2])
+        self.server.release(requests[1])
+        self.assertEqual(started, requests)
+
+    def test_other_requests_run_alone(self):
+        """The other requests wait for the running, and the next wait."""
+        requests, started = self.schedule(True, False, True)
+        self.assertEqual(started, requests[:1])
+        self.server.release(requests[0])
+        self.assertEqual(started, requests[:2])
+        self.server.release(requests[1])
+        self.assertEqual(started, requests)
+
+    def test_queue_wait_metric(self):
+        """The time waited in the queue is informed."""
+        timings = []
+        self.patch(self.server.factory.metrics, 'timing',
+                   lambda name, value: timings.append(name))
+        requests, _ = self.schedule(False, False)
+        self.assertEqual(timings, ['request_queue_wait'])
+        self.server.release(requests[0])
+        self.assertEqual(timings, ['request_queue_wait'] * 2)
+
     def test_handle_PROTOCOL_VERSION_when_version_too_low(self):
         """handle_PROTOCOL_VERSION when unsupported version."""
         message = self.make_protocol_message(msg_type='PROTOCOL_VERSION')
@@ -397,6 +496,58 @@ class StorageServerTestCase(BaseStorageServerTestCase):
         self.assertEqual(response[0].type, protocol_pb2.Message.PONG)
         self.handler.assert_trace("ping pong")
 
+    def test_get_bucket(self):
+        """The buckets of the connection are under the user's ones."""
+        limits = self.server.factory.bandwidth
+        manager = FakedFactory()
+        manager.rpc_dal = None
+        user = User(manager, 'user_id', 'root_id', 'username', 'name')
+        self.server.set_user(user)
+        bucket = self.server.get_bucket(bandwidth.UPLOAD)
+        self.assertEqual(bucket.level, bandwidth.CONNECTION)
+        self.assertEqual(bucket.direction, bandwidth.UPLOAD)
+        self.assertIs(bucket.parent, user.get_bucket(limits, 'upload'))
+        self.assertIs(bucket.parent.parent, limits.buckets['upload'])
+        self.assertIs(self.server.get_bucket(bandwidth.UPLOAD), bucket)
+
+    def test_throttle_upload_not_limited(self):
+        """The uploads are not throttled without limits."""
+        self.server.throttle_upload(2 ** 30)
+        self.assertIsNone(self.server._upload_throttle)
+
+    def test_throttle_upload(self):
+        """The reading is paused while the upload is over the limits."""
+        clock = task.Clock()
+        limits = BandwidthLimits(burst_time=1, clock=clock)
+        limits.set_rate(bandwidth.GLOBAL, bandwidth.UPLOAD, 10)
+        self.server.factory.bandwidth = limits
+        self.patch(self.server, 'get_bucket', lambda d: limits.buckets[d])
+        calls = []
+        self.server.transport.pauseProducing = lambda: calls.append('pause')
+        self.server.transport.resumeProducing = lambda: calls.append('resume')
+        self.server.throttle_upload(10)
+        self.assertEqual(calls, [])
+        self.server.throttle_upload(20)
+        self.assertEqual(calls, ['pause'])
+        # the upload job can pause it meanwhile
+        self.server.reading.pauseProducing()
+        clock.advance(2)
+        self.assertEqual(calls, ['pause'])
+        self.server.reading.resumeProducing()
+        self.assertEqual(calls, ['pause', 'resume'])
+
+    def test_shutdown_stops_upload_throttle(self):
+        """The throttle of the uploads is stopped on shutdown."""
+        clock = task.Clock()
+        limits = BandwidthLimits(burst_time=1, clock=clock)
+        limits.set_rate(bandwidth.GLOBAL, bandwidth.UPLOAD, 10)
+        self.server.factory.bandwidth = limits
+        self.patch(self.server, 'get_bucket', lambda d: limits.buckets[d])
+        self.server.transport.pauseProducing = noop
+        self.server.throttle_upload(20)
+        self.server.shutdown()
+        self.assertEqual(clock.getDelayedCalls(), [])
+
 
 class ActionTestCase(BaseStorageServerTestCase):
     """Test the Action class."""
@@ -774,6 +925,15 @@ class SimpleRequestResponseTestCase(StorageServerRequestResponseTestCase):
         self.assertEqual(
             "TryAgain (RetryLimitReached: %s)" % self.msg, self.last_error[1])
 
+    def test_dal_overloaded_handled_as_try_again(self):
+        """_send_protocol_error handles the DAL Overloaded as TRY_AGAIN."""
+        failure = Failure(inthread.Overloaded(self.msg))
+        self.response._send_protocol_error(failure=failure)
+        self.assertTrue(self.last_error is not None)
+        self.assertEqual(protocol_pb2.Error.TRY_AGAIN, self.last_error[0])
+        self.assertEqual(
+            "TryAgain (Overloaded: %s)" % self.msg, self.last_error[1])
+
     def test_tcp_timeout_handled_as_try_again(self):
         """_send_protocol_error handles TCPTimedOutError as TRY_AGAIN."""
         failure = Failure(txerror.TCPTimedOutError())
@@ -1023,8 +1183,11 @@ class SimpleRequestResponseTestCase(StorageServerRequestResponseTestCase):
             response.start()
         self.assertTrue(self.server.pending_requests)
 
-        # we should have 4 pending_requests
-        self.assertEqual(len(self.server.pending_requests), 4,
+        # we should have 4 pending_requests, less the read-only ones
+        # running with the first one
+        running = (settings.MAX_READONLY_REQUESTS
+                   if self.response_class.readonly else 1)
+        self.assertEqual(len(self.server.pending_requests), 5 - running,
                          self.server.pending_requests)
 
         # the first request should be executing
@@ -1482,6 +1645,7 @@ class PutContentResponseTestCase(SimpleRequestResponseTestCase,
         # fake uploadjob
         uploadjob = mocker.mock()
         expect(uploadjob.deferred).result(defer.Deferred())
+        uploadjob.transport = self.response.protocol.reading
         expect(uploadjob.connect()).result(defer.succeed(None))
         expect(uploadjob.stop()).result(defer.succeed(None))
         self.patch(self.response, '_get_upload_job',
@@ -2012,6 +2176,18 @@ class PutContentResponseTestCase(SimpleRequestResponseTestCase,
                          PutContentResponse.states.uploading)
         self.assertEqual(self.response.upload_job.bytes, "foobar")
 
+    def test_processwhileuploading_bytes_throttled(self):
+        """The bytes received go through the bandwidth limits."""
+        self.response.state = PutContentResponse.states.uploading
+        message = self.make_protocol_message(msg_type='BYTES')
+        message.bytes.bytes = "foobar"
+        self.response.upload_job = self.FakeUploadJob()
+        called = []
+        self.patch(self.response.protocol, 'throttle_upload', called.append)
+
+        self.response._process_while_uploading(message)
+        self.assertEqual(called, [6])
+
     def test_processwhileuploading_strange(self):
         """Got other message while uploading."""
         self.response.state = PutContentResponse.states.uploading
@@ -2316,49 +2492,17 @@ class GetDeltaResponseTestCase(SimpleRequestResponseTestCase):
 
     response_class = GetDeltaResponse
 
-    def test_cooperative_send_delta_info(self):
-        """Test that send_delta_info isn't blocking."""
-        d = self.response.send_delta_info([], '')
-        self.assertTrue(isinstance(d, defer.Deferred))
-        # check if _send_delta_info returns a generator
-        gen = self.response._send_delta_info([], '')
-        self.assertTrue(hasattr(gen, 'next'))
-        # check if send_delta_info use the cooperator
-        called = []
-        real_cooperate = task.cooperate
-
-        def cooperate(iterator):
-            """Intercept the call to task.cooperate."""
-            called.append(iterator)
-            return real_cooperate(iterator)
-        self.patch(task, 'cooperate', cooperate)
-        self.response.send_delta_info([], '')
-        self.assertEqual(len(called), 1)
-        self.assertTrue(hasattr(called[0], 'next'))
-
-    def test_reset_send_delta_info_counter(self):
-        """Test that the count is reset on each iteration."""
-        self.patch(settings, 'MAX_DELTA_INFO', 5)
-        # create a few fake nodes
-        nodes = []
-        right_now = now()
-        for i in range(10):
-            node = FakeNode()
-            node.id = str(uuid.uuid4())
-            node.parent_id = str(uuid.uuid4())
-            node.generation = 100
-            node.name = u"node_%s" % i
-            node.is_live = True
-            node.is_file = True
-            node.is_public = True
-            node.content_hash = 'sha1:foo'
-            node.crc32 = 10
-            node.size = 1024
-            node.last_modified = int(time.mktime(right_now.timetuple()))
-            nodes.append(node)
-        gen = self.response._send_delta_info(nodes, 'share_id')
-        gen.next()
-        self.assertEqual(gen.gi_frame.f_locals['count'], 0)
+    @defer.inlineCallbacks
+    def test_send_delta_info(self):
+        """The nodes are sent by a producer of the request."""
+        written = []
+        self.patch(self.server, 'write', written.append)
+        d = self.response.send_delta_info([FakeNode(), FakeNode()], '')
+        self.assertIsInstance(self.response.producer, DeltaInfoProducer)
+        self.response.resumeProducing()
+        yield d
+        self.assertEqual(len(written), 1)
+        self.assertEqual(self.response.producer, None)
 
     @defer.inlineCallbacks
     def test_process_set_length(self):
@@ -2373,15 +2517,35 @@ class GetDeltaResponseTestCase(SimpleRequestResponseTestCase):
 
         # fake user
         user = mocker.mock()
-        nodes = [FakeNode(), FakeNode()]
-        expect(user.get_delta(None, 10, KWARGS)).result((nodes, 12, 123))
+        stream = make_stream([[FakeNode(), FakeNode()]], 12, 123)
+        expect(user.stream_delta(None, 10, KWARGS)).result(stream)
         self.response.protocol.user = user
+        self.patch(GetDeltaResponse, 'send_delta_stream',
+                   lambda *a: defer.succeed(None))
 
         with mocker:
             yield self.response._process()
 
         self.assertEqual(self.response.length, 2)
 
+    @defer.inlineCallbacks
+    def test_process_delta_end(self):
+        """The DELTA_END tells if the delta is full."""
+        self.response.source_message.get_delta.from_generation = 10
+        node = FakeNode()
+        node.generation = 11
+        self.response.protocol.user = FakeStreamUser(
+            make_stream([[node]], 12, 123))
+        self.patch(GetDeltaResponse, 'send_delta_stream',
+                   lambda *a: defer.succeed(None))
+
+        yield self.response._process()
+
+        delta_end = self.last_msg.delta_end
+        self.assertFalse(delta_end.full)
+        self.assertEqual(delta_end.generation, 11)
+        self.assertEqual(delta_end.free_bytes, 123)
+
 
 class RescanFromScratchResponseTestCase(SimpleRequestResponseTestCase):
     """Test the RescanFromScratchResponse class."""
@@ -2390,70 +2554,25 @@ class RescanFromScratchResponseTestCase(SimpleRequestResponseTestCase):
     response_class = types.ClassType(RescanFromScratchResponse.__name__,
                                      (RescanFromScratchResponse,), {})
 
-    def test_cooperative_send_delta_info(self):
-        """Test that send_delta_info isn't blocking."""
-        d = self.response.send_delta_info([], '')
-        self.assertTrue(isinstance(d, defer.Deferred))
-        # check if _send_delta_info returns a generator
-        gen = self.response._send_delta_info([], '')
-        self.assertTrue(hasattr(gen, 'next'))
-        # check if send_delta_info use the cooperator
-        called = []
-        real_cooperate = task.cooperate
-
-        def cooperate(iterator):
-            """Intercept the call to task.cooperate."""
-            called.append(iterator)
-            return real_cooperate(iterator)
-        self.patch(task, 'cooperate', cooperate)
-        self.response.send_delta_info([], '')
-        self.assertEqual(len(called), 1)
-        self.assertTrue(hasattr(called[0], 'next'))
-
     @defer.inlineCallbacks
-    def test_chunked_get_from_scratch(self):
-        """Get the nodes list in chunks."""
-        self.patch(settings, 'GET_FROM_SCRATCH_LIMIT', 5)
-        # build fake nodes
-        nodes = []
-        right_now = now()
-        for i in range(20):
-            node = FakeNode()
-            node.id = str(uuid.uuid4())
-            node.parent_id = str(uuid.uuid4())
-            node.path = u"/"
-            node.generation = i
-            node.name = u"node_%s" % i
-            node.is_live = True
-            node.is_file = True
-            node.is_public = True
-            node.content_hash = 'sha1:foo'
-            node.crc32 = 10
-            node.size = 1024
-            node.last_modified = int(time.mktime(right_now.timetuple()))
-            nodes.append(node)
-        # set required caps
-        self.response.protocol.working_caps = PREFERRED_CAP
-        mocker = Mocker()
-        user = mocker.mock()
-        self.patch(self.response, "send_delta_info", lambda *a: None)
-        self.response.protocol.user = user
-        # expect 3 calls to get_from_scratch
-        expect(user.get_from_scratch(
-            None, limit=5)
-        ).count(1).result((nodes[:10], 20, 100))
-        expect(user.get_from_scratch(
-            None, limit=5, max_generation=20,
-            start_from_path=("/", "node_9"))
-        ).count(1).result((nodes[10:], 20, 100))
-        expect(user.get_from_scratch(
-            None, limit=5, max_generation=20,
-            start_from_path=("/", "node_19"))
-        ).count(1).result(([], 20, 100))
+    def test_get_from_scratch(self):
+        """Send the nodes of the stream, and then the DELTA_END."""
+        nodes = [FakeNode() for i in range(5)]
+        stream = make_stream([nodes[:3], nodes[3:]], 20, 100)
+        self.response.protocol.user = FakeStreamUser(stream)
+        sent = []
+        self.patch(self.response, 'send_delta_stream',
+                   lambda *a: sent.append(a) or defer.succeed(None))
 
-        mocker.replay()
         yield self.response._process()
 
+        self.assertEqual(sent, [(stream, '')])
+        self.assertEqual(self.response.length, 5)
+        delta_end = self.last_msg.delta_end
+        self.assertTrue(delta_end.full)
+        self.assertEqual(delta_end.generation, 20)
+        self.assertEqual(delta_end.free_bytes, 100)
+
     @defer.inlineCallbacks
     def test_process_set_length(self):
         """Set length attribute while processing."""
@@ -2466,10 +2585,11 @@ class RescanFromScratchResponseTestCase(SimpleRequestResponseTestCase):
 
         # fake user
         user = mocker.mock()
-        nodes = [[FakeNode(), FakeNode()], []]
-        action = expect(user.get_from_scratch(None, KWARGS))
-        action.count(2).call(lambda *a, **k: (nodes.pop(0), 12, 123))
+        stream = make_stream([[FakeNode(), FakeNode()]], 12, 123)
+        expect(user.get_rescan_stream(None)).result(defer.succeed(stream))
         self.response.protocol.user = user
+        self.patch(self.response, 'send_delta_stream',
+                   lambda *a: defer.succeed(None))
 
         with mocker:
             yield self.response._process()
@@ -2624,9 +2744,13 @@ class BytesMessageProducerTestCase(BaseStorageServerTestCase):
         yield super(BytesMessageProducerTestCase, self).setUp()
         req = GetContentResponse(protocol=self.server,
                                  message=self.make_protocol_message())
+        # the id the request gets when it's started
+        req.id = 42
         self.patch(GetContentResponse, 'sendMessage', lambda *a: None)
         self.producer = FakeProducer()
         self.bmp = BytesMessageProducer(self.producer, req)
+        self.written = []
+        self.patch(self.server, 'writeSequence', self.written.extend)
 
     def test_resume_log(self):
         """Log when resumed."""
@@ -2652,6 +2776,253 @@ class BytesMessageProducerTestCase(BaseStorageServerTestCase):
         self.bmp.write("foobar")
         self.assertEqual(self.bmp.request.transferred, 6)
 
+    def make_frames(self, content):
+        """Build the frames of the content message by message."""
+        frames = []
+        size = self.bmp.payload_size
+        for start in range(0, len(content), size):
+            message = protocol_pb2.Message()
+            message.id = self.bmp.request.id
+            message.type = protocol_pb2.Message.BYTES
+            message.bytes.bytes = content[start:start + size]
+            data = message.SerializeToString()
+            frames.append(struct.pack(request.SIZE_FMT, len(data)) + data)
+        return ''.join(frames)
+
+    def test_frames(self):
+        """The frames are the same as sending the messages one by one."""
+        self.patch(self.bmp, 'payload_size', 1000)
+        content = os.urandom(2500)
+        self.bmp.write(content)
+        self.assertEqual(''.join(self.written), self.make_frames(content))
+        # all the frames are sent together
+        self.assertEqual(len(self.written), 6)
+
+    def test_frames_from_buffer(self):
+        """The content can be a buffer."""
+        content = os.urandom(2500)
+        self.bmp.write(buffer(content, 100))
+        self.assertEqual(
+            ''.join(self.written), self.make_frames(content[100:]))
+
+    def test_payload_not_copied(self):
+        """The content is not copied if it fits in a message."""
+        content = os.urandom(100)
+        self.bmp.write(content)
+        self.assertIdentical(self.written[1], content)
+
+    def test_not_written_if_cancelled(self):
+        """Nothing is sent if the request was cancelled."""
+        self.bmp.request.cancelled = True
+        self.bmp.write("foobar")
+        self.assertEqual(self.written, [])
+        self.assertEqual(self.bmp.request.transferred, 0)
+
+    def limit_bandwidth(self):
+        """Limit the downloads to 10 bytes per second."""
+        clock = task.Clock()
+        limits = BandwidthLimits(burst_time=1, clock=clock)
+        limits.set_rate(bandwidth.GLOBAL, bandwidth.DOWNLOAD, 10)
+        self.server.factory.bandwidth = limits
+        self.patch(self.server, 'get_bucket', lambda d: limits.buckets[d])
+        self.calls = []
+        self.patch(self.producer, 'pauseProducing',
+                   lambda: self.calls.append('pause'))
+        self.patch(self.producer, 'resumeProducing',
+                   lambda: self.calls.append('resume'))
+        return clock
+
+    def test_not_throttled(self):
+        """Nothing is throttled without limits."""
+        self.bmp.write("x" * 1000)
+        self.assertIsNone(self.bmp.throttle)
+
+    def test_throttled(self):
+        """The producer is paused while over the bandwidth limits."""
+        clock = self.limit_bandwidth()
+        self.bmp.write("x" * 10)
+        self.assertEqual(self.calls, [])
+        self.bmp.write("x" * 10)
+        self.assertEqual(self.calls, ['pause'])
+        # the transport can't resume it meanwhile
+        self.bmp.pauseProducing()
+        self.bmp.resumeProducing()
+        self.assertEqual(self.calls, ['pause', 'pause'])
+        clock.advance(1)
+        self.assertEqual(self.calls, ['pause', 'pause', 'resume'])
+
+    def test_throttled_paused_by_transport(self):
+        """It's resumed by the transport if paused by it meanwhile."""
+        clock = self.limit_bandwidth()
+        self.bmp.write("x" * 20)
+        self.bmp.pauseProducing()
+        clock.advance(1)
+        self.assertEqual(self.calls, ['pause', 'pause'])
+        self.bmp.resumeProducing()
+        self.assertEqual(self.calls, ['pause', 'pause', 'resume'])
+
+    def test_throttled_finished(self):
+        """It's not resumed once finished."""
+        clock = self.limit_bandwidth()
+        self.bmp.write("x" * 20)
+        self.assertEqual(self.bmp.finished('result'), 'result')
+        clock.advance(1)
+        self.assertEqual(self.calls, ['pause'])
+
+
+class DeltaInfoProducerTestCase(BaseStorageServerTestCase):
+    """Test the DeltaInfoProducer class."""
+
+    @defer.inlineCallbacks
+    def setUp(self):
+        """Set up."""
+        yield super(DeltaInfoProducerTestCase, self).setUp()
+        self.request = GetDeltaResponse(
+            protocol=self.server, message=self.make_protocol_message())
+        self.request.id = 7
+        self.nodes = []
+        for i in range(10):
+            node = FakeNode()
+            node.id = str(uuid.uuid4())
+            node.name = u"node_%s" % i
+            node.generation = i
+            self.nodes.append(node)
+        self.written = []
+        self.patch(self.server, 'write', self.written.append)
+
+    def make_producer(self):
+        """Make a producer of the nodes."""
+        return DeltaInfoProducer(self.request, self.nodes, 'share_id')
+
+    def read_messages(self):
+        """Return the messages written."""
+        data = ''.join(self.written)
+        messages = []
+        while data:
+            size = struct.unpack(request.SIZE_FMT, data[:4])[0]
+            message = protocol_pb2.Message()
+            message.ParseFromString(data[4:4 + size])
+            messages.append(message)
+            data = data[4 + size:]
+        return messages
+
+    @defer.inlineCallbacks
+    def test_send(self):
+        """All the messages are sent, with the request id."""
+        producer = self.make_producer()
+        producer.resumeProducing()
+        yield producer.deferred
+        expected = []
+        for node in self.nodes:
+            message = self.request.build_delta_info(node, 'share_id')
+            message.id = 7
+            expected.append(message)
+        self.assertEqual(self.read_messages(), expected)
+
+    @defer.inlineCallbacks
+    def test_batches_grow(self):
+        """The batches grow while they take less than the batch time."""
+        self.patch(settings, 'MAX_DELTA_INFO', 3)
+        producer = self.make_producer()
+        producer.batch_time = 60
+        producer.resumeProducing()
+        yield producer.deferred
+        self.assertEqual(len(self.written), 3)
+        self.assertEqual(len(self.read_messages()), 10)
+
+    @defer.inlineCallbacks
+    def test_batches_shrink(self):
+        """The batches shrink while they take more than the batch time."""
+        self.patch(settings, 'MAX_DELTA_INFO', 4)
+        producer = self.make_producer()
+        producer.batch_time = -1
+        producer.resumeProducing()
+        yield producer.deferred
+        self.assertEqual(len(self.written), 6)
+        self.assertEqual(len(self.read_messages()), 10)
+
+    @defer.inlineCallbacks
+    def test_paused(self):
+        """Nothing is sent while paused."""
+        self.patch(settings, 'MAX_DELTA_INFO', 4)
+        producer = self.make_producer()
+
+        def write(data):
+            self.written.append(data)
+            producer.pauseProducing()
+
+        self.patch(self.server, 'write', write)
+        producer.resumeProducing()
+        yield task.deferLater(reactor, 0.01, lambda: None)
+        self.assertEqual(len(self.written), 1)
+        self.assertFalse(producer.deferred.called)
+
+        self.patch(self.server, 'write', self.written.append)
+        producer.resumeProducing()
+        yield producer.deferred
+        self.assertEqual(len(self.read_messages()), 10)
+
+    @defer.inlineCallbacks
+    def test_stop(self):
+        """When stopped nothing else is sent."""
+        producer = self.make_producer()
+        producer.resumeProducing()
+        producer.stopProducing()
+        yield producer.deferred
+        yield task.deferLater(reactor, 0, lambda: None)
+        self.assertEqual(self.written, [])
+
+    @defer.inlineCallbacks
+    def test_stream(self):
+        """The nodes of the stream are sent as they are fetched."""
+        fetched = []
+
+        def fetch(last, limit):
+            """Return a deferred for the page."""
+            d = defer.Deferred()
+            fetched.append(d)
+            return d
+
+        stream = NodeStream(fetch, 5, max_pages=1)
+        stream.start()
+        producer = DeltaInfoProducer(
+            self.request, [], 'share_id', stream=stream)
+        producer.resumeProducing()
+        yield task.deferLater(reactor, 0.01, lambda: None)
+        self.assertEqual(self.written, [])
+        fetched[0].callback((self.nodes[:5], 12, 34))
+        yield task.deferLater(reactor, 0.01, lambda: None)
+        self.assertEqual(len(self.read_messages()), 5)
+        self.assertFalse(producer.deferred.called)
+        fetched[1].callback((self.nodes[5:], 12, 34))
+        yield task.deferLater(reactor, 0.01, lambda: None)
+        fetched[2].callback(([], 12, 34))
+        yield producer.deferred
+        self.assertEqual(len(self.read_messages()), 10)
+
+    @defer.inlineCallbacks
+    def test_stream_failure(self):
+        """A failure fetching the nodes of the stream is propagated."""
+        stream = NodeStream(
+            lambda last, limit: defer.fail(ValueError('crash')), 5)
+        stream.start()
+        producer = DeltaInfoProducer(
+            self.request, [], 'share_id', stream=stream)
+        producer.resumeProducing()
+        yield self.assertFailure(producer.deferred, ValueError)
+
+    @defer.inlineCallbacks
+    def test_stop_stream(self):
+        """When stopped, the stream is stopped too."""
+        stream = NodeStream(lambda last, limit: defer.Deferred(), 5)
+        stream.start()
+        producer = DeltaInfoProducer(
+            self.request, [], 'share_id', stream=stream)
+        producer.resumeProducing()
+        producer.stopProducing()
+        yield producer.deferred
+        self.assertTrue(stream.stopped)
+
 
 class TestMetricsSetup(testcase.TestWithDatabase):
     """Tests that metrics are setup from configs properly"""
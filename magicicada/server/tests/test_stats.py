@@ -19,9 +19,12 @@
 """Tests for the stats helpers."""
 
 from twisted.internet import defer
+from twisted.trial.unittest import TestCase as TwistedTestCase
+from twisted.web.test.requesthelper import DummyRequest
 
 from magicicada import metrics
-from magicicada.server.stats import StatsWorker
+from magicicada.server.bandwidth import BandwidthLimits
+from magicicada.server.stats import StatsWorker, _Bandwidth
 from magicicada.server.testing.testcase import TestWithDatabase
 
 
@@ -64,3 +67,49 @@ class TestStats(TestWithDatabase):
                        len(reactor.getReaders())), self.metrics.calls)
         self.assertIn(('gauge', 'reactor.writers',
                        len(reactor.getWriters())), self.metrics.calls)
+
+
+class FakeService(object):
+    """A service with the factory with the bandwidth limits."""
+
+    def __init__(self):
+        self.factory = self
+        self.bandwidth = BandwidthLimits()
+
+
+class BandwidthTestCase(TwistedTestCase):
+    """Test the status of the bandwidth limits."""
+
+    def setUp(self):
+        super(BandwidthTestCase, self).setUp()
+        self.service = FakeService()
+        self.limits = self.service.bandwidth
+        self.resource = _Bandwidth(self.service)
+
+    def test_get(self):
+        """The rates are listed, with the throttles."""
+        self.limits.set_rate('user', 'upload', 1000)
+        self.limits.throttled('user', 'upload')
+        lines = self.resource.render_GET(DummyRequest([])).splitlines()
+        self.assertEqual(len(lines), 6)
+        self.assertIn('user_upload 1000 throttled 1', lines)
+        self.assertIn('global_download 0 throttled 0', lines)
+
+    def test_post(self):
+        """The rates are changed."""
+        request = DummyRequest([])
+        request.args = {'user_upload': ['1000'], 'global_download': ['5']}
+        lines = self.resource.render_POST(request).splitlines()
+        self.assertIn('user_upload 1000 throttled 0', lines)
+        self.assertEqual(self.limits.rates['user', 'upload'], 1000)
+        self.assertEqual(self.limits.rates['global', 'download'], 5)
+
+    def test_post_invalid(self):
+        """Nothing invalid is taken."""
+        for args in [{'user_other': ['1']}, {'user_upload': ['x']},
+                     {'user_upload': ['-1']}]:
+            request = DummyRequest([])
+            request.args = args
+            self.resource.render_POST(request)
+            self.assertEqual(request.responseCode, 400)
+        self.assertFalse(self.limits.limited('upload'))
@@ -20,6 +20,7 @@
 
 import os
 import shutil
+import threading
 import zlib
 
 from magicicadaprotocol.content_hash import (
@@ -28,12 +29,28 @@ from magicicadaprotocol.content_hash import (
     magic_hash_factory,
 )
 from twisted.internet import defer, reactor, task
+from twisted.python.threadpool import ThreadPool
+from twisted.trial.unittest import TestCase
 
-from magicicada.server import upload, diskstorage
+from magicicada import settings
+from magicicada.server import diskstorage, errors, upload
 from magicicada.server.auth import DummyAuthProvider
 from magicicada.server.testing import testcase
 
 
+class FakeTransport(object):
+    """A transport that records if it's paused or resumed."""
+
+    def __init__(self):
+        self.calls = []
+
+    def pauseProducing(self):
+        self.calls.append('pause')
+
+    def resumeProducing(self):
+        self.calls.append('resume')
+
+
 class UploadTestCase(testcase.BaseProtocolTestCase):
     """Base test case for upload stuff."""
     auth_provider_class = DummyAuthProvider
@@ -76,7 +93,7 @@ class ProxyHashingProducerTest(UploadTestCase):
             yield producer.dataReceived(message[part:part + chunk_sz])
         producer.stopProducing()
         yield producer.flush_decompressor()
-        consumer.commit()
+        yield consumer.commit()
 
         with open(consumer.filepath, "rb") as fh:
             self.assertEqual(fh.read(), message)
@@ -110,7 +127,7 @@ class ProxyHashingProducerTest(UploadTestCase):
 
         # stop and re-check
         producer.stopProducing()
-        consumer.commit()
+        yield consumer.commit()
         yield producer.flush_decompressor()
         with open(consumer.filepath, "rb") as fh:
             self.assertEqual(fh.read(), message)
@@ -166,3 +183,355 @@ class ProxyHashingProducerTest(UploadTestCase):
         producer.add_deflated_data('')
         # check that we have all the chunks
         self.assertEqual(0, len(called))
+
+    def _check_hashes(self, producer, data):
+        """Check the producer hashed correctly all the data."""
+        hasher = content_hash_factory()
+        hasher.update(data)
+        self.assertEqual(producer.hash_object.content_hash(),
+                         hasher.content_hash())
+        magic_hasher = magic_hash_factory()
+        magic_hasher.update(data)
+        self.assertEqual(producer.magic_hash_object.content_hash()._magic_hash,
+                         magic_hasher.content_hash()._magic_hash)
+        self.assertEqual(producer.inflated_size, len(data))
+        self.assertEqual(producer.crc32, crc32(data))
+
+    def _upload_part(self, ds, offset, message, state=None, streaming=True):
+        """Upload a part of the message, return the producer."""
+        consumer = ds.put("somenode", offset)
+        producer = upload.ProxyHashingProducer(consumer, streaming, state)
+        chunk_sz = 100
+        for part in xrange(0, len(message), chunk_sz):
+            producer.dataReceived(message[part:part + chunk_sz])
+        return producer
+
+    @defer.inlineCallbacks
+    def test_proxy_producer_resume_streaming(self):
+        """Test ProxyHashingProducer resuming from a checkpoint."""
+        data = os.urandom(1024 * 10)
+        message = zlib.compress(data)
+        cut = len(message) // 3
+        ds = diskstorage.DiskStorage(os.path.join(self.tmpdir, "testfile"))
+
+        # upload the first part and take the hashing state
+        producer = self._upload_part(ds, 0, message[:cut])
+        state = producer.checkpoint()
+        self.assertEqual(state.deflated_size, cut)
+        producer.stopProducing()
+        yield producer.consumer.closed
+
+        # resume from there, it's all hashed while streaming
+        producer = self._upload_part(ds, cut, message[cut:], state)
+        producer.stopProducing()
+        yield producer.consumer.commit()
+        self.patch(upload, 'FileReaderProducer', None)
+        yield producer.flush_decompressor()
+
+        self.assertEqual(producer.deflated_size, len(message))
+        self._check_hashes(producer, data)
+
+    @defer.inlineCallbacks
+    def test_proxy_producer_resume_after_checkpoint(self):
+        """Test ProxyHashingProducer resuming after its checkpoint."""
+        data = os.urandom(1024 * 10)
+        message = zlib.compress(data)
+        cut = len(message) // 3
+        ds = diskstorage.DiskStorage(os.path.join(self.tmpdir, "testfile"))
+
+        # upload two parts, but take the hashing state after the first one
+        producer = self._upload_part(ds, 0, message[:cut])
+        state = producer.checkpoint()
+        for part in xrange(cut, cut * 2, 100):
+            producer.dataReceived(message[part:min(part + 100, cut * 2)])
+        producer.stopProducing()
+        yield producer.consumer.closed
+
+        # resume after that, only the data after the checkpoint is re-read
+        producer = self._upload_part(
+            ds, cut * 2, message[cut * 2:], state, streaming=False)
+        producer.stopProducing()
+        yield producer.consumer.commit()
+        read_from = []
+        orig_reader = upload.FileReaderProducer
+
+        def reader(filepath, offset, **kwargs):
+            read_from.append(offset)
+            return orig_reader(filepath, offset, **kwargs)
+        self.patch(upload, 'FileReaderProducer', reader)
+        yield producer.flush_decompressor()
+
+        self.assertEqual(read_from, [cut])
+        self.assertEqual(producer.deflated_size, len(message))
+        self._check_hashes(producer, data)
+
+    @defer.inlineCallbacks
+    def test_proxy_producer_resume_chunked(self):
+        """Test ProxyHashingProducer resuming a chunked node, re-reading."""
+        self.patch(settings, 'STORAGE_DEDUP_CHUNK_MIN_SIZE', 100)
+        self.patch(settings, 'STORAGE_DEDUP_CHUNK_MAX_SIZE', 1000)
+        data = os.urandom(1024 * 10)
+        message = zlib.compress(data)
+        cut = len(message) // 3
+        ds = diskstorage.DiskStorage(
+            os.path.join(self.tmpdir, "testfile"), dedup_min_size=1)
+
+        consumer = ds.put("somenode", 0, len(message))
+        consumer.write(message[:cut])
+        consumer.unregisterProducer()
+        yield consumer.closed
+
+        # resume without a hashing state, so all is re-read at the end
+        consumer = ds.put("somenode", cut, len(message))
+        producer = upload.ProxyHashingProducer(consumer, False)
+        producer.dataReceived(message[cut:])
+        producer.stopProducing()
+        yield consumer.commit()
+        self.assertFalse(os.path.exists(consumer.temppath))
+        yield producer.flush_decompressor()
+
+        self.assertEqual(producer.deflated_size, len(message))
+        self._check_hashes(producer, data)
+        self.assertEqual(ds.read("somenode"), message)
+
+    def test_proxy_producer_checkpoint_not_streaming(self):
+        """Test there is no hashing state if not hashing on the fly."""
+        producer = upload.ProxyHashingProducer('consumer', False)
+        self.assertIdentical(producer.checkpoint(), None)
+
+    def test_proxy_producer_checkpoint_is_a_copy(self):
+        """Test the hashing state is not changed by the producer."""
+        data = zlib.compress(os.urandom(1000))
+        producer = upload.ProxyHashingProducer(upload.NullConsumer(), True)
+        producer.dataReceived(data[:500])
+        state = producer.checkpoint()
+        digest = state.hash_object.hexdigest()
+        producer.dataReceived(data[500:])
+        self.assertEqual(state.hash_object.hexdigest(), digest)
+        self.assertEqual(state.deflated_size, 500)
+
+
+class ThreadedVerificationTest(TestCase):
+    """Tests for ProxyHashingProducer verifying in a threadpool."""
+
+    def setUp(self):
+        self.threadpool = ThreadPool(minthreads=0, maxthreads=2)
+        self.threadpool.start()
+        self.addCleanup(self.threadpool.stop)
+        self.transport = FakeTransport()
+        return super(ThreadedVerificationTest, self).setUp()
+
+    def get_producer(self, **kwargs):
+        """Return a producer verifying in the threadpool."""
+        consumer = upload.NullConsumer()
+        producer = upload.ProxyHashingProducer(
+            consumer, True, threadpool=self.threadpool,
+            transport=self.transport, **kwargs)
+        consumer.registerProducer(producer)
+        return producer
+
+    @defer.inlineCallbacks
+    def test_hashes(self):
+        """The data is verified in the threadpool, in order."""
+        data = os.urandom(1024 * 100)
+        message = zlib.compress(data)
+        producer = self.get_producer()
+        for part in xrange(0, len(message), 1000):
+            producer.dataReceived(message[part:part + 1000])
+        yield producer.flush_decompressor()
+
+        hasher = content_hash_factory()
+        hasher.update(data)
+        self.assertEqual(producer.hash_object.content_hash(),
+                         hasher.content_hash())
+        self.assertEqual(producer.inflated_size, len(data))
+        self.assertEqual(producer.deflated_size, len(message))
+        self.assertEqual(producer.crc32, crc32(data))
+        self.assertEqual(producer.pending, 0)
+
+    @defer.inlineCallbacks
+    def test_corrupt_data(self):
+        """An error verifying is raised later, as UploadCorrupt."""
+        producer = self.get_producer()
+        producer.dataReceived("not zlib data")
+        yield self.assertFailure(producer.flush_decompressor(),
+                                 errors.UploadCorrupt)
+        self.assertRaises(errors.UploadCorrupt,
+                          producer.dataReceived, "more data")
+
+    @defer.inlineCallbacks
+    def test_backpressure(self):
+        """The transport is paused while too much data is pending."""
+        release = threading.Event()
+        producer = self.get_producer(max_pending=20)
+        self.patch(producer, 'add_deflated_data', lambda _: release.wait())
+
+        producer.dataReceived('x' * 10)
+        self.assertEqual(self.transport.calls, [])
+        producer.dataReceived('x' * 10)
+        self.assertEqual(self.transport.calls, ['pause'])
+
+        release.set()
+        d = defer.Deferred()
+        producer._queue.addCallback(d.callback)
+        yield d
+        self.assertEqual(self.transport.calls, ['pause', 'resume'])
+        self.assertFalse(producer.paused)
+
+    def test_stop_resumes_transport(self):
+        """The transport is not left paused when stopping."""
+        producer = self.get_producer()
+        producer._pause()
+        producer.stopProducing()
+        self.assertEqual(self.transport.calls, ['pause', 'resume'])
+
+    def test_paused_by_consumer(self):
+        """The consumer pauses the transport apart from the verification."""
+        producer = self.get_producer()
+        producer.pauseProducing()
+        producer._pause()
+        producer._resume()
+        self.assertTrue(producer.consumer_paused)
+        producer.stopProducing()
+        self.assertFalse(producer.consumer_paused)
+        self.assertEqual(self.transport.calls,
+                         ['pause', 'pause', 'resume', 'resume'])
+
+    @defer.inlineCallbacks
+    def test_checkpoint_waits_verification(self):
+        """The hashing state is taken after all the data is verified."""
+        message = zlib.compress(os.urandom(1000))
+        producer = self.get_producer()
+        producer.dataReceived(message[:500])
+        state = yield producer.checkpoint()
+        self.assertEqual(state.deflated_size, 500)
+
+    @defer.inlineCallbacks
+    def test_checkpoint_after_error(self):
+        """There is no hashing state after an error verifying."""
+        producer = self.get_producer()
+        producer.dataReceived("not zlib data")
+        state = yield producer.checkpoint()
+        self.assertIdentical(state, None)
+
+
+class VerifyContentTest(TestCase):
+    """Tests for verify_content."""
+
+    def setUp(self):
+        super(VerifyContentTest, self).setUp()
+        self.data = os.urandom(1000)
+        self.deflated = zlib.compress(self.data)
+        hasher = content_hash_factory()
+        hasher.update(self.data)
+        self.blob = dict(
+            hash_value=hasher.content_hash(), crc32_value=crc32(self.data),
+            size=len(self.data), deflated_size=len(self.deflated))
+
+    def verify(self, deflated, **kwargs):
+        """Verify the deflated content, in chunks, against the blob."""
+        chunks = [deflated[i:i + 100] for i in range(0, len(deflated), 100)]
+        blob = dict(self.blob, **kwargs)
+        return upload.verify_content(chunks, **blob)
+
+    def test_ok(self):
+        self.assertIdentical(self.verify(self.deflated), None)
+
+    def test_no_deflated_size(self):
+        self.assertIdentical(
+            self.verify(self.deflated, deflated_size=None), None)
+
+    def test_not_deflated(self):
+        problem = self.verify(self.data)
+        self.assertIn("Can not inflate the content", problem)
+
+    def test_truncated(self):
+        problem = self.verify(self.deflated[:-10])
+        self.assertIn("Deflated size is", problem)
+
+    def test_bad_size(self):
+        problem = self.verify(self.deflated, size=1001)
+        self.assertEqual(problem, "Size is 1000 instead of 1001")
+
+    def test_bad_hash(self):
+        problem = self.verify(self.deflated, hash_value='sha1:foo')
+        self.assertIn("instead of sha1:foo", problem)
+
+    def test_bad_crc32(self):
+        problem = self.verify(self.deflated, crc32_value=0)
+        self.assertIn("instead of 0", problem)
+
+
+class HashingCheckpointsTest(TestCase):
+    """Tests for HashingCheckpoints."""
+
+    def test_save_and_get(self):
+        """Test the states are kept by upload."""
+        checkpoints = upload.HashingCheckpoints()
+        checkpoints.save('upload1', 'state1')
+        checkpoints.save('upload2', 'state2')
+        self.assertEqual(checkpoints.get('upload1'), 'state1')
+        self.assertEqual(checkpoints.get('upload2'), 'state2')
+        self.assertIdentical(checkpoints.get('upload3'), None)
+
+    def test_save_replaces(self):
+        """Test only the last state is kept for an upload."""
+        checkpoints = upload.HashingCheckpoints()
+        checkpoints.save('upload', 'old')
+        checkpoints.save('upload', 'new')
+        self.assertEqual(checkpoints.get('upload'), 'new')
+        self.assertEqual(len(checkpoints), 1)
+
+    def test_bounded(self):
+        """Test the least recently saved states are forgotten."""
+        checkpoints = upload.HashingCheckpoints(size=2)
+        checkpoints.save('upload1', 'state1')
+        checkpoints.save('upload2', 'state2')
+        checkpoints.save('upload1', 'state1')
+        checkpoints.save('upload3', 'state3')
+        self.assertEqual(len(checkpoints), 2)
+        self.assertIdentical(checkpoints.get('upload2'), None)
+
+    def test_size_from_settings(self):
+        """Test the default size comes from the settings."""
+        self.patch(settings, 'UPLOAD_MAX_CHECKPOINTS', 7)
+        self.assertEqual(upload.HashingCheckpoints().size, 7)
+
+    def test_discard(self):
+        """Test a state can be forgotten, even if not there."""
+        checkpoints = upload.HashingCheckpoints()
+        checkpoints.save('upload', 'state')
+        checkpoints.discard('upload')
+        checkpoints.discard('upload')
+        self.assertIdentical(checkpoints.get('upload'), None)
+
+
+class InlineConsumerTest(TestCase):
+    """Tests for InlineConsumer."""
+
+    def test_keeps_the_data(self):
+        """Test all the data written is kept."""
+        consumer = upload.InlineConsumer()
+        producer = upload.ProxyHashingProducer(consumer, True)
+        consumer.registerProducer(producer)
+        deflated = zlib.compress(b'some content' * 100)
+        producer.dataReceived(deflated[:10])
+        producer.dataReceived(deflated[10:])
+        consumer.unregisterProducer()
+        self.assertEqual(consumer.data, deflated)
+        self.assertEqual(producer.deflated_size, len(deflated))
+
+    def test_size_exceeded(self):
+        """The upload fails as soon as more than the size is written."""
+        consumer = upload.InlineConsumer(10)
+        consumer.write(b'x' * 6)
+        consumer.write(b'x' * 4)
+        self.assertRaises(upload.errors.UploadCorrupt, consumer.write, b'x')
+        self.assertEqual(consumer.data, b'x' * 10)
+
+    def test_paused(self):
+        """Test it can not be written while paused."""
+        consumer = upload.InlineConsumer()
+        consumer.paused = True
+        self.assertRaises(RuntimeError, consumer.write, b'data')
+        self.assertEqual(consumer.data, b'')
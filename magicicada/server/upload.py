@@ -20,56 +20,193 @@
 
 ProxyHashingProducer is a producer proxy that calculates the hash of the entire
 produced data, doing it on the fly if streaming, else at the end, re-reading
-the entire file.
+the entire file (or from the point its hashing state was checkpointed).
 
-The NullConsumer is just a consumer that discards whatever it gets.
+HashingCheckpoints keeps the hashing state of the uploads, to resume them.
+
+The NullConsumer is just a consumer that discards whatever it gets, and the
+InlineConsumer one that keeps it in memory (for the content stored in the
+database instead of the disk).
 """
 
+import collections
 import zlib
 
-from cStringIO import StringIO
-
 from magicicadaprotocol.content_hash import (
     content_hash_factory,
     crc32,
     magic_hash_factory,
 )
-from twisted.internet import defer
+from twisted.internet import defer, reactor, threads
 
+from magicicada import settings
 from magicicada.server import errors
 from magicicada.server.diskstorage import FileReaderProducer
 
 
+# the state of a ProxyHashingProducer after hashing deflated_size bytes
+HashingState = collections.namedtuple('HashingState', [
+    'decompressor', 'hash_object', 'magic_hash_object', 'crc32',
+    'inflated_size', 'deflated_size'])
+
+
+def copy_hasher(hasher):
+    """Copy a content hasher.
+
+    The magic one can not be copied with its own method, as it refuses to
+    be pickled.
+    """
+    new = object.__new__(type(hasher))
+    new.hash_object = hasher.hash_object.copy()
+    return new
+
+
 class ProxyHashingProducer(object):
     """A producer that streams stuff off to the consumer.
 
     This producer calculates the hash, crc32 and inflated size on the fly
     if 'streaming' if True, else it calculates everything re-reading at the
     end.
+
+    If a HashingState is given the calculation continues from it, so only
+    the data after that point is re-read when not streaming.
+
+    If a threadpool is given, the data is inflated and hashed there when
+    streaming, in order. While more than `max_pending` bytes wait for it the
+    transport (if any) is paused, and an error there is raised on the next
+    received data or when flushing. The consumer can also pause the
+    transport while it catches up, independently of that (the transport
+    must count the pauses, see bandwidth.PausableReading).
     """
 
     chunks = 10
 
-    def __init__(self, consumer, streaming):
-        self.decompressor = zlib.decompressobj()
-        self.hash_object = content_hash_factory()
-        self.magic_hash_object = magic_hash_factory()
-        self.crc32 = 0
-        self.inflated_size = 0
-        self.deflated_size = 0
+    def __init__(self, consumer, streaming, state=None, threadpool=None,
+                 transport=None, max_pending=None):
+        if state is None:
+            self.decompressor = zlib.decompressobj()
+            self.hash_object = content_hash_factory()
+            self.magic_hash_object = magic_hash_factory()
+            self.crc32 = 0
+            self.inflated_size = 0
+            self.deflated_size = 0
+        else:
+            # copy everything, so the state can be used again
+            self.decompressor = state.decompressor.copy()
+            self.hash_object = copy_hasher(state.hash_object)
+            self.magic_hash_object = copy_hasher(state.magic_hash_object)
+            self.crc32 = state.crc32
+            self.inflated_size = state.inflated_size
+            self.deflated_size = state.deflated_size
         self.consumer = consumer
         self.streaming = streaming
 
+        # the verification pipeline, if threaded
+        self.threadpool = threadpool
+        self.transport = transport
+        if max_pending is None:
+            max_pending = settings.UPLOAD_BUFFER_MAX_SIZE
+        self.max_pending = max_pending
+        self.pending = 0
+        self.paused = False
+        self.consumer_paused = False
+        self._queue = defer.succeed(None)
+        self._failure = None
+
+    def _get_state(self):
+        """Return a copy of the current hashing state."""
+        return HashingState(
+            self.decompressor.copy(), copy_hasher(self.hash_object),
+            copy_hasher(self.magic_hash_object), self.crc32,
+            self.inflated_size, self.deflated_size)
+
+    def checkpoint(self):
+        """Return the current hashing state, None if not hashing yet.
+
+        If verifying in threads, return a deferred with the state once all
+        the data received so far is verified (None if it failed).
+        """
+        if not self.streaming:
+            return
+        if self.threadpool is None:
+            return self._get_state()
+
+        d = defer.Deferred()
+
+        def get_state(_):
+            d.callback(self._get_state() if self._failure is None else None)
+        self._queue.addCallback(get_state)
+        return d
+
+    def _verify(self, data):
+        """Queue the data to be verified in the threadpool."""
+        self.pending += len(data)
+        if self.pending >= self.max_pending:
+            self._pause()
+
+        def verify(_):
+            if self._failure is None:
+                return threads.deferToThreadPool(
+                    reactor, self.threadpool, self.add_deflated_data, data)
+
+        def failed(failure):
+            if self._failure is None:
+                self._failure = failure
+
+        def verified(_):
+            self.pending -= len(data)
+            if self.pending < self.max_pending // 2:
+                self._resume()
+
+        self._queue.addCallback(verify)
+        self._queue.addErrback(failed)
+        self._queue.addCallback(verified)
+
+    def _pause(self):
+        """Stop receiving data until the verification catches up."""
+        if not self.paused and self.transport is not None:
+            self.paused = True
+            self.transport.pauseProducing()
+
+    def _resume(self):
+        """Receive data again, if paused."""
+        if self.paused:
+            self.paused = False
+            self.transport.resumeProducing()
+
+    def _check_failure(self):
+        """Raise the error of a previous verification, if any."""
+        if self._failure is not None:
+            self._failure.raiseException()
+
+    def pauseProducing(self):
+        """Stop receiving data until the consumer catches up."""
+        if not self.consumer_paused and self.transport is not None:
+            self.consumer_paused = True
+            self.transport.pauseProducing()
+
+    def resumeProducing(self):
+        """Receive data again, if the consumer paused it."""
+        if self.consumer_paused:
+            self.consumer_paused = False
+            self.transport.resumeProducing()
+
     def stopProducing(self):
         """Tell consumer to stop."""
+        self._resume()
+        self.resumeProducing()
         if self.consumer is not None:
             self.consumer.unregisterProducer()
 
     def dataReceived(self, data):
         """Handle data from client."""
+        self._check_failure()
         self.consumer.write(data)
         if self.streaming:
-            self.add_deflated_data(data)
+            if self.threadpool is None:
+                self.add_deflated_data(data)
+            else:
+                self._verify(data)
 
     def add_inflated_data(self, data):
         """Process inflated data to make sure checksums match."""
@@ -85,11 +222,14 @@ class ProxyHashingProducer(object):
             return
         self.deflated_size += len(data)
         chunk_size = len(data) // self.chunks
-        buf = StringIO(data)
-        for i in xrange(self.chunks):  # split the data in 10 chunks
-            self.add_inflated_data(self.decompress(buf.read(chunk_size)))
-        if buf.tell() < len(data):
-            self.add_inflated_data(self.decompress(buf.read()))
+        # split the data in 10 chunks (and the rest), without copying it
+        pos = 0
+        for i in xrange(self.chunks):
+            self.add_inflated_data(
+                self.decompress(buffer(data, pos, chunk_size)))
+            pos += chunk_size
+        if pos < len(data):
+            self.add_inflated_data(self.decompress(buffer(data, pos)))
 
     def write(self, data):
         """Receives data from the FileReaderProducer when not streaming."""
@@ -98,8 +238,19 @@ class ProxyHashingProducer(object):
     @defer.inlineCallbacks
     def flush_decompressor(self):
         """Flush the decompressor object and handle pending bytes."""
+        if self.threadpool is not None:
+            # wait for all the data to be verified
+            d = defer.Deferred()
+            self._queue.addCallback(d.callback)
+            yield d
+            self._check_failure()
+
         if not self.streaming:
-            frp = FileReaderProducer(self.consumer.filepath)
+            # all that was hashed before is already in deflated_size; the
+            # content is read from where the consumer committed it
+            fh, size = self.consumer.open_committed()
+            frp = FileReaderProducer(fh, self.deflated_size,
+                                     size=size - self.deflated_size)
             frp.startProducing(self)
             yield frp.deferred
 
@@ -115,6 +266,64 @@ class ProxyHashingProducer(object):
             raise errors.UploadCorrupt(str(e))
 
 
+def verify_content(chunks, hash_value, crc32_value, size, deflated_size):
+    """Check the stored (deflated) content against what its blob says.
+
+    The content is given in chunks, and checked as the uploads are. Return
+    what doesn't match, None if everything does.
+    """
+    producer = ProxyHashingProducer(None, True)
+    try:
+        for data in chunks:
+            producer.add_deflated_data(data)
+        producer.add_inflated_data(producer.decompressor.flush())
+    except errors.UploadCorrupt as err:
+        return "Can not inflate the content: %s" % (err,)
+
+    if deflated_size is not None and producer.deflated_size != deflated_size:
+        return "Deflated size is %d instead of %d" % (
+            producer.deflated_size, deflated_size)
+    if producer.inflated_size != size:
+        return "Size is %d instead of %d" % (producer.inflated_size, size)
+    content_hash = producer.hash_object.content_hash()
+    if content_hash != hash_value:
+        return "Hash is %s instead of %s" % (content_hash, hash_value)
+    if producer.crc32 != crc32_value:
+        return "Crc32 is %d instead of %d" % (producer.crc32, crc32_value)
+
+
+class HashingCheckpoints(object):
+    """The last hashing states of the uploads, to resume them.
+
+    The states are kept in memory because they can not be serialized (and
+    the magic hash must never touch disk), so only the uploads resumed in
+    the same server benefit from them. At most `size` of them are kept,
+    forgetting the least recently saved.
+    """
+
+    def __init__(self, size=None):
+        self.size = settings.UPLOAD_MAX_CHECKPOINTS if size is None else size
+        self._states = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._states)
+
+    def save(self, upload_id, state):
+        """Save the hashing state of an upload."""
+        self._states.pop(upload_id, None)
+        self._states[upload_id] = state
+        while len(self._states) > self.size:
+            self._states.popitem(last=False)
+
+    def get(self, upload_id):
+        """Return the hashing state of an upload, None if unknown."""
+        return self._states.get(upload_id)
+
+    def discard(self, upload_id):
+        """Forget the hashing state of an upload, if any."""
+        self._states.pop(upload_id, None)
+
+
 class NullConsumer(object):
     """A consumer that does nothing."""
 
@@ -149,3 +358,31 @@ class NullConsumer(object):
         """Write into the void."""
         if self.paused:
             raise RuntimeError("Asked to write to consumer while paused")
+
+
+class InlineConsumer(NullConsumer):
+    """A consumer that keeps in memory whatever it gets.
+
+    If a `size` is given the upload is failed as soon as more than that is
+    written, instead of keeping whatever the client decides to send.
+    """
+
+    def __init__(self, size=None):
+        super(InlineConsumer, self).__init__()
+        self.size = size
+        self._received = 0
+        self._data = []
+
+    @property
+    def data(self):
+        """All the data written."""
+        return b''.join(self._data)
+
+    def write(self, data):
+        """Keep the data."""
+        super(InlineConsumer, self).write(data)
+        self._received += len(data)
+        if self.size is not None and self._received > self.size:
+            raise errors.UploadCorrupt(
+                "Received more than the %d bytes expected." % (self.size,))
+        self._data.append(data)
@@ -234,32 +234,130 @@ SYSLOG_FORMAT = (
 
 API_SERVER_NAME = 'filesync-server'
 API_STATUS_PORT = 21102
+# the uploads and downloads take up to these many bytes per second (0 for no
+# limit) in the whole server, for each user and each connection, in bursts of
+# up to BANDWIDTH_BURST_TIME seconds of it; the limits can be changed while
+# running through the status service, see server.bandwidth
+BANDWIDTH_BURST_TIME = 1
+BANDWIDTH_CONNECTION_DOWNLOAD = 0
+BANDWIDTH_CONNECTION_UPLOAD = 0
+BANDWIDTH_GLOBAL_DOWNLOAD = 0
+BANDWIDTH_GLOBAL_UPLOAD = 0
+BANDWIDTH_USER_DOWNLOAD = 0
+BANDWIDTH_USER_UPLOAD = 0
+# the hashes of the blobs are kept in a filter with this rate of false
+# positives, to not look for the new content in the database; it's
+# rebuilt every BLOB_FILTER_REBUILD_INTERVAL seconds (0 to not use it),
+# and updated every BLOB_FILTER_UPDATE_INTERVAL seconds in between
+BLOB_FILTER_ERROR_RATE = 0.01
+BLOB_FILTER_REBUILD_INTERVAL = 3600
+BLOB_FILTER_UPDATE_INTERVAL = 10
 CERTS_FOLDER = os.path.join(BASE_DIR, 'certs')
 # the `crt` key with the content of `cacert.pem` file
 CRT = get_file_content(CERTS_FOLDER, 'cacert.pem')
 CRT_CHAIN = None
 # the `key` key with the content of `privkey.pem` file
 CRT_KEY = get_file_content(CERTS_FOLDER, 'privkey.pem')
+# the calls to the DAL run in up to DAL_THREADS threads, up to
+# DAL_USER_THREADS at the same time for each user, and up to DAL_MAX_QUEUED
+# wait for one (the other calls get a TRY_AGAIN), see rpcdb.inthread
+DAL_MAX_QUEUED = 1000
+DAL_THREADS = 10
+DAL_USER_THREADS = 2
 DELTA_MAX_SIZE = 1000
+# the nodes of a delta are fetched in pages of this many (the ones of a
+# rescan, of GET_FROM_SCRATCH_LIMIT), up to this many pages ahead of what
+# is sent, see content.NodeStream
+DELTA_PAGE_SIZE = 250
+DELTA_PAGES_AHEAD = 2
 DISABLE_SSL_COMPRESSION = True
 GC_DEBUG = False
+# the last nodes changed (up to MAX_NODES) in up to this many volumes are
+# kept in memory to answer the GET_DELTAs, refreshed after the changes are
+# notified or MAX_AGE seconds (0 volumes to not use them), see
+# server.generationlog
+GENERATION_LOG_MAX_AGE = 60
+GENERATION_LOG_MAX_NODES = 100
+GENERATION_LOG_VOLUMES = 5000
 GET_FROM_SCRATCH_LIMIT = 2000
 GRACEFUL_SHUTDOWN = True
 HEARTBEAT_INTERVAL = 5
 IDLE_TIMEOUT = 7200
 MAGIC_UPLOAD_ACTIVE = True
+# the DELTA_INFO messages are sent in batches of this many nodes at first,
+# adapted to how long they take to build, see server.DeltaInfoProducer
 MAX_DELTA_INFO = 20
+# the read-only requests of a connection (as GET_DELTA, GET_CONTENT or
+# FREE_SPACE_INQUIRY) run at the same time up to this many, the others alone
+MAX_READONLY_REQUESTS = 4
 PROTOCOL_WEAKREF = False
+# the rescans of the volumes of this many live nodes or more are served from
+# their manifests in RESCAN_MANIFEST_DIR, kept up to MAX_AGE seconds while no
+# more than MAX_DELTA nodes changed, and up to MAX_SIZE bytes in total (0 to
+# not use them), see server.manifests
+RESCAN_MANIFEST_MAX_AGE = 3600
+RESCAN_MANIFEST_MAX_DELTA = 5000
+RESCAN_MANIFEST_MAX_SIZE = 1073741824
+RESCAN_MANIFEST_MIN_NODES = 10000
 SSL_LOG_FILENAME = 'ssl-proxy.log'
 SSL_PORT = 21101
 SSL_SERVER_NAME = 'ssl-proxy'
 SSL_STATUS_PORT = 21103
 STATS_LOG_INTERVAL = 0
+# the content downloaded again is kept in memory, up to
+# STORAGE_CACHE_MAX_ITEM_SIZE bytes per node and STORAGE_CACHE_SIZE bytes in
+# total (0 to not cache it)
+STORAGE_CACHE_MAX_ITEM_SIZE = 4194304
+STORAGE_CACHE_SIZE = 268435456
 STORAGE_CHUNK_SIZE = 5242880
+# the uploads with content from STORAGE_DEDUP_MIN_SIZE bytes (deflated) are
+# stored split in chunks shared by all the nodes (0 to never split them), of
+# STORAGE_DEDUP_CHUNK_MIN_SIZE to STORAGE_DEDUP_CHUNK_MAX_SIZE bytes, see
+# server.chunkstorage
+STORAGE_DEDUP_CHUNK_MAX_SIZE = 8388608
+STORAGE_DEDUP_CHUNK_MIN_SIZE = 1048576
+STORAGE_DEDUP_MIN_SIZE = 67108864
+# one of 'none', 'fsync' or 'fsync+dirfsync', see server.diskstorage
+STORAGE_DURABILITY = 'fsync'
+# the uploads with content up to this size (deflated) are stored in the
+# database instead of the disk (0 to always store them in disk)
+STORAGE_INLINE_MAX_SIZE = 4096
+# disk reads and writes are done in this many threads (0 to do them in the
+# reactor thread), reading up to STORAGE_READ_AHEAD chunks in advance and
+# writing in blocks of STORAGE_WRITE_BLOCK_SIZE (pausing the upload while
+# STORAGE_WRITE_MAX_PENDING bytes wait to be written)
+STORAGE_IO_THREADS = 8
+# new nodes are not stored in volumes with less free space than this
+STORAGE_MIN_FREE_BYTES = 1073741824
+# the segments of the pack files with at least this part of removed content
+# are compacted, every STORAGE_PACK_COMPACT_INTERVAL seconds (0 to never)
+STORAGE_PACK_COMPACT_INTERVAL = 3600
+STORAGE_PACK_GARBAGE_RATIO = 0.5
+# the uploads with content up to this size (deflated) are appended to pack
+# files instead of having their own (0 to never pack them), in segments of
+# STORAGE_PACK_SEGMENT_SIZE bytes
+STORAGE_PACK_MAX_SIZE = 65536
+STORAGE_PACK_SEGMENT_SIZE = 268435456
+# create all the storage tree directories when starting the server
+STORAGE_PRECREATE_DIRS = True
+STORAGE_READ_AHEAD = 4
+STORAGE_READ_CHUNK_SIZE = 262144
+# to spread the nodes in many disks, (basedir, weight) pairs to use instead
+# of STORAGE_BASEDIR, see server.diskstorage
+STORAGE_VOLUMES = []
+STORAGE_WRITE_BLOCK_SIZE = 1048576
+STORAGE_WRITE_MAX_PENDING = 8388608
 TCP_PORT = 21100
 TRACE_USERS = ['test', 'etc']
+# uploads are inflated and hashed in this many threads (0 to do it in the
+# reactor thread), pausing the client while UPLOAD_BUFFER_MAX_SIZE bytes
+# are waiting for it
 UPLOAD_BUFFER_MAX_SIZE = 10485761
+UPLOAD_HASHING_THREADS = 4
+# hashing states kept in memory to resume uploads, see server.upload
+UPLOAD_MAX_CHECKPOINTS = 256
 STORAGE_BASEDIR = os.path.join(BASE_DIR, 'tmp', 'filestorage')
+RESCAN_MANIFEST_DIR = os.path.join(BASE_DIR, 'tmp', 'manifests')
 
 
 try: